@@ -0,0 +1,435 @@
+# This file holds our two layers of memory for USGS results:
+# L1 - a small in-process cache in every worker (no network, no JSON parsing)
+# L2 - Redis, shared by all workers
+# In Redis, every event is stored once and cached searches only list the events they hold (see set_cached)
+# Entries stay in both layers a while past their time to live, so they can still be served
+# while they are being refreshed or when USGS is failing (stale-while-revalidate / stale-if-error)
+
+import contextvars
+import json
+import time
+from collections import OrderedDict
+from app.config import (
+    CACHE_DURATION,
+    L1_CACHE_MAX_ENTRIES,
+    L1_CACHE_MAX_BYTES,
+    CACHE_STALE_WHILE_REVALIDATE,
+    CACHE_STALE_IF_ERROR,
+    CACHE_NORMALIZE_EVENTS,
+)
+from app.redis_client import redis_pool
+from app.codec import encode, decode, decode_entry, dumps_json, record_size
+from app import metrics
+from app.logger import setup_logging
+
+# Start logging the information
+logger = setup_logging()
+
+
+class LRUCache:
+    """
+    Size-bounded, least-recently-used cache with a per-entry time to live.
+    Entries can be kept for a while after they stop being fresh (`keep`), for serving stale data.
+    Keeps already-parsed values, so callers must treat what they get back as read-only.
+    """
+
+    def __init__(self, max_entries: int, max_bytes: int, ttl: float, clock=time.monotonic):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.clock = clock
+        self._entries = OrderedDict()  # key -> (value, size, expires_at, fresh_until)
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        entry = self.get_entry(key)
+        return None if entry is None else entry[0]
+
+    def get_entry(self, key):
+        # Like get, but returns (value, seconds since it stopped being fresh - 0 while fresh) or None
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        value, size, expires_at, fresh_until = entry
+        now = self.clock()
+        if expires_at <= now:
+            self._remove(key)
+            self.expirations += 1
+            self.misses += 1
+            return None
+        # Mark as recently used
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value, max(0.0, now - fresh_until)
+
+    def fresh_left(self, key) -> float:
+        # Seconds until the entry stops being fresh (0 if it is stale or missing), without counting a hit
+        entry = self._entries.get(key)
+        if entry is None:
+            return 0.0
+        return max(0.0, entry[3] - self.clock())
+
+    def set(self, key, value, size: int, ttl: float = None, keep: float = 0):
+        # `ttl`: seconds the value is fresh; `keep`: seconds it is kept (stale) after that
+        if size > self.max_bytes:
+            # Too big to ever fit, don't throw everything else out for it
+            return
+        if key in self._entries:
+            self._remove(key)
+        ttl = self.ttl if ttl is None else ttl
+        fresh_until = self.clock() + ttl
+        self._entries[key] = (value, size, fresh_until + keep, fresh_until)
+        self.total_bytes += size
+        # Evict the least recently used entries until we are back within our limits
+        while len(self._entries) > self.max_entries or self.total_bytes > self.max_bytes:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.evictions += 1
+
+    def discard(self, key):
+        if key in self._entries:
+            self._remove(key)
+
+    def clear(self):
+        self._entries.clear()
+        self.total_bytes = 0
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "bytes": self.total_bytes,
+            "max_entries": self.max_entries,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+    def _remove(self, key):
+        _, size, _, _ = self._entries.pop(key)
+        self.total_bytes -= size
+
+
+# Every worker gets its own L1 cache; entries live exactly as long as the Redis copy would
+l1_cache = LRUCache(L1_CACHE_MAX_ENTRIES, L1_CACHE_MAX_BYTES, CACHE_DURATION)
+
+# How long entries are kept after their time to live ends (the longer of the two stale periods)
+STALE_KEEP = max(CACHE_STALE_WHILE_REVALIDATE, CACHE_STALE_IF_ERROR)
+
+# Counters showing how often stale data was served
+stale_stats = {
+    "stale_served": 0,          # Expired entries served while a background refresh replaced them
+    "background_refreshes": 0,  # Background refreshes started
+    "stale_on_error": 0,        # Expired entries served because USGS failed
+}
+
+# Set for every request by the app's middleware; whatever serves stale data for the request flags it here
+# (a dict, so flags set inside tasks the request started are seen by the middleware too)
+_stale_flags = contextvars.ContextVar("stale_flags", default=None)
+
+
+def track_stale() -> dict:
+    # Start tracking stale answers for the current request
+    flags = {"stale": False}
+    _stale_flags.set(flags)
+    return flags
+
+
+def mark_stale():
+    # Note that the current request is being answered (partly) with stale data
+    flags = _stale_flags.get()
+    if flags is not None:
+        flags["stale"] = True
+
+
+def is_stale() -> bool:
+    flags = _stale_flags.get()
+    return bool(flags and flags["stale"])
+
+# Rough size of one GeoJSON earthquake, for results we never turned into JSON text
+APPROX_FEATURE_BYTES = 1200
+
+# Where single events live in Redis, by id and revision (see set_cached)
+EVENT_KEY_PREFIX = "usgs_event:"
+# The newest revision (`updated`) stored of each event, so older revisions can be dropped
+EVENT_LATEST_PREFIX = "usgs_event_latest:"
+
+# Writes the events of a search: KEYS = event key, latest-revision key, per event; ARGV = lifetime (ms), then
+# updated ("" if none) and blob per event. An event's lifetime is only ever extended (other cached searches
+# may need it longer), and a newer revision deletes the one stored before it
+_STORE_EVENTS_SCRIPT = """
+local lifetime = tonumber(ARGV[1])
+for i = 1, #KEYS / 2 do
+    local key, latest_key = KEYS[2 * i - 1], KEYS[2 * i]
+    local updated, blob = ARGV[2 * i], ARGV[2 * i + 1]
+    if redis.call('pttl', key) < lifetime then
+        redis.call('set', key, blob, 'PX', lifetime)
+    end
+    if updated ~= '' then
+        local latest = redis.call('get', latest_key)
+        if latest and tonumber(latest) < tonumber(updated) then
+            redis.call('del', string.sub(key, 1, #key - #updated) .. latest)
+            redis.call('set', latest_key, updated, 'PX', lifetime)
+        elseif not latest or (latest == updated and redis.call('pttl', latest_key) < lifetime) then
+            redis.call('set', latest_key, updated, 'PX', lifetime)
+        end
+    end
+end
+return #KEYS / 2
+"""
+# How many events go into one script call
+_STORE_EVENTS_BATCH = 500
+# How many events we ask Redis for in one MGET
+_MGET_BATCH = 1000
+
+# Counters showing how much the per-event storage shares
+normalized_stats = {
+    "searches_written": 0,  # Searches stored as lists of events
+    "events_written": 0,    # Events written along with them (an event in several searches is stored once)
+    "searches_read": 0,     # Searches put back together from their events
+    "missing_events": 0,    # Reads that found an event gone (counted as a miss)
+}
+
+
+def make_cache_key(clean_params: dict, where: dict = None) -> str:
+    # Create a special label for this specific search (and the local filters applied to it, if any)
+    key = f"usgs_data:{json.dumps(clean_params, sort_keys=True)}"
+    if where:
+        key += f":where:{json.dumps(where, sort_keys=True)}"
+    return key
+
+
+def set_local(cache_key: str, data: dict, ttl: int = CACHE_DURATION):
+    # Keep a result we worked out ourselves (e.g. filtered from a cached superset) in L1 only
+    l1_cache.set(cache_key, data, APPROX_FEATURE_BYTES * len(data.get("features", [])), ttl=ttl, keep=STALE_KEEP)
+
+
+"""
+async def get_cached(cache_key: str):
+
+    Purpose: Looks up previously fetched USGS data that is still fresh, nearest cache first
+    Parameters:
+    - cache_key: The label the data was stored under
+    Returns: The cached dictionary, or None if neither layer has it (or it has expired)
+"""
+async def get_cached(cache_key: str):
+    entry = await get_cached_entry(cache_key)
+    if entry is None or entry[1] > 0:
+        return None
+    return entry[0]
+
+
+"""
+async def get_cached_entry(cache_key: str):
+
+    Purpose: Looks up previously fetched USGS data, fresh or stale, nearest cache first
+    What it does:
+    - Checks the in-process L1 cache (already parsed, no network)
+    - Falls back to Redis (L2) on a miss, and also when L1 only has an expired copy: another worker
+      may have refreshed it already, and its fresher value wins over ours
+    - Copies an L2 hit into L1 for the rest of its Redis lifetime
+    - Entries are kept STALE_KEEP seconds past their time to live; Redis values carry the time
+      they stop being fresh (values written without it are fresh until Redis drops them)
+    Parameters:
+    - cache_key: The label the data was stored under
+    Returns: (data, seconds since it expired - 0 while fresh), or None if neither layer has it
+"""
+async def get_cached_entry(cache_key: str):
+    entry = l1_cache.get_entry(cache_key)
+    if entry is not None and not entry[1]:
+        logger.info("🎯 Cache HIT (L1): Returning cached data")
+        metrics.inc("cache_lookups_total", "l1", "hit")
+        return entry
+    metrics.inc("cache_lookups_total", "l1", "stale" if entry is not None else "miss")
+
+    shared = await _get_shared_entry(cache_key)
+    if shared is None or (entry is not None and shared[1] >= entry[1]):
+        if entry is not None:
+            logger.info("🕰️ Cache STALE (L1)")
+        return entry
+    data, stale_for, fresh_left, left = shared
+    l1_cache.set(cache_key, data, APPROX_FEATURE_BYTES * len(data.get("features", [])),
+                 ttl=fresh_left, keep=left - fresh_left)
+    return data, stale_for
+
+
+async def _get_shared_entry(cache_key: str):
+    # Reads the Redis (L2) copy and unpacks it (see app/codec.py); searches stored as lists of events are
+    # put back together from the events (all of them, or it counts as a miss)
+    # Returns (data, seconds since it expired, seconds it stays fresh, seconds Redis keeps it) or None
+    client = redis_pool.binary_client
+    if not client:
+        return None
+    try:
+        # Ask for the value and how long it has left in one round trip
+        pipe = client.pipeline()
+        pipe.get(cache_key)
+        pipe.pttl(cache_key)
+        cached_data, ttl_ms = await pipe.execute()
+    except Exception as e:
+        logger.warning(f"⚠️ Redis read failed: {str(e)}")
+        return None
+    if not cached_data:
+        metrics.inc("cache_lookups_total", "redis", "miss")
+        return None
+
+    try:
+        data, fresh_until = decode_entry(cached_data)
+        if isinstance(data, dict) and "event_refs" in data:
+            data = await _load_events(client, data)
+    except Exception as e:
+        # Written in a format we can't read (e.g. by a newer version) - same as not cached
+        logger.warning(f"⚠️ Could not decode cached value: {str(e)}")
+        metrics.inc("cache_lookups_total", "redis", "miss")
+        return None
+    if data is None:
+        metrics.inc("cache_lookups_total", "redis", "miss")
+        return None
+
+    left = ttl_ms / 1000 if ttl_ms and ttl_ms > 0 else CACHE_DURATION
+    fresh_left = left if fresh_until is None else min(max(fresh_until - time.time(), 0.0), left)
+    stale_for = 0.0 if fresh_until is None else max(0.0, time.time() - fresh_until)
+    logger.info("🎯 Cache HIT (L2): Returning cached data" if not stale_for else "🕰️ Cache STALE (L2)")
+    metrics.inc("cache_lookups_total", "redis", "stale" if stale_for else "hit")
+    return data, stale_for, fresh_left, left
+
+
+"""
+async def fresh_for(cache_key: str) -> float:
+
+    Purpose: Tells how much longer a cached entry stays fresh, without reading the value
+    What it does:
+    - Asks L1 and Redis (the key's remaining lifetime, minus the STALE_KEEP seconds an entry
+      is kept after it expires) and returns the longer of the two
+    - If another worker already refreshed the entry in Redis, drops our older L1 copy,
+      so the next read picks up the new one
+    Parameters:
+    - cache_key: The label the data was stored under
+    Returns: Seconds left (0 if it expired or isn't cached)
+    Used for: Refreshing popular entries shortly before they expire (see app/hotkeys.py)
+"""
+async def fresh_for(cache_key: str) -> float:
+    left = l1_cache.fresh_left(cache_key)
+    client = redis_pool.binary_client
+    if not client:
+        return left
+    try:
+        ttl_ms = await client.pttl(cache_key)
+    except Exception as e:
+        logger.warning(f"⚠️ Redis read failed: {str(e)}")
+        return left
+    shared_left = ttl_ms / 1000 - STALE_KEEP if ttl_ms and ttl_ms > 0 else 0.0
+    if shared_left > left + 1:
+        l1_cache.discard(cache_key)
+        return shared_left
+    return left
+
+
+"""
+async def set_cached(cache_key: str, data: dict, ttl: int = CACHE_DURATION):
+
+    Purpose: Remembers freshly fetched USGS data in both cache layers
+    Parameters:
+    - cache_key: The label to store the data under
+    - data: The parsed USGS response
+    - ttl: Seconds it stays fresh (defaults to CACHE_DURATION); it is kept STALE_KEEP seconds longer
+    Redis gets the compact msgpack + zstd form from app/codec.py, so big windows take a fraction of the memory
+    Used for: Making the next request for the same search a cache hit, even when Redis is down
+"""
+async def set_cached(cache_key: str, data: dict, ttl: int = CACHE_DURATION):
+    raw_size = len(dumps_json(data))
+    l1_cache.set(cache_key, data, raw_size, ttl=ttl, keep=STALE_KEEP)
+    client = redis_pool.binary_client
+    if client:
+        try:
+            fresh_until = time.time() + ttl
+            refs = _event_refs(data) if CACHE_NORMALIZE_EVENTS else None
+            if refs is None:
+                blob = encode(data, key=cache_key, raw_size=raw_size, fresh_until=fresh_until)
+                await client.setex(cache_key, int(ttl + STALE_KEEP), blob)
+            else:
+                await _store_events(client, cache_key, data, refs, ttl, raw_size, fresh_until)
+            logger.info("💾 Stored new data in cache")
+        except Exception as e:
+            logger.warning(f"⚠️ Redis write failed: {str(e)}")
+
+
+def _event_refs(data: dict):
+    # The Redis name (id and revision) of every event of a result, or None if it can't be stored per event
+    features = data.get("features")
+    if not features:
+        return None
+    refs = []
+    for feature in features:
+        event_id = feature.get("id")
+        if not event_id:
+            return None
+        updated = feature.get("properties", {}).get("updated")
+        refs.append(event_id if updated is None else f"{event_id}:{updated}")
+    return refs
+
+
+"""
+async def _store_events(client, cache_key: str, data: dict, refs: list, ttl: int, raw_size: int, fresh_until: float):
+
+    Purpose: Writes a result to Redis as its events plus the list of them
+    What it does:
+    - Writes every event under usgs_event:<id>:<updated>, compressed against the feature dictionary
+      (see app/codec.py); a search sharing events with other cached searches just rewrites the same keys
+    - Keeps each event as long as the search writing it (ttl + STALE_KEEP), extending, never shortening,
+      what other searches holding it set; the revision in the name means a list always gets back the exact
+      events it was written with
+    - Deletes an event's previous revision when a newer one arrives (searches still listing the old one
+      become misses and are fetched again, which they should be)
+    - Writes the result itself without its features: the rest of the FeatureCollection plus the event list
+    - Sends all of it in one pipeline, events first
+"""
+async def _store_events(client, cache_key: str, data: dict, refs: list, ttl: int, raw_size: int,
+                        fresh_until: float):
+    lifetime_ms = int((ttl + STALE_KEEP) * 1000)
+    pipe = client.pipeline(transaction=False)
+    stored = 0
+    events = list(zip(refs, data["features"]))
+    for start in range(0, len(events), _STORE_EVENTS_BATCH):
+        keys, args = [], [lifetime_ms]
+        for ref, feature in events[start:start + _STORE_EVENTS_BATCH]:
+            blob = encode(feature, feature=True, record=False)
+            stored += len(blob)
+            updated = feature.get("properties", {}).get("updated")
+            keys += [EVENT_KEY_PREFIX + ref, EVENT_LATEST_PREFIX + feature["id"]]
+            args += ["" if updated is None else str(updated), blob]
+        pipe.eval(_STORE_EVENTS_SCRIPT, len(keys), *keys, *args)
+    # Keep the FeatureCollection's keys in their order, with the features left out
+    index = encode({"collection": dict(data, features=None), "event_refs": refs}, fresh_until=fresh_until, record=False)
+    pipe.setex(cache_key, int(ttl + STALE_KEEP), index)
+    await pipe.execute()
+    record_size(cache_key, raw_size, stored + len(index))
+    normalized_stats["searches_written"] += 1
+    normalized_stats["events_written"] += len(refs)
+
+
+async def _load_events(client, index: dict):
+    # Puts a result stored by _store_events back together; None if any of its events is gone
+    refs = index["event_refs"]
+    pipe = client.pipeline(transaction=False)
+    for i in range(0, len(refs), _MGET_BATCH):
+        pipe.mget([EVENT_KEY_PREFIX + ref for ref in refs[i:i + _MGET_BATCH]])
+    blobs = [blob for batch in await pipe.execute() for blob in batch]
+    missing = sum(1 for blob in blobs if blob is None)
+    if missing:
+        normalized_stats["missing_events"] += 1
+        logger.warning(f"⚠️ {missing} cached events are gone, fetching the search again")
+        return None
+    normalized_stats["searches_read"] += 1
+    data = index["collection"]
+    data["features"] = [decode(blob) for blob in blobs]
+    return data
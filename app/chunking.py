@@ -0,0 +1,130 @@
+# This file splits time windows that are too busy for one USGS request into smaller chunks
+# USGS refuses searches matching more than 20,000 events, and one huge request is the slowest way to get them anyway
+
+import asyncio
+import json
+import math
+from app.config import USGS_MAX_EVENTS, CHUNK_TARGET_EVENTS, CHUNK_COUNT_MIN_SECONDS
+from app.usgs_client import count_events
+from app.cache import LRUCache
+from app.windows import parse_time, format_time
+from app.logger import setup_logging
+
+# Start logging the information
+logger = setup_logging()
+
+# Events per second we saw for each kind of search (everything but the window), from past fetches and counts
+_density = {}
+
+# Chunk plans we already worked out: cache key -> list of (starttime, endtime), for as long as the search
+# is cached; past _MAX_PLANS the least recently used plans are dropped (each counts as size 1)
+_MAX_PLANS = 1000
+_plans = LRUCache(_MAX_PLANS, _MAX_PLANS, 0)
+
+# Counters showing how often windows needed splitting
+stats = {
+    "counts": 0,          # /count requests sent to USGS
+    "split_windows": 0,   # Windows fetched as several chunks
+    "chunks": 0,          # Chunks those windows were split into
+}
+
+
+def _density_key(clean_params: dict) -> str:
+    return json.dumps({k: v for k, v in clean_params.items() if k not in ("starttime", "endtime")}, sort_keys=True)
+
+
+def _window_seconds(clean_params: dict) -> float:
+    return (parse_time(clean_params["endtime"]) - parse_time(clean_params["starttime"])).total_seconds()
+
+
+def record_density(clean_params: dict, events: int):
+    # Remember how busy this kind of search is, so similar windows can skip the /count request
+    seconds = _window_seconds(clean_params)
+    if seconds > 0:
+        _density[_density_key(clean_params)] = events / seconds
+
+
+def estimate_events(clean_params: dict):
+    # Expected number of events in the window, or None if we have never seen this kind of search
+    density = _density.get(_density_key(clean_params))
+    if density is None:
+        return None
+    return density * _window_seconds(clean_params)
+
+
+def split_evenly(clean_params: dict, pieces: int) -> list:
+    # Cuts the window into `pieces` equally long windows (whole seconds, neighbours share their edge)
+    start = parse_time(clean_params["starttime"])
+    end = parse_time(clean_params["endtime"])
+    step = (end - start) / pieces
+    edges = [format_time(start + step * i) for i in range(pieces)] + [clean_params["endtime"]]
+    edges[0] = clean_params["starttime"]
+    windows = []
+    for chunk_start, chunk_end in zip(edges, edges[1:]):
+        if chunk_start != chunk_end:
+            windows.append((chunk_start, chunk_end))
+    return windows
+
+
+"""
+async def plan_chunks(clean_params: dict, cache_key: str, ttl: int, recount: bool = False) -> list:
+
+    Purpose: Decides whether a window can be fetched in one go or has to be split
+    What it does:
+    - Reuses a plan we already made for this exact search
+    - Skips the count when past searches of the same kind say the window comfortably fits in one request
+      (under 3/4 of USGS_MAX_EVENTS), or when it is short and we know nothing about it yet
+    - Otherwise asks USGS to count the events and splits the window into chunks of about CHUNK_TARGET_EVENTS
+    Parameters:
+    - clean_params: USGS query parameters including starttime and endtime
+    - cache_key: Cache key of the search (plans are remembered under it)
+    - ttl: How long to remember the plan, in seconds
+    - recount: Ask USGS even if our estimate says the window is quiet (e.g. USGS just refused it)
+    Returns: List of (starttime, endtime) windows - just the original window if no split is needed
+"""
+async def plan_chunks(clean_params: dict, cache_key: str, ttl: int, recount: bool = False) -> list:
+    plan = _plans.get(cache_key)
+    if plan is not None and not recount:
+        return plan
+
+    whole = [(clean_params["starttime"], clean_params["endtime"])]
+    if not recount:
+        estimate = estimate_events(clean_params)
+        if estimate is None and _window_seconds(clean_params) < CHUNK_COUNT_MIN_SECONDS:
+            return whole
+        if estimate is not None and estimate < USGS_MAX_EVENTS * 0.75:
+            return whole
+
+    stats["counts"] += 1
+    events = await count_events(clean_params)
+    record_density(clean_params, events)
+    pieces = math.ceil(events / CHUNK_TARGET_EVENTS)
+    windows = whole if pieces <= 1 else split_evenly(clean_params, pieces)
+    if len(windows) > 1:
+        logger.info(f"✂️ Splitting a window with {events} events into {len(windows)} chunks")
+        stats["split_windows"] += 1
+        stats["chunks"] += len(windows)
+
+    _plans.set(cache_key, windows, 1, ttl=ttl)
+    return windows
+
+
+"""
+async def gather_limited(coroutines: list, limit: int) -> list:
+
+    Purpose: Like asyncio.gather, but runs at most `limit` of the coroutines at the same time
+    Returns: Their results, in the order given
+    Used for: Fetching many buckets or chunks of one search without flooding USGS
+"""
+async def gather_limited(coroutines: list, limit: int) -> list:
+    semaphore = asyncio.Semaphore(limit)
+
+    async def run(coroutine):
+        try:
+            async with semaphore:
+                return await coroutine
+        finally:
+            # Cancelled before its turn came - don't leave it un-awaited
+            coroutine.close()
+
+    return await asyncio.gather(*(run(coroutine) for coroutine in coroutines))
@@ -0,0 +1,273 @@
+# This file turns cache values into compact bytes for Redis and back again
+#
+# Every stored value starts with a 3 byte header so the format can change without breaking old entries:
+#   byte 0 - format version (1, or 2 when the value says how long it is fresh)
+#   byte 1 - serializer: 0 raw bytes, 1 JSON, 2 msgpack
+#   byte 2 - compression: 0 none, 1 zlib, 2 zstd, 3 lz4, 4 zstd with our built-in GeoJSON feature dictionary
+# Version 2 adds 8 more bytes: when the value stops being fresh, in milliseconds since 1970 (big-endian)
+
+import json
+import zlib
+from collections import OrderedDict
+from app.config import CACHE_SERIALIZER, CACHE_COMPRESSION, CACHE_COMPRESSION_LEVEL, CACHE_COMPRESSION_MIN_BYTES
+from app.logger import setup_logging
+
+# The faster/smaller libraries are optional - we fall back to the standard library without them
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+
+# Start logging the information
+logger = setup_logging()
+
+FORMAT_VERSION = 1
+FORMAT_VERSION_FRESH_UNTIL = 2
+
+SERIALIZER_RAW = 0
+SERIALIZER_JSON = 1
+SERIALIZER_MSGPACK = 2
+
+COMPRESSION_NONE = 0
+COMPRESSION_ZLIB = 1
+COMPRESSION_ZSTD = 2
+COMPRESSION_LZ4 = 3
+COMPRESSION_ZSTD_FEATURE = 4
+
+# A USGS GeoJSON feature with empty values, used as a zstd dictionary for values holding a single event
+# (a few hundred bytes are too little for zstd to find repeats in on its own; against this it finds the keys)
+# Never change it - stored values can only be read with the exact dictionary they were written with
+_FEATURE_TEMPLATE = {
+    "type": "Feature",
+    "properties": {
+        "mag": None, "place": "", "time": 0, "updated": 0, "tz": None,
+        "url": "https://earthquake.usgs.gov/earthquakes/eventpage/",
+        "detail": "https://earthquake.usgs.gov/fdsnws/event/1/query?eventid=&format=geojson",
+        "felt": None, "cdi": None, "mmi": None, "alert": None, "status": "reviewed", "tsunami": 0, "sig": 0,
+        "net": "", "code": "", "ids": "", "sources": "", "types": ",origin,phase-data,", "nst": None,
+        "dmin": None, "rms": None, "gap": None, "magType": "ml", "type": "earthquake", "title": "M  - ",
+    },
+    "geometry": {"type": "Point", "coordinates": [0.0, 0.0, 0.0]},
+    "id": "",
+}
+
+# How many recently written keys we keep size figures for
+_MAX_TRACKED_KEYS = 200
+
+# Sizes of what we wrote: totals plus the most recent keys, JSON size vs. stored size
+stats = {
+    "writes": 0,
+    "raw_bytes": 0,      # What the values would take as plain JSON (what we used to store)
+    "stored_bytes": 0,   # What they actually take in Redis
+}
+_key_sizes = OrderedDict()
+
+
+"""
+def dumps_json(data) -> bytes:
+
+    Purpose: Turns data into compact JSON bytes as fast as we can
+    What it does:
+    - Uses orjson (written in Rust, several times faster) when it is installed
+    - Falls back to the standard json module with the same compact output as JSONResponse
+    Returns: UTF-8 encoded JSON
+"""
+def dumps_json(data) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode("utf-8")
+
+
+def _pick_serializer() -> int:
+    if CACHE_SERIALIZER == 'msgpack':
+        if msgpack is not None:
+            return SERIALIZER_MSGPACK
+        logger.warning("⚠️ CACHE_SERIALIZER is msgpack but the 'msgpack' package is missing, using JSON")
+    return SERIALIZER_JSON
+
+
+def _pick_compression() -> int:
+    if CACHE_COMPRESSION == 'none':
+        return COMPRESSION_NONE
+    if CACHE_COMPRESSION == 'zstd' and zstandard is not None:
+        return COMPRESSION_ZSTD
+    if CACHE_COMPRESSION == 'lz4' and lz4_frame is not None:
+        return COMPRESSION_LZ4
+    if CACHE_COMPRESSION not in ('zlib', 'zstd', 'lz4'):
+        logger.warning(f"⚠️ Unknown CACHE_COMPRESSION '{CACHE_COMPRESSION}', using zlib")
+    elif CACHE_COMPRESSION != 'zlib':
+        logger.warning(f"⚠️ CACHE_COMPRESSION is {CACHE_COMPRESSION} but its package is missing, using zlib")
+    return COMPRESSION_ZLIB
+
+
+# Decided once at startup
+serializer = _pick_serializer()
+compression = _pick_compression()
+
+
+def _feature_codecs() -> tuple:
+    # (compressor, decompressor) for the feature dictionary, built on first use from the msgpack form
+    # of _FEATURE_TEMPLATE and reused (setting up a dictionary costs more than compressing one event)
+    global _feature_codecs_cache
+    if _feature_codecs_cache is None:
+        dictionary = zstandard.ZstdCompressionDict(msgpack.packb(_FEATURE_TEMPLATE, use_bin_type=True),
+                                                   dict_type=zstandard.DICT_TYPE_RAWCONTENT)
+        _feature_codecs_cache = (
+            zstandard.ZstdCompressor(level=CACHE_COMPRESSION_LEVEL, dict_data=dictionary),
+            zstandard.ZstdDecompressor(dict_data=dictionary),
+        )
+    return _feature_codecs_cache
+
+
+_feature_codecs_cache = None
+
+
+def _compress(payload: bytes, method: int) -> bytes:
+    if method == COMPRESSION_ZSTD_FEATURE:
+        return _feature_codecs()[0].compress(payload)
+    if method == COMPRESSION_ZSTD:
+        return zstandard.ZstdCompressor(level=CACHE_COMPRESSION_LEVEL).compress(payload)
+    if method == COMPRESSION_LZ4:
+        return lz4_frame.compress(payload)
+    if method == COMPRESSION_ZLIB:
+        return zlib.compress(payload, min(CACHE_COMPRESSION_LEVEL, 9))
+    return payload
+
+
+def _decompress(payload: bytes, method: int) -> bytes:
+    if method == COMPRESSION_ZSTD_FEATURE:
+        if zstandard is None or msgpack is None:
+            raise ValueError("Cache value needs the 'zstandard' and 'msgpack' packages")
+        return _feature_codecs()[1].decompress(payload)
+    if method == COMPRESSION_ZSTD:
+        return zstandard.ZstdDecompressor().decompress(payload)
+    if method == COMPRESSION_LZ4:
+        return lz4_frame.decompress(payload)
+    if method == COMPRESSION_ZLIB:
+        return zlib.decompress(payload)
+    if method == COMPRESSION_NONE:
+        return payload
+    raise ValueError(f"Unknown cache compression {method}")
+
+
+def record_size(key: str, raw_size: int, stored_size: int):
+    # Counts a write for the size stats (encode does this itself unless told not to)
+    stats["writes"] += 1
+    stats["raw_bytes"] += raw_size
+    stats["stored_bytes"] += stored_size
+    if key is None:
+        return
+    _key_sizes[key] = {"raw_bytes": raw_size, "stored_bytes": stored_size}
+    _key_sizes.move_to_end(key)
+    while len(_key_sizes) > _MAX_TRACKED_KEYS:
+        _key_sizes.popitem(last=False)
+
+
+"""
+def encode(value, key: str = None, raw_size: int = None, fresh_until: float = None,
+           feature: bool = False, record: bool = True) -> bytes:
+
+    Purpose: Packs a cache value (dicts/lists, or finished response bytes) for Redis
+    What it does:
+    - Serializes with msgpack (or JSON); bytes values are kept as they are
+    - Compresses with zstd/lz4/zlib when the value is big enough to be worth it
+    - Puts the 3 byte format header in front (plus the fresh-until time, if given)
+    - Records the plain-JSON size and the stored size for the cache stats
+    Parameters:
+    - value: What to store
+    - key: The cache key (only used for the size stats)
+    - raw_size: Plain JSON size if the caller already knows it (saves encoding twice)
+    - fresh_until: Unix time the value stops being fresh (it may be stored for longer than that)
+    - feature: The value is a single GeoJSON feature - compress it against our feature dictionary, however small
+    - record: False when the caller counts the write in the size stats itself (see record_size)
+    Returns: Bytes ready for a binary-safe Redis client
+"""
+def encode(value, key: str = None, raw_size: int = None, fresh_until: float = None,
+           feature: bool = False, record: bool = True) -> bytes:
+    if isinstance(value, bytes):
+        method, payload = SERIALIZER_RAW, value
+        raw_size = len(value) if raw_size is None else raw_size
+    elif serializer == SERIALIZER_MSGPACK:
+        method, payload = SERIALIZER_MSGPACK, msgpack.packb(value, use_bin_type=True)
+    else:
+        method, payload = SERIALIZER_JSON, dumps_json(value)
+        raw_size = len(payload) if raw_size is None else raw_size
+    if raw_size is None and record:
+        raw_size = len(dumps_json(value))
+
+    if feature and method == SERIALIZER_MSGPACK and compression == COMPRESSION_ZSTD:
+        compress_with = COMPRESSION_ZSTD_FEATURE
+    else:
+        compress_with = compression if len(payload) >= CACHE_COMPRESSION_MIN_BYTES else COMPRESSION_NONE
+    if fresh_until is None:
+        header = bytes([FORMAT_VERSION, method, compress_with])
+    else:
+        header = bytes([FORMAT_VERSION_FRESH_UNTIL, method, compress_with]) + int(fresh_until * 1000).to_bytes(8, "big")
+    blob = header + _compress(payload, compress_with)
+    if record:
+        record_size(key, raw_size, len(blob))
+    return blob
+
+
+"""
+def decode(blob: bytes):
+
+    Purpose: Unpacks a value written by encode()
+    What it does:
+    - Reads the format header and undoes the compression and serialization it names
+    - Still reads plain JSON written before this format existed
+    Returns: The original value
+    Raises: ValueError if the value uses a format we don't know
+"""
+def decode(blob: bytes):
+    return decode_entry(blob)[0]
+
+
+def decode_entry(blob: bytes) -> tuple:
+    # Like decode, but returns (value, unix time it stops being fresh - None if it didn't say)
+    if isinstance(blob, str):
+        blob = blob.encode("utf-8")
+    if blob[:1] in (b"{", b"["):
+        # Plain JSON from before cache values had a header
+        return json.loads(blob), None
+    if len(blob) >= 11 and blob[0] == FORMAT_VERSION_FRESH_UNTIL:
+        fresh_until, start = int.from_bytes(blob[3:11], "big") / 1000, 11
+    elif len(blob) >= 3 and blob[0] == FORMAT_VERSION:
+        fresh_until, start = None, 3
+    else:
+        raise ValueError(f"Unknown cache value format {blob[:1]!r}")
+    payload = _decompress(blob[start:], blob[2])
+    if blob[1] == SERIALIZER_RAW:
+        return payload, fresh_until
+    if blob[1] == SERIALIZER_MSGPACK:
+        if msgpack is None:
+            raise ValueError("Cache value is msgpack but the 'msgpack' package is missing")
+        return msgpack.unpackb(payload, raw=False), fresh_until
+    if blob[1] == SERIALIZER_JSON:
+        return json.loads(payload), fresh_until
+    raise ValueError(f"Unknown cache serializer {blob[1]}")
+
+
+def size_stats() -> dict:
+    # Totals and recent keys, for /admin/stats
+    ratio = stats["stored_bytes"] / stats["raw_bytes"] if stats["raw_bytes"] else None
+    return {
+        "serializer": {SERIALIZER_JSON: "json", SERIALIZER_MSGPACK: "msgpack"}[serializer],
+        "compression": {COMPRESSION_NONE: "none", COMPRESSION_ZLIB: "zlib", COMPRESSION_ZSTD: "zstd",
+                        COMPRESSION_LZ4: "lz4"}[compression],
+        **stats,
+        "compression_ratio": round(ratio, 3) if ratio is not None else None,
+        "keys": dict(_key_sizes),
+    }
@@ -0,0 +1,223 @@
+# This file keeps a columnar copy of the results we filter and merge over and over: one NumPy array
+# per number we filter or sort on (time, position, depth, magnitude, felt reports, tsunami flag)
+# Filters, sorts and time-range cuts then run as vectorized masks instead of walking feature dicts
+# NumPy is optional - without it (or for small results) callers use their plain Python code
+
+import math
+import time
+from app.config import (
+    COLUMNAR_ENABLED,
+    COLUMNAR_MIN_FEATURES,
+    COLUMNAR_CACHE_MAX_ENTRIES,
+    COLUMNAR_CACHE_MAX_BYTES,
+    HISTORICAL_CACHE_DURATION,
+    CACHE_STALE_IF_ERROR,
+)
+from app.cache import LRUCache, APPROX_FEATURE_BYTES
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+EARTH_RADIUS_KM = 6371.0
+
+
+class FeatureColumns:
+    """
+    The numbers of a list of GeoJSON features, one array per property; row i describes features[i].
+    Missing times, magnitudes, felt counts and depths are NaN (so every comparison with them is False),
+    a missing tsunami flag is 0. Treat it as read-only, like the cached results it belongs to.
+    """
+
+    __slots__ = ("features", "ids", "time", "lat", "lon", "depth", "mag", "felt", "tsunami")
+
+    def __init__(self, features, ids, time, lat, lon, depth, mag, felt, tsunami):
+        self.features = features
+        self.ids = ids
+        self.time = time
+        self.lat = lat
+        self.lon = lon
+        self.depth = depth
+        self.mag = mag
+        self.felt = felt
+        self.tsunami = tsunami
+
+    @classmethod
+    def build(cls, features: list) -> "FeatureColumns":
+        # One pass over the dicts, then every column is converted to an array at once
+        ids, times, lats, lons, depths, mags, felts, tsunamis = [], [], [], [], [], [], [], []
+        for feature in features:
+            properties = feature["properties"]
+            coordinates = feature["geometry"]["coordinates"]
+            ids.append(feature.get("id") or "")
+            times.append(properties.get("time"))
+            lons.append(coordinates[0])
+            lats.append(coordinates[1])
+            depths.append(coordinates[2] if len(coordinates) > 2 else None)
+            mags.append(properties.get("mag"))
+            felt = properties.get("felt")
+            felts.append(None if felt is None else float(felt))
+            tsunamis.append(properties.get("tsunami") or 0)
+        return cls(
+            features,
+            np.array(ids, dtype=str),
+            np.array(times, dtype=np.float64),  # None becomes NaN (times in ms fit a float exactly)
+            np.array(lats, dtype=np.float64),
+            np.array(lons, dtype=np.float64),
+            np.array(depths, dtype=np.float64),
+            np.array(mags, dtype=np.float64),
+            np.array(felts, dtype=np.float64),
+            np.array(tsunamis, dtype=np.int64),
+        )
+
+    @classmethod
+    def concat(cls, parts: list) -> "FeatureColumns":
+        features = []
+        for part in parts:
+            features.extend(part.features)
+        return cls(features, *(np.concatenate([getattr(part, name) for part in parts]) for name in cls.__slots__[1:]))
+
+    def __len__(self):
+        return len(self.features)
+
+    @property
+    def nbytes(self) -> int:
+        # The arrays plus the list of references to the features
+        return sum(getattr(self, name).nbytes for name in self.__slots__[1:]) + 8 * len(self.features)
+
+    def take(self, rows) -> "FeatureColumns":
+        # The given rows (a boolean mask or row numbers), in that order
+        if rows.dtype == bool:
+            rows = np.flatnonzero(rows)
+        features = self.features
+        return FeatureColumns([features[i] for i in rows.tolist()],
+                              *(getattr(self, name)[rows] for name in self.__slots__[1:]))
+
+    def bbox(self) -> list:
+        # [min lon, min lat, min depth, max lon, max lat, max depth] like windows.merge_buckets works it out,
+        # with the values exactly as the features have them (a missing depth counts as 0)
+        depths = np.nan_to_num(self.depth, nan=0.0)
+        rows = [self.lon.argmin(), self.lat.argmin(), depths.argmin(), self.lon.argmax(), self.lat.argmax(), depths.argmax()]
+        box = []
+        for axis, row in zip((0, 1, 2, 0, 1, 2), rows):
+            coordinates = self.features[row]["geometry"]["coordinates"]
+            value = coordinates[axis] if len(coordinates) > axis else None
+            box.append(0 if value is None else value)
+        return box
+
+    def mask(self, min_mag: float = -math.inf, center: tuple = None, radius: float = math.inf,
+             where: dict = None):
+        """
+        Rows matching a search: magnitude >= min_mag (rows without a magnitude only match without a floor),
+        within `radius` km of `center` (lat, lon), and the local filters in `where`
+        (the same rules as containment.filter_to and containment.local_filter)
+        """
+        keep = np.ones(len(self.features), dtype=bool)
+        if where:
+            if where.get("tsunami"):
+                keep &= self.tsunami > 0
+            if "minfelt" in where:
+                keep &= self.felt >= int(where["minfelt"])
+        if min_mag != -math.inf:
+            keep &= self.mag >= min_mag
+        if radius != math.inf and center is not None:
+            keep &= distances_km(center[0], center[1], self.lat, self.lon) <= radius
+        return keep
+
+
+def distances_km(lat, lon, lats, lons):
+    # containment.distance_km for a whole array of points at once
+    lat1, lon1 = math.radians(lat), math.radians(lon)
+    lat2, lon2 = np.radians(lats), np.radians(lons)
+    a = np.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return EARTH_RADIUS_KM * 2 * np.arcsin(np.sqrt(np.minimum(1.0, a)))
+
+
+# Columnar copies by the identity of the result they belong to: id(result) -> (result, columns)
+# (holding on to the result means its id can't be reused by another object while the copy is here,
+# so an entry is charged for the result's features as well as its arrays)
+# Results never change once cached, so a copy stays right for as long as it lives
+_columns = LRUCache(COLUMNAR_CACHE_MAX_ENTRIES, COLUMNAR_CACHE_MAX_BYTES,
+                    HISTORICAL_CACHE_DURATION + CACHE_STALE_IF_ERROR)
+
+# Counters showing how much of the filtering ran vectorized
+stats = {
+    "builds": 0,          # Columnar copies built from feature dicts
+    "build_seconds": 0.0, # Time spent building them
+    "vectorized": 0,      # Filters and merges that ran on columns
+}
+
+
+def enabled() -> bool:
+    return COLUMNAR_ENABLED and np is not None
+
+
+"""
+def columns_of(data: dict, min_features: int = None, build: bool = True):
+
+    Purpose: Gets the columnar copy of a result, building it the first time it is asked for
+    What it does:
+    - Returns the copy kept for this exact result object (cached results are shared and never change,
+      so every request filtering the same cached result reuses one copy)
+    - Builds and keeps a new copy otherwise, unless `build` is False: answers made for one request
+      pass False, so they neither stay alive here nor push out the copies of cached results
+    Parameters:
+    - data: A GeoJSON FeatureCollection
+    - min_features: Results with fewer features get no copy (defaults to COLUMNAR_MIN_FEATURES)
+    - build: Whether to build (and keep) a copy when there is none yet
+    Returns: FeatureColumns, or None when NumPy is unavailable, the result is too small to bother,
+             or it has no copy and `build` is False
+"""
+def columns_of(data: dict, min_features: int = None, build: bool = True):
+    features = data.get("features", [])
+    if not enabled() or len(features) < (COLUMNAR_MIN_FEATURES if min_features is None else min_features):
+        return None
+    entry = _columns.get(id(data))
+    if entry is not None and entry[0] is data:
+        return entry[1]
+    if not build:
+        return None
+    started = time.perf_counter()
+    columns = FeatureColumns.build(features)
+    stats["builds"] += 1
+    stats["build_seconds"] += time.perf_counter() - started
+    _columns.set(id(data), (data, columns), columns.nbytes + APPROX_FEATURE_BYTES * len(features))
+    return columns
+
+
+def clear():
+    _columns.clear()
+
+
+def cache_stats() -> dict:
+    return dict(stats, build_seconds=round(stats["build_seconds"], 3), **_columns.stats())
+
+
+"""
+def merge_columns(results: list, start_ms: int, end_ms: int):
+
+    Purpose: The vectorized part of windows.merge_buckets
+    What it does:
+    - Joins the columnar copies of all buckets (built once per cached bucket, however small, as long as
+      the buckets add up to COLUMNAR_MIN_FEATURES) and keeps rows with start_ms <= time <= end_ms
+    - Drops repeated event ids (keeping the first, in bucket order)
+    - Orders the rows newest first (stable, so equal times keep their order)
+    Parameters:
+    - results: USGS FeatureCollections, one per bucket
+    - start_ms, end_ms: The requested window in ms
+    Returns: FeatureColumns of the merged answer, or None when the merge should run in plain Python
+"""
+def merge_columns(results: list, start_ms: int, end_ms: int):
+    results = [result for result in results if result.get("features")]
+    if not enabled() or not results or sum(len(result["features"]) for result in results) < COLUMNAR_MIN_FEATURES:
+        return None
+    parts = [columns_of(result, min_features=1) for result in results]
+    joined = parts[0] if len(parts) == 1 else FeatureColumns.concat(parts)
+    rows = np.flatnonzero((joined.time >= start_ms) & (joined.time <= end_ms))
+    _, first = np.unique(joined.ids[rows], return_index=True)
+    if len(first) < len(rows):
+        rows = rows[np.sort(first)]
+    rows = rows[np.argsort(-joined.time[rows], kind="stable")]
+    stats["vectorized"] += 1
+    return joined.take(rows)
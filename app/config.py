@@ -5,6 +5,7 @@ Manages Redis connection settings and USGS API endpoint configuration
 '''
 
 import os
+import tempfile
 # Where to find our Redis database - if not specified, use 'localhost' (our own computer)
 REDIS_HOST = os.getenv('REDIS_HOST', 'localhost')
 # Searth REDIS_PORT in .env file or if not found use 6379 as default port.
@@ -14,4 +15,219 @@ REDIS_PORT = int(os.getenv('REDIS_PORT', 6379))
 CACHE_DURATION = 30  # seconds
 
 # The web address where we can get earthquake information from USGS
-USGS_API_URL = "https://earthquake.usgs.gov/fdsnws/event/1/query"
\ No newline at end of file
+USGS_API_URL = "https://earthquake.usgs.gov/fdsnws/event/1/query"
+# Same search parameters, but USGS only tells us how many events would match
+USGS_COUNT_URL = "https://earthquake.usgs.gov/fdsnws/event/1/count"
+
+# How many connections to USGS one worker may have open at the same time (shared by all requests)
+USGS_MAX_CONNECTIONS = int(os.getenv('USGS_MAX_CONNECTIONS', 200))
+# How many idle connections we keep alive so the next request can skip the TLS handshake
+USGS_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv('USGS_MAX_KEEPALIVE_CONNECTIONS', 50))
+# How long an idle kept-alive connection may stay open - in seconds
+USGS_KEEPALIVE_EXPIRY = float(os.getenv('USGS_KEEPALIVE_EXPIRY', 30))
+# Talk HTTP/2 to USGS when the 'h2' package is installed (USGS_HTTP2=true to turn on)
+USGS_HTTP2 = os.getenv('USGS_HTTP2', 'false').lower() == 'true'
+# Give up on a USGS request after this many seconds (waiting for a pooled connection or sending the request)
+USGS_TIMEOUT = float(os.getenv('USGS_TIMEOUT', 60))
+# Give up connecting to USGS after this many seconds
+USGS_CONNECT_TIMEOUT = float(os.getenv('USGS_CONNECT_TIMEOUT', 5))
+# Give up on a USGS answer when no bytes arrived for this many seconds
+USGS_READ_TIMEOUT = float(os.getenv('USGS_READ_TIMEOUT', 30))
+
+# While one worker fetches a key from USGS it holds a short Redis lock so other workers wait instead of fetching too
+CACHE_LOCK_TIMEOUT = float(os.getenv('CACHE_LOCK_TIMEOUT', 15))  # seconds before a forgotten lock frees itself
+CACHE_LOCK_WAIT = float(os.getenv('CACHE_LOCK_WAIT', 10))  # seconds a waiting worker waits before fetching itself
+CACHE_LOCK_POLL_INTERVAL = float(os.getenv('CACHE_LOCK_POLL_INTERVAL', 0.05))  # seconds between cache checks while waiting
+
+# In-process (L1) cache kept by every worker in front of Redis
+L1_CACHE_MAX_ENTRIES = int(os.getenv('L1_CACHE_MAX_ENTRIES', 256))  # most searches remembered per worker
+L1_CACHE_MAX_BYTES = int(os.getenv('L1_CACHE_MAX_BYTES', 64 * 1024 * 1024))  # approximate size limit (JSON bytes)
+
+# Time windows are split into hour/day/month/year aligned buckets that are cached on their own,
+# using the smallest bucket size that keeps a search within this many buckets
+# (each bucket a cold search misses is one USGS request, so this is also what a cold search costs:
+# a 24-hour window is 2 day buckets, not 25 hour buckets that would use up the upstream burst)
+WINDOW_MAX_BUCKETS = int(os.getenv('WINDOW_MAX_BUCKETS', 8))
+# Buckets that ended longer ago than this are "history" and barely change - in seconds
+BUCKET_SETTLE_SECONDS = int(os.getenv('BUCKET_SETTLE_SECONDS', 3600))
+# How long to cache a historical bucket - in seconds (6 hours)
+HISTORICAL_CACHE_DURATION = int(os.getenv('HISTORICAL_CACHE_DURATION', 6 * 3600))
+
+# Serve stricter searches (higher minmagnitude, smaller radius) by filtering a cached wider one.
+# On a miss, searches above this magnitude are fetched at this magnitude so every threshold shares one fetch
+CONTAINMENT_MIN_MAGNITUDE = float(os.getenv('CONTAINMENT_MIN_MAGNITUDE', 2.0))
+CONTAINMENT_WIDEN = os.getenv('CONTAINMENT_WIDEN', 'true').lower() == 'true'
+
+# Finished response bodies (already encoded as JSON/XML bytes) kept per worker, so hits skip all encoding
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv('RESPONSE_CACHE_MAX_ENTRIES', 512))
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv('RESPONSE_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+
+# How cache values are stored in Redis: serializer (msgpack or json) and compression (zstd, lz4, zlib or none)
+# If the chosen library isn't installed we fall back to json / zlib from the standard library
+CACHE_SERIALIZER = os.getenv('CACHE_SERIALIZER', 'msgpack')
+CACHE_COMPRESSION = os.getenv('CACHE_COMPRESSION', 'zstd')
+CACHE_COMPRESSION_LEVEL = int(os.getenv('CACHE_COMPRESSION_LEVEL', 3))
+# Values smaller than this are stored uncompressed - in bytes
+CACHE_COMPRESSION_MIN_BYTES = int(os.getenv('CACHE_COMPRESSION_MIN_BYTES', 1024))
+
+# XML responses: indent them like before (set to 'false' for smaller, single-line XML)
+XML_PRETTY = os.getenv('XML_PRETTY', 'true').lower() == 'true'
+# Roughly how many characters of XML we send at a time when streaming
+XML_CHUNK_SIZE = int(os.getenv('XML_CHUNK_SIZE', 64 * 1024))
+# Streamed answers up to this size are also kept in the response cache - in bytes
+STREAM_CACHE_MAX_BYTES = int(os.getenv('STREAM_CACHE_MAX_BYTES', 8 * 1024 * 1024))
+
+# JSON responses with at least this many features are streamed instead of encoded in one go
+JSON_STREAM_MIN_FEATURES = int(os.getenv('JSON_STREAM_MIN_FEATURES', 1000))
+# Roughly how many bytes of JSON we send at a time when streaming
+JSON_CHUNK_SIZE = int(os.getenv('JSON_CHUNK_SIZE', 64 * 1024))
+
+# USGS refuses searches matching more events than this
+USGS_MAX_EVENTS = int(os.getenv('USGS_MAX_EVENTS', 20000))
+# Windows expected to hold more events than this are split into chunks of about this size
+CHUNK_TARGET_EVENTS = int(os.getenv('CHUNK_TARGET_EVENTS', 10000))
+# Windows shorter than this are never counted/split unless past searches say they are busy - in seconds
+CHUNK_COUNT_MIN_SECONDS = int(os.getenv('CHUNK_COUNT_MIN_SECONDS', 86400))
+# How many buckets or chunks of one search we fetch from USGS at the same time
+FETCH_CONCURRENCY = int(os.getenv('FETCH_CONCURRENCY', 8))
+
+# Local SQLite store of every event we fetched, answering searches it fully covers without asking USGS
+EVENT_STORE_ENABLED = os.getenv('EVENT_STORE_ENABLED', 'true').lower() == 'true'
+# Where the database lives (outside the source tree; it is a copy of USGS data and can be thrown away)
+EVENT_STORE_PATH = os.getenv('EVENT_STORE_PATH', os.path.join(tempfile.gettempdir(), 'earthquake_api_events.sqlite3'))
+# Stored searches not synced again for this many days are forgotten, along with events no other search holds
+EVENT_STORE_RETENTION_DAYS = float(os.getenv('EVENT_STORE_RETENTION_DAYS', 30))
+# How often each worker prunes the store (on its next write) - in seconds
+EVENT_STORE_PRUNE_INTERVAL = float(os.getenv('EVENT_STORE_PRUNE_INTERVAL', 3600))
+
+# Background ingester that keeps the recent buckets of the busiest searches warm (one per deployment)
+INGEST_ENABLED = os.getenv('INGEST_ENABLED', 'true').lower() == 'true'
+# How often the ingester polls USGS - in seconds (keep it below CACHE_DURATION so recent buckets never expire)
+INGEST_INTERVAL = float(os.getenv('INGEST_INTERVAL', 15))
+# How many days (today included) the ingester keeps warm
+INGEST_LOOKBACK_DAYS = int(os.getenv('INGEST_LOOKBACK_DAYS', 2))
+# How long the ingester's leadership lock lasts without being renewed - in seconds
+INGEST_LEADER_TTL = int(os.getenv('INGEST_LEADER_TTL', 60))
+
+# Refreshes of synced windows ask USGS for events updated since the last sync, minus this margin
+# (USGS takes a little while to make revisions searchable) - in seconds
+INCREMENTAL_OVERLAP_SECONDS = int(os.getenv('INCREMENTAL_OVERLAP_SECONDS', 120))
+
+# After a cache entry's time to live, it is still served for this long while one background refresh
+# replaces it (stale-while-revalidate) - in seconds
+CACHE_STALE_WHILE_REVALIDATE = int(os.getenv('CACHE_STALE_WHILE_REVALIDATE', 60))
+# When USGS fails, expired entries up to this old are served instead of an error (stale-if-error) - in seconds
+CACHE_STALE_IF_ERROR = int(os.getenv('CACHE_STALE_IF_ERROR', 3600))
+
+# Searches are ranked by how often they were requested lately (a counter that halves every
+# HOT_KEY_HALF_LIFE seconds); the HOT_KEY_TOP_N most popular are refreshed before they expire
+HOT_KEYS_ENABLED = os.getenv('HOT_KEYS_ENABLED', 'true').lower() == 'true'
+HOT_KEY_HALF_LIFE = float(os.getenv('HOT_KEY_HALF_LIFE', 600))
+HOT_KEY_TOP_N = int(os.getenv('HOT_KEY_TOP_N', 50))
+# How many searches we keep counting (the least popular are forgotten)
+HOT_KEY_MAX_TRACKED = int(os.getenv('HOT_KEY_MAX_TRACKED', 1000))
+# How often the refresher looks at the hot searches - in seconds
+HOT_KEY_REFRESH_INTERVAL = float(os.getenv('HOT_KEY_REFRESH_INTERVAL', 5))
+# Hot searches with less fresh time left than this are refreshed - in seconds (keep it above the interval)
+HOT_KEY_REFRESH_AHEAD = float(os.getenv('HOT_KEY_REFRESH_AHEAD', 10))
+
+# Keep a columnar copy (NumPy arrays) of results we filter and merge, so those run as vectorized masks
+# (needs numpy; without it everything runs in plain Python)
+COLUMNAR_ENABLED = os.getenv('COLUMNAR_ENABLED', 'true').lower() == 'true'
+# Results with fewer features than this are filtered in plain Python (building the arrays isn't worth it)
+COLUMNAR_MIN_FEATURES = int(os.getenv('COLUMNAR_MIN_FEATURES', 256))
+# How many columnar copies each worker keeps, and how big they may get in total - in bytes (a copy counts
+# its arrays plus the result it belongs to, which it keeps alive)
+COLUMNAR_CACHE_MAX_ENTRIES = int(os.getenv('COLUMNAR_CACHE_MAX_ENTRIES', 1024))
+COLUMNAR_CACHE_MAX_BYTES = int(os.getenv('COLUMNAR_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+
+# Store every event once in Redis (usgs_event:<id>:<updated>) and cached searches as lists of event ids,
+# instead of a full copy of every event in every search that contains it
+CACHE_NORMALIZE_EVENTS = os.getenv('CACHE_NORMALIZE_EVENTS', 'true').lower() == 'true'
+
+# Index of tsunami-flagged events (in Redis, shared by all workers), so the tsunami route doesn't scan
+# the global catalog; filled from every fitting USGS answer and kept up to date by the ingester's leader
+TSUNAMI_INDEX_ENABLED = os.getenv('TSUNAMI_INDEX_ENABLED', 'true').lower() == 'true'
+# How often the leader brings the index up to date - in seconds (hours still filling up are only
+# trusted for CACHE_DURATION seconds after a sync, so keep this below that)
+TSUNAMI_INDEX_INTERVAL = float(os.getenv('TSUNAMI_INDEX_INTERVAL', 15))
+# How many hours back the leader keeps the index complete (the tsunami route asks for up to 168)
+TSUNAMI_INDEX_LOOKBACK_HOURS = int(os.getenv('TSUNAMI_INDEX_LOOKBACK_HOURS', 168))
+# Smallest magnitude the index holds (must not be above the tsunami route's 2.0)
+TSUNAMI_INDEX_MIN_MAGNITUDE = float(os.getenv('TSUNAMI_INDEX_MIN_MAGNITUDE', 2.0))
+
+# How far out to sea (from the state's outline) an earthquake still counts for a coastal state's
+# tsunami alerts - in km
+STATE_COASTAL_ZONE_KM = float(os.getenv('STATE_COASTAL_ZONE_KM', 300))
+
+# Most sub-queries one /batch request may hold
+BATCH_MAX_QUERIES = int(os.getenv('BATCH_MAX_QUERIES', 50))
+# How many different sub-queries of one /batch request are worked on at the same time
+BATCH_CONCURRENCY = int(os.getenv('BATCH_CONCURRENCY', 10))
+
+# Most connections each async Redis pool (text and bytes) opens per worker; requests beyond it wait for a free one
+REDIS_POOL_SIZE = int(os.getenv('REDIS_POOL_SIZE', 50))
+# How long a request waits for a free pooled Redis connection before treating Redis as down - in seconds
+REDIS_POOL_TIMEOUT = float(os.getenv('REDIS_POOL_TIMEOUT', 2))
+# How long one Redis command may take before it counts as failed - in seconds
+REDIS_SOCKET_TIMEOUT = float(os.getenv('REDIS_SOCKET_TIMEOUT', 2))
+
+# How often a failed USGS request is tried again (connection errors, timeouts, 5xx and 429 answers)
+USGS_RETRIES = int(os.getenv('USGS_RETRIES', 2))
+# Retry n waits a random time up to USGS_RETRY_BACKOFF * 2^n, at most USGS_RETRY_MAX_BACKOFF - in seconds
+USGS_RETRY_BACKOFF = float(os.getenv('USGS_RETRY_BACKOFF', 0.2))
+USGS_RETRY_MAX_BACKOFF = float(os.getenv('USGS_RETRY_MAX_BACKOFF', 2))
+# When USGS takes longer to answer than this percentile of its recent answers, send the same request again
+# and take whichever answers first (hedged request; 0 turns it off)
+USGS_HEDGE_PERCENTILE = float(os.getenv('USGS_HEDGE_PERCENTILE', 95))
+# How many recent answer times the percentile is taken from, and how many are needed before hedging starts
+USGS_HEDGE_WINDOW = int(os.getenv('USGS_HEDGE_WINDOW', 200))
+USGS_HEDGE_MIN_SAMPLES = int(os.getenv('USGS_HEDGE_MIN_SAMPLES', 20))
+# Never hedge sooner than this - in seconds
+USGS_HEDGE_MIN_DELAY = float(os.getenv('USGS_HEDGE_MIN_DELAY', 0.1))
+# After this many failed USGS requests in a row, stop asking (fail fast, or serve cached data) ...
+USGS_BREAKER_FAILURES = int(os.getenv('USGS_BREAKER_FAILURES', 5))
+# ... for this long, then let one trial request through to see whether USGS is back - in seconds
+USGS_BREAKER_RESET = float(os.getenv('USGS_BREAKER_RESET', 30))
+
+# Time budget of one request per route for everything it asks USGS, retries and hedges included - in seconds
+# (0 = no budget); a request running out of it is answered 504 (or with expired data, see CACHE_STALE_IF_ERROR)
+DEADLINE_EARTHQUAKE_SF = float(os.getenv('DEADLINE_EARTHQUAKE_SF', 20))
+DEADLINE_EARTHQUAKE_FELT = float(os.getenv('DEADLINE_EARTHQUAKE_FELT', 20))
+DEADLINE_TSUNAMI = float(os.getenv('DEADLINE_TSUNAMI', 30))
+ROUTE_DEADLINES = {
+    "earthquake/sf": DEADLINE_EARTHQUAKE_SF,
+    "earthquake-felt": DEADLINE_EARTHQUAKE_FELT,
+    "tsunami": DEADLINE_TSUNAMI,
+}
+
+# Most requests to USGS in flight at once, across all workers (shared through Redis; 0 = no limit)
+UPSTREAM_MAX_CONCURRENCY = int(os.getenv('UPSTREAM_MAX_CONCURRENCY', 50))
+# Requests per second we send USGS across all workers, with bursts of up to UPSTREAM_BURST (token bucket; 0 = no limit)
+# The burst is sized so several cold searches of WINDOW_MAX_BUCKETS buckets each fit in it at once
+UPSTREAM_RATE = float(os.getenv('UPSTREAM_RATE', 20))
+UPSTREAM_BURST = int(os.getenv('UPSTREAM_BURST', max(40, 5 * WINDOW_MAX_BUCKETS)))
+# A request slot not given back after this long is taken to belong to a crashed worker - in seconds
+UPSTREAM_SLOT_TTL = float(os.getenv('UPSTREAM_SLOT_TTL', 120))
+# How long a request waits for a slot or token before it is shed (503 with Retry-After) - in seconds
+UPSTREAM_QUEUE_WAIT = float(os.getenv('UPSTREAM_QUEUE_WAIT', 1))
+# Most requests each worker works on at the same time; more are shed right away with 503 (0 = no limit)
+ADMISSION_MAX_IN_FLIGHT = int(os.getenv('ADMISSION_MAX_IN_FLIGHT', 500))
+# Seconds shed requests are told to wait before trying again (Retry-After)
+SHED_RETRY_AFTER = int(os.getenv('SHED_RETRY_AFTER', 1))
+
+# Limit how many requests each client (API key, or IP address without one) makes per RATE_LIMIT_WINDOW seconds,
+# counted in a sliding window shared by all workers through Redis; more are answered 429
+RATE_LIMIT_ENABLED = os.getenv('RATE_LIMIT_ENABLED', 'true').lower() == 'true'
+RATE_LIMIT_REQUESTS = int(os.getenv('RATE_LIMIT_REQUESTS', 600))
+RATE_LIMIT_WINDOW = float(os.getenv('RATE_LIMIT_WINDOW', 60))
+# Header clients send their API key in
+RATE_LIMIT_KEY_HEADER = os.getenv('RATE_LIMIT_KEY_HEADER', 'X-API-Key')
+# Take the client's address from X-Forwarded-For (only behind a proxy that sets it)
+RATE_LIMIT_TRUST_FORWARDED = os.getenv('RATE_LIMIT_TRUST_FORWARDED', 'false').lower() == 'true'
+
+# Collect request, cache and upstream metrics for /metrics (Prometheus text format)
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', 'true').lower() == 'true'
+# How often each worker shares its metrics through Redis, so /metrics on any worker adds up all of them -
+# in seconds (a worker not heard from for three intervals is left out)
+METRICS_PUSH_INTERVAL = float(os.getenv('METRICS_PUSH_INTERVAL', 5))
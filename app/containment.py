@@ -0,0 +1,218 @@
+# This file lets us answer a strict search from a cached, looser one
+# Example: "M3.5+ within 100 km of SF" is just "M2.0+ within 100 km of SF" with a few events removed
+
+import json
+import math
+import time
+from app.config import CONTAINMENT_MIN_MAGNITUDE, CONTAINMENT_WIDEN
+from app.redis_client import redis_pool
+from app.columns import columns_of, stats as column_stats
+from app.logger import setup_logging
+
+# Start logging the information
+logger = setup_logging()
+
+# Search parameters we know how to tighten locally
+CONTAINMENT_PARAMS = ("minmagnitude", "maxradiuskm")
+
+# Cached variants this worker knows about: family key -> {(minmagnitude, maxradiuskm): expires_at}
+# (kept as the original strings so they rebuild exactly the same cache key)
+_variants = {}
+
+# Counters showing how often a cached superset saved an upstream call
+stats = {
+    "superset_hits": 0,     # Searches answered by filtering a cached wider search
+    "widened_fetches": 0,   # Misses fetched at a lower magnitude so later searches can share them
+}
+
+
+def family_key(clean_params: dict) -> str:
+    # Everything about a search except the filters we can tighten (same window, same centre...)
+    family = {k: v for k, v in clean_params.items() if k not in CONTAINMENT_PARAMS}
+    return f"usgs_variants:{json.dumps(family, sort_keys=True)}"
+
+
+def variant_of(clean_params: dict) -> tuple:
+    # The (minmagnitude, maxradiuskm) strings of a search, None when not given
+    return clean_params.get("minmagnitude"), clean_params.get("maxradiuskm")
+
+
+def limits_of(variant: tuple) -> tuple:
+    # The variant as numbers, with "not given" meaning "no limit"
+    min_mag, radius = variant
+    return (
+        -math.inf if min_mag is None else float(min_mag),
+        math.inf if radius is None else float(radius),
+    )
+
+
+def is_superset(candidate: tuple, wanted: tuple) -> bool:
+    # A lower magnitude floor and a bigger circle contain every event of the stricter search
+    candidate_mag, candidate_radius = limits_of(candidate)
+    wanted_mag, wanted_radius = limits_of(wanted)
+    return candidate_mag <= wanted_mag and candidate_radius >= wanted_radius
+
+
+def params_for(clean_params: dict, variant: tuple) -> dict:
+    # The search parameters of another variant in the same family
+    params = {k: v for k, v in clean_params.items() if k not in CONTAINMENT_PARAMS}
+    for name, value in zip(CONTAINMENT_PARAMS, variant):
+        if value is not None:
+            params[name] = value
+    return params
+
+
+"""
+def widen(clean_params: dict) -> dict:
+
+    Purpose: Picks what to actually ask USGS for on a miss
+    What it does:
+    - Lowers minmagnitude to CONTAINMENT_MIN_MAGNITUDE when the search asks for more
+    - Leaves everything else (and searches already below the floor) unchanged
+    Returns: The parameters to fetch - the same dict if nothing changes
+    Used for: Making every magnitude threshold for one window share a single upstream fetch
+"""
+def widen(clean_params: dict) -> dict:
+    if not CONTAINMENT_WIDEN or "minmagnitude" not in clean_params:
+        return clean_params
+    if float(clean_params["minmagnitude"]) <= CONTAINMENT_MIN_MAGNITUDE:
+        return clean_params
+    return dict(clean_params, minmagnitude=str(CONTAINMENT_MIN_MAGNITUDE))
+
+
+"""
+async def remember_variant(clean_params: dict, ttl: int):
+
+    Purpose: Records that the result of this search is now cached
+    What it does:
+    - Adds the variant to this worker's list for its family
+    - Adds it to a Redis set so other workers can find it too
+    Parameters:
+    - clean_params: The search that was just cached
+    - ttl: How long it stays cached, in seconds
+"""
+async def remember_variant(clean_params: dict, ttl: int):
+    family = family_key(clean_params)
+    variant = variant_of(clean_params)
+    _variants.setdefault(family, {})[variant] = time.monotonic() + ttl
+    client = redis_pool.client
+    if client:
+        try:
+            pipe = client.pipeline()
+            pipe.sadd(family, _variant_to_json(variant))
+            pipe.expire(family, ttl)
+            await pipe.execute()
+        except Exception as e:
+            logger.warning(f"⚠️ Could not record cached variant: {str(e)}")
+
+
+"""
+async def find_supersets(clean_params: dict) -> list:
+
+    Purpose: Lists cached searches in the same family that contain every answer to this one
+    Returns: Parameter dicts of the candidates, tightest first (least filtering work)
+"""
+async def find_supersets(clean_params: dict) -> list:
+    family = family_key(clean_params)
+    wanted = variant_of(clean_params)
+    now = time.monotonic()
+
+    known = _variants.get(family, {})
+    for variant, expires_at in list(known.items()):
+        if expires_at <= now:
+            del known[variant]
+    candidates = set(known)
+
+    client = redis_pool.client
+    if client:
+        try:
+            for member in await client.smembers(family):
+                candidates.add(_variant_from_json(member))
+        except Exception as e:
+            logger.warning(f"⚠️ Could not read cached variants: {str(e)}")
+
+    supersets = [v for v in candidates if v != wanted and is_superset(v, wanted)]
+    # Highest magnitude floor and smallest radius first - they need the least filtering
+    supersets.sort(key=lambda v: (-limits_of(v)[0], limits_of(v)[1]))
+    return [params_for(clean_params, v) for v in supersets]
+
+
+def distance_km(lat1, lon1, lat2, lon2) -> float:
+    # Great-circle distance between two points on Earth
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 6371.0 * 2 * math.asin(math.sqrt(min(1.0, a)))
+
+
+"""
+def local_filter(where: dict):
+
+    Purpose: Builds the check for filters USGS can't apply for us
+    What it does:
+    - "tsunami": keeps events flagged with a tsunami alert
+    - "minfelt": keeps events with at least that many felt reports
+    Returns: A feature -> bool function, or None when there is nothing to filter
+    Used for: Dropping unwanted events while the USGS response is still downloading
+"""
+def local_filter(where: dict):
+    if not where:
+        return None
+    checks = []
+    if where.get("tsunami"):
+        checks.append(lambda p: (p.get("tsunami") or 0) > 0)
+    if "minfelt" in where:
+        min_felt = int(where["minfelt"])
+        checks.append(lambda p: p.get("felt") is not None and int(p["felt"]) >= min_felt)
+    return lambda feature: all(check(feature["properties"]) for check in checks)
+
+
+"""
+def filter_to(data: dict, clean_params: dict, where: dict = None, cached: bool = True) -> dict:
+
+    Purpose: Cuts a cached superset down to the answer of a stricter search
+    What it does:
+    - Keeps events with magnitude >= minmagnitude (events without a magnitude are dropped, like USGS does)
+    - Keeps events within maxradiuskm of the search centre
+    - Applies the local filters in `where` (see local_filter)
+    - Runs as vectorized masks on the result's columnar copy when it can (see app/columns.py)
+    Parameters:
+    - cached: False for data made for this request only (a merged answer, a fresh USGS response):
+      it is filtered on a columnar copy only if one already exists, and none is built for it
+    Returns: A new FeatureCollection (the cached superset is left untouched)
+"""
+def filter_to(data: dict, clean_params: dict, where: dict = None, cached: bool = True) -> dict:
+    min_mag, radius = limits_of(variant_of(clean_params))
+    columns = columns_of(data, build=cached)
+    if columns is not None:
+        center = None
+        if "latitude" in clean_params and "longitude" in clean_params:
+            center = float(clean_params["latitude"]), float(clean_params["longitude"])
+        kept = columns.take(columns.mask(min_mag, center, radius, where))
+        column_stats["vectorized"] += 1
+        metadata = dict(data.get("metadata", {}))
+        metadata["count"] = len(kept)
+        return {"type": "FeatureCollection", "metadata": metadata, "features": kept.features}
+
+    features = data.get("features", [])
+    keep = local_filter(where)
+    if keep is not None:
+        features = [f for f in features if keep(f)]
+    if min_mag != -math.inf:
+        features = [f for f in features if f["properties"].get("mag") is not None and f["properties"]["mag"] >= min_mag]
+    if radius != math.inf and "latitude" in clean_params and "longitude" in clean_params:
+        lat, lon = float(clean_params["latitude"]), float(clean_params["longitude"])
+        features = [
+            f for f in features
+            if distance_km(lat, lon, f["geometry"]["coordinates"][1], f["geometry"]["coordinates"][0]) <= radius
+        ]
+    metadata = dict(data.get("metadata", {}))
+    metadata["count"] = len(features)
+    return {"type": "FeatureCollection", "metadata": metadata, "features": features}
+
+
+def _variant_to_json(variant: tuple) -> str:
+    return json.dumps(list(variant))
+
+
+def _variant_from_json(member) -> tuple:
+    return tuple(json.loads(member))
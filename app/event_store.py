@@ -0,0 +1,465 @@
+# This file keeps our own copy of every earthquake we got from USGS, in a local SQLite database
+# Searches the copy fully covers are answered from it in milliseconds, and it keeps us
+# answering (with what we have) when USGS is slow or down
+
+import asyncio
+import json
+import math
+import sqlite3
+import threading
+import time
+from datetime import datetime, timezone
+from app.config import (
+    EVENT_STORE_ENABLED,
+    EVENT_STORE_PATH,
+    EVENT_STORE_RETENTION_DAYS,
+    EVENT_STORE_PRUNE_INTERVAL,
+    BUCKET_SETTLE_SECONDS,
+    CACHE_DURATION,
+    INCREMENTAL_OVERLAP_SECONDS,
+)
+from app.cache import mark_stale
+from app import metrics
+from app.codec import dumps_json
+from app.containment import distance_km, local_filter
+from app.usgs_client import fetch_json
+from app.windows import parse_time, to_millis, format_time
+from app.logger import setup_logging
+
+# Start logging the information
+logger = setup_logging()
+
+# Searches made of only these parameters can be stored and answered locally
+STORABLE_PARAMS = {"format", "starttime", "endtime", "minmagnitude", "latitude", "longitude", "maxradiuskm"}
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS events (
+    id TEXT PRIMARY KEY,
+    time INTEGER NOT NULL,
+    updated INTEGER,
+    mag REAL,
+    lat REAL NOT NULL,
+    lon REAL NOT NULL,
+    felt INTEGER,
+    tsunami INTEGER,
+    feature BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS events_time ON events (time);
+CREATE INDEX IF NOT EXISTS events_mag ON events (mag);
+CREATE TABLE IF NOT EXISTS coverage (
+    min_mag REAL,
+    lat REAL,
+    lon REAL,
+    radius REAL,
+    tsunami_only INTEGER NOT NULL,
+    min_felt INTEGER,
+    start INTEGER NOT NULL,
+    end INTEGER NOT NULL,
+    synced_at INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS coverage_search ON coverage (min_mag, lat, lon, radius, start, end);
+CREATE INDEX IF NOT EXISTS coverage_window ON coverage (end, start);
+CREATE INDEX IF NOT EXISTS coverage_synced ON coverage (synced_at);
+"""
+
+# Events no stored search holds any more (nothing can read them): outside every search's window,
+# circle, magnitude floor or local filters (distance_km is registered on the connection, see EventStore)
+_UNCOVERED = """NOT EXISTS (SELECT 1 FROM coverage c WHERE c.end >= events.time AND c.start <= events.time
+    AND (c.min_mag IS NULL OR events.mag >= c.min_mag)
+    AND (c.radius IS NULL OR distance_km(c.lat, c.lon, events.lat, events.lon) <= c.radius)
+    AND (c.tsunami_only = 0 OR events.tsunami > 0)
+    AND (c.min_felt IS NULL OR events.felt >= c.min_felt))"""
+
+
+class EventStore:
+    """
+    SQLite store of USGS events keyed by event id, with indexes on time and magnitude and an
+    R-tree on latitude/longitude. Also records which searches (window, area, magnitude floor)
+    it holds completely, so it knows which searches it can answer on its own.
+    Searches not synced for EVENT_STORE_RETENTION_DAYS are forgotten by prune(), and so are the
+    events no remaining search holds (by window, area, magnitude and filters), so the database
+    doesn't grow forever.
+    All methods block; call them through asyncio.to_thread from async code.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.create_function("distance_km", 4, distance_km, deterministic=True)
+        self._db.executescript(_SCHEMA)
+        try:
+            self._db.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS events_rtree USING rtree(id, min_lat, max_lat, min_lon, max_lon)"
+            )
+            self.rtree = True
+        except sqlite3.OperationalError:
+            # SQLite built without R-tree support - a plain index does the job, just slower
+            self._db.execute("CREATE INDEX IF NOT EXISTS events_lat_lon ON events (lat, lon)")
+            self.rtree = False
+        self._db.commit()
+        self.hits = 0
+        self.fallbacks = 0
+        self.refreshes = 0
+        self.pruned_events = 0
+        self.pruned_at = 0
+
+    def add(self, clean_params: dict, data: dict, where: dict = None, synced_at: int = None):
+        # Store the events of a complete USGS answer (updates go through add_updates) and remember that the search is covered
+        search = _search_of(clean_params, where)
+        if search is None:
+            return
+        rows, deleted = [], []
+        for feature in data.get("features", []):
+            properties = feature["properties"]
+            if properties.get("status") == "deleted":
+                deleted.append((feature["id"],))
+                continue
+            coordinates = feature["geometry"]["coordinates"]
+            rows.append((
+                feature["id"], properties["time"], properties.get("updated"), properties.get("mag"),
+                coordinates[1], coordinates[0], properties.get("felt"), properties.get("tsunami"),
+                dumps_json(feature),
+            ))
+        synced_at = synced_at if synced_at is not None else int(time.time() * 1000)
+        with self._lock, self._db:
+            # Newer revisions of an event replace older ones, never the other way round
+            self._db.executemany("""
+                INSERT INTO events (id, time, updated, mag, lat, lon, felt, tsunami, feature)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(id) DO UPDATE SET
+                    time = excluded.time, updated = excluded.updated, mag = excluded.mag,
+                    lat = excluded.lat, lon = excluded.lon, felt = excluded.felt,
+                    tsunami = excluded.tsunami, feature = excluded.feature
+                WHERE excluded.updated IS NULL OR events.updated IS NULL OR excluded.updated >= events.updated
+            """, rows)
+            if self.rtree and deleted:
+                self._db.executemany(
+                    "DELETE FROM events_rtree WHERE id = (SELECT rowid FROM events WHERE id = ?)", deleted
+                )
+            self._db.executemany("DELETE FROM events WHERE id = ?", deleted)
+            if self.rtree and rows:
+                for start in range(0, len(rows), 500):
+                    ids = [row[0] for row in rows[start:start + 500]]
+                    self._db.execute(f"""
+                        INSERT OR REPLACE INTO events_rtree
+                        SELECT rowid, lat, lat, lon, lon FROM events WHERE id IN ({",".join("?" * len(ids))})
+                    """, ids)
+            # A refetch of the same search replaces its old coverage record
+            self._db.execute(
+                "DELETE FROM coverage WHERE min_mag IS ? AND lat IS ? AND lon IS ? AND radius IS ? "
+                "AND tsunami_only = ? AND min_felt IS ? AND start = ? AND end = ?",
+                (search["min_mag"], search["lat"], search["lon"], search["radius"], search["tsunami_only"],
+                 search["min_felt"], search["start"], search["end"]),
+            )
+            self._db.execute(
+                "INSERT INTO coverage VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (search["min_mag"], search["lat"], search["lon"], search["radius"], search["tsunami_only"],
+                 search["min_felt"], search["start"], search["end"], synced_at),
+            )
+
+    def add_updates(self, clean_params: dict, updates: dict, where: dict = None, synced_at: int = None):
+        # Store the changes to a search: events the search keeps, plus revisions and deletions of events
+        # already stored (an event revised out of the search still gets its new values); others are skipped
+        search = _search_of(clean_params, where)
+        if search is None:
+            return
+        features = updates.get("features", [])
+        ids = [feature["id"] for feature in features]
+        stored = set()
+        with self._lock:
+            for start in range(0, len(ids), 500):
+                chunk = ids[start:start + 500]
+                stored.update(row[0] for row in self._db.execute(
+                    f"SELECT id FROM events WHERE id IN ({','.join('?' * len(chunk))})", chunk))
+        keep = local_filter(where)
+        kept = [
+            feature for feature in features
+            if feature["id"] in stored
+            or (feature["properties"].get("status") != "deleted" and _keeps(search, feature)
+                and (keep is None or keep(feature)))
+        ]
+        self.add(clean_params, dict(updates, features=kept), where, synced_at)
+
+    def covers(self, clean_params: dict, where: dict = None, fresh: bool = True, now: int = None) -> bool:
+        # Do stored searches containing this one together span its whole window?
+        return self.last_synced(clean_params, where, fresh, now) is not None
+
+    def last_synced(self, clean_params: dict, where: dict = None, fresh: bool = False, now: int = None):
+        # When the stored searches spanning this one were synced (the oldest of them), or None if they don't
+        search = _search_of(clean_params, where)
+        if search is None:
+            return None
+        now = now if now is not None else int(time.time() * 1000)
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT min_mag, lat, lon, radius, tsunami_only, min_felt, start, end, synced_at FROM coverage "
+                "WHERE start <= ? AND end >= ? ORDER BY start",
+                (search["end"], search["start"]),
+            ).fetchall()
+        reached, oldest = search["start"], None
+        for min_mag, lat, lon, radius, tsunami_only, min_felt, start, end, synced_at in rows:
+            if not _contains(min_mag, lat, lon, radius, tsunami_only, min_felt, search):
+                continue
+            # A window that was still filling up when we synced it is only trusted for a short while
+            settled = end <= synced_at - BUCKET_SETTLE_SECONDS * 1000
+            if fresh and not settled and now - synced_at > CACHE_DURATION * 1000:
+                continue
+            if start > reached:
+                break
+            if end > reached:
+                reached = end
+                oldest = synced_at if oldest is None else min(oldest, synced_at)
+            if reached >= search["end"]:
+                return oldest if oldest is not None else synced_at
+        return None
+
+    def query(self, clean_params: dict, where: dict = None) -> dict:
+        # The stored answer to a search, shaped like a USGS response (newest first)
+        search = _search_of(clean_params, where)
+        sql = ["SELECT e.feature FROM events e"]
+        args = []
+        box = _bounding_box(search)
+        if box is not None and self.rtree:
+            sql.append("JOIN events_rtree r ON r.id = e.rowid AND r.min_lat >= ? AND r.max_lat <= ? "
+                       "AND r.min_lon >= ? AND r.max_lon <= ?")
+            args += box
+        sql.append("WHERE e.time BETWEEN ? AND ?")
+        args += [search["start"], search["end"]]
+        if box is not None and not self.rtree:
+            sql.append("AND e.lat BETWEEN ? AND ? AND e.lon BETWEEN ? AND ?")
+            args += box
+        if search["min_mag"] is not None:
+            sql.append("AND e.mag >= ?")
+            args.append(search["min_mag"])
+        sql.append("ORDER BY e.time DESC")
+        with self._lock:
+            rows = self._db.execute(" ".join(sql), args).fetchall()
+
+        features = [json.loads(row[0]) for row in rows]
+        if search["radius"] is not None:
+            features = [
+                f for f in features
+                if distance_km(search["lat"], search["lon"],
+                               f["geometry"]["coordinates"][1], f["geometry"]["coordinates"][0]) <= search["radius"]
+            ]
+        keep = local_filter(where)
+        if keep is not None:
+            features = [f for f in features if keep(f)]
+        metadata = {"generated": int(time.time() * 1000), "title": "USGS Earthquakes (local store)",
+                    "status": 200, "count": len(features)}
+        return {"type": "FeatureCollection", "metadata": metadata, "features": features}
+
+    def prune(self, now: int = None) -> int:
+        # Forget searches not synced for EVENT_STORE_RETENTION_DAYS, then the events no remaining search
+        # would return; returns how many events were dropped
+        now = now if now is not None else int(time.time() * 1000)
+        cutoff = now - int(EVENT_STORE_RETENTION_DAYS * 86400 * 1000)
+        with self._lock, self._db:
+            searches = self._db.execute("DELETE FROM coverage WHERE synced_at < ?", (cutoff,)).rowcount
+            if self.rtree:
+                self._db.execute(f"DELETE FROM events_rtree WHERE id IN (SELECT rowid FROM events WHERE {_UNCOVERED})")
+            events = self._db.execute(f"DELETE FROM events WHERE {_UNCOVERED}").rowcount
+        self.pruned_at = now
+        self.pruned_events += events
+        if searches or events:
+            logger.info(f"🧹 Pruned {searches} old searches and {events} events from the local event store")
+        return events
+
+    def stats(self) -> dict:
+        with self._lock:
+            events = self._db.execute("SELECT COUNT(*) FROM events").fetchone()[0]
+            coverage = self._db.execute("SELECT COUNT(*) FROM coverage").fetchone()[0]
+        return {"events": events, "covered_searches": coverage, "hits": self.hits, "fallbacks": self.fallbacks,
+                "refreshes": self.refreshes, "pruned_events": self.pruned_events}
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+def _search_of(clean_params: dict, where: dict = None):
+    # A search as numbers (None = no limit), or None if the store can't hold/answer it
+    if not set(clean_params) <= STORABLE_PARAMS or "starttime" not in clean_params or "endtime" not in clean_params:
+        return None
+    if ("maxradiuskm" in clean_params) != ("latitude" in clean_params and "longitude" in clean_params):
+        return None
+    where = where or {}
+    return {
+        "start": to_millis(parse_time(clean_params["starttime"])),
+        "end": to_millis(parse_time(clean_params["endtime"])),
+        "min_mag": float(clean_params["minmagnitude"]) if "minmagnitude" in clean_params else None,
+        "lat": float(clean_params["latitude"]) if "maxradiuskm" in clean_params else None,
+        "lon": float(clean_params["longitude"]) if "maxradiuskm" in clean_params else None,
+        "radius": float(clean_params["maxradiuskm"]) if "maxradiuskm" in clean_params else None,
+        "tsunami_only": 1 if where.get("tsunami") else 0,
+        "min_felt": int(where["minfelt"]) if "minfelt" in where else None,
+    }
+
+
+def _keeps(search: dict, feature: dict) -> bool:
+    # Would USGS return this event for the search? (window, magnitude floor and circle)
+    properties = feature["properties"]
+    if not search["start"] <= properties["time"] <= search["end"]:
+        return False
+    if search["min_mag"] is not None and (properties.get("mag") is None or properties["mag"] < search["min_mag"]):
+        return False
+    if search["radius"] is not None:
+        lon, lat = feature["geometry"]["coordinates"][:2]
+        return distance_km(search["lat"], search["lon"], lat, lon) <= search["radius"]
+    return True
+
+
+def _contains(min_mag, lat, lon, radius, tsunami_only, min_felt, search: dict) -> bool:
+    # Does a stored search hold every event of `search`? (lower floors, bigger area, fewer filters)
+    if min_mag is not None and (search["min_mag"] is None or min_mag > search["min_mag"]):
+        return False
+    if radius is not None and (search["radius"] is None or (lat, lon) != (search["lat"], search["lon"])
+                               or radius < search["radius"]):
+        return False
+    if tsunami_only and not search["tsunami_only"]:
+        return False
+    if min_felt is not None and (search["min_felt"] is None or min_felt > search["min_felt"]):
+        return False
+    return True
+
+
+def _bounding_box(search: dict):
+    # Latitude/longitude box around the search circle, for the spatial index (None = no circle or it wraps)
+    if search["radius"] is None:
+        return None
+    lat_delta = search["radius"] / 111.0
+    lon_delta = search["radius"] / (111.0 * max(math.cos(math.radians(search["lat"])), 0.01))
+    min_lon, max_lon = search["lon"] - lon_delta, search["lon"] + lon_delta
+    if min_lon < -180 or max_lon > 180 or abs(search["lat"]) + lat_delta > 90:
+        return None
+    return [search["lat"] - lat_delta, search["lat"] + lat_delta, min_lon, max_lon]
+
+
+# Opened on first use, so importing the app doesn't create a database file
+store = None
+
+
+def get_store():
+    global store
+    if store is None and EVENT_STORE_ENABLED:
+        store = EventStore(EVENT_STORE_PATH)
+        logger.info(f"🗄️ Opened local event store at {EVENT_STORE_PATH}")
+    return store
+
+
+"""
+async def read_covered(clean_params: dict, where: dict = None, fresh: bool = True):
+
+    Purpose: Answers a search from the local event store if the store holds all of it
+    Parameters:
+    - clean_params: USGS query parameters, all strings
+    - where: Local filters (see containment.local_filter)
+    - fresh: False to also accept windows synced long ago that were still changing (when USGS is down)
+    Returns: A GeoJSON FeatureCollection, or None if the store doesn't cover the search
+"""
+async def read_covered(clean_params: dict, where: dict = None, fresh: bool = True):
+    event_store = get_store()
+    if event_store is None:
+        return None
+    try:
+        if not await asyncio.to_thread(event_store.covers, clean_params, where, fresh):
+            if fresh:
+                metrics.inc("cache_lookups_total", "event_store", "miss")
+            return None
+        data = await asyncio.to_thread(event_store.query, clean_params, where)
+    except sqlite3.Error as e:
+        logger.warning(f"⚠️ Local event store read failed: {str(e)}")
+        return None
+    metrics.inc("cache_lookups_total", "event_store", "hit" if fresh else "stale")
+    if fresh:
+        event_store.hits += 1
+        logger.info("🗄️ Answered from the local event store")
+    else:
+        event_store.fallbacks += 1
+        mark_stale()
+        logger.warning("⚠️ USGS unavailable, answered from the local event store")
+    return data
+
+
+"""
+def updates_query(clean_params: dict, updated_after: datetime) -> dict:
+
+    Purpose: The USGS request for what changed in a search's window since `updated_after`
+    What it does:
+    - Keeps the window and the search's circle, so only events near the search come back
+      (not every event updated worldwide)
+    - Leaves out the magnitude floor, so an event whose magnitude went down below it shows up
+      and gets its new values instead of lingering with the old ones
+    - Includes deletions (`includedeleted`)
+    Returns: USGS query parameters, all strings
+    Used for: Refreshing stored searches (refresh_covered) and the ingester's incremental polls
+"""
+def updates_query(clean_params: dict, updated_after: datetime) -> dict:
+    params = {
+        "format": "geojson",
+        "starttime": clean_params["starttime"],
+        "endtime": clean_params["endtime"],
+        "updatedafter": format_time(updated_after),
+        "includedeleted": "true",
+    }
+    if "maxradiuskm" in clean_params:
+        for name in ("latitude", "longitude", "maxradiuskm"):
+            params[name] = str(clean_params[name])
+    return params
+
+
+"""
+async def refresh_covered(clean_params: dict, where: dict = None):
+
+    Purpose: Brings a search the store holds (but synced a while ago) up to date with only the changes
+    What it does:
+    - Finds when the stored copy of the search was last synced
+    - Asks USGS only for events in the window updated since then (`updatedafter`, minus
+      INCREMENTAL_OVERLAP_SECONDS because USGS takes a moment to index revisions), deletions included
+    - Merges new, revised and deleted events into the store by event id and marks the search synced now
+      (see updates_query for what is asked, EventStore.add_updates for what is kept)
+    Parameters:
+    - clean_params: USGS query parameters, all strings
+    - where: Local filters (see containment.local_filter)
+    Returns: The refreshed answer, or None if the store doesn't hold the search at all
+    Raises: httpx.HTTPError if USGS fails (the caller falls back to the stored copy)
+"""
+async def refresh_covered(clean_params: dict, where: dict = None):
+    event_store = get_store()
+    if event_store is None:
+        return None
+    try:
+        synced_at = await asyncio.to_thread(event_store.last_synced, clean_params, where)
+    except sqlite3.Error as e:
+        logger.warning(f"⚠️ Local event store read failed: {str(e)}")
+        return None
+    if synced_at is None:
+        return None
+
+    now = int(time.time() * 1000)
+    updated_after = datetime.fromtimestamp(synced_at / 1000 - INCREMENTAL_OVERLAP_SECONDS, timezone.utc)
+    updates = await fetch_json(updates_query(clean_params, updated_after))
+    try:
+        await asyncio.to_thread(event_store.add_updates, clean_params, updates, where, now)
+        data = await asyncio.to_thread(event_store.query, clean_params, where)
+    except sqlite3.Error as e:
+        logger.warning(f"⚠️ Local event store refresh failed: {str(e)}")
+        return None
+    event_store.refreshes += 1
+    logger.info(f"🔄 Refreshed a stored window with {len(updates.get('features', []))} updated events")
+    return data
+
+
+async def remember(clean_params: dict, data: dict, where: dict = None):
+    # Keep a fresh USGS answer in the local store (best effort - a failure only costs us the copy),
+    # pruning old searches every EVENT_STORE_PRUNE_INTERVAL seconds
+    event_store = get_store()
+    if event_store is None:
+        return
+    try:
+        await asyncio.to_thread(event_store.add, clean_params, data, where)
+        if time.time() * 1000 - event_store.pruned_at >= EVENT_STORE_PRUNE_INTERVAL * 1000:
+            await asyncio.to_thread(event_store.prune)
+    except sqlite3.Error as e:
+        logger.warning(f"⚠️ Local event store write failed: {str(e)}")
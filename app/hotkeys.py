@@ -0,0 +1,312 @@
+# This file keeps track of which route queries are requested the most and refreshes the most popular ones
+# shortly before their cached answers expire, so the busiest dashboard searches (practically) never miss
+# Popularity is a counter per query (route + parameters, any format) that halves every HOT_KEY_HALF_LIFE
+# seconds, shared between workers in a Redis sorted set (or kept in this worker only when Redis is unavailable)
+# Every request counts, response cache hits included; the cached USGS searches a query was built from are
+# remembered with it, so the refresher knows what to fetch again
+
+import asyncio
+import contextvars
+import json
+import time
+import uuid
+from app.config import (
+    HOT_KEYS_ENABLED,
+    HOT_KEY_HALF_LIFE,
+    HOT_KEY_TOP_N,
+    HOT_KEY_MAX_TRACKED,
+    HOT_KEY_REFRESH_INTERVAL,
+    HOT_KEY_REFRESH_AHEAD,
+    FETCH_CONCURRENCY,
+)
+from app.redis_client import redis_pool
+from app.chunking import gather_limited
+from app.ingester import is_leader, release_leadership
+from app.logger import setup_logging
+
+# Start logging the information
+logger = setup_logging()
+
+SCORES_KEY = "hot_keys:scores"      # Sorted set: query key -> popularity (scaled, see below)
+SEARCHES_KEY = "hot_keys:searches"  # Hash: query key -> the query and the searches behind it, as JSON
+EPOCH_KEY = "hot_keys:epoch"        # Unix time the scores are scaled to
+LEADER_KEY = "hot_keys:leader"      # Lock held by the one worker refreshing hot queries
+
+# Instead of decaying every counter all the time, a request at time t adds 2^((t - epoch) / half life).
+# Dividing a score by 2^((now - epoch) / half life) gives the decayed count, and the order of the
+# searches is the same either way. Once the weights get big, everything is scaled back down.
+_MAX_EXPONENT = 32
+
+# Adds a batch of requests: KEYS = scores, searches, epoch; ARGV = now, half life, max tracked,
+# then (query key, requests, query or '' if unchanged) for every query. Returns the epoch.
+_ADD_SCRIPT = """
+local now = tonumber(ARGV[1])
+local half_life = tonumber(ARGV[2])
+local epoch = tonumber(redis.call('get', KEYS[3]))
+if not epoch then
+    epoch = now
+    redis.call('set', KEYS[3], ARGV[1])
+end
+local exponent = (now - epoch) / half_life
+if exponent > %d then
+    local factor = 2 ^ -exponent
+    local members = redis.call('zrange', KEYS[1], 0, -1, 'withscores')
+    for i = 1, #members, 2 do
+        redis.call('zadd', KEYS[1], tonumber(members[i + 1]) * factor, members[i])
+    end
+    epoch = now
+    exponent = 0
+    redis.call('set', KEYS[3], ARGV[1])
+end
+local weight = 2 ^ exponent
+for i = 4, #ARGV, 3 do
+    redis.call('zincrby', KEYS[1], tonumber(ARGV[i + 1]) * weight, ARGV[i])
+    if ARGV[i + 2] ~= '' then
+        redis.call('hset', KEYS[2], ARGV[i], ARGV[i + 2])
+    end
+end
+local extra = redis.call('zcard', KEYS[1]) - tonumber(ARGV[3])
+if extra > 0 then
+    local dropped = redis.call('zrange', KEYS[1], 0, extra - 1)
+    redis.call('zremrangebyrank', KEYS[1], 0, extra - 1)
+    redis.call('hdel', KEYS[2], unpack(dropped))
+end
+return tostring(epoch)
+""" % _MAX_EXPONENT
+
+# Counters showing what hot-key tracking did in this worker
+stats = {
+    "leader": False,        # Whether this worker is the one refreshing hot queries
+    "requests_counted": 0,  # Requests counted towards popularity (response cache hits included)
+    "flushes": 0,           # Batches of counts written to Redis (or the local counters)
+    "checks": 0,            # Hot searches checked for freshness
+    "refreshes": 0,         # Hot queries fetched again before they expired
+    "refresh_errors": 0,    # Refreshes that failed
+}
+
+# Requests counted since the last flush: query key -> [requests, query as JSON or '' if unchanged]
+_pending = {}
+
+# Set while a response is built; the cached searches it reads are noted here (see note_search)
+_searches = contextvars.ContextVar("hot_key_searches", default=None)
+
+# Used instead of Redis when it is unavailable
+_local_scores = {}
+_local_searches = {}
+_local_epoch = None
+
+_task = None
+_token = uuid.uuid4().hex
+
+
+def track_searches() -> dict:
+    # Start noting the cached searches the current response is built from: cache key -> search
+    searches = {}
+    _searches.set(searches)
+    return searches
+
+
+def note_search(cache_key: str, clean_params: dict, ttl: int, where: dict = None):
+    # Note a cached search the response being built reads (nothing happens outside of a build)
+    searches = _searches.get()
+    if searches is not None and cache_key not in searches:
+        searches[cache_key] = {"params": clean_params, "ttl": ttl, "where": where}
+
+
+"""
+def record_access(key: str, query: dict = None):
+
+    Purpose: Counts one request for a route query towards its popularity
+    What it does:
+    - Adds it to a small in-process batch (written out by flush), so requests don't wait on Redis
+    - With `query` (known after the response was built), also remembers the query and the searches
+      behind it, so the refresher can fetch them again; a cache hit only counts
+    Parameters:
+    - key: The query's key (route + parameters, see response_cache.query_key)
+    - query: {"route", "params", "searches": [{"params", "ttl", "where"}, ...]}
+"""
+def record_access(key: str, query: dict = None):
+    if not HOT_KEYS_ENABLED:
+        return
+    stats["requests_counted"] += 1
+    entry = _pending.get(key)
+    if entry is None:
+        entry = _pending[key] = [0, ""]
+    entry[0] += 1
+    if query is not None:
+        entry[1] = json.dumps(query, sort_keys=True, default=str)
+
+
+def reset():
+    # Forget every count kept in this worker
+    global _local_epoch
+    _pending.clear()
+    _local_scores.clear()
+    _local_searches.clear()
+    _local_epoch = None
+
+
+def _add_locally(batch: dict, now: float):
+    # The same as _ADD_SCRIPT, for this worker only
+    global _local_epoch
+    if _local_epoch is None:
+        _local_epoch = now
+    exponent = (now - _local_epoch) / HOT_KEY_HALF_LIFE
+    if exponent > _MAX_EXPONENT:
+        factor = 2 ** -exponent
+        for cache_key in _local_scores:
+            _local_scores[cache_key] *= factor
+        _local_epoch, exponent = now, 0
+    weight = 2 ** exponent
+    for key, (requests, query) in batch.items():
+        _local_scores[key] = _local_scores.get(key, 0.0) + requests * weight
+        if query:
+            _local_searches[key] = query
+    if len(_local_scores) > HOT_KEY_MAX_TRACKED:
+        for key in sorted(_local_scores, key=_local_scores.get)[:len(_local_scores) - HOT_KEY_MAX_TRACKED]:
+            del _local_scores[key]
+            _local_searches.pop(key, None)
+
+
+"""
+async def flush(now: float = None):
+
+    Purpose: Writes the requests counted since the last flush into the shared popularity counters
+    What it does:
+    - Adds the batch to the Redis sorted set in one script call (decaying, see _ADD_SCRIPT)
+    - Forgets the least popular queries beyond HOT_KEY_MAX_TRACKED
+    - Uses this worker's own counters if Redis is unavailable
+    Parameters:
+    - now: Current unix time (tests pass their own)
+"""
+async def flush(now: float = None):
+    global _pending
+    if not _pending:
+        return
+    now = time.time() if now is None else now
+    batch, _pending = _pending, {}
+    stats["flushes"] += 1
+    client = redis_pool.client
+    if client:
+        args = [now, HOT_KEY_HALF_LIFE, HOT_KEY_MAX_TRACKED]
+        for key, (requests, query) in batch.items():
+            args += [key, requests, query]
+        try:
+            await client.eval(_ADD_SCRIPT, 3, SCORES_KEY, SEARCHES_KEY, EPOCH_KEY, *args)
+            return
+        except Exception as e:
+            logger.warning(f"⚠️ Could not write hot-key counts to Redis, counting locally: {str(e)}")
+    _add_locally(batch, now)
+
+
+"""
+async def hot_keys(limit: int = HOT_KEY_TOP_N, now: float = None) -> list:
+
+    Purpose: Lists the most popular route queries right now
+    Parameters:
+    - limit: How many to return
+    - now: Current unix time (tests pass their own)
+    Returns: List of {"key", "score", "route", "params", "searches"}, most popular first;
+             "score" is roughly the number of requests in the last HOT_KEY_HALF_LIFE seconds, decayed
+             (queries counted only by cache hits, whose searches no worker has noted yet, are left out)
+"""
+async def hot_keys(limit: int = HOT_KEY_TOP_N, now: float = None) -> list:
+    now = time.time() if now is None else now
+    ranked = None
+    client = redis_pool.client
+    if client:
+        try:
+            pipe = client.pipeline()
+            pipe.get(EPOCH_KEY)
+            pipe.zrevrange(SCORES_KEY, 0, limit - 1, withscores=True)
+            epoch, ranked = await pipe.execute()
+            searches = await client.hmget(SEARCHES_KEY, [key for key, _ in ranked]) if ranked else []
+            epoch = float(epoch) if epoch else now
+        except Exception as e:
+            logger.warning(f"⚠️ Could not read hot keys from Redis: {str(e)}")
+            ranked = None
+    if ranked is None:
+        ranked = sorted(_local_scores.items(), key=lambda item: item[1], reverse=True)[:limit]
+        searches = [_local_searches.get(key) for key, _ in ranked]
+        epoch = _local_epoch if _local_epoch is not None else now
+
+    decay = 2 ** -((now - epoch) / HOT_KEY_HALF_LIFE)
+    result = []
+    for (key, score), query in zip(ranked, searches):
+        if not query:
+            continue
+        result.append({"key": key, "score": round(score * decay, 3), **json.loads(query)})
+    return result
+
+
+"""
+async def refresh_hot_keys(refresh, now: float = None) -> int:
+
+    Purpose: Refreshes the most popular route queries that are about to expire
+    What it does:
+    - Writes out the counted requests, then takes the HOT_KEY_TOP_N most popular queries
+    - Calls `refresh` for each of them (at most FETCH_CONCURRENCY at a time); it fetches the
+      query's searches again only if they have less than HOT_KEY_REFRESH_AHEAD seconds of freshness left
+    Parameters:
+    - refresh: Coroutine function (query, ahead) -> bool, see response_cache.refresh_query
+    - now: Current unix time (tests pass their own)
+    Returns: Number of queries fetched again
+"""
+async def refresh_hot_keys(refresh, now: float = None) -> int:
+    await flush(now)
+    hot = await hot_keys(HOT_KEY_TOP_N, now)
+
+    async def refresh_one(query: dict) -> bool:
+        try:
+            return await refresh(query, HOT_KEY_REFRESH_AHEAD)
+        except Exception as e:
+            # The query just gets fetched by the next request that misses, like any other
+            stats["refresh_errors"] += 1
+            logger.warning(f"⚠️ Refreshing a hot query failed: {str(e)}")
+            return False
+
+    refreshed = sum(await gather_limited([refresh_one(query) for query in hot], FETCH_CONCURRENCY))
+    stats["checks"] += len(hot)
+    stats["refreshes"] += refreshed
+    return refreshed
+
+
+async def run_refresher(refresh, token: str):
+    # Check the hot queries every HOT_KEY_REFRESH_INTERVAL seconds for as long as the app runs, whenever
+    # we hold the refresher's leader lock (every other worker only counts requests)
+    while True:
+        await asyncio.sleep(HOT_KEY_REFRESH_INTERVAL)
+        stats["leader"] = await is_leader(token, LEADER_KEY)
+        if not stats["leader"]:
+            await flush()
+            continue
+        try:
+            refreshed = await refresh_hot_keys(refresh)
+            if refreshed:
+                logger.info(f"🔥 Refreshed {refreshed} hot queries ahead of expiry")
+        except Exception as e:
+            logger.warning(f"⚠️ Hot-key refresh failed: {str(e)}")
+
+
+def start_refresher(refresh):
+    # Called from the app's lifespan, after the USGS client is open
+    global _task
+    if not HOT_KEYS_ENABLED or _task is not None:
+        return
+    _task = asyncio.create_task(run_refresher(refresh, _token))
+    logger.info(f"🔥 Hot-key refresher started (every {HOT_KEY_REFRESH_INTERVAL:g}s)")
+
+
+async def stop_refresher():
+    global _task
+    if _task is None:
+        return
+    _task.cancel()
+    try:
+        await _task
+    except asyncio.CancelledError:
+        pass
+    _task = None
+    if stats["leader"]:
+        await release_leadership(_token, LEADER_KEY)
+        stats["leader"] = False
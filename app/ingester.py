@@ -0,0 +1,263 @@
+# This file runs a background task that polls USGS for the recent events of our busiest searches
+# and writes them into the cache, so user requests for recent windows are hits instead of waiting on USGS
+# Only one worker in the deployment polls at a time (whoever holds a Redis lock)
+
+import asyncio
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from app.config import (
+    INGEST_ENABLED,
+    INGEST_INTERVAL,
+    INGEST_LOOKBACK_DAYS,
+    INGEST_LEADER_TTL,
+    BUCKET_SETTLE_SECONDS,
+    INCREMENTAL_OVERLAP_SECONDS,
+)
+from app.cache import make_cache_key, get_cached, set_cached
+from app.containment import remember_variant, filter_to
+from app.usgs_client import fetch_json
+from app.redis_client import redis_pool
+from app.windows import floor_time, next_boundary, format_time, to_millis, bucket_ttl, merge_updates
+from app import event_store, tsunami_index
+from app.logger import setup_logging
+
+# Start logging the information
+logger = setup_logging()
+
+# The searches we keep warm, written exactly like the routes write them (so the cache keys match)
+# (tsunami requests are answered from the tsunami index, which tsunami_index.sync keeps up to date)
+FEEDS = {
+    # /earthquake/sf and /earthquake-felt: M2.0+ within 100 km of San Francisco
+    "sf": {"format": "geojson", "minmagnitude": "2.0", "latitude": "37.7749",
+           "longitude": "-122.4194", "maxradiuskm": "100"},
+}
+
+# Bucket sizes recent windows are cut into (see windows.split_window)
+WARM_UNITS = ("hour", "day")
+
+LEADER_KEY = "ingester:leader"
+
+# Extend the lock only if we still hold it
+_RENEW_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('pexpire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+# Give the lock up only if we still hold it
+_RELEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+# Counters showing what the ingester did in this worker
+stats = {
+    "leader": False,        # Whether this worker is the one polling right now
+    "polls": 0,             # Completed polls (all feeds)
+    "incremental_polls": 0, # Feed polls that only asked for the events updated since the last one
+    "events": 0,            # Events received from USGS, over all polls
+    "buckets_warmed": 0,    # Cache entries written
+    "errors": 0,            # Polls that failed
+}
+
+_task = None
+_token = uuid.uuid4().hex
+
+# The last answer of every feed: feed name -> (window start, FeatureCollection, unix time we asked USGS)
+_synced = {}
+
+
+"""
+async def is_leader(token: str) -> bool:
+
+    Purpose: Decides whether this worker should poll USGS right now
+    What it does:
+    - Without Redis there is nobody to share with, so we always poll
+    - Tries to take the leader lock (SET NX with an expiry); if we already hold it, extends it
+    - If Redis fails we poll anyway - a few duplicate polls are better than cold caches
+    Parameters:
+    - token: This worker's unique id, stored as the lock's value
+    - key: The lock (other background jobs with one worker at a time, like the hot-key refresher, pass their own)
+    Returns: True if this worker is the leader
+"""
+async def is_leader(token: str, key: str = LEADER_KEY) -> bool:
+    client = redis_pool.client
+    if not client:
+        return True
+    ttl = INGEST_LEADER_TTL * 1000
+    try:
+        if await client.set(key, token, nx=True, px=ttl):
+            logger.info(f"👑 This worker now holds {key}")
+            return True
+        return bool(await client.eval(_RENEW_SCRIPT, 1, key, token, ttl))
+    except Exception as e:
+        logger.warning(f"⚠️ Could not check {key}, going ahead anyway: {str(e)}")
+        return True
+
+
+async def release_leadership(token: str, key: str = LEADER_KEY):
+    # Let another worker take over right away instead of waiting for the lock to expire
+    client = redis_pool.client
+    if not client:
+        return
+    try:
+        await client.eval(_RELEASE_SCRIPT, 1, key, token)
+    except Exception as e:
+        logger.warning(f"⚠️ Could not release {key}: {str(e)}")
+
+
+def _slice(data: dict, start: datetime, end: datetime) -> dict:
+    # The part of a USGS answer that falls in [start, end], shaped like USGS' answer for that window
+    start_ms, end_ms = to_millis(start), to_millis(end)
+    features = [f for f in data.get("features", []) if start_ms <= f["properties"]["time"] <= end_ms]
+    metadata = dict(data.get("metadata", {}))
+    metadata.pop("url", None)
+    metadata["count"] = len(features)
+    return {"type": "FeatureCollection", "metadata": metadata, "features": features}
+
+
+"""
+async def warm_buckets(feed: dict, data: dict, start: datetime, end: datetime, now: datetime,
+                       changed: list = None) -> int:
+
+    Purpose: Writes a freshly polled window into the cache as the buckets user requests look up
+    What it does:
+    - Cuts the window into hour and day buckets (the sizes recent windows are split into)
+    - Caches every bucket that has started under the same key a user request would use,
+      and records it as a cached variant so stricter searches can be filtered from it
+    - Skips buckets that have settled and are still cached, unless one of their events just changed
+    Parameters:
+    - feed: The feed's USGS parameters without starttime/endtime
+    - data: USGS answer for the whole window
+    - start, end: The polled window, aligned to whole days
+    - now: Current time
+    - changed: Times (ms) of the events that changed since the last poll
+    Returns: Number of buckets written
+"""
+async def warm_buckets(feed: dict, data: dict, start: datetime, end: datetime, now: datetime,
+                       changed: list = None) -> int:
+    changed = changed or []
+    warmed = 0
+    for unit in WARM_UNITS:
+        bucket_start = start
+        while bucket_start < end and bucket_start <= now:
+            bucket_end = next_boundary(bucket_start, unit)
+            bucket_params = dict(feed, starttime=format_time(bucket_start), endtime=format_time(bucket_end))
+            cache_key = make_cache_key(bucket_params)
+            ttl = bucket_ttl(bucket_end, now)
+            settled = bucket_end <= now - timedelta(seconds=BUCKET_SETTLE_SECONDS)
+            touched = any(to_millis(bucket_start) <= t <= to_millis(bucket_end) for t in changed)
+            if not settled or touched or await get_cached(cache_key) is None:
+                await set_cached(cache_key, _slice(data, bucket_start, bucket_end), ttl)
+                await remember_variant(bucket_params, ttl)
+                warmed += 1
+            bucket_start = bucket_end
+    return warmed
+
+
+"""
+async def ingest_once(now: datetime = None) -> int:
+
+    Purpose: Polls USGS once for every feed and warms the cache with the answers
+    What it does:
+    - Asks USGS for the last INGEST_LOOKBACK_DAYS days of each feed (one request per feed)
+    - After the first poll of a window, only asks for the events updated since the previous poll
+      (`updatedafter`, deletions included) and merges them into the previous answer by event id
+    - Writes the hour and day buckets into the cache (see warm_buckets)
+    - Keeps the events in the local event store as well
+    Parameters:
+    - now: Current time (tests pass a time inside their fake catalog)
+    Returns: Number of events received
+"""
+async def ingest_once(now: datetime = None) -> int:
+    now = now or datetime.now(timezone.utc)
+    start = floor_time(now, "day") - timedelta(days=INGEST_LOOKBACK_DAYS - 1)
+    end = next_boundary(floor_time(now, "day"), "day")
+
+    async def poll(name: str, feed: dict) -> int:
+        params = dict(feed, starttime=format_time(start), endtime=format_time(end))
+        synced_at = time.time()
+        last = _synced.get(name)
+        if last is None or last[0] != start:
+            # First poll, or the window moved on to a new day - get the whole window
+            data = received = await fetch_json(params)
+            stored, changed = data, []
+        else:
+            # Only what changed near the feed since the last poll; without its magnitude floor, so an
+            # event revised out of the feed (its magnitude went down) shows up and gets dropped
+            updated_after = datetime.fromtimestamp(last[2] - INCREMENTAL_OVERLAP_SECONDS, timezone.utc)
+            received = await fetch_json(event_store.updates_query(params, updated_after))
+            in_feed = {f["id"] for f in filter_to(received, feed, cached=False)["features"]}
+            data = merge_updates(last[1], received, keep=lambda f: f["id"] in in_feed)
+            # The local store gets the whole answer plus the deletions and revisions of the events that were
+            # in it, so it can drop or update those too (events that were never in the feed aren't stored)
+            before = {f["id"]: f["properties"]["time"] for f in last[1]["features"]}
+            dropped = [f for f in received["features"]
+                       if f["id"] in before and (f["id"] not in in_feed or f["properties"].get("status") == "deleted")]
+            stored = dict(data, features=data["features"] + dropped)
+            # Buckets holding a changed event need rewriting - where it is now and where it was before
+            changed = [f["properties"]["time"] for f in received["features"]]
+            changed += [before[f["id"]] for f in received["features"] if f["id"] in before]
+            stats["incremental_polls"] += 1
+        _synced[name] = (start, data, synced_at)
+        stats["buckets_warmed"] += await warm_buckets(feed, data, start, end, now, changed)
+        await event_store.remember(params, stored)
+        return len(received.get("features", []))
+
+    events = sum(await asyncio.gather(*(poll(name, feed) for name, feed in FEEDS.items())))
+    stats["polls"] += 1
+    stats["events"] += events
+    return events
+
+
+async def run_ingester(token: str):
+    # Poll every INGEST_INTERVAL seconds for as long as the app runs, whenever we are the leader
+    while True:
+        leader = await is_leader(token)
+        if stats["leader"] and not leader:
+            logger.info("👑 Another worker took over the ingester")
+        stats["leader"] = leader
+        if leader:
+            try:
+                events = await ingest_once()
+                logger.info(f"📥 Ingested {events} recent events from USGS")
+            except Exception as e:
+                # A failed poll only means user requests fetch for themselves until the next one
+                stats["errors"] += 1
+                logger.warning(f"⚠️ Ingester poll failed: {str(e)}")
+            if tsunami_index.sync_due():
+                try:
+                    await tsunami_index.sync()
+                except Exception as e:
+                    # Tsunami requests the index can't answer go to USGS until the next sync
+                    tsunami_index.stats["errors"] += 1
+                    logger.warning(f"⚠️ Tsunami index sync failed: {str(e)}")
+        await asyncio.sleep(INGEST_INTERVAL)
+
+
+def start_ingester():
+    # Called from the app's lifespan, after the USGS client is open
+    global _task
+    if not INGEST_ENABLED or _task is not None:
+        return
+    _task = asyncio.create_task(run_ingester(_token))
+    logger.info(f"📥 Ingester started (every {INGEST_INTERVAL:g}s)")
+
+
+async def stop_ingester():
+    global _task
+    if _task is None:
+        return
+    _task.cancel()
+    try:
+        await _task
+    except asyncio.CancelledError:
+        pass
+    _task = None
+    if stats["leader"]:
+        await release_leadership(_token)
+        stats["leader"] = False
@@ -0,0 +1,153 @@
+# This file reads and writes big GeoJSON FeatureCollections a piece at a time:
+# - reading: turns the USGS response into features while it is still downloading, optionally
+#   dropping the ones a route doesn't want, so the whole body never sits in memory at once
+# - writing: sends our JSON answer a batch of features at a time
+
+import codecs
+import json
+import re
+from app.codec import dumps_json
+from app.config import JSON_CHUNK_SIZE
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+
+class FeatureCollectionParser:
+    """
+    Incremental parser for a GeoJSON FeatureCollection.
+    Feed it the response body chunk by chunk; every complete feature is decoded (and filtered)
+    as soon as it has arrived, and only the not-yet-complete tail of the body is kept.
+    """
+
+    def __init__(self, keep=None):
+        self.keep = keep                  # Optional feature -> bool check; features failing it are dropped
+        self.result = {}
+        self.features = []
+        self.parsed = 0                   # Features seen, before filtering
+        self._decoder = json.JSONDecoder()
+        self._text = codecs.getincrementaldecoder("utf-8")()
+        self._buffer = ""
+        self._pos = 0
+        self._state = "start"
+        self._key = None
+
+    def feed(self, chunk: bytes, final: bool = False):
+        self._buffer = self._buffer[self._pos:] + self._text.decode(chunk, final)
+        self._pos = 0
+        self._scan(final)
+
+    def close(self) -> dict:
+        # Call after the last chunk; returns the parsed collection
+        self.feed(b"", final=True)
+        if self._state != "done":
+            raise ValueError("USGS response ended before the FeatureCollection was complete")
+        if self.keep is not None and isinstance(self.result.get("metadata"), dict):
+            self.result["metadata"]["count"] = len(self.features)
+        return self.result
+
+    def _skip_whitespace(self) -> bool:
+        # Moves past whitespace; False if we ran out of text
+        self._pos = _WHITESPACE.match(self._buffer, self._pos).end()
+        return self._pos < len(self._buffer)
+
+    def _decode(self):
+        # The next complete JSON value, or None if it hasn't fully arrived yet
+        try:
+            value, end = self._decoder.raw_decode(self._buffer, self._pos)
+        except json.JSONDecodeError:
+            return None
+        return value, end
+
+    def _scan(self, final: bool):
+        while self._state != "done" and self._skip_whitespace():
+            char = self._buffer[self._pos]
+
+            if self._state == "start":
+                if char != "{":
+                    raise ValueError("USGS response is not a JSON object")
+                self._pos += 1
+                self._state = "key"
+
+            elif self._state == "key":
+                if char == "}":
+                    self._pos += 1
+                    self._state = "done"
+                elif char == ",":
+                    self._pos += 1
+                else:
+                    decoded = self._decode()
+                    if decoded is None:
+                        return
+                    self._key, self._pos = decoded
+                    self._state = "colon"
+
+            elif self._state == "colon":
+                if char != ":":
+                    raise ValueError("Malformed USGS response")
+                self._pos += 1
+                self._state = "features" if self._key == "features" else "value"
+
+            elif self._state == "value":
+                decoded = self._decode()
+                if decoded is None:
+                    return
+                value, end = decoded
+                # A number at the very end of what we have may still continue in the next chunk
+                if _WHITESPACE.match(self._buffer, end).end() == len(self._buffer) and not final:
+                    return
+                self.result[self._key] = value
+                self._pos = end
+                self._state = "key"
+
+            elif self._state == "features":
+                if char != "[":
+                    raise ValueError("USGS features are not a list")
+                self._pos += 1
+                self.result["features"] = self.features
+                self._state = "feature"
+
+            elif self._state == "feature":
+                if char == "]":
+                    self._pos += 1
+                    self._state = "key"
+                elif char == ",":
+                    self._pos += 1
+                else:
+                    decoded = self._decode()
+                    if decoded is None:
+                        return
+                    feature, self._pos = decoded
+                    self.parsed += 1
+                    if self.keep is None or self.keep(feature):
+                        self.features.append(feature)
+
+
+"""
+def iter_json(data: dict):
+
+    Purpose: Writes response data as JSON in chunks
+    What it does:
+    - Writes everything except the features list as usual
+    - Writes the features one at a time, handing out roughly JSON_CHUNK_SIZE bytes at once
+    Returns: Generator of byte chunks that join up to exactly dumps_json(data)
+    Used for: Streaming big JSON answers without one giant encoded copy in memory
+"""
+def iter_json(data: dict):
+    chunk, size, first = [b"{"], 0, True
+    for key, value in data.items():
+        chunk.append((b"" if first else b",") + dumps_json(key) + b":")
+        first = False
+        if key != "features" or not isinstance(value, list):
+            chunk.append(dumps_json(value))
+            continue
+        chunk.append(b"[")
+        for index, feature in enumerate(value):
+            encoded = dumps_json(feature)
+            chunk.append(encoded if index == 0 else b"," + encoded)
+            size += len(encoded)
+            if size >= JSON_CHUNK_SIZE:
+                yield b"".join(chunk)
+                chunk, size = [], 0
+        chunk.append(b"]")
+    chunk.append(b"}")
+    yield b"".join(chunk)
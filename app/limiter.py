@@ -0,0 +1,268 @@
+# This file keeps bursts from piling up: a limit on requests to USGS shared by every worker
+# (token bucket + concurrency slots, one atomic Redis script per request) and admission control
+# that sheds requests with 503 + Retry-After when a worker is already busy, instead of queueing them
+# Without Redis every worker applies the limits on its own
+
+import asyncio
+import math
+import random
+import time
+import uuid
+from contextlib import asynccontextmanager
+import httpx
+from app.config import (
+    UPSTREAM_MAX_CONCURRENCY,
+    UPSTREAM_RATE,
+    UPSTREAM_BURST,
+    UPSTREAM_SLOT_TTL,
+    UPSTREAM_QUEUE_WAIT,
+    ADMISSION_MAX_IN_FLIGHT,
+    SHED_RETRY_AFTER,
+)
+from app.redis_client import redis_pool
+from app.logger import setup_logging
+
+# Start logging the information
+logger = setup_logging()
+
+SLOTS_KEY = "upstream:usgs:slots"    # Sorted set: holder -> when its slot expires (ms)
+BUCKET_KEY = "upstream:usgs:bucket"  # Hash: tokens left and when they were last counted (ms)
+
+# Requests that are never shed here nor rate limited (app/ratelimit.py), since checks and counters must
+# work while we're busy: the health check at "/" exactly, and everything under these prefixes
+EXEMPT_PATHS = ("/",)
+EXEMPT_PREFIXES = ("/admin", "/metrics")
+
+# Counters showing how often the limits kicked in
+stats = {
+    "granted": 0,           # USGS requests that got a slot and a token
+    "waited": 0,            # ... of which had to wait for one first
+    "shed_concurrency": 0,  # USGS requests given up because every slot stayed taken
+    "shed_rate": 0,         # USGS requests given up because the token bucket stayed empty
+    "skipped_hedges": 0,    # Hedges not sent because the limits said no
+    "local_fallbacks": 0,   # Times Redis failed and this worker's own limits were used
+    "admitted": 0,          # Requests this worker took on
+    "shed_requests": 0,     # Requests answered 503 right away because this worker was full
+}
+
+# Takes a slot and a token if both are free: KEYS = slots, bucket; ARGV = holder, now (ms), max concurrency,
+# rate per second, burst, slot ttl (ms). Returns {1, 0, 0} when granted, otherwise {0, ms to wait, reason}
+# with reason 1 for "no free slot" and 2 for "no token"
+_ACQUIRE_SCRIPT = """
+local now = tonumber(ARGV[2])
+local limit = tonumber(ARGV[3])
+local rate = tonumber(ARGV[4])
+local burst = tonumber(ARGV[5])
+local ttl = tonumber(ARGV[6])
+redis.call('zremrangebyscore', KEYS[1], '-inf', now)
+if limit > 0 and redis.call('zcard', KEYS[1]) >= limit then
+    return {0, 50, 1}
+end
+if rate > 0 then
+    local bucket = redis.call('hmget', KEYS[2], 'tokens', 'at')
+    local tokens = tonumber(bucket[1]) or burst
+    local at = tonumber(bucket[2]) or now
+    tokens = math.min(burst, tokens + math.max(0, now - at) * rate / 1000)
+    if tokens < 1 then
+        return {0, math.ceil((1 - tokens) * 1000 / rate), 2}
+    end
+    redis.call('hset', KEYS[2], 'tokens', tokens - 1, 'at', now)
+    redis.call('pexpire', KEYS[2], math.ceil(burst * 1000 / rate) + 1000)
+end
+if limit > 0 then
+    redis.call('zadd', KEYS[1], now + ttl, ARGV[1])
+    redis.call('pexpire', KEYS[1], ttl)
+end
+return {1, 0, 0}
+"""
+
+# This worker's own limits, used without Redis: holder -> slot expiry (ms), and [tokens, counted at (ms)]
+_local_slots = {}
+_local_bucket = [None, None]
+
+# Requests this worker is working on right now
+_in_flight = 0
+
+
+class UpstreamBusy(httpx.TransportError):
+    # USGS' request budget is used up for now; not USGS' fault, so it isn't retried or held against it
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def reset():
+    # Forget this worker's slots, tokens and counters
+    global _in_flight
+    _local_slots.clear()
+    _local_bucket[:] = [None, None]
+    _in_flight = 0
+    for name in stats:
+        stats[name] = 0
+
+
+def _acquire_locally(holder: str, now_ms: int) -> tuple:
+    # The same as _ACQUIRE_SCRIPT, for this worker only
+    for other, expires in list(_local_slots.items()):
+        if expires <= now_ms:
+            del _local_slots[other]
+    if UPSTREAM_MAX_CONCURRENCY > 0 and len(_local_slots) >= UPSTREAM_MAX_CONCURRENCY:
+        return False, 50, 1
+    if UPSTREAM_RATE > 0:
+        tokens, at = _local_bucket
+        tokens = UPSTREAM_BURST if tokens is None else tokens
+        at = now_ms if at is None else at
+        tokens = min(UPSTREAM_BURST, tokens + max(0, now_ms - at) * UPSTREAM_RATE / 1000)
+        if tokens < 1:
+            return False, math.ceil((1 - tokens) * 1000 / UPSTREAM_RATE), 2
+        _local_bucket[:] = [tokens - 1, now_ms]
+    if UPSTREAM_MAX_CONCURRENCY > 0:
+        _local_slots[holder] = now_ms + UPSTREAM_SLOT_TTL * 1000
+    return True, 0, 0
+
+
+async def _try_acquire(holder: str, now: float = None) -> tuple:
+    # One go at a slot and a token: (granted, ms to wait before trying again, reason)
+    now_ms = int((time.time() if now is None else now) * 1000)
+    client = redis_pool.client
+    if client:
+        try:
+            granted, wait_ms, reason = await client.eval(
+                _ACQUIRE_SCRIPT, 2, SLOTS_KEY, BUCKET_KEY, holder, now_ms, UPSTREAM_MAX_CONCURRENCY,
+                UPSTREAM_RATE, UPSTREAM_BURST, int(UPSTREAM_SLOT_TTL * 1000))
+            return bool(granted), int(wait_ms), int(reason)
+        except Exception as e:
+            stats["local_fallbacks"] += 1
+            logger.warning(f"⚠️ Could not check the shared USGS limits in Redis, limiting locally: {str(e)}")
+    return _acquire_locally(holder, now_ms)
+
+
+"""
+async def acquire(wait: float = None, now: float = None) -> str:
+
+    Purpose: Gets permission to send one request to USGS, within the limits shared by all workers
+    What it does:
+    - Takes one of UPSTREAM_MAX_CONCURRENCY slots and one token of the UPSTREAM_RATE bucket,
+      both at once in one atomic Redis script (or this worker's own limits without Redis)
+    - If either is missing, tries again after the time the script says (with a little jitter),
+      for up to `wait` seconds
+    - Gives up after that, so a burst is shed quickly instead of queueing until it times out
+    Parameters:
+    - wait: Longest time to wait for a slot and token, in seconds (default UPSTREAM_QUEUE_WAIT)
+    - now: Current unix time (tests pass their own)
+    Returns: The holder id of the slot, to hand back to release()
+    Raises: UpstreamBusy (with the suggested retry_after) when nothing became free in time
+    Used for: Every request to USGS (see resilience._attempt); hedges use try_acquire instead
+"""
+async def acquire(wait: float = None, now: float = None) -> str:
+    holder = uuid.uuid4().hex
+    give_up = time.monotonic() + (UPSTREAM_QUEUE_WAIT if wait is None else wait)
+    waited = False
+    while True:
+        granted, wait_ms, reason = await _try_acquire(holder, now)
+        if granted:
+            stats["granted"] += 1
+            if waited:
+                stats["waited"] += 1
+            return holder
+        left = give_up - time.monotonic()
+        if left <= 0:
+            stats["shed_concurrency" if reason == 1 else "shed_rate"] += 1
+            what = "USGS requests in flight" if reason == 1 else "USGS requests per second"
+            raise UpstreamBusy(f"Too many {what}, try again shortly", max(wait_ms / 1000, SHED_RETRY_AFTER))
+        waited = True
+        await asyncio.sleep(min(left, wait_ms / 1000 * random.uniform(1, 1.5)))
+
+
+async def try_acquire(now: float = None):
+    # A slot and token if they are free right now, without waiting (holder id or None)
+    holder = uuid.uuid4().hex
+    granted, _, _ = await _try_acquire(holder, now)
+    if not granted:
+        stats["skipped_hedges"] += 1
+        return None
+    stats["granted"] += 1
+    return holder
+
+
+"""
+async def release(holder: str):
+
+    Purpose: Gives a slot back as soon as its USGS request is done
+    Parameters:
+    - holder: The id acquire() or try_acquire() returned (None is ignored)
+"""
+async def release(holder: str):
+    if holder is None or UPSTREAM_MAX_CONCURRENCY <= 0:
+        return
+    _local_slots.pop(holder, None)
+    client = redis_pool.client
+    if client:
+        try:
+            await client.zrem(SLOTS_KEY, holder)
+        except Exception as e:
+            # The slot expires on its own after UPSTREAM_SLOT_TTL
+            logger.warning(f"⚠️ Could not give back a USGS request slot: {str(e)}")
+
+
+@asynccontextmanager
+async def upstream_slot(wait: float = None):
+    # Holds a slot (and took a token) while the block sends its USGS request
+    holder = await acquire(wait)
+    try:
+        yield holder
+    finally:
+        await release(holder)
+
+
+def retry_after(error: UpstreamBusy) -> str:
+    # Retry-After header value: whole seconds, at least 1
+    return str(max(1, math.ceil(error.retry_after)))
+
+
+"""
+def admit(path: str) -> bool:
+
+    Purpose: Decides whether this worker takes on one more request
+    What it does:
+    - Counts the requests this worker is working on; beyond ADMISSION_MAX_IN_FLIGHT a request is
+      refused right away (the caller answers 503 with Retry-After) instead of waiting in line
+    - Health checks and admin requests are always let in
+    Parameters:
+    - path: The request's URL path
+    Returns: True if the request may go ahead (call leave() when it is done), False to shed it
+    Used for: The admission middleware in app/main.py
+"""
+def admit(path: str) -> bool:
+    global _in_flight
+    if is_exempt(path):
+        return True
+    if ADMISSION_MAX_IN_FLIGHT > 0 and _in_flight >= ADMISSION_MAX_IN_FLIGHT:
+        stats["shed_requests"] += 1
+        return False
+    _in_flight += 1
+    stats["admitted"] += 1
+    return True
+
+
+def leave(path: str):
+    # An admitted request is done
+    global _in_flight
+    if not is_exempt(path):
+        _in_flight -= 1
+
+
+def is_exempt(path: str) -> bool:
+    # Whether a request skips admission and rate limits: the health check and the admin and metrics routes
+    return path in EXEMPT_PATHS or path.startswith(EXEMPT_PREFIXES)
+
+
+def limiter_stats() -> dict:
+    # Counters plus the current limits and this worker's requests in flight, for /admin/stats
+    return {
+        **stats,
+        "in_flight_requests": _in_flight,
+        "max_in_flight_requests": ADMISSION_MAX_IN_FLIGHT,
+        "upstream_max_concurrency": UPSTREAM_MAX_CONCURRENCY,
+        "upstream_rate": UPSTREAM_RATE,
+    }
@@ -6,39 +6,155 @@ Acts as the entry point for the web service
 
 # This is the main control center of our earthquake information service
 
-from fastapi import FastAPI
-from app.routes import earthquakes, tsunami, health, earthquake_felt
+import math
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+from starlette.routing import Match
+import time
+from app.routes import earthquakes, tsunami, health, earthquake_felt, admin, batch
+from app.routes import metrics as metrics_route
 from app.logger import setup_logging
-from app.redis_client import get_redis_client  # Import the Redis client initialization
+from app.redis_client import redis_pool  # Import the shared Redis pools
+from app.usgs_client import start_http_client, close_http_client
+from app.ingester import start_ingester, stop_ingester
+from app.hotkeys import start_refresher, stop_refresher
+from app.response_cache import refresh_query
+from app.cache import track_stale
+from app.states import get_index as load_states
+from app import limiter, ratelimit, metrics
+from app.config import SHED_RETRY_AFTER, METRICS_ENABLED
 import uvicorn
 
 
 # Set up logging for the application
 logger = setup_logging()
 
+
+# Things to set up when the service starts and tidy up when it stops
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Open the shared async Redis pools once; every cache read and write awaits them instead of blocking
+    if await redis_pool.start():
+        logger.info("Redis connection is successful.")
+    else:
+        logger.warning("Redis connection failed, caching in this worker's memory only.")
+    # Open the shared connection pool to USGS once, instead of a new connection per request
+    await start_http_client()
+    # Read the state outlines once, before the first tsunami request needs them
+    load_states()
+    # Keep the recent buckets of the busiest searches warm in the background (one worker polls)
+    start_ingester()
+    # Refresh the most requested searches before their cached answers expire
+    start_refresher(refresh_query)
+    # Share this worker's metrics with the others every few seconds, so /metrics adds up all of them
+    metrics.start_pusher(metrics_route.internal)
+    yield
+    await metrics.stop_pusher()
+    await stop_refresher()
+    await stop_ingester()
+    await close_http_client()
+    await redis_pool.close()
+
+
 # Create our web application using FastAPI
-app = FastAPI(title="Earthquake API Service")
+app = FastAPI(title="Earthquake API Service", lifespan=lifespan)
+
+# Mark answers that were (partly) built from expired data, so clients can tell
+@app.middleware("http")
+async def mark_stale_responses(request: Request, call_next):
+    flags = track_stale()
+    response = await call_next(request)
+    if flags["stale"]:
+        response.headers["X-Cache-Stale"] = "true"
+    return response
+
+
+# Turn requests away right away (503 + Retry-After) when this worker is already working on
+# ADMISSION_MAX_IN_FLIGHT of them, instead of letting them queue up until they time out
+# A request counts as in progress until its body is sent: streamed bodies are still being built then
+@app.middleware("http")
+async def shed_excess_requests(request: Request, call_next):
+    path = request.url.path
+    if not limiter.admit(path):
+        return JSONResponse(status_code=503, content={"detail": "Too many requests in progress, try again shortly"},
+                            headers={"Retry-After": str(SHED_RETRY_AFTER)})
+    try:
+        response = await call_next(request)
+    except BaseException:
+        limiter.leave(path)
+        raise
+    response.body_iterator = _leave_when_sent(response.body_iterator, path)
+    return response
+
+
+async def _leave_when_sent(body, path: str):
+    # Passes the body through and lets the request go once it's sent (or the client went away)
+    try:
+        async for chunk in body:
+            yield chunk
+    finally:
+        limiter.leave(path)
+
+
+# Answer 429 to clients (API key or IP address) that made more than RATE_LIMIT_REQUESTS requests in the last
+# RATE_LIMIT_WINDOW seconds; checked before anything else, so they don't take up other clients' room
+@app.middleware("http")
+async def limit_clients(request: Request, call_next):
+    if not ratelimit.applies_to(request.url.path):
+        return await call_next(request)
+    allowed, left, wait = await ratelimit.check(ratelimit.client_id(request))
+    if not allowed:
+        return JSONResponse(status_code=429, content={"detail": "Rate limit exceeded, slow down"}, headers={
+            "Retry-After": str(max(1, math.ceil(wait))),
+            "X-RateLimit-Limit": str(ratelimit.RATE_LIMIT_REQUESTS),
+            "X-RateLimit-Remaining": "0",
+        })
+    response = await call_next(request)
+    response.headers["X-RateLimit-Limit"] = str(ratelimit.RATE_LIMIT_REQUESTS)
+    response.headers["X-RateLimit-Remaining"] = str(left)
+    return response
+
+
+# Count every request and time it until its last byte is sent (declared last, so it runs outermost and
+# also sees the 429s and 503s the middlewares above answer themselves); requests are labelled with their
+# route template, not the raw path
+@app.middleware("http")
+async def record_metrics(request: Request, call_next):
+    if not METRICS_ENABLED:
+        return await call_next(request)
+    started = time.perf_counter()
+    metrics.inc("http_requests_in_flight")
+    try:
+        response = await call_next(request)
+    except Exception:
+        metrics.inc("http_requests_in_flight", amount=-1)
+        raise
+    route = _route_of(request)
+    response.body_iterator = metrics.count_body(response.body_iterator, route.path if route else "unmatched",
+                                                request.method, response.status_code, started)
+    return response
+
+
+def _route_of(request: Request):
+    # The route that answered, or for requests turned away before routing, the one that would have
+    return request.scope.get("route") or next(
+        (route for route in app.routes if route.matches(request.scope)[0] == Match.FULL), None)
 
-# Connect to our memory helper (Redis)
-redis_client = get_redis_client()
 
 # Include routers
 # Tell our app about all the different services we offer
 app.include_router(earthquakes.router, tags=["Earthquakes"])
 app.include_router(earthquake_felt.router, tags=["Earthquakes-felt"])
+app.include_router(admin.router, tags=["Admin"])
+app.include_router(batch.router, tags=["Batch"])
+app.include_router(metrics_route.router, tags=["Metrics"])
 app.include_router(tsunami.router,tags=["Tsunami Alerts"])
 app.include_router(health.router, tags=["Health"])
 
 
 # This code runs when we start the program directly
 if __name__ == "__main__":
-    # Check if Redis connection was successful
-    if redis_client:
-        # Check Connection with the Redis-Server
-        logger.info("Redis connection is successful.")
-    else:
-        logger.warning("Redis connection failed.")
-
     # Start our web service
     # Tell it to listen for requests from anywhere (0.0.0.0) on port number 8000
     uvicorn.run(app, host="0.0.0.0", port=8000)
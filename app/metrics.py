@@ -0,0 +1,278 @@
+# This file collects the numbers behind /metrics: request latency and response sizes per route, cache results
+# per layer, USGS requests and how long they took, and requests in flight, in the Prometheus text format
+# Each worker counts in plain dictionaries (no locks or I/O on the request path) and shares a snapshot
+# through Redis every METRICS_PUSH_INTERVAL seconds, so /metrics on any worker adds up all of them
+
+import asyncio
+import json
+import os
+import socket
+import time
+from bisect import bisect_left
+from app.config import METRICS_ENABLED, METRICS_PUSH_INTERVAL
+from app.redis_client import redis_pool
+from app.logger import setup_logging
+
+# Start logging the information
+logger = setup_logging()
+
+PREFIX = "earthquake_"
+WORKERS_KEY = "metrics:workers"     # Set of the workers that shared their metrics
+SNAPSHOT_PREFIX = "metrics:worker:"  # + worker id: that worker's latest snapshot (expires if it stops sharing)
+
+# This worker, as it appears in Redis
+WORKER = f"{socket.gethostname()}:{os.getpid()}"
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000, 100000000)
+
+# Every metric: name -> (type, help text, label names, histogram buckets)
+METRICS = {
+    "http_requests_total": (
+        "counter", "Requests answered, by route, method and status", ("route", "method", "status"), None),
+    "http_request_duration_seconds": (
+        "histogram", "Time to answer a request, until its last byte was sent", ("route",), LATENCY_BUCKETS),
+    "http_response_size_bytes": (
+        "histogram", "Size of response bodies", ("route",), SIZE_BUCKETS),
+    "http_requests_in_flight": (
+        "gauge", "Requests being answered right now", (), None),
+    "cache_lookups_total": (
+        "counter", "Cache lookups by layer (l1, redis, response, response_redis, event_store) and result "
+                   "(hit, stale, miss)", ("layer", "result"), None),
+    "upstream_requests_total": (
+        "counter", "USGS requests by endpoint and result (ok, http_4xx, http_5xx, timeout, connection_error, "
+                   "deadline, error; breaker_open and shed were never sent)", ("endpoint", "result"), None),
+    "upstream_request_duration_seconds": (
+        "histogram", "Time a USGS request took, body included", ("endpoint",), LATENCY_BUCKETS),
+    "internal_events_total": (
+        "counter", "The counters of /admin/stats (single flight, stale data, limiter, rate limit, ...)",
+        ("source", "event"), None),
+    "workers": (
+        "gauge", "Workers whose metrics are added up here", (), None),
+}
+
+# This worker's values: name -> {label values -> number}; a histogram's value is
+# [observations per bucket (the last one above every bucket)..., sum of all observations]
+_values = {name: {} for name in METRICS}
+
+# The background task sharing this worker's snapshot
+_task = None
+
+
+def reset():
+    # Forget every value (tests start from zero)
+    for values in _values.values():
+        values.clear()
+
+
+def inc(name: str, *labels, amount: float = 1):
+    # Adds to a counter (or a gauge, with a negative amount to take away)
+    if METRICS_ENABLED:
+        values = _values[name]
+        values[labels] = values.get(labels, 0) + amount
+
+
+def observe(name: str, value: float, *labels):
+    # Records one observation of a histogram
+    if not METRICS_ENABLED:
+        return
+    values = _values[name]
+    buckets = METRICS[name][3]
+    counts = values.get(labels)
+    if counts is None:
+        counts = values[labels] = [0] * (len(buckets) + 1) + [0.0]
+    counts[bisect_left(buckets, value)] += 1
+    counts[-1] += value
+
+
+"""
+def snapshot(internal: dict = None) -> dict:
+
+    Purpose: Captures this worker's metrics in a form that can be stored and added up
+    Parameters:
+    - internal: Optional source -> counters dict (like singleflight.stats) to include as internal_events_total
+    Returns: {"values": {name: [[labels, value], ...]}, "at": unix time}
+"""
+def snapshot(internal: dict = None) -> dict:
+    values = {name: [[list(labels), value] for labels, value in series.items()] for name, series in _values.items()}
+    if internal:
+        values["internal_events_total"] = [
+            [[source, event], count] for source, counters in internal.items()
+            for event, count in counters.items() if isinstance(count, (int, float)) and not isinstance(count, bool)
+        ]
+    values["workers"] = [[[], 1]]
+    return {"values": values, "at": time.time()}
+
+
+def merge(snapshots: list) -> dict:
+    # Adds up the snapshots of several workers: name -> {label values -> number or histogram list}
+    merged = {name: {} for name in METRICS}
+    for snap in snapshots:
+        for name, series in snap["values"].items():
+            if name not in merged:
+                continue
+            target = merged[name]
+            for labels, value in series:
+                labels = tuple(labels)
+                if isinstance(value, list):
+                    previous = target.get(labels)
+                    target[labels] = list(value) if previous is None else [a + b for a, b in zip(previous, value)]
+                else:
+                    target[labels] = target.get(labels, 0) + value
+    return merged
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+"""
+def render(merged: dict) -> str:
+
+    Purpose: Writes metrics in the Prometheus text exposition format
+    What it does:
+    - Writes HELP and TYPE lines, then one line per label combination
+    - Writes histograms as cumulative _bucket lines (with le="+Inf"), _sum and _count
+    Parameters:
+    - merged: Values as returned by merge()
+    Returns: The text served at /metrics
+"""
+def render(merged: dict) -> str:
+    lines = []
+    for name, (kind, help_text, label_names, buckets) in METRICS.items():
+        series = merged.get(name)
+        if not series:
+            continue
+        full = PREFIX + name
+        lines.append(f"# HELP {full} {help_text}")
+        lines.append(f"# TYPE {full} {kind}")
+        for labels, value in sorted(series.items()):
+            if kind != "histogram":
+                lines.append(f"{full}{_labels(label_names, labels)} {_number(value)}")
+                continue
+            cumulative = 0
+            for bound, count in zip(buckets + ("+Inf",), value[:-1]):
+                cumulative += count
+                le = 'le="%s"' % bound
+                lines.append(f"{full}_bucket{_labels(label_names, labels, le)} {cumulative}")
+            lines.append(f"{full}_sum{_labels(label_names, labels)} {_number(value[-1])}")
+            lines.append(f"{full}_count{_labels(label_names, labels)} {cumulative}")
+    return "\n".join(lines) + "\n"
+
+
+"""
+async def push(internal: dict = None) -> bool:
+
+    Purpose: Shares this worker's snapshot with the other workers
+    What it does:
+    - Stores the snapshot under metrics:worker:<host>:<pid> for three push intervals, and the worker
+      in the metrics:workers set, in one pipelined round trip
+    Parameters:
+    - internal: See snapshot()
+    Returns: True if Redis took it, False without Redis
+"""
+async def push(internal: dict = None) -> bool:
+    client = redis_pool.client
+    if not client:
+        return False
+    try:
+        pipe = client.pipeline(transaction=False)
+        pipe.set(SNAPSHOT_PREFIX + WORKER, json.dumps(snapshot(internal)), ex=max(1, int(METRICS_PUSH_INTERVAL * 3)))
+        pipe.sadd(WORKERS_KEY, WORKER)
+        await pipe.execute()
+        return True
+    except Exception as e:
+        logger.warning(f"⚠️ Could not share metrics through Redis: {str(e)}")
+        return False
+
+
+"""
+async def collect(internal: dict = None) -> str:
+
+    Purpose: Builds the /metrics page for every worker of the deployment
+    What it does:
+    - Shares this worker's latest numbers first, then reads every worker's snapshot from Redis and adds
+      them up (counters and histograms summed, in-flight gauges too)
+    - Forgets workers whose snapshot expired (stopped or crashed); their counts drop out of the sums,
+      which Prometheus treats like a counter reset
+    - Without Redis, shows this worker only
+    Parameters:
+    - internal: See snapshot()
+    Returns: The metrics in the Prometheus text format
+"""
+async def collect(internal: dict = None) -> str:
+    snapshots = [snapshot(internal)]
+    client = redis_pool.client
+    if client and await push(internal):
+        try:
+            workers = sorted(await client.smembers(WORKERS_KEY))
+            others = [worker for worker in workers if worker != WORKER]
+            stored = await client.mget([SNAPSHOT_PREFIX + worker for worker in others]) if others else []
+            gone = [worker for worker, body in zip(others, stored) if body is None]
+            if gone:
+                await client.srem(WORKERS_KEY, *gone)
+            snapshots += [json.loads(body) for body in stored if body is not None]
+        except Exception as e:
+            logger.warning(f"⚠️ Could not read other workers' metrics, showing this worker only: {str(e)}")
+    return render(merge(snapshots))
+
+
+"""
+async def count_body(body, route: str, method: str, status: int, started: float):
+
+    Purpose: Passes a response body through while measuring it
+    What it does:
+    - Counts the bytes of every chunk as it is sent (streamed answers included)
+    - When the last chunk is out, records the request's latency, size and status and lowers the
+      in-flight gauge
+    Used for: The metrics middleware in app/main.py
+"""
+async def count_body(body, route: str, method: str, status: int, started: float):
+    size = 0
+    try:
+        async for chunk in body:
+            size += len(chunk)
+            yield chunk
+    finally:
+        inc("http_requests_in_flight", amount=-1)
+        inc("http_requests_total", route, method, str(status))
+        observe("http_request_duration_seconds", time.perf_counter() - started, route)
+        observe("http_response_size_bytes", size, route)
+
+
+async def run_pusher(internal):
+    # Share this worker's metrics every METRICS_PUSH_INTERVAL seconds for as long as the app runs
+    while True:
+        await asyncio.sleep(METRICS_PUSH_INTERVAL)
+        await push(internal())
+
+
+def start_pusher(internal):
+    # Called from the app's lifespan, after Redis is open; `internal` returns the counters of /admin/stats
+    global _task
+    if not METRICS_ENABLED or _task is not None:
+        return
+    _task = asyncio.create_task(run_pusher(internal))
+
+
+async def stop_pusher():
+    global _task
+    if _task is None:
+        return
+    _task.cancel()
+    try:
+        await _task
+    except asyncio.CancelledError:
+        pass
+    _task = None
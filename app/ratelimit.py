@@ -0,0 +1,142 @@
+# This file keeps one busy client from using up the service for everyone: every client (API key, or IP
+# address without one) may make RATE_LIMIT_REQUESTS requests per RATE_LIMIT_WINDOW seconds
+# The count is a sliding window counter: this window's requests plus the previous window's, weighted by how
+# much of it still overlaps the last RATE_LIMIT_WINDOW seconds. Two small counters per client, shared
+# between workers in Redis and updated in one script call (or kept in this worker only without Redis)
+
+import hashlib
+import math
+import time
+from app.config import (
+    RATE_LIMIT_ENABLED,
+    RATE_LIMIT_REQUESTS,
+    RATE_LIMIT_WINDOW,
+    RATE_LIMIT_KEY_HEADER,
+    RATE_LIMIT_TRUST_FORWARDED,
+)
+from app.redis_client import redis_pool
+from app.limiter import is_exempt
+from app.logger import setup_logging
+
+# Start logging the information
+logger = setup_logging()
+
+KEY_PREFIX = "ratelimit:"
+
+# Counters showing how often clients hit their limit
+stats = {
+    "allowed": 0,          # Requests within their client's limit
+    "limited": 0,          # Requests answered 429
+    "local_fallbacks": 0,  # Checks made in this worker only because Redis failed
+}
+
+# Counts a request if it fits: KEYS = this window's counter, the previous window's counter;
+# ARGV = limit, window (ms), ms since this window started. Returns {allowed, requests left, ms to wait}
+_CHECK_SCRIPT = """
+local limit = tonumber(ARGV[1])
+local window = tonumber(ARGV[2])
+local elapsed = tonumber(ARGV[3])
+local current = tonumber(redis.call('get', KEYS[1]) or '0')
+local previous = tonumber(redis.call('get', KEYS[2]) or '0')
+local weighted = previous * (window - elapsed) / window + current
+if weighted + 1 > limit then
+    local wait = window - elapsed
+    if current + 1 <= limit and previous > 0 then
+        wait = math.ceil(window - elapsed - (limit - 1 - current) * window / previous)
+    end
+    return {0, 0, math.max(1, wait)}
+end
+redis.call('incr', KEYS[1])
+redis.call('pexpire', KEYS[1], window * 2)
+return {1, math.floor(limit - weighted - 1), 0}
+"""
+
+# This worker's own counters, used without Redis: (client, window number) -> requests
+_local_counts = {}
+
+
+def reset():
+    # Forget this worker's counters
+    _local_counts.clear()
+    for name in stats:
+        stats[name] = 0
+
+
+"""
+def client_id(request) -> str:
+
+    Purpose: Works out who a request comes from
+    What it does:
+    - Uses the API key from the RATE_LIMIT_KEY_HEADER header if there is one (hashed, so keys
+      never end up in Redis)
+    - Otherwise the client's IP address (the first X-Forwarded-For address if RATE_LIMIT_TRUST_FORWARDED)
+    Parameters:
+    - request: The incoming request
+    Returns: "key:<hash>" or "ip:<address>"
+"""
+def client_id(request) -> str:
+    api_key = request.headers.get(RATE_LIMIT_KEY_HEADER)
+    if api_key:
+        return "key:" + hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:16]
+    forwarded = request.headers.get("X-Forwarded-For") if RATE_LIMIT_TRUST_FORWARDED else None
+    if forwarded:
+        return "ip:" + forwarded.split(",")[0].strip()
+    return "ip:" + (request.client.host if request.client else "unknown")
+
+
+def _check_locally(client: str, number: int, elapsed_ms: int, window_ms: int) -> tuple:
+    # The same as _CHECK_SCRIPT, for this worker only
+    if len(_local_counts) > 10000:
+        for key in [key for key in _local_counts if key[1] < number - 1]:
+            del _local_counts[key]
+    current = _local_counts.get((client, number), 0)
+    previous = _local_counts.get((client, number - 1), 0)
+    weighted = previous * (window_ms - elapsed_ms) / window_ms + current
+    if weighted + 1 > RATE_LIMIT_REQUESTS:
+        wait = window_ms - elapsed_ms
+        if current + 1 <= RATE_LIMIT_REQUESTS and previous > 0:
+            wait = math.ceil(window_ms - elapsed_ms - (RATE_LIMIT_REQUESTS - 1 - current) * window_ms / previous)
+        return False, 0, max(1, wait)
+    _local_counts[(client, number)] = current + 1
+    return True, math.floor(RATE_LIMIT_REQUESTS - weighted - 1), 0
+
+
+"""
+async def check(client: str, now: float = None) -> tuple:
+
+    Purpose: Counts one request of a client, if it is within the client's limit
+    What it does:
+    - Estimates the client's requests in the last RATE_LIMIT_WINDOW seconds from the counters of
+      this window and the previous one (sliding window counter)
+    - If one more still fits under RATE_LIMIT_REQUESTS, counts it; refused requests aren't counted
+    - One Redis round trip (a script reading both counters and bumping this one), shared by every
+      worker; this worker's own counters when Redis is unavailable
+    Parameters:
+    - client: Who is asking (see client_id)
+    - now: Current unix time (tests pass their own)
+    Returns: (allowed, requests left, seconds until the next request would be allowed)
+    Used for: The rate limiting middleware in app/main.py
+"""
+async def check(client: str, now: float = None) -> tuple:
+    now_ms = int((time.time() if now is None else now) * 1000)
+    window_ms = int(RATE_LIMIT_WINDOW * 1000)
+    number, elapsed_ms = divmod(now_ms, window_ms)
+    redis = redis_pool.client
+    if redis:
+        try:
+            allowed, left, wait_ms = await redis.eval(
+                _CHECK_SCRIPT, 2, f"{KEY_PREFIX}{client}:{number}", f"{KEY_PREFIX}{client}:{number - 1}",
+                RATE_LIMIT_REQUESTS, window_ms, elapsed_ms)
+        except Exception as e:
+            stats["local_fallbacks"] += 1
+            logger.warning(f"⚠️ Could not check the rate limit in Redis, counting locally: {str(e)}")
+            allowed, left, wait_ms = _check_locally(client, number, elapsed_ms, window_ms)
+    else:
+        allowed, left, wait_ms = _check_locally(client, number, elapsed_ms, window_ms)
+    stats["allowed" if allowed else "limited"] += 1
+    return bool(allowed), int(left), wait_ms / 1000
+
+
+def applies_to(path: str) -> bool:
+    # Whether requests to this path are rate limited at all
+    return RATE_LIMIT_ENABLED and not is_exempt(path)
@@ -1,8 +1,9 @@
 
 # Importing the library and other files from package
 import redis
+from redis import asyncio as aioredis
 from app.logger import setup_logging
-from app.config import REDIS_HOST, REDIS_PORT
+from app.config import REDIS_HOST, REDIS_PORT, REDIS_POOL_SIZE, REDIS_POOL_TIMEOUT, REDIS_SOCKET_TIMEOUT
 
 # Start our program's diary
 logger = setup_logging()
@@ -15,20 +16,22 @@ logger = setup_logging()
     - Verifies connection with a ping test
     - Handles connection failures with logs
     - Logs connection status (success/failure)
+    Parameters:
+    - decode_responses: True gives back text, False gives back raw bytes (for binary cache values)
     Returns: 
     - Redis client object if connection successful
     - None if connection fails
-    Used for: Caching earthquake data to improve performance
+    Used for: Tests and scripts that talk to Redis outside the event loop (the app itself uses redis_pool)
 """
 
-def get_redis_client():
+def get_redis_client(decode_responses: bool = True):
     """Create and return a Redis client - Making a new connection to our server."""
     try:
         client = redis.Redis(
             host=REDIS_HOST,          # Where to find Redis
             port=REDIS_PORT,          # Which port to use
             db=0,                     # Which datbase to use (0 is the first one)
-            decode_responses=True,     # Tell Redis to give us readable text back
+            decode_responses=decode_responses,  # Readable text back (or raw bytes for binary values)
             socket_connect_timeout=5   # Give up waiting after 5 seconds
         )
         # Check if Redis is responding by sending it a "ping"
@@ -42,6 +45,74 @@ def get_redis_client():
         # If something goes wrong while connecting, write a log
         logger.warning(f"⚠️ Failed to connect to Redis: {str(e)}")
         return None
-    
-# Try to connect to Redis right away when this file is loaded
-redis_client = get_redis_client()
\ No newline at end of file
+
+
+class AsyncRedisPool:
+    """
+    The async Redis clients every request shares: one for text, one for raw bytes, each on its own
+    connection pool of at most REDIS_POOL_SIZE connections. Opened by the app's lifespan and closed at
+    shutdown (async connections belong to the event loop that opened them). `client` and `binary_client`
+    are None while closed, when Redis didn't answer at startup, or when switched off with `enabled`.
+    """
+
+    def __init__(self, max_connections: int = REDIS_POOL_SIZE, timeout: float = REDIS_POOL_TIMEOUT):
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.enabled = True
+        self.client = None
+        self.binary_client = None
+
+    def _open(self, decode_responses: bool):
+        # A full pool makes callers wait up to `timeout` seconds for a free connection instead of failing
+        pool = aioredis.BlockingConnectionPool(
+            host=REDIS_HOST,
+            port=REDIS_PORT,
+            db=0,
+            decode_responses=decode_responses,
+            max_connections=self.max_connections,
+            timeout=self.timeout,
+            socket_connect_timeout=5,
+            socket_timeout=REDIS_SOCKET_TIMEOUT,
+        )
+        return aioredis.Redis(connection_pool=pool)
+
+    async def start(self) -> bool:
+        # Opens both pools and checks Redis answers; True if Redis can be used
+        if not self.enabled:
+            return False
+        if self.client is not None:
+            return True
+        client, binary_client = self._open(True), self._open(False)
+        try:
+            await binary_client.ping()
+        except redis.RedisError as e:
+            logger.warning(f"⚠️ Failed to connect to Redis, running without it: {str(e)}")
+            await client.aclose(close_connection_pool=True)
+            await binary_client.aclose(close_connection_pool=True)
+            return False
+        self.client, self.binary_client = client, binary_client
+        logger.info(f"✅ Async Redis pools open at {REDIS_HOST}:{REDIS_PORT} (max {self.max_connections} connections each)")
+        return True
+
+    async def close(self):
+        # Closes both clients and every pooled connection
+        client, binary_client = self.client, self.binary_client
+        self.client = self.binary_client = None
+        for pooled in (client, binary_client):
+            if pooled is not None:
+                await pooled.aclose(close_connection_pool=True)
+        if client is not None:
+            logger.info("✅ Async Redis pools closed")
+
+    async def ping(self) -> bool:
+        # Whether Redis answers right now
+        if self.client is None:
+            return False
+        try:
+            return bool(await self.client.ping())
+        except Exception:
+            return False
+
+
+# The pools the app uses for everything on the event loop (see AsyncRedisPool)
+redis_pool = AsyncRedisPool()
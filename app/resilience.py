@@ -0,0 +1,427 @@
+# This file keeps a slow or failing USGS from taking our requests down with it:
+# bounded retries with jittered backoff, hedged requests, a circuit breaker and per-request time budgets
+
+import asyncio
+import contextvars
+import random
+import time
+from collections import deque
+from contextlib import contextmanager
+import httpx
+from app.config import (
+    USGS_RETRIES,
+    USGS_RETRY_BACKOFF,
+    USGS_RETRY_MAX_BACKOFF,
+    USGS_HEDGE_PERCENTILE,
+    USGS_HEDGE_WINDOW,
+    USGS_HEDGE_MIN_SAMPLES,
+    USGS_HEDGE_MIN_DELAY,
+    USGS_BREAKER_FAILURES,
+    USGS_BREAKER_RESET,
+)
+from app import limiter, metrics
+from app.limiter import UpstreamBusy
+from app.logger import setup_logging
+
+# Start logging the information
+logger = setup_logging()
+
+# Counters showing how often USGS needed a second chance
+stats = {
+    "attempts": 0,            # Requests sent to USGS (hedges included)
+    "failures": 0,            # Attempts that failed on USGS' side (connection, timeout, 5xx, 429)
+    "retries": 0,             # Attempts made again after a failure
+    "hedges": 0,              # Second requests sent because the first was slower than usual
+    "hedge_wins": 0,          # Hedges that answered before the request they backed up
+    "late_answers_discarded": 0,  # Answers of cancelled attempts that arrived anyway and were closed
+    "breaker_opened": 0,      # Times the circuit breaker stopped asking USGS
+    "breaker_rejected": 0,    # Calls failed fast because the breaker was open
+    "deadline_exceeded": 0,   # Calls given up because the request ran out of its time budget
+}
+
+# When the current request's time budget runs out (time.monotonic()), or None without a budget
+_deadline = contextvars.ContextVar("usgs_deadline", default=None)
+
+
+class CircuitOpenError(httpx.TransportError):
+    # USGS failed too often lately, so we didn't ask it (an httpx.HTTPError, so the usual fallbacks apply)
+    pass
+
+
+class DeadlineExceeded(httpx.TimeoutException):
+    # The request ran out of its time budget before USGS answered
+    pass
+
+
+"""
+class CircuitBreaker:
+
+    Purpose: Stops asking USGS for a while after it failed several times in a row
+    What it does:
+    - Closed (normal): every call goes through; `failures` failed attempts in a row open it
+    - Open: calls fail right away with CircuitOpenError, for `reset_after` seconds
+    - Half-open: then lets one trial call through; if USGS answers it closes again, otherwise it reopens
+    - Only USGS' own trouble counts (connection errors, timeouts, 5xx and 429 answers); a 400 is an answer
+    Used for: Failing fast (or serving cached data) instead of making every request wait for a dead USGS
+"""
+class CircuitBreaker:
+    def __init__(self, failures: int = USGS_BREAKER_FAILURES, reset_after: float = USGS_BREAKER_RESET,
+                 clock=time.monotonic):
+        self.threshold = failures
+        self.reset_after = reset_after
+        self.clock = clock
+        self.failures = 0        # Failed attempts in a row
+        self.opened_at = None    # When the breaker last opened, None while closed
+        self.trial = False       # Whether the half-open trial call is running
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if self.clock() - self.opened_at < self.reset_after:
+            return "open"
+        return "half-open"
+
+    def allow(self) -> bool:
+        # May a call go to USGS now? Half-open lets exactly one through
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "open" or self.trial:
+            return False
+        self.trial = True
+        return True
+
+    def success(self):
+        if self.opened_at is not None:
+            logger.info("✅ USGS answered the trial request, closing the circuit breaker")
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+
+    def failure(self):
+        self.failures += 1
+        if self.trial or (self.opened_at is None and self.failures >= self.threshold):
+            if self.opened_at is None:
+                stats["breaker_opened"] += 1
+            logger.warning(f"🚧 USGS failed {self.failures} times in a row, not asking it for {self.reset_after:g}s")
+            self.opened_at = self.clock()
+        self.trial = False
+
+    def release(self):
+        # A call ended without telling us anything about USGS (it was cancelled)
+        self.trial = False
+
+
+"""
+class LatencyTracker:
+
+    Purpose: Remembers how long USGS took to answer lately
+    What it does:
+    - Keeps the last `window` answer times (seconds until the response headers arrived)
+    - Works out the delay after which a request is slower than USGS_HEDGE_PERCENTILE of them
+    Used for: Deciding when a request is slow enough to send a hedge
+"""
+class LatencyTracker:
+    def __init__(self, window: int = USGS_HEDGE_WINDOW):
+        self.samples = deque(maxlen=window)
+
+    def record(self, seconds: float):
+        self.samples.append(seconds)
+
+    def hedge_delay(self):
+        # Seconds to wait before hedging, or None when hedging is off or we haven't seen enough answers
+        if USGS_HEDGE_PERCENTILE <= 0 or len(self.samples) < USGS_HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(self.samples)
+        index = min(len(ordered) - 1, int(len(ordered) * USGS_HEDGE_PERCENTILE / 100))
+        return max(ordered[index], USGS_HEDGE_MIN_DELAY)
+
+
+# One breaker for USGS in this worker, and answer times per kind of request ("query", "count")
+breaker = CircuitBreaker()
+_latencies = {}
+
+
+def latency(name: str) -> LatencyTracker:
+    if name not in _latencies:
+        _latencies[name] = LatencyTracker()
+    return _latencies[name]
+
+
+def reset():
+    # Forget every failure, answer time and counter (tests start from a healthy USGS)
+    global breaker
+    breaker = CircuitBreaker()
+    _latencies.clear()
+    for name in stats:
+        stats[name] = 0
+
+
+def upstream_stats() -> dict:
+    # Counters plus the breaker's state and current hedge delays, for /admin/stats
+    return {
+        **stats,
+        "breaker": breaker.state,
+        "hedge_after_ms": {
+            name: None if tracker.hedge_delay() is None else round(tracker.hedge_delay() * 1000, 1)
+            for name, tracker in _latencies.items()
+        },
+    }
+
+
+"""
+def deadline(seconds):
+
+    Purpose: Gives everything a request asks USGS a time budget
+    What it does:
+    - While the `with` block runs, USGS calls (retries and hedges included) must finish within
+      `seconds` from now; a budget already running (a shorter one) is kept
+    - Tasks started inside the block (like a shared single-flight fetch) inherit the budget
+    Parameters:
+    - seconds: The budget, or None / 0 for none
+    Used for: Per-route deadlines (ROUTE_DEADLINES), see response_cache.cached_response
+"""
+@contextmanager
+def deadline(seconds):
+    ends = _deadline.get()
+    if seconds:
+        mine = time.monotonic() + seconds
+        ends = mine if ends is None else min(ends, mine)
+    token = _deadline.set(ends)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def time_left():
+    # Seconds left of the current request's budget, or None without one
+    ends = _deadline.get()
+    return None if ends is None else ends - time.monotonic()
+
+
+def _upstream_failure(error: BaseException) -> bool:
+    # Trouble on USGS' side (worth a retry, and counted by the breaker)
+    if isinstance(error, (CircuitOpenError, UpstreamBusy)):
+        return False
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code >= 500 or error.response.status_code == 429
+    return isinstance(error, httpx.TransportError)
+
+
+def _retry_after(error: BaseException):
+    # Seconds a 429 / 503 answer asked us to wait, if it said so
+    if isinstance(error, httpx.HTTPStatusError):
+        try:
+            return float(error.response.headers.get("Retry-After"))
+        except (TypeError, ValueError):
+            return None
+    return None
+
+
+async def _attempt(name: str, call):
+    # One try: asks the breaker first, waits for a slot of the shared USGS limits (see app/limiter.py),
+    # keeps to the time budget and tells the breaker how it went
+    if not breaker.allow():
+        stats["breaker_rejected"] += 1
+        metrics.inc("upstream_requests_total", name, "breaker_open")
+        raise CircuitOpenError("USGS is failing, not asking it for now (circuit breaker open)")
+    left = time_left()
+    if left is not None and left <= 0:
+        breaker.release()
+        stats["deadline_exceeded"] += 1
+        raise DeadlineExceeded("Out of time for asking USGS")
+    try:
+        holder = await limiter.acquire(limiter.UPSTREAM_QUEUE_WAIT if left is None
+                                       else min(limiter.UPSTREAM_QUEUE_WAIT, left))
+    except UpstreamBusy:
+        breaker.release()
+        metrics.inc("upstream_requests_total", name, "shed")
+        raise
+    except BaseException:
+        breaker.release()
+        raise
+    try:
+        return await _send_attempt(name, call)
+    finally:
+        await limiter.release(holder)
+
+
+def _result(error: BaseException) -> str:
+    # How a failed attempt ended, for the metrics
+    if isinstance(error, DeadlineExceeded):
+        return "deadline"
+    if isinstance(error, httpx.HTTPStatusError):
+        return f"http_{error.response.status_code // 100}xx"
+    if isinstance(error, httpx.TimeoutException):
+        return "timeout"
+    if isinstance(error, httpx.TransportError):
+        return "connection_error"
+    return "error"
+
+
+async def _send_attempt(name: str, call):
+    # The request itself, cut off when the time budget runs out
+    left = time_left()
+    started = time.monotonic()
+    try:
+        if left is None:
+            result = await call()
+        else:
+            try:
+                result = await asyncio.wait_for(call(), left)
+            except asyncio.TimeoutError:
+                stats["deadline_exceeded"] += 1
+                raise DeadlineExceeded(f"USGS didn't answer within the request's {left:.1f}s left")
+    except Exception as e:
+        metrics.inc("upstream_requests_total", name, _result(e))
+        metrics.observe("upstream_request_duration_seconds", time.monotonic() - started, name)
+        if _upstream_failure(e):
+            stats["failures"] += 1
+            breaker.failure()
+        else:
+            # USGS answered (maybe with a 400) - it is up
+            breaker.success()
+        raise
+    except BaseException:
+        breaker.release()
+        raise
+    metrics.inc("upstream_requests_total", name, "ok")
+    metrics.observe("upstream_request_duration_seconds", time.monotonic() - started, name)
+    breaker.success()
+    return result
+
+
+"""
+async def call_usgs(name: str, call):
+
+    Purpose: Runs one USGS request with retries, a circuit breaker and the request's time budget
+    What it does:
+    - Fails right away with CircuitOpenError while the breaker is open
+    - Waits (briefly) for a slot of the USGS limits shared by all workers, or fails with UpstreamBusy
+    - Tries `call()` up to USGS_RETRIES more times after connection errors, timeouts, 5xx and 429
+      answers, waiting a random time up to USGS_RETRY_BACKOFF * 2^n first (full jitter, so workers
+      retrying together don't hit USGS in step), or what a Retry-After header asked for
+    - Never waits or tries beyond the time budget (see deadline); running out raises DeadlineExceeded
+    - Other errors (like USGS refusing a search as too big with a 400, or our own limits) are not retried
+    - Counts every attempt and how long it took per endpoint (see app/metrics.py)
+    Parameters:
+    - name: Which USGS endpoint ("query", "count"), for the metrics
+    - call: Zero-argument coroutine function making the request and reading the answer
+    Returns: Whatever `call()` returns
+    Raises: The last attempt's error (all USGS trouble is an httpx.HTTPError)
+    Used for: Every request to USGS (see usgs_client.fetch_json and count_events)
+"""
+async def call_usgs(name: str, call):
+    for retry in range(USGS_RETRIES + 1):
+        try:
+            return await _attempt(name, call)
+        except Exception as e:
+            if retry >= USGS_RETRIES or not _upstream_failure(e) or isinstance(e, DeadlineExceeded):
+                raise
+            pause = random.uniform(0, min(USGS_RETRY_MAX_BACKOFF, USGS_RETRY_BACKOFF * 2 ** retry))
+            asked = _retry_after(e)
+            if asked is not None:
+                pause = max(pause, min(asked, USGS_RETRY_MAX_BACKOFF))
+            left = time_left()
+            if left is not None and left <= pause:
+                raise
+            stats["retries"] += 1
+            logger.warning(f"🔁 USGS request failed ({type(e).__name__}: {str(e)}), trying again in {pause:.2f}s")
+            await asyncio.sleep(pause)
+
+
+# Closing answers nobody uses any more (kept referenced until they are done)
+_discarding = set()
+
+
+def _discard_late(task, discard):
+    # Once a cancelled attempt is done: if it got an answer after all, hand it to `discard`
+    if discard is None:
+        return
+
+    def done(task):
+        if task.cancelled() or task.exception() is not None:
+            return
+        stats["late_answers_discarded"] += 1
+        closing = asyncio.ensure_future(discard(task.result()))
+        _discarding.add(closing)
+        closing.add_done_callback(_discarding.discard)
+
+    task.add_done_callback(done)
+
+
+"""
+async def hedged(name: str, send, discard=None):
+
+    Purpose: Sends a request again when USGS is slower to answer it than usual, and takes the first answer
+    What it does:
+    - Starts `send()` and times it; answer times are remembered per kind of request (`name`)
+    - If no answer arrived after the USGS_HEDGE_PERCENTILE percentile of recent answer times,
+      starts `send()` a second time (only while the breaker is closed and the shared USGS limits have
+      a slot free right away)
+    - Returns whichever answers first and cancels the other; an answer that arrives anyway (at the
+      same moment, or after the winner but before the cancel took effect) is handed to `discard`
+      (to close it and give its pooled connection back)
+    - If one of them fails, waits for the other; fails only if both do
+    Parameters:
+    - name: Kind of request ("query", "count"), each with its own answer times
+    - send: Zero-argument coroutine function sending the request (returns once the headers arrived)
+    - discard: Optional coroutine function closing an answer that isn't used
+    Returns: The first answer
+    Used for: Cutting the slow tail of USGS answer times for the price of a few extra requests
+"""
+async def hedged(name: str, send, discard=None):
+    tracker = latency(name)
+
+    async def timed():
+        stats["attempts"] += 1
+        started = time.monotonic()
+        # Sent as a task of its own, so an answer that already arrived survives this attempt being cancelled
+        attempt = asyncio.ensure_future(send())
+        try:
+            answer = await asyncio.shield(attempt)
+        except asyncio.CancelledError:
+            attempt.cancel()
+            _discard_late(attempt, discard)
+            raise
+        tracker.record(time.monotonic() - started)
+        return answer
+
+    delay = tracker.hedge_delay()
+    if delay is None:
+        return await timed()
+
+    first = asyncio.ensure_future(timed())
+    pending = {first}
+    holder = None
+    try:
+        done, pending = await asyncio.wait(pending, timeout=delay)
+        if not done and breaker.state == "closed":
+            holder = await limiter.try_acquire()
+        if holder is not None:
+            stats["hedges"] += 1
+            logger.info(f"🏇 USGS {name} request slower than {delay * 1000:.0f}ms, sending it again")
+            pending.add(asyncio.ensure_future(timed()))
+        error = None
+        while True:
+            for task in done:
+                if task.exception() is not None:
+                    error = error or task.exception()
+                    continue
+                if task is not first:
+                    stats["hedge_wins"] += 1
+                for other in done:
+                    if other is not task and other.exception() is None and discard is not None:
+                        await discard(other.result())
+                return task.result()
+            if not pending:
+                raise error
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in pending:
+            task.cancel()
+            _discard_late(task, discard)
+        # Whichever request won goes on under the slot of the attempt
+        await limiter.release(holder)
@@ -0,0 +1,250 @@
+# This file remembers finished responses (the exact bytes we send) per route, parameters and format,
+# so a repeated request skips fetching, filtering and JSON/XML encoding altogether
+
+import json
+from collections import namedtuple
+from fastapi import Response
+from fastapi.responses import StreamingResponse
+from app.cache import LRUCache, is_stale
+from app.config import (
+    CACHE_DURATION,
+    RESPONSE_CACHE_MAX_ENTRIES,
+    RESPONSE_CACHE_MAX_BYTES,
+    STREAM_CACHE_MAX_BYTES,
+    JSON_STREAM_MIN_FEATURES,
+    ROUTE_DEADLINES,
+)
+from app.redis_client import redis_pool
+from app.codec import encode, decode
+from app.resilience import deadline
+from app import hotkeys, metrics
+from app.chunking import gather_limited
+from app.config import FETCH_CONCURRENCY
+from app.utils import encode_response, refresh_search
+from app.xml_writer import iter_xml
+from app.json_stream import iter_json
+from app.logger import setup_logging
+
+# Start logging the information
+logger = setup_logging()
+
+# Every worker keeps its own encoded bodies: key -> (body bytes, media type)
+response_cache = LRUCache(RESPONSE_CACHE_MAX_ENTRIES, RESPONSE_CACHE_MAX_BYTES, CACHE_DURATION)
+
+# Everything a route needs to answer a request, worked out from its parameters (see the query functions
+# in app/routes): the route name and parameters that make up the cache key, a zero-argument coroutine
+# function building the response data, and how long to keep the answer
+RouteQuery = namedtuple("RouteQuery", ["route", "params", "build", "ttl"])
+
+
+def response_cache_key(route: str, params: dict, format_type: str) -> str:
+    # One label per route + search + output format
+    format_type = 'xml' if format_type.lower() == 'xml' else 'json'
+    return f"usgs_response:{route}:{format_type}:{json.dumps(params, sort_keys=True, default=str)}"
+
+
+def query_key(route: str, params: dict) -> str:
+    # One label per route + search, whatever the format (what hot-key popularity is counted for)
+    return f"usgs_query:{route}:{json.dumps(params, sort_keys=True, default=str)}"
+
+
+def count_request(route: str, params: dict, searches: dict = None):
+    # Count a request towards its query's popularity; after a build, with the cached searches it read
+    query = None
+    if searches is not None:
+        query = {"route": route, "params": params, "searches": list(searches.values())}
+    hotkeys.record_access(query_key(route, params), query)
+
+
+async def _build(route: str, params: dict, build):
+    # Builds a response's data within the route's time budget, counting the request and its searches
+    searches = hotkeys.track_searches()
+    with deadline(ROUTE_DEADLINES.get(route)):
+        data = await build()
+    count_request(route, params, searches)
+    return data
+
+
+"""
+async def cached_response(route: str, params: dict, format_type: str, build, ttl: int = CACHE_DURATION) -> Response:
+
+    Purpose: Returns a route's response from the response cache, or builds and caches it
+    What it does:
+    - Looks for the finished body in this worker's response cache, then in Redis (stored compressed)
+    - On a hit, sends the stored bytes as they are (no parsing, filtering or encoding)
+    - On a miss, awaits `build()` for the response data, encodes it once and stores the bytes;
+      whatever `build()` asks USGS has to fit in the route's time budget (ROUTE_DEADLINES)
+    - XML misses, and JSON misses with at least JSON_STREAM_MIN_FEATURES features, are streamed
+      as they are written; only answers up to STREAM_CACHE_MAX_BYTES get stored
+    - Answers built from stale data are sent but not stored, so the next request gets fresh data
+    - Counts every request, hit or miss, towards the query's popularity (see app/hotkeys.py)
+    Parameters:
+    - route: Name of the route (part of the cache key)
+    - params: The route's own parameters (part of the cache key)
+    - format_type: 'json' or 'xml'
+    - build: Zero-argument coroutine function producing the response data
+    - ttl: Seconds to keep the encoded response
+    Returns: A FastAPI Response with the encoded body
+"""
+async def cached_response(route: str, params: dict, format_type: str, build, ttl: int = CACHE_DURATION) -> Response:
+    cache_key = response_cache_key(route, params, format_type)
+
+    cached = await _lookup(cache_key, ttl)
+    if cached is not None:
+        count_request(route, params)
+        body, media_type = cached
+        return Response(content=body, media_type=media_type)
+
+    data = await _build(route, params, build)
+    store = not is_stale()
+    if format_type.lower() == 'xml':
+        return StreamingResponse(_stream_and_store(cache_key, iter_xml(data), "application/xml", ttl, store),
+                                 media_type="application/xml")
+    if len(data.get("features", [])) >= JSON_STREAM_MIN_FEATURES:
+        return StreamingResponse(_stream_and_store(cache_key, iter_json(data), "application/json", ttl, store),
+                                 media_type="application/json")
+    body, media_type = encode_response(data, format_type)
+    if store:
+        await _store(cache_key, body, media_type, ttl)
+    return Response(content=body, media_type=media_type)
+
+
+"""
+async def cached_json(route: str, params: dict, build, ttl: int = CACHE_DURATION) -> bytes:
+
+    Purpose: Like cached_response, but returns the encoded JSON body itself
+    What it does:
+    - Shares the JSON entries of cached_response, so a search answered by its route is a hit here and the
+      other way round
+    - On a miss, awaits `build()` within the route's time budget, encodes the data once and stores it
+      (unless it was built from stale data)
+    Returns: The JSON body as bytes
+    Used for: Putting several route answers into one response without parsing and encoding them again
+"""
+async def cached_json(route: str, params: dict, build, ttl: int = CACHE_DURATION) -> bytes:
+    cache_key = response_cache_key(route, params, 'json')
+    cached = await _lookup(cache_key, ttl)
+    if cached is not None:
+        count_request(route, params)
+        return cached[0]
+    data = await _build(route, params, build)
+    body, media_type = encode_response(data, 'json')
+    if not is_stale():
+        await _store(cache_key, body, media_type, ttl)
+    return body
+
+
+async def _lookup(cache_key: str, ttl: int):
+    # (body, media type) from this worker's response cache or Redis, or None
+    found = await lookup_many({cache_key: ttl})
+    return found.get(cache_key)
+
+
+"""
+async def lookup_many(ttls: dict) -> dict:
+
+    Purpose: Looks up several finished responses at once
+    What it does:
+    - Takes what this worker's response cache has
+    - Asks Redis for all the others (value and remaining lifetime) in one pipelined round trip,
+      and keeps what it finds in this worker's response cache for the rest of its Redis lifetime
+    Parameters:
+    - ttls: Cache key -> seconds to keep a found entry if Redis doesn't say how long it has left
+    Returns: Cache key -> (body, media type), for the keys that were found
+    Used for: Answering a route, or every query of a /batch request, with as few Redis round trips as possible
+"""
+async def lookup_many(ttls: dict) -> dict:
+    found = {}
+    for cache_key in ttls:
+        cached = response_cache.get(cache_key)
+        if cached is not None:
+            found[cache_key] = cached
+    missing = [cache_key for cache_key in ttls if cache_key not in found]
+    metrics.inc("cache_lookups_total", "response", "hit", amount=len(found))
+    metrics.inc("cache_lookups_total", "response", "miss", amount=len(missing))
+    client = redis_pool.binary_client
+    if not missing or not client:
+        return found
+    try:
+        pipe = client.pipeline(transaction=False)
+        for cache_key in missing:
+            pipe.get(cache_key)
+            pipe.pttl(cache_key)
+        replies = await pipe.execute()
+    except Exception as e:
+        logger.warning(f"⚠️ Redis read failed: {str(e)}")
+        return found
+    for cache_key, stored, ttl_ms in zip(missing, replies[::2], replies[1::2]):
+        if not stored:
+            metrics.inc("cache_lookups_total", "response_redis", "miss")
+            continue
+        try:
+            media_type, _, body = decode(stored).partition(b"\n")
+        except Exception as e:
+            logger.warning(f"⚠️ Could not decode cached response: {str(e)}")
+            metrics.inc("cache_lookups_total", "response_redis", "miss")
+            continue
+        metrics.inc("cache_lookups_total", "response_redis", "hit")
+        media_type = media_type.decode("utf-8")
+        remaining = ttl_ms / 1000 if ttl_ms and ttl_ms > 0 else ttls[cache_key]
+        response_cache.set(cache_key, (body, media_type), len(body), ttl=remaining)
+        found[cache_key] = (body, media_type)
+    return found
+
+
+async def _store(cache_key: str, body: bytes, media_type: str, ttl: int):
+    response_cache.set(cache_key, (body, media_type), len(body), ttl=ttl)
+    client = redis_pool.binary_client
+    if client:
+        try:
+            # Store the media type in front of the (compressed) body so a hit needs a single GET
+            await client.setex(cache_key, ttl, encode(media_type.encode("utf-8") + b"\n" + body, key=cache_key))
+        except Exception as e:
+            logger.warning(f"⚠️ Redis write failed: {str(e)}")
+
+
+async def _stream_and_store(cache_key: str, chunks, media_type: str, ttl: int, store: bool = True):
+    # Send the body as it is written, keeping a copy for the cache until it gets too big
+    kept, kept_bytes = ([], 0) if store else (None, 0)
+    for chunk in chunks:
+        if kept is not None:
+            kept_bytes += len(chunk)
+            if kept_bytes <= STREAM_CACHE_MAX_BYTES:
+                kept.append(chunk)
+            else:
+                kept = None
+        yield chunk
+    if kept is not None:
+        await _store(cache_key, b"".join(kept), media_type, ttl)
+
+
+"""
+async def refresh_query(query: dict, ahead: float = 0) -> bool:
+
+    Purpose: Refreshes a popular route query before its cached answers expire
+    What it does:
+    - Fetches every cached search the query was built from again, if it has less than `ahead` seconds
+      of freshness left (see utils.refresh_search; at most FETCH_CONCURRENCY at a time)
+    - If any of them was fetched, drops the query's stored responses (JSON and XML, here and in Redis),
+      so its next request is built from the new data instead of being answered with the old bytes
+    Parameters:
+    - query: {"route", "params", "searches"} as noted by count_request
+    - ahead: Searches with at least this many seconds of freshness left are left alone
+    Returns: True if anything was fetched
+    Used for: The hot-key refresher (see app/hotkeys.py)
+"""
+async def refresh_query(query: dict, ahead: float = 0) -> bool:
+    refreshed = await gather_limited([refresh_search(search["params"], search["ttl"], search["where"], ahead)
+                                      for search in query["searches"]], FETCH_CONCURRENCY)
+    if not any(refreshed):
+        return False
+    keys = [response_cache_key(query["route"], query["params"], format_type) for format_type in ("json", "xml")]
+    for cache_key in keys:
+        response_cache.discard(cache_key)
+    client = redis_pool.binary_client
+    if client:
+        try:
+            await client.delete(*keys)
+        except Exception as e:
+            logger.warning(f"⚠️ Could not drop refreshed responses from Redis: {str(e)}")
+    return True
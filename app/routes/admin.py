@@ -0,0 +1,77 @@
+from fastapi import APIRouter, Query
+from app import (singleflight, containment, codec, chunking, event_store, ingester, hotkeys, columns, tsunami_index,
+                 resilience, limiter, ratelimit)
+from app.cache import l1_cache, stale_stats, normalized_stats
+from app.response_cache import response_cache
+
+router = APIRouter()
+
+"""
+    Purpose: Shows internal counters that help us tune caching and upstream traffic
+
+    What it does:
+    - Reports how many USGS fetches this worker started
+    - Reports how many requests shared an already running fetch instead of calling USGS
+    - Reports the size and hit/miss/eviction counts of this worker's in-process cache
+    - Reports how many searches were answered by filtering a cached wider search
+    - Reports the size and hit counts of the finished-response (encoded bytes) cache
+    - Reports how big cache values are as plain JSON vs. compressed in Redis, per recent key
+    - Reports how many events were written to Redis once for all the searches holding them
+    - Reports how often busy windows were counted and split into chunks
+    - Reports the size of the local event store and how often it answered instead of USGS
+    - Reports whether this worker runs the background ingester and what it has polled
+    - Reports how often expired data was served while refreshing or because USGS failed
+    - Reports how many columnar copies were built and how often filters and merges ran vectorized
+    - Reports how often tsunami requests were answered from the tsunami index and how it was synced
+    - Reports how often USGS requests were retried or hedged, the circuit breaker's state and how often
+      requests ran out of their time budget
+    - Reports how many USGS requests got a slot of the shared limits, waited for one or were shed,
+      and how many requests this worker is working on or turned away
+    - Reports how many requests were within their client's rate limit and how many got 429
+
+    Returns: Dictionary of counters for this worker
+    Used for: Seeing how much upstream traffic request coalescing saves
+"""
+@router.get("/admin/stats")
+async def get_stats():
+    return {
+        "single_flight": dict(singleflight.stats),
+        "l1_cache": l1_cache.stats(),
+        "containment": dict(containment.stats),
+        "response_cache": response_cache.stats(),
+        "redis_sizes": codec.size_stats(),
+        "redis_events": dict(normalized_stats),
+        "chunking": dict(chunking.stats),
+        "event_store": event_store.get_store().stats() if event_store.get_store() else None,
+        "ingester": dict(ingester.stats),
+        "stale": dict(stale_stats),
+        "columnar": columns.cache_stats(),
+        "tsunami_index": dict(tsunami_index.stats),
+        "upstream": resilience.upstream_stats(),
+        "limiter": limiter.limiter_stats(),
+        "rate_limit": dict(ratelimit.stats),
+    }
+
+
+"""
+    Purpose: Shows which route queries are requested the most right now
+
+    What it does:
+    - Lists the most popular route queries (shared by all workers when Redis is up), most popular first,
+      with their decayed request counts
+    - Reports how many requests this worker counted and how many hot queries it refreshed ahead of expiry
+      (if it is the worker doing the refreshing)
+
+    Parameters:
+    - limit: How many queries to list
+
+    Returns: Dictionary with the hot queries and this worker's refresh counters
+    Used for: Checking that the busiest dashboard searches are the ones being kept warm
+"""
+@router.get("/admin/hot-keys")
+async def get_hot_keys(limit: int = Query(hotkeys.HOT_KEY_TOP_N, ge=1, le=1000)):
+    await hotkeys.flush()
+    return {
+        "hot_keys": await hotkeys.hot_keys(limit),
+        "stats": dict(hotkeys.stats),
+    }
@@ -0,0 +1,132 @@
+import json
+from typing import List
+from fastapi import APIRouter, HTTPException, Response
+from pydantic import BaseModel, Field, ValidationError
+from app.config import BATCH_MAX_QUERIES, BATCH_CONCURRENCY
+from app.response_cache import cached_json, response_cache_key, lookup_many, count_request
+from app.routes.earthquakes import sf_query
+from app.routes.earthquake_felt import felt_query
+from app.routes.tsunami import tsunami_query
+from app.chunking import gather_limited
+from app.codec import dumps_json
+from app.logger import setup_logging
+
+logger = setup_logging()
+router = APIRouter()
+
+
+# The parameters each route takes, checked like the routes check their query strings
+class SFParams(BaseModel):
+    start_time: str
+    end_time: str
+    min_magnitude: float = 2.0
+
+
+class FeltParams(BaseModel):
+    start_time: str
+    end_time: str
+    min_felt_reports: int = 10
+
+
+class TsunamiParams(BaseModel):
+    state: str
+    start_time: str
+    time_range: int = Field(24, ge=1, le=168)
+
+
+# Route name in a sub-query -> (its parameters, its query function)
+ROUTES = {
+    "earthquake/sf": (SFParams, sf_query),
+    "earthquake-felt": (FeltParams, felt_query),
+    "tsunami": (TsunamiParams, tsunami_query),
+}
+
+
+class SubQuery(BaseModel):
+    route: str
+    params: dict = {}
+
+
+class BatchRequest(BaseModel):
+    queries: List[SubQuery]
+
+
+def _error(route: str, status: int, detail) -> bytes:
+    return dumps_json({"route": route, "status": status, "detail": detail})
+
+
+"""
+    Purpose: Answers several earthquake, felt-report and tsunami queries in one request
+
+    What it does:
+    - Takes a list of sub-queries, each a route name ("earthquake/sf", "earthquake-felt" or "tsunami")
+      with the same parameters as that route's query string
+    - Works on identical sub-queries once, and on up to BATCH_CONCURRENCY different ones at the same time
+    - Looks up every cached answer at once (one pipelined Redis round trip)
+    - Sub-queries share their USGS fetches like separate requests do: the same time buckets, one
+      fetch per window for every magnitude threshold (containment), one fetch in flight per search
+      (single-flight), and the same response cache as the routes themselves
+    - Puts the already encoded answers side by side in one JSON response
+
+    Parameters:
+    - queries: List of {"route": ..., "params": {...}}, at most BATCH_MAX_QUERIES
+
+    Returns: {"results": [...]} in the order of the sub-queries; each result holds the route, the
+             HTTP status it would have got on its own and either "data" (the route's answer) or "detail"
+
+    Error Handling:
+    - A failing sub-query only fails its own result (400 bad dates, 404 unknown state or route,
+      422 invalid parameters, 503 USGS unavailable, 504 USGS too slow for the route's time budget)
+    - More than BATCH_MAX_QUERIES sub-queries is a 400 for the whole batch
+
+    Used for: Dashboards that need 10-20 answers per page load
+"""
+@router.post("/batch")
+async def batch(request: BatchRequest):
+    if len(request.queries) > BATCH_MAX_QUERIES:
+        raise HTTPException(status_code=400, detail=f"At most {BATCH_MAX_QUERIES} queries per batch")
+
+    # Work out every sub-query first; identical ones (same cache key) share one task
+    planned = {}
+    results = []
+    for sub in request.queries:
+        if sub.route not in ROUTES:
+            results.append(_error(sub.route, 404, f"Unknown route: {sub.route}"))
+            continue
+        model, make_query = ROUTES[sub.route]
+        try:
+            params = model(**sub.params)
+            # model_dump on pydantic 2, dict on pydantic 1
+            query = make_query(**(params.model_dump() if hasattr(params, "model_dump") else params.dict()))
+        except ValidationError as e:
+            results.append(_error(sub.route, 422, json.loads(e.json())))
+            continue
+        except HTTPException as e:
+            results.append(_error(sub.route, e.status_code, e.detail))
+            continue
+        key = response_cache_key(query.route, query.params, 'json')
+        planned.setdefault(key, query)
+        results.append(key)
+
+    # The answers that are cached already come back in one pipelined Redis round trip
+    cached = await lookup_many({key: query.ttl for key, query in planned.items()})
+
+    async def answer(key, query) -> bytes:
+        try:
+            if key in cached:
+                count_request(query.route, query.params)
+                body = cached[key][0]
+            else:
+                body = await cached_json(query.route, query.params, query.build, query.ttl)
+        except HTTPException as e:
+            return _error(query.route, e.status_code, e.detail)
+        except Exception as e:
+            logger.error(f"Error answering a batch query: {str(e)}")
+            return _error(query.route, 500, str(e))
+        return b'{"route":' + dumps_json(query.route) + b',"status":200,"data":' + body + b'}'
+
+    answers = dict(zip(planned, await gather_limited([answer(key, query) for key, query in planned.items()],
+                                                     BATCH_CONCURRENCY)))
+    logger.info(f"📦 Answered a batch of {len(results)} queries ({len(planned)} different)")
+    body = b'{"results":[' + b",".join(answers.get(result, result) for result in results) + b"]}"
+    return Response(content=body, media_type="application/json")
@@ -1,8 +1,41 @@
 from fastapi import APIRouter, Query
-from app.utils import fetch_usgs_data, format_response, validate_date
+from app.utils import fetch_usgs_data, validate_date
+from app.response_cache import cached_response, RouteQuery
+from app.windows import parse_time, bucket_ttl
 
 router = APIRouter()
 
+"""
+def sf_query(start_time: str, end_time: str, min_magnitude: float = 2.0) -> RouteQuery:
+
+    Purpose: Works out how to answer an /earthquake/sf request
+    What it does:
+    - Validates the dates (HTTP 400 if they are wrong)
+    - Sets up the USGS search: a 100 km radius around San Francisco, at least `min_magnitude`
+    Returns: RouteQuery (cache key parts, how to build the data, how long to keep it)
+    Used for: The /earthquake/sf route and /batch
+"""
+def sf_query(start_time: str, end_time: str, min_magnitude: float = 2.0) -> RouteQuery:
+    # Validate date formats before processing
+    start = validate_date(start_time, "Start_time")
+    end = validate_date(end_time, "end_time")
+    params = {
+        "format": "geojson",               # Request GeoJSON formatted data
+        "starttime": start,                # Start of time window
+        "endtime": end,                    # End of time window
+        "minmagnitude": min_magnitude,     # Minimum earthquake magnitude to include
+        "latitude": 37.7749,              # SF latitude
+        "longitude": -122.4194,           # SF longitude
+        "maxradiuskm": 100                # Search radius in kilometers
+    }
+    return RouteQuery(
+        "earthquake/sf",
+        {"start": start, "end": end, "min_magnitude": min_magnitude},
+        lambda: fetch_usgs_data(params),
+        bucket_ttl(parse_time(end)),
+    )
+
+
 """
     Purpose: Retrieves all earthquakes in the SF Bay Area within specified parameters
     
@@ -23,27 +56,15 @@ router = APIRouter()
 """
 
 @router.get("/earthquake/sf")
-def get_sf_earthquakes(
+async def get_sf_earthquakes(
     # Define required and optional query parameters with descriptions
     start_time: str = Query(..., description="Start time (YYYY-MM-DDTHH:MM:SS)"),
     end_time: str = Query(..., description="End time (YYYY-MM-DDTHH:MM:SS)"),
     format: str = Query('json', description="Response format (json or xml)"),
     min_magnitude: float = Query(2.0, description="Minimum magnitude")
 ):
-    
-    # Validate date formats before processing
-    start = validate_date(start_time, "Start_time")
-    end = validate_date(end_time, "end_time")
-    params = {
-        "format": "geojson",               # Request GeoJSON formatted data
-        "starttime": start,                # Start of time window
-        "endtime": end,                    # End of time window
-        "minmagnitude": min_magnitude,     # Minimum earthquake magnitude to include
-        "latitude": 37.7749,              # SF latitude
-        "longitude": -122.4194,           # SF longitude
-        "maxradiuskm": 100                # Search radius in kilometers
-    }
+    query = sf_query(start_time, end_time, min_magnitude)
 
     # Get earthquake data and return in requested format
-    data = fetch_usgs_data(params)
-    return format_response(data, format)
+    # (a repeat of the same request is answered with the already encoded bytes)
+    return await cached_response(query.route, query.params, format, query.build, ttl=query.ttl)
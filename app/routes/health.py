@@ -1,6 +1,6 @@
 from fastapi import APIRouter
 from datetime import datetime
-from app.redis_client import redis_client
+from app.redis_client import redis_pool
 
 router = APIRouter()
 
@@ -22,11 +22,11 @@ router = APIRouter()
     Used for: Monitoring system health and detecting service issues
 """
 @router.get("/")
-def health_check():
-    # Check if Redis is connected and responding to ping
+async def health_check():
+    # Check if Redis is connected and responding to ping (over the shared pool, without blocking other requests)
     # Returns 'connected' if Redis client exists and responds to ping
     # Returns 'disconnected' if Redis is not available or not responding
-    cache_status = "connected" if redis_client and redis_client.ping() else "disconnected"
+    cache_status = "connected" if await redis_pool.ping() else "disconnected"
     
     # Return health status object with:
         # - Current service status
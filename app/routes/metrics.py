@@ -0,0 +1,43 @@
+from fastapi import APIRouter
+from fastapi.responses import Response
+from app import (metrics, singleflight, containment, chunking, ingester, hotkeys, columns, tsunami_index,
+                 resilience, limiter, ratelimit)
+from app.cache import stale_stats, normalized_stats
+
+router = APIRouter()
+
+
+def internal() -> dict:
+    # The counters of /admin/stats that /metrics shows as earthquake_internal_events_total
+    return {
+        "single_flight": singleflight.stats,
+        "containment": containment.stats,
+        "redis_events": normalized_stats,
+        "chunking": chunking.stats,
+        "ingester": ingester.stats,
+        "hot_keys": hotkeys.stats,
+        "stale": stale_stats,
+        "columnar": columns.stats,
+        "tsunami_index": tsunami_index.stats,
+        "upstream": resilience.stats,
+        "limiter": limiter.stats,
+        "rate_limit": ratelimit.stats,
+    }
+
+
+"""
+    Purpose: Serves the service's metrics for Prometheus to scrape
+
+    What it does:
+    - Reports request counts by route, method and status, with latency and response size histograms per route
+    - Reports cache lookups per layer (in-process, Redis, finished responses, local event store) by result
+    - Reports USGS requests by endpoint and result, with a latency histogram, and requests in flight
+    - Reports the counters of /admin/stats as earthquake_internal_events_total
+    - Adds up every worker's numbers (shared through Redis), so it doesn't matter which worker is scraped
+
+    Returns: The metrics in the Prometheus text format (version 0.0.4)
+    Used for: Dashboards and alerts on latency, cache hit ratio and upstream health
+"""
+@router.get("/metrics")
+async def get_metrics():
+    return Response(await metrics.collect(internal()), media_type="text/plain; version=0.0.4; charset=utf-8")
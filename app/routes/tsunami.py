@@ -1,23 +1,103 @@
 from fastapi import APIRouter, Query, HTTPException
 from datetime import datetime, timedelta
-from app.utils import fetch_usgs_data, format_response, validate_date
+from app.utils import fetch_usgs_data, validate_date
+from app.response_cache import cached_response, RouteQuery
+from app.windows import parse_time, to_millis, bucket_ttl
+from app import tsunami_index, states
 from app.logger import setup_logging
 
 logger = setup_logging()
 router = APIRouter()
 
+"""
+def tsunami_query(state: str, start_time: str, time_range: int = 24) -> RouteQuery:
+
+    Purpose: Works out how to answer a tsunami alert request
+    What it does:
+    - Looks the state up (HTTP 404 if there is no such state) and validates the dates (HTTP 400)
+    - Sets up reading the window's tsunami events from the index or USGS, and keeping the state's events
+      (on its land or in its coastal zone)
+    Returns: RouteQuery (cache key parts, how to build the data, how long to keep it)
+    Used for: The /{state} route and /batch
+"""
+def tsunami_query(state: str, start_time: str, time_range: int = 24) -> RouteQuery:
+    # Find the state's outline and coastal zone
+    index = states.get_index()
+    region = index.resolve(state)
+    if region is None:
+        raise HTTPException(status_code=404, detail=f"Unknown state: {state}")
+
+    try:
+        # Convert start time string to datetime object
+        # Remove 'Z' suffix and add UTC timezone (+00:00)
+
+        start_time = datetime.fromisoformat(start_time.replace('Z', '+00:00'))
+        
+        
+        # Calculate end time by subtracting the time range in hours
+        end_time = start_time - timedelta(hours=time_range)
+
+        # Validate both date strings are in correct format
+        start = validate_date(start_time.isoformat(), "Start_time")
+        end = validate_date(end_time.isoformat(), "End_time")
+    except ValueError as e:
+        # Handle invalid date format errors with clear error message
+        raise HTTPException(
+            status_code=400,
+            detail=f"Invalid date format: {str(e)}"
+        )
+
+    async def build():
+        # Printing for more information for debugging purpose
+        logger.info(f"Fetching tsunami data from {end} to {start}")
+
+        # The tsunami index usually has every tsunami event of the window already
+        features = await tsunami_index.read(to_millis(parse_time(end)), to_millis(parse_time(start)), min_magnitude=2.0)
+        if features is None:
+            # Fetch data from USGS API for the area around the state, keeping only earthquakes that
+            # triggered tsunami alerts (tsunami property > 0) - the rest is dropped while the response is still downloading
+            data = await fetch_usgs_data({
+                "format": "geojson",
+                "starttime": end,
+                "endtime": start,
+                "minmagnitude": 2.0,
+                **region.search_area(),
+            }, where={"tsunami": True})
+            features = data["features"]
+        # The search circle (and the index) also hold events of other states and open ocean
+        features = index.filter(features, region.code)
+
+        return {
+            "type": "FeatureCollection",
+            "metadata": {
+                "state": region.code,
+                "state_name": region.name,
+                "time_range": f"{time_range} hours",
+                "start_time": start,
+                "end_time": end
+            },
+            "features": features
+        }
+
+    return RouteQuery("tsunami", {"state": region.code, "start": start, "end": end}, build,
+                      bucket_ttl(parse_time(start)))
+
+
 """
     Purpose: Retrieves earthquake events that triggered tsunami alerts for a specific US state
     
     What it does:
     - Validates and processes input date parameters
     - Calculates time range based on input hours
-    - Fetches earthquake data from USGS
+    - Looks the state up by code or name (404 for anything else)
+    - Reads the tsunami events from the tsunami index, or fetches earthquake data from USGS
+      for a circle around the state only
     - Filters for events with tsunami potential
+    - Keeps the events in the state or its coastal zone (see app/states.py)
     - Adds state-specific metadata to response
     
     Parameters:
-    - state: US state to get alerts for
+    - state: US state to get alerts for (code like 'CA' or name like 'california')
     - start_time: Start of time range (YYYY-MM-DDTHH:MM:SS)
     - time_range: Number of hours to look back (1-168)
     - format: Response format ('json' or 'xml')
@@ -28,11 +108,12 @@ router = APIRouter()
     - Validates date formats
     - Logs data fetching operations
     - Handles invalid input errors
+    - Returns 404 for unknown states
     
     Used for: Monitoring tsunami risks from earthquakes in specific states
     """
 @router.get("/{state}")
-def get_tsunami_alerts(
+async def get_tsunami_alerts(
     state: str,
     start_time: str = Query(..., description="Start time (YYYY-MM-DDTHH:MM:SS)"),
     time_range: int = Query(24, ge=1, le=168, description="Time range in hours (max 168)"),
@@ -42,54 +123,7 @@ def get_tsunami_alerts(
     Get earthquakes with tsunami alerts for a US state starting from a specific time
     going back by the specified number of hours.
     """
-    try:
-        # Convert start time string to datetime object
-        # Remove 'Z' suffix and add UTC timezone (+00:00)
-
-        start_time = datetime.fromisoformat(start_time.replace('Z', '+00:00'))
-        
-        
-        # Calculate end time by subtracting the time range in hours
-        end_time = start_time - timedelta(hours=time_range)
-
-        # Validate both date strings are in correct format
-        start = validate_date(start_time.isoformat(), "Start_time")
-        end = validate_date(end_time.isoformat(), "End_time")
-
-        # Printing for more information for debugging purpose
-        logger.info(f"Fetching tsunami data from {end} to {start}")
-
-        # Fetch data from USGS API
-        data = fetch_usgs_data({
-            "format": "geojson",
-            "starttime": end,
-            "endtime": start,
-            "minmagnitude": 2.0
-        })
-
-        # Filter for tsunami-related earthquakes
-        tsunami_quakes = {
-            "type": "FeatureCollection",
-            "metadata": {
-                "state": state,
-                "time_range": f"{time_range} hours",
-                "start_time": start,
-                "end_time": end
-            },
-            "features": [
+    query = tsunami_query(state, start_time, time_range)
 
-                # Only include earthquakes that triggered tsunami alerts
-                # tsunami property > 0 indicates a tsunami alert was issued
-                feature for feature in data["features"]
-                if feature["properties"].get("tsunami", 0) > 0
-            ]
-        }
-
-        return format_response(tsunami_quakes, format)
-
-    except ValueError as e:
-        # Handle invalid date format errors with clear error message
-        raise HTTPException(
-            status_code=400,
-            detail=f"Invalid date format: {str(e)}"
-        )
+    # A repeat of the same request is answered with the already encoded bytes
+    return await cached_response(query.route, query.params, format, query.build, ttl=query.ttl)
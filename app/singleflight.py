@@ -0,0 +1,132 @@
+# This file makes sure many requests for the same data share one trip to USGS
+
+import asyncio
+import time
+import uuid
+from app.config import CACHE_LOCK_TIMEOUT, CACHE_LOCK_WAIT, CACHE_LOCK_POLL_INTERVAL
+from app.redis_client import redis_pool
+from app.logger import setup_logging
+
+# Start logging the information
+logger = setup_logging()
+
+# Fetches currently running in this worker, by cache key
+_in_flight = {}
+
+# Counters showing how much upstream traffic coalescing saved
+stats = {
+    "leader_fetches": 0,         # Fetches this worker actually started
+    "coalesced_waiters": 0,      # Requests in this worker that shared someone else's fetch
+    "lock_acquired": 0,          # Times this worker won the cross-worker Redis lock
+    "lock_waits": 0,             # Times this worker waited because another worker held the lock
+    "lock_wait_hits": 0,         # Waits that ended with the other worker's result in the cache
+    "lock_wait_fallbacks": 0,    # Waits that gave up (timeout or lock freed without a result) and fetched anyway
+}
+
+# Only delete the lock if we still own it (it may have expired and been taken by someone else)
+_RELEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+def _consume_exception(task: asyncio.Task):
+    # Mark a failed fetch's exception as seen even if every waiter has gone away
+    if not task.cancelled():
+        task.exception()
+
+
+"""
+async def single_flight(key: str, fetch) -> dict:
+
+    Purpose: Runs at most one fetch per key at a time inside this worker
+    What it does:
+    - If nobody is fetching this key yet, starts `fetch()` as a task
+    - If a fetch for this key is already running, waits for it and shares its result (or error)
+    - Runs the fetch as its own task so a caller disconnecting does not cancel it for the others
+    Parameters:
+    - key: The cache key being fetched
+    - fetch: Zero-argument coroutine function that produces the data
+    Returns: The fetched data
+    Used for: Turning N concurrent cache misses for one key into one upstream call
+"""
+async def single_flight(key: str, fetch) -> dict:
+    task = _in_flight.get(key)
+    if task is None:
+        stats["leader_fetches"] += 1
+        task = asyncio.ensure_future(fetch())
+        _in_flight[key] = task
+        task.add_done_callback(lambda t: _in_flight.pop(key, None))
+        task.add_done_callback(_consume_exception)
+    else:
+        stats["coalesced_waiters"] += 1
+    return await asyncio.shield(task)
+
+
+def refresh_in_background(key: str, fetch) -> bool:
+    # Start a single-flight fetch for `key` without waiting for it; False if one is already running
+    if key in _in_flight:
+        return False
+    task = asyncio.ensure_future(single_flight(key, fetch))
+    task.add_done_callback(_consume_exception)
+    return True
+
+
+"""
+async def cluster_single_flight(key: str, fetch, read_cached) -> dict:
+
+    Purpose: Coalesces fetches for the same key across all workers using a short Redis lock
+    What it does:
+    - Tries to take the lock `lock:<key>` with SET NX and an expiry
+    - The winner fetches (and caches) the data, then releases the lock
+    - Everyone else polls the cache until the winner's result shows up
+    - If the wait takes too long (or Redis is down) it falls back to fetching itself
+    Parameters:
+    - key: The cache key being fetched
+    - fetch: Zero-argument coroutine function that fetches and caches the data
+    - read_cached: Zero-argument coroutine function returning the cached data or None
+    Returns: The fetched or cached data
+"""
+async def cluster_single_flight(key: str, fetch, read_cached) -> dict:
+    client = redis_pool.client
+    if not client:
+        return await fetch()
+
+    lock_key = f"lock:{key}"
+    token = uuid.uuid4().hex
+    try:
+        acquired = await client.set(lock_key, token, nx=True, px=int(CACHE_LOCK_TIMEOUT * 1000))
+    except Exception as e:
+        logger.warning(f"⚠️ Could not take cache lock, fetching anyway: {str(e)}")
+        return await fetch()
+
+    if acquired:
+        stats["lock_acquired"] += 1
+        try:
+            return await fetch()
+        finally:
+            try:
+                await client.eval(_RELEASE_SCRIPT, 1, lock_key, token)
+            except Exception as e:
+                logger.warning(f"⚠️ Could not release cache lock: {str(e)}")
+
+    # Another worker is already asking USGS - wait for its answer to land in the cache
+    stats["lock_waits"] += 1
+    deadline = time.monotonic() + CACHE_LOCK_WAIT
+    while time.monotonic() < deadline:
+        await asyncio.sleep(CACHE_LOCK_POLL_INTERVAL)
+        cached = await read_cached()
+        if cached is not None:
+            stats["lock_wait_hits"] += 1
+            return cached
+        try:
+            if not await client.exists(lock_key):
+                # The other worker finished without caching anything (probably an error)
+                break
+        except Exception as e:
+            logger.warning(f"⚠️ Could not check cache lock, fetching anyway: {str(e)}")
+            break
+    stats["lock_wait_fallbacks"] += 1
+    return await fetch()
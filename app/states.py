@@ -0,0 +1,191 @@
+# This file knows where the US states are, so the tsunami route returns the events of the state asked for
+# The outlines (simplified, a few dozen points per state) are bundled in app/data/us_states.geojson and
+# loaded once. A point on land belongs to the state whose outline contains it. A point outside every
+# state (at sea, mostly) belongs to the coastal states within STATE_COASTAL_ZONE_KM of it, which is where
+# the offshore earthquakes that trigger tsunami alerts happen.
+# A grid of 1-degree cells lists the states that can reach into each cell, so finding the states of an
+# event only tests the one or two outlines near it
+
+import json
+import math
+import os
+from app.config import STATE_COASTAL_ZONE_KM
+from app.logger import setup_logging
+
+# Start logging the information
+logger = setup_logging()
+
+STATES_PATH = os.path.join(os.path.dirname(__file__), "data", "us_states.geojson")
+
+KM_PER_DEGREE = 111.195
+EARTH_RADIUS_KM = 6371.0
+GRID_DEGREES = 1.0
+
+
+def _distance_km(lat1, lon1, lat2, lon2) -> float:
+    # Great-circle distance between two points on Earth
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return EARTH_RADIUS_KM * 2 * math.asin(math.sqrt(min(1.0, a)))
+
+
+def _inside(ring: list, lon: float, lat: float) -> bool:
+    # Ray casting: a point is inside if a ray from it crosses the outline an odd number of times
+    inside = False
+    x1, y1 = ring[-1]
+    for x2, y2 in ring:
+        if (y1 > lat) != (y2 > lat) and lon < x1 + (lat - y1) * (x2 - x1) / (y2 - y1):
+            inside = not inside
+        x1, y1 = x2, y2
+    return inside
+
+
+def _distance_to_ring_km(ring: list, lon: float, lat: float) -> float:
+    # Shortest distance from the point to the outline, on a flat map centred on the point
+    # (close enough for the few hundred km of a coastal zone)
+    scale = math.cos(math.radians(lat))
+    best = math.inf
+    x1, y1 = (ring[-1][0] - lon) * scale, ring[-1][1] - lat
+    for px, py in ring:
+        x2, y2 = (px - lon) * scale, py - lat
+        dx, dy = x2 - x1, y2 - y1
+        t = 0.0 if dx == dy == 0 else max(0.0, min(1.0, -(x1 * dx + y1 * dy) / (dx * dx + dy * dy)))
+        best = min(best, math.hypot(x1 + t * dx, y1 + t * dy))
+        x1, y1 = x2, y2
+    return best * KM_PER_DEGREE
+
+
+class StateRegion:
+    """
+    One state: its outline (one or more polygons, [lon, lat] points; longitudes may run past -180 for
+    places west of the antimeridian, like the western Aleutians) and how far its coastal zone reaches.
+    """
+
+    def __init__(self, code: str, name: str, polygons: list, zone_km: float):
+        self.code = code
+        self.name = name
+        self.polygons = polygons
+        self.zone_km = zone_km
+        points = [point for ring in polygons for point in ring]
+        lats = [lat for _, lat in points]
+        lons = [lon for lon, _ in points]
+        self.outline_bbox = (min(lons), min(lats), max(lons), max(lats))
+        # Bounding box of the region (outline plus coastal zone), in degrees
+        pad_lat = zone_km / KM_PER_DEGREE
+        pad_lon = zone_km / (KM_PER_DEGREE * max(0.1, math.cos(math.radians(min(89.0, max(map(abs, lats)) + pad_lat)))))
+        self.bbox = (min(lons) - pad_lon, min(lats) - pad_lat, max(lons) + pad_lon, max(lats) + pad_lat)
+        # A circle around the region, for USGS searches (latitude/longitude/maxradiuskm); the centre is
+        # rounded so the search parameters stay short
+        self.center = (round((self.bbox[1] + self.bbox[3]) / 2, 2), round((min(lons) + max(lons)) / 2, 2))
+        self.radius_km = max(_distance_km(self.center[0], self.center[1], lat, lon) for lon, lat in points) + zone_km
+
+    def _near_lon(self, lon: float) -> float:
+        # The same longitude, written the way this region writes its own (e.g. 173 -> -187 for Alaska)
+        return lon + 360 * round((self.center[1] - lon) / 360)
+
+    def inside(self, lat: float, lon: float) -> bool:
+        # Whether a point is inside the state's outline
+        lon = self._near_lon(lon)
+        min_lon, min_lat, max_lon, max_lat = self.outline_bbox
+        if not (min_lat <= lat <= max_lat and min_lon <= lon <= max_lon):
+            return False
+        return any(_inside(ring, lon, lat) for ring in self.polygons)
+
+    def near(self, lat: float, lon: float) -> bool:
+        # Whether a point is in the state's coastal zone (inland states have none)
+        if self.zone_km <= 0:
+            return False
+        lon = self._near_lon(lon)
+        min_lon, min_lat, max_lon, max_lat = self.bbox
+        if not (min_lat <= lat <= max_lat and min_lon <= lon <= max_lon):
+            return False
+        return any(_distance_to_ring_km(ring, lon, lat) <= self.zone_km for ring in self.polygons)
+
+    def search_area(self) -> dict:
+        # USGS query parameters for a circle around the region
+        return {
+            "latitude": f"{self.center[0]:g}",
+            "longitude": f"{(self.center[1] + 180) % 360 - 180:g}",
+            "maxradiuskm": f"{math.ceil(self.radius_km)}",
+        }
+
+
+class StateIndex:
+    """
+    All states, found by code or name, plus a grid telling which states can contain a point.
+    """
+
+    def __init__(self, regions: list):
+        self.regions = {region.code: region for region in regions}
+        self._names = {}
+        for region in regions:
+            self._names[_normalize(region.code)] = region
+            self._names[_normalize(region.name)] = region
+        self._grid = {}
+        for region in regions:
+            min_lon, min_lat, max_lon, max_lat = region.bbox
+            for x in range(math.floor(min_lon / GRID_DEGREES), math.floor(max_lon / GRID_DEGREES) + 1):
+                for y in range(math.floor(min_lat / GRID_DEGREES), math.floor(max_lat / GRID_DEGREES) + 1):
+                    self._grid.setdefault(self._cell(x * GRID_DEGREES, y * GRID_DEGREES), []).append(region)
+
+    @staticmethod
+    def _cell(lon: float, lat: float) -> tuple:
+        # Cells wrap around the antimeridian, so -187 and 173 are the same cell
+        columns = round(360 / GRID_DEGREES)
+        return math.floor(lon / GRID_DEGREES) % columns, math.floor(lat / GRID_DEGREES)
+
+    def resolve(self, state: str):
+        # The state for a code or name ("CA", "ca", "California", "new-york", "New_York"), or None
+        return self._names.get(_normalize(state))
+
+    def states_at(self, lat: float, lon: float) -> list:
+        # Codes of the state the point is in, or else of every coastal state whose zone reaches it
+        nearby = self._grid.get(self._cell(lon, lat), [])
+        land = [region.code for region in nearby if region.inside(lat, lon)]
+        return land or [region.code for region in nearby if region.near(lat, lon)]
+
+    def filter(self, features: list, code: str) -> list:
+        # The features located in the state (or its coastal zone), in the same order
+        return [f for f in features
+                if code in self.states_at(f["geometry"]["coordinates"][1], f["geometry"]["coordinates"][0])]
+
+
+def _normalize(name: str) -> str:
+    return "".join(ch for ch in name.lower() if ch.isalnum())
+
+
+"""
+def load_states(path: str = STATES_PATH, zone_km: float = STATE_COASTAL_ZONE_KM) -> StateIndex:
+
+    Purpose: Reads the bundled state outlines and builds the lookup grid
+    Parameters:
+    - path: GeoJSON FeatureCollection with one MultiPolygon per state, "id" = two-letter code,
+      properties "name" and "coastal"
+    - zone_km: How far the coastal zone of a coastal state reaches from its outline
+    Returns: StateIndex
+"""
+def load_states(path: str = STATES_PATH, zone_km: float = STATE_COASTAL_ZONE_KM) -> StateIndex:
+    with open(path) as f:
+        collection = json.load(f)
+    regions = []
+    for feature in collection["features"]:
+        polygons = [[tuple(point) for point in polygon[0][:-1]] for polygon in feature["geometry"]["coordinates"]]
+        regions.append(StateRegion(feature["id"], feature["properties"]["name"], polygons,
+                                   zone_km if feature["properties"].get("coastal") else 0.0))
+    return StateIndex(regions)
+
+
+_index = None
+
+
+def get_index() -> StateIndex:
+    # Loaded on first use (the app's lifespan does it at startup)
+    global _index
+    if _index is None:
+        _index = load_states()
+        logger.info(f"🗺️ Loaded {len(_index.regions)} state outlines")
+    return _index
+
+
+def resolve(state: str):
+    return get_index().resolve(state)
@@ -0,0 +1,285 @@
+# This file keeps an index of the events USGS flags with a tsunami alert, so the tsunami route
+# answers from a handful of records instead of every M2+ event on Earth in its window
+# The index lives in Redis (shared by all workers; in this worker only when Redis is unavailable) and
+# records which hours it holds completely. It is filled from every USGS answer that holds all
+# tsunami events of its window, and the ingester's leader keeps the last days up to date with
+# small "what changed since" requests
+
+import math
+import time
+from datetime import datetime, timedelta, timezone
+from app.config import (
+    TSUNAMI_INDEX_ENABLED,
+    TSUNAMI_INDEX_INTERVAL,
+    TSUNAMI_INDEX_LOOKBACK_HOURS,
+    TSUNAMI_INDEX_MIN_MAGNITUDE,
+    INCREMENTAL_OVERLAP_SECONDS,
+    BUCKET_SETTLE_SECONDS,
+    CACHE_DURATION,
+)
+from app.redis_client import redis_pool
+from app.codec import encode, decode
+from app.containment import local_filter
+from app.usgs_client import fetch_json
+from app.windows import parse_time, to_millis, format_time, floor_time, next_boundary
+from app.logger import setup_logging
+
+# Start logging the information
+logger = setup_logging()
+
+EVENTS_KEY = "tsunami:events"      # Sorted set: event id -> event time (ms)
+FEATURES_KEY = "tsunami:features"  # Hash: event id -> the GeoJSON feature (packed by app/codec.py)
+COVERAGE_KEY = "tsunami:coverage"  # Hash: start of an hour (ms) -> when we last had all its tsunami events (ms)
+
+# The index knows it is complete hour by hour
+SLOT_MS = 3600 * 1000
+
+# A USGS answer holds every tsunami event of its window only if it was limited by nothing but time
+# and a magnitude floor no higher than ours
+_COMPLETE_PARAMS = {"format", "starttime", "endtime", "minmagnitude"}
+
+TSUNAMI_ONLY = {"tsunami": True}
+
+# Counters showing what the index did in this worker
+stats = {
+    "hits": 0,               # Tsunami requests answered from the index
+    "misses": 0,             # Requests the index didn't fully cover
+    "syncs": 0,              # Full syncs of the last TSUNAMI_INDEX_LOOKBACK_HOURS
+    "incremental_syncs": 0,  # Syncs that only asked for the events updated since the last one
+    "errors": 0,             # Index reads/writes or syncs that failed
+}
+
+# Used instead of Redis when it is unavailable: event id -> (time, feature), hour start -> synced at (ms)
+_local_events = {}
+_local_coverage = {}
+
+# Unix time of this worker's last sync (None until it ran once)
+_last_sync = None
+
+
+def enabled() -> bool:
+    return TSUNAMI_INDEX_ENABLED
+
+
+def reset():
+    # Forget everything kept in this worker
+    global _last_sync
+    _local_events.clear()
+    _local_coverage.clear()
+    _last_sync = None
+
+
+def _is_tsunami(feature: dict) -> bool:
+    properties = feature["properties"]
+    return ((properties.get("tsunami") or 0) > 0 and properties.get("status") != "deleted"
+            and properties.get("mag") is not None and properties["mag"] >= TSUNAMI_INDEX_MIN_MAGNITUDE)
+
+
+def _slots_inside(start_ms: int, end_ms: int) -> list:
+    # The hours that lie completely inside [start_ms, end_ms]
+    first = math.ceil(start_ms / SLOT_MS) * SLOT_MS
+    return list(range(first, end_ms - SLOT_MS + 1, SLOT_MS))
+
+
+def _slots_touching(start_ms: int, end_ms: int) -> list:
+    # The hours [start_ms, end_ms] reaches into (a window ending right on the hour doesn't count the
+    # next hour: an event at exactly that millisecond is in every answer that covered the hour before)
+    return list(range(start_ms // SLOT_MS * SLOT_MS, end_ms, SLOT_MS))
+
+
+"""
+async def _write(add: list, remove: set, slots: list, synced_at: int):
+
+    Purpose: Changes the index in one go
+    Parameters:
+    - add: Tsunami features to add or replace (by event id)
+    - remove: Event ids to drop
+    - slots: Hours the index now holds completely
+    - synced_at: When we had their events (ms)
+"""
+async def _write(add: list, remove: set, slots: list, synced_at: int):
+    remove = remove - {feature["id"] for feature in add}
+    client = redis_pool.binary_client
+    if client:
+        try:
+            pipe = client.pipeline()
+            if remove:
+                pipe.zrem(EVENTS_KEY, *remove)
+                pipe.hdel(FEATURES_KEY, *remove)
+            if add:
+                pipe.zadd(EVENTS_KEY, {feature["id"]: feature["properties"]["time"] for feature in add})
+                pipe.hset(FEATURES_KEY, mapping={feature["id"]: encode(feature, feature=True, record=False)
+                                                 for feature in add})
+            if slots:
+                pipe.hset(COVERAGE_KEY, mapping={slot: synced_at for slot in slots})
+            await pipe.execute()
+            return
+        except Exception as e:
+            stats["errors"] += 1
+            logger.warning(f"⚠️ Could not write the tsunami index to Redis, keeping it locally: {str(e)}")
+    for event_id in remove:
+        _local_events.pop(event_id, None)
+    for feature in add:
+        _local_events[feature["id"]] = (feature["properties"]["time"], feature)
+    for slot in slots:
+        _local_coverage[slot] = synced_at
+
+
+async def _ids_between(start_ms: int, end_ms: int) -> set:
+    # Ids of the indexed events with start_ms <= time < end_ms
+    client = redis_pool.binary_client
+    if client:
+        try:
+            return {member.decode() for member in await client.zrangebyscore(EVENTS_KEY, start_ms, f"({end_ms}")}
+        except Exception as e:
+            stats["errors"] += 1
+            logger.warning(f"⚠️ Could not read the tsunami index: {str(e)}")
+    return {event_id for event_id, (event_time, _) in _local_events.items() if start_ms <= event_time < end_ms}
+
+
+"""
+async def remember(clean_params: dict, data: dict, where: dict = None, synced_at: float = None):
+
+    Purpose: Adds the tsunami events of a fresh USGS answer to the index
+    What it does:
+    - Does nothing unless the answer holds every tsunami event in its window (only limited by time
+      and a magnitude floor up to TSUNAMI_INDEX_MIN_MAGNITUDE, and at most filtered to tsunami events)
+    - Replaces what the index has for the whole hours inside the window (so events that lost
+      their tsunami flag or were deleted disappear) and marks those hours as complete
+    Parameters:
+    - clean_params: The USGS query parameters of the answer, all strings
+    - data: The answer (a FeatureCollection)
+    - where: Local filters it was fetched with (see containment.local_filter)
+    - synced_at: Unix time we asked USGS (defaults to now)
+"""
+async def remember(clean_params: dict, data: dict, where: dict = None, synced_at: float = None):
+    if not enabled() or set(clean_params) - _COMPLETE_PARAMS or (where and where != TSUNAMI_ONLY):
+        return
+    if "starttime" not in clean_params or "endtime" not in clean_params:
+        return
+    if float(clean_params.get("minmagnitude", "-inf")) > TSUNAMI_INDEX_MIN_MAGNITUDE:
+        return
+    start_ms = to_millis(parse_time(clean_params["starttime"]))
+    end_ms = to_millis(parse_time(clean_params["endtime"]))
+    synced_at = int((time.time() if synced_at is None else synced_at) * 1000)
+    add = [f for f in data.get("features", []) if _is_tsunami(f) and start_ms <= f["properties"]["time"] <= end_ms]
+    slots = _slots_inside(start_ms, end_ms)
+    remove = await _ids_between(slots[0], slots[-1] + SLOT_MS) if slots else set()
+    await _write(add, remove, slots, synced_at)
+
+
+"""
+async def read(start_ms: int, end_ms: int, min_magnitude: float = TSUNAMI_INDEX_MIN_MAGNITUDE, now: float = None):
+
+    Purpose: Answers "which tsunami events happened between these times" from the index
+    What it does:
+    - Checks that the index holds every hour the window reaches into: hours that are still filling up
+      only count if they were synced in the last CACHE_DURATION seconds, hours that haven't started
+      have no events yet
+    - Returns the indexed events in the window, newest first (like USGS)
+    Parameters:
+    - start_ms, end_ms: The window, in ms
+    - min_magnitude: Smallest magnitude wanted (the index only holds TSUNAMI_INDEX_MIN_MAGNITUDE and up)
+    - now: Current unix time (tests pass their own)
+    Returns: List of GeoJSON features, or None if the index doesn't cover the window
+"""
+async def read(start_ms: int, end_ms: int, min_magnitude: float = TSUNAMI_INDEX_MIN_MAGNITUDE, now: float = None):
+    if not enabled():
+        return None
+    now_ms = int((time.time() if now is None else now) * 1000)
+    slots = [slot for slot in _slots_touching(start_ms, end_ms) if slot <= now_ms]
+    try:
+        features = await _read(start_ms, end_ms, slots, now_ms)
+    except Exception as e:
+        stats["errors"] += 1
+        logger.warning(f"⚠️ Could not read the tsunami index: {str(e)}")
+        features = None
+    if features is None or min_magnitude < TSUNAMI_INDEX_MIN_MAGNITUDE:
+        stats["misses"] += 1
+        return None
+    features = [f for f in features if f["properties"]["mag"] >= min_magnitude]
+    stats["hits"] += 1
+    logger.info(f"🌊 Answered {len(features)} tsunami events from the index")
+    return features
+
+
+def _covered(slot: int, synced_at, now_ms: int) -> bool:
+    if synced_at is None:
+        return False
+    settled = slot + SLOT_MS <= now_ms - BUCKET_SETTLE_SECONDS * 1000
+    return settled or int(synced_at) >= now_ms - CACHE_DURATION * 1000
+
+
+async def _read(start_ms: int, end_ms: int, slots: list, now_ms: int):
+    client = redis_pool.binary_client
+    if client:
+        # Coverage and event ids in one round trip, then the events themselves
+        pipe = client.pipeline(transaction=False)
+        pipe.zrevrangebyscore(EVENTS_KEY, end_ms, start_ms)
+        if slots:
+            pipe.hmget(COVERAGE_KEY, slots)
+        ids, *coverage = await pipe.execute()
+        if slots and not all(_covered(slot, synced_at, now_ms) for slot, synced_at in zip(slots, coverage[0])):
+            return None
+        if not ids:
+            return []
+        blobs = await client.hmget(FEATURES_KEY, ids)
+        if any(blob is None for blob in blobs):
+            return None
+        return [decode(blob) for blob in blobs]
+
+    if not all(_covered(slot, _local_coverage.get(slot), now_ms) for slot in slots):
+        return None
+    events = [(event_time, feature) for event_time, feature in _local_events.values()
+              if start_ms <= event_time <= end_ms]
+    events.sort(key=lambda event: event[0], reverse=True)
+    return [feature for _, feature in events]
+
+
+"""
+async def sync(now: datetime = None) -> int:
+
+    Purpose: Brings the index up to date for the last TSUNAMI_INDEX_LOOKBACK_HOURS hours
+    What it does:
+    - The first time: fetches every M2+ event of the window, keeping only tsunami events while
+      the response downloads, and replaces the window in the index
+    - After that: only asks for the events updated since the last sync (`updatedafter`, deletions
+      included, no magnitude floor so downgraded events show up too) and adds, replaces or drops them;
+      events that happened since then were also updated since then, so this is complete too
+    - Marks every hour of the window as synced
+    Parameters:
+    - now: Current time (tests pass a time inside their fake catalog)
+    Returns: Number of events received from USGS
+"""
+async def sync(now: datetime = None) -> int:
+    global _last_sync
+    now = now or datetime.now(timezone.utc)
+    end = next_boundary(floor_time(now, "hour"), "hour")
+    start = end - timedelta(hours=TSUNAMI_INDEX_LOOKBACK_HOURS)
+    synced_at = time.time()
+    if _last_sync is None:
+        params = {"format": "geojson", "starttime": format_time(start), "endtime": format_time(end),
+                  "minmagnitude": str(TSUNAMI_INDEX_MIN_MAGNITUDE)}
+        received = await fetch_json(params, keep=local_filter(TSUNAMI_ONLY))
+        await remember(params, received, TSUNAMI_ONLY, synced_at)
+        stats["syncs"] += 1
+    else:
+        updated_after = datetime.fromtimestamp(_last_sync - INCREMENTAL_OVERLAP_SECONDS, timezone.utc)
+        received = await fetch_json({
+            "format": "geojson",
+            "starttime": format_time(start),
+            "endtime": format_time(end),
+            "updatedafter": format_time(updated_after),
+            "includedeleted": "true",
+        })
+        features = received.get("features", [])
+        await _write([f for f in features if _is_tsunami(f)], {f["id"] for f in features if not _is_tsunami(f)},
+               _slots_inside(to_millis(start), to_millis(end)), int(synced_at * 1000))
+        stats["incremental_syncs"] += 1
+    _last_sync = synced_at
+    return len(received.get("features", []))
+
+
+def sync_due() -> bool:
+    # Whether the ingester's leader should run sync now
+    return enabled() and (_last_sync is None or time.time() - _last_sync >= TSUNAMI_INDEX_INTERVAL)
@@ -0,0 +1,160 @@
+# This file keeps one shared, connection-pooled HTTP client for talking to USGS
+# (every request goes through app/resilience.py: retries, hedging, circuit breaker and time budgets)
+
+import httpx
+from app.config import (
+    USGS_API_URL,
+    USGS_COUNT_URL,
+    USGS_MAX_CONNECTIONS,
+    USGS_MAX_KEEPALIVE_CONNECTIONS,
+    USGS_KEEPALIVE_EXPIRY,
+    USGS_HTTP2,
+    USGS_TIMEOUT,
+    USGS_CONNECT_TIMEOUT,
+    USGS_READ_TIMEOUT,
+)
+from app.json_stream import FeatureCollectionParser
+from app.resilience import call_usgs, hedged
+from app.logger import setup_logging
+
+# Start logging the information
+logger = setup_logging()
+
+# The one client every request shares - created at app startup, closed at shutdown
+http_client = None
+
+
+"""
+def _http2_available() -> bool:
+
+    Purpose: Checks whether the optional 'h2' package needed for HTTP/2 is installed
+    Returns: True if HTTP/2 can be used, False otherwise
+"""
+def _http2_available() -> bool:
+    try:
+        import h2  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+"""
+async def start_http_client() -> httpx.AsyncClient:
+
+    Purpose: Creates the shared HTTP client used for every USGS request
+    What it does:
+    - Opens a connection pool sized by USGS_MAX_CONNECTIONS
+    - Keeps idle connections alive so repeat requests skip the TCP/TLS handshake
+    - Turns on HTTP/2 when requested and the 'h2' package is available
+    - Gives up connecting after USGS_CONNECT_TIMEOUT and waiting for bytes after USGS_READ_TIMEOUT seconds
+    Returns: The shared httpx.AsyncClient
+    Used for: Called once from the application lifespan when the app starts
+"""
+async def start_http_client() -> httpx.AsyncClient:
+    global http_client
+    if http_client is None:
+        http2 = USGS_HTTP2 and _http2_available()
+        if USGS_HTTP2 and not http2:
+            logger.warning("⚠️ USGS_HTTP2 is on but the 'h2' package is missing, using HTTP/1.1")
+        http_client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=USGS_MAX_CONNECTIONS,
+                max_keepalive_connections=USGS_MAX_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=USGS_KEEPALIVE_EXPIRY,
+            ),
+            timeout=httpx.Timeout(USGS_TIMEOUT, connect=USGS_CONNECT_TIMEOUT, read=USGS_READ_TIMEOUT),
+            http2=http2,
+        )
+        logger.info(f"🌐 USGS HTTP client started (max {USGS_MAX_CONNECTIONS} connections, http2={http2})")
+    return http_client
+
+
+"""
+async def close_http_client():
+
+    Purpose: Closes the shared HTTP client and all of its pooled connections
+    Used for: Called from the application lifespan when the app shuts down
+"""
+async def close_http_client():
+    global http_client
+    if http_client is not None:
+        await http_client.aclose()
+        http_client = None
+        logger.info("🌐 USGS HTTP client closed")
+
+
+"""
+async def get_http_client() -> httpx.AsyncClient:
+
+    Purpose: Returns the shared HTTP client, creating it if the app lifespan has not run yet
+    Returns: The shared httpx.AsyncClient
+"""
+async def get_http_client() -> httpx.AsyncClient:
+    if http_client is None:
+        return await start_http_client()
+    return http_client
+
+
+"""
+async def fetch_json(params: dict, keep=None) -> dict:
+
+    Purpose: Asks the USGS API for earthquake data over the shared connection pool
+    What it does:
+    - Streams the response body and decodes features as they arrive (never the whole body at once)
+    - Drops features failing `keep` right away, so only the wanted ones are ever kept
+    - Retries, hedges and fails fast while USGS is unhealthy (see resilience.call_usgs and hedged)
+    Parameters:
+    - params: Dictionary of query parameters for USGS API (already strings)
+    - keep: Optional feature -> bool check applied while the body downloads
+    Returns: The decoded GeoJSON FeatureCollection
+    Raises: httpx.HTTPError if the request fails or USGS answers with an error status (after retries;
+            resilience.CircuitOpenError / DeadlineExceeded when USGS wasn't asked or was too slow),
+            ValueError if the body is not a complete FeatureCollection
+"""
+async def fetch_json(params: dict, keep=None) -> dict:
+    client = await get_http_client()
+
+    async def send() -> httpx.Response:
+        # Returns as soon as the headers arrived; the body is streamed below
+        return await client.send(client.build_request("GET", USGS_API_URL, params=params), stream=True)
+
+    async def attempt() -> dict:
+        response = await hedged("query", send, discard=_close)
+        try:
+            response.raise_for_status()
+            parser = FeatureCollectionParser(keep)
+            async for chunk in response.aiter_bytes():
+                parser.feed(chunk)
+            return parser.close()
+        finally:
+            await response.aclose()
+
+    return await call_usgs("query", attempt)
+
+
+async def _close(response: httpx.Response):
+    await response.aclose()
+
+
+"""
+async def count_events(params: dict) -> int:
+
+    Purpose: Asks USGS how many events a search would return, without fetching them
+    Parameters:
+    - params: Dictionary of query parameters for USGS API (already strings)
+    Returns: The number of matching events
+    Used for: Deciding whether a window has to be split into chunks before fetching it
+"""
+async def count_events(params: dict) -> int:
+    client = await get_http_client()
+
+    async def attempt() -> httpx.Response:
+        response = await hedged("count", lambda: client.get(USGS_COUNT_URL, params=params))
+        response.raise_for_status()
+        return response
+
+    response = await call_usgs("count", attempt)
+    # format=geojson gives {"count": n, "maxAllowed": 20000}, otherwise the answer is just the number
+    if params.get("format") == "geojson":
+        return int(response.json()["count"])
+    return int(response.text.strip())
@@ -1,13 +1,22 @@
 # This file contains helpful tools we use throughout our earthquake service
 
 from fastapi import HTTPException, Response
-from fastapi.responses import JSONResponse
 from datetime import datetime
-import requests
 import json
-import xmltodict
-from app.config import USGS_API_URL, CACHE_DURATION
-from app.redis_client import redis_client
+import httpx
+from app.config import CACHE_DURATION, FETCH_CONCURRENCY, CACHE_STALE_WHILE_REVALIDATE, CACHE_STALE_IF_ERROR
+from app.cache import get_cached, get_cached_entry, set_cached, set_local, make_cache_key, mark_stale, stale_stats, fresh_for
+from app import containment
+from app.containment import find_supersets, filter_to, widen, remember_variant, local_filter
+from app.usgs_client import fetch_json
+from app.resilience import DeadlineExceeded
+from app.limiter import UpstreamBusy, retry_after
+from app.chunking import plan_chunks, record_density, gather_limited
+from app import event_store, hotkeys, tsunami_index
+from app.singleflight import single_flight, cluster_single_flight, refresh_in_background
+from app.windows import parse_time, format_time, split_window, bucket_ttl, merge_buckets
+from app.codec import dumps_json
+from app.xml_writer import to_xml
 from app.logger import setup_logging
 
 # Start logging the information
@@ -42,49 +51,309 @@ def validate_date(date_str: str, param_name: str = "date") -> str:
 
 
 """
-def fetch_usgs_data(params: dict) -> dict:
+async def fetch_cached(clean_params: dict, ttl: int = CACHE_DURATION, where: dict = None) -> dict:
+
+    Purpose: Gets the USGS answer for exactly these parameters, from cache if we can
+    What it does:
+    - Checks the in-process cache, then Redis, for existing data
+    - If cached data exists, returns it (shared and read-only - don't modify it)
+    - If no cached data, fetches from USGS API without blocking the event loop
+      (busy windows are split into individually cached chunks first, see fetch_window)
+    - Concurrent misses for the same search share one USGS request (in this worker and across workers)
+    - Stores new data in cache for `ttl` seconds
+    - Data that expired less than CACHE_STALE_WHILE_REVALIDATE seconds ago is returned right away
+      while one background fetch replaces it; older data is only returned if USGS fails
+      (up to CACHE_STALE_IF_ERROR seconds after it expired). Either way the request is marked stale
+    Parameters:
+    - clean_params: Dictionary of USGS query parameters, all strings
+    - ttl: Seconds to cache a freshly fetched answer
+    - where: Local filters (see containment.local_filter) applied while the response downloads
+    Returns: Dictionary containing earthquake data
+"""
+async def fetch_cached(clean_params: dict, ttl: int = CACHE_DURATION, where: dict = None) -> dict:
+    data, _ = await fetch_cached_entry(clean_params, ttl, where)
+    return data
+
+
+async def fetch_cached_entry(clean_params: dict, ttl: int = CACHE_DURATION, where: dict = None) -> tuple:
+    # fetch_cached, but returns (data, whether it is stale)
+    # Create a special label for this specific search
+    cache_key = make_cache_key(clean_params, where)
+
+    def fetch_and_store():
+        return _fetch_and_store(clean_params, cache_key, ttl, where)
+
+    # Check if we already wrote down this information (in this worker first, then Redis)
+    cached = await get_cached_entry(cache_key)
+    stale = None
+    if cached is not None:
+        cached_data, stale_for = cached
+        if not stale_for:
+            return cached_data, False
+        if stale_for <= CACHE_STALE_WHILE_REVALIDATE:
+            # Only just expired - answer with it now and let one background fetch replace it
+            stale_stats["stale_served"] += 1
+            if refresh_in_background(cache_key, lambda: _fetch_once(cache_key, fetch_and_store)):
+                stale_stats["background_refreshes"] += 1
+            mark_stale()
+            return cached_data, True
+        if stale_for <= CACHE_STALE_IF_ERROR:
+            stale = cached_data
+    logger.info("❌ Cache MISS: Fetching from USGS API")
+
+    # Only one request per search goes to USGS, everyone else waiting for it shares the answer
+    try:
+        return await single_flight(cache_key, lambda: _fetch_once(cache_key, fetch_and_store)), False
+    except Exception as e:
+        if stale is None:
+            raise
+        # Old data beats an error
+        logger.warning(f"⚠️ USGS failed, serving expired data: {str(e)}")
+        stale_stats["stale_on_error"] += 1
+        mark_stale()
+        return stale, True
+
+
+async def _fetch_and_store(clean_params: dict, cache_key: str, ttl: int, where: dict = None) -> dict:
+    # If we didn't find it in our notes, ask USGS (over our shared, kept-alive connections)
+    data = await fetch_window(clean_params, cache_key, ttl, where)
+
+    # Write down this new information for the next request
+    await set_cached(cache_key, data, ttl)
+    return data
+
+
+def _fetch_once(cache_key: str, fetch_and_store):
+    # One fetch across all workers; the others wait for it to land in the cache
+    return cluster_single_flight(cache_key, fetch_and_store, lambda: get_cached(cache_key))
+
+
+"""
+async def fetch_window(clean_params: dict, cache_key: str, ttl: int, where: dict = None) -> dict:
+
+    Purpose: Fetches one search from USGS, in chunks if it is too busy for a single request
+    What it does:
+    - Answers from the local event store instead when the store holds the whole search
+    - If the store held it but synced a while ago, only asks USGS for the events updated since
+      (see event_store.refresh_covered)
+    - Asks chunking.plan_chunks whether the window needs splitting (past density or the USGS count method)
+    - Fetches a quiet window with a single request
+    - Fetches the chunks of a busy window through the cache, at most FETCH_CONCURRENCY at a time,
+      so a partly cached window only asks USGS for the missing chunks
+    - If USGS refuses a window as too big anyway (HTTP 400), counts it and splits it after all
+    - Merges the chunks in time order without duplicates
+    - Keeps every fresh answer in the local event store; if USGS fails, answers from the store if it can
+    - Adds the tsunami events of fitting answers to the tsunami index
+    Parameters:
+    - clean_params: Dictionary of USGS query parameters, all strings
+    - cache_key: Cache key of the search
+    - ttl: Seconds to cache the chunks
+    - where: Local filters (see containment.local_filter)
+    Returns: Dictionary containing earthquake data
+"""
+async def fetch_window(clean_params: dict, cache_key: str, ttl: int, where: dict = None) -> dict:
+    if not _can_bucket(clean_params):
+        return await fetch_json(clean_params, keep=local_filter(where))
+
+    data = await event_store.read_covered(clean_params, where)
+    if data is not None:
+        return data
+
+    try:
+        data = await event_store.refresh_covered(clean_params, where)
+        if data is not None:
+            return data
+        windows = await plan_chunks(clean_params, cache_key, ttl)
+        if len(windows) == 1:
+            try:
+                data = await fetch_json(clean_params, keep=local_filter(where))
+            except httpx.HTTPStatusError as e:
+                # USGS answers 400 when a search matches more events than it is willing to return
+                if e.response.status_code != 400:
+                    raise
+                windows = await plan_chunks(clean_params, cache_key, ttl, recount=True)
+                if len(windows) == 1:
+                    raise
+    except httpx.HTTPError:
+        # USGS is down or failing - whatever the store has for this window beats an error
+        data = await event_store.read_covered(clean_params, where, fresh=False)
+        if data is not None:
+            return data
+        raise
+
+    if len(windows) == 1:
+        if not where:
+            record_density(clean_params, len(data.get("features", [])))
+        await event_store.remember(clean_params, data, where)
+        await tsunami_index.remember(clean_params, data, where)
+        return data
+
+    results = await gather_limited(
+        [fetch_cached(dict(clean_params, starttime=start, endtime=end), ttl, where) for start, end in windows],
+        FETCH_CONCURRENCY,
+    )
+    return merge_buckets(results, parse_time(clean_params["starttime"]), parse_time(clean_params["endtime"]))
+
+
+"""
+async def fetch_contained(clean_params: dict, ttl: int = CACHE_DURATION, where: dict = None) -> dict:
+
+    Purpose: Gets the answer to a search, reusing any cached search that contains it
+    What it does:
+    - Returns the exact search from cache if we have it
+    - Otherwise looks for a cached search of the same window and centre with a lower
+      minmagnitude or bigger radius, and filters it down locally
+    - On a real miss, fetches a widened search (minmagnitude lowered to CONTAINMENT_MIN_MAGNITUDE)
+      so later searches with other thresholds can reuse it, then filters
+    - With local filters (`where`), a miss is fetched as is and filtered while it downloads,
+      so only the wanted events are kept and cached
+    - Notes the search for the response being built, so a hot query can refresh it (see app/hotkeys.py)
+    Parameters:
+    - clean_params: Dictionary of USGS query parameters, all strings
+    - ttl: Seconds to cache a freshly fetched answer
+    - where: Local filters (see containment.local_filter), e.g. {"tsunami": True}
+    Returns: Dictionary containing earthquake data
+    Used for: Collapsing many per-threshold dashboard searches into one upstream fetch per window
+"""
+async def fetch_contained(clean_params: dict, ttl: int = CACHE_DURATION, where: dict = None) -> dict:
+    cache_key = make_cache_key(clean_params, where)
+    hotkeys.note_search(cache_key, clean_params, ttl, where)
+    cached_data = await get_cached(cache_key)
+    if cached_data is not None:
+        return cached_data
+
+    # Do we already have a looser version of this search? Then we only need to filter it
+    # (with local filters, the unfiltered search itself is such a version)
+    candidates = await find_supersets(clean_params)
+    if where:
+        candidates.insert(0, clean_params)
+    for superset_params in candidates:
+        superset = await get_cached(make_cache_key(superset_params))
+        if superset is not None:
+            containment.stats["superset_hits"] += 1
+            data = filter_to(superset, clean_params, where)
+            set_local(cache_key, data, ttl)
+            return data
+
+    if where:
+        return await fetch_cached(clean_params, ttl, where)
+
+    fetch_params = widen(clean_params)
+    data, stale = await fetch_cached_entry(fetch_params, ttl)
+    await remember_variant(fetch_params, ttl)
+    if fetch_params is clean_params:
+        return data
+    containment.stats["widened_fetches"] += 1
+    data = filter_to(data, clean_params)
+    if not stale:
+        set_local(cache_key, data, ttl)
+    return data
+
+
+"""
+async def refresh_search(clean_params: dict, ttl: int = CACHE_DURATION, where: dict = None, ahead: float = 0) -> bool:
+
+    Purpose: Fetches a search again before its cached answer expires
+    What it does:
+    - Works out which cache entry the search is served from on a miss (the widened search,
+      see fetch_contained) and does nothing if it stays fresh for at least `ahead` seconds
+    - Otherwise fetches it from USGS and caches it (one fetch per search across all workers),
+      and keeps the search's own filtered answer in L1 so its next request is a plain hit
+    Parameters:
+    - clean_params: Dictionary of USGS query parameters, all strings
+    - ttl: Seconds to cache the new answer
+    - where: Local filters (see containment.local_filter)
+    - ahead: Entries with at least this many seconds of freshness left are left alone
+    Returns: True if it fetched, False if the entry was still fresh enough
+    Used for: Refreshing the most popular searches ahead of time (see app/hotkeys.py)
+"""
+async def refresh_search(clean_params: dict, ttl: int = CACHE_DURATION, where: dict = None, ahead: float = 0) -> bool:
+    fetch_params = clean_params if where else widen(clean_params)
+    cache_key = make_cache_key(fetch_params, where)
+    if ahead > 0 and await fresh_for(cache_key) >= ahead:
+        return False
+
+    data = await single_flight(cache_key, lambda: _fetch_once(
+        cache_key, lambda: _fetch_and_store(fetch_params, cache_key, ttl, where)))
+    if fetch_params is not clean_params:
+        await remember_variant(fetch_params, ttl)
+        set_local(make_cache_key(clean_params), filter_to(data, clean_params), ttl)
+    return True
+
+
+"""
+async def fetch_bucketed(clean_params: dict, where: dict = None) -> dict:
+
+    Purpose: Answers a time-window search from independently cached time buckets
+    What it does:
+    - Splits starttime/endtime into hour/day/month/year aligned buckets
+    - Fetches every bucket through the cache at the same time (past buckets are cached for hours),
+      reusing cached buckets of looser searches where possible (at most FETCH_CONCURRENCY at a time)
+    - Trims the edge buckets to the requested window and merges them, without duplicates
+    Parameters:
+    - clean_params: Dictionary of USGS query parameters including starttime and endtime
+    - where: Local filters applied to every bucket
+    Returns: A GeoJSON FeatureCollection for the requested window
+    Used for: Letting searches with overlapping or slightly shifted windows share upstream fetches
+"""
+async def fetch_bucketed(clean_params: dict, where: dict = None) -> dict:
+    start = parse_time(clean_params["starttime"])
+    end = parse_time(clean_params["endtime"])
+    buckets = split_window(start, end)
+
+    bucket_fetches = []
+    for bucket_start, bucket_end in buckets:
+        bucket_params = dict(clean_params, starttime=format_time(bucket_start), endtime=format_time(bucket_end))
+        bucket_fetches.append(fetch_contained(bucket_params, bucket_ttl(bucket_end), where))
+    results = await gather_limited(bucket_fetches, FETCH_CONCURRENCY)
+    return merge_buckets(results, start, end)
+
+
+def _can_bucket(clean_params: dict) -> bool:
+    # Only plain time-window searches can be cut into buckets and glued back together
+    if "starttime" not in clean_params or "endtime" not in clean_params:
+        return False
+    if any(name in clean_params for name in ("limit", "offset", "orderby")):
+        return False
+    try:
+        return parse_time(clean_params["starttime"]) < parse_time(clean_params["endtime"])
+    except ValueError:
+        return False
+
+
+"""
+async def fetch_usgs_data(params: dict, where: dict = None) -> dict:
 
     Purpose: Retrieves earthquake data from USGS API with caching
     What it does:
-    - Checks Redis cache for existing data
-    - If cached data exists, returns it
-    - If no cached data, fetches from USGS API
-    - Stores new data in cache for future use
-    - Handles errors in API communication
+    - Splits time-window searches into cached time buckets (see fetch_bucketed)
+    - Fetches anything else as a single cached search (see fetch_contained)
+    - Handles errors in API communication: 504 when the request ran out of its time budget,
+      503 with Retry-After when the shared USGS limits are used up, 503 for anything else
     Parameters:
     - params: Dictionary of query parameters for USGS API
-    Returns: Dictionary containing earthquake data
+    - where: Filters USGS can't apply, applied by us while the response downloads
+      ({"tsunami": True} and/or {"minfelt": n})
+    Returns: Dictionary containing earthquake data (shared - don't modify it)
     Used for: Getting earthquake information while minimizing API calls
 """
 
-def fetch_usgs_data(params: dict) -> dict:
-    # Get earthquake data from USGS, but first check if we already have it as cache in Redis server.
+async def fetch_usgs_data(params: dict, where: dict = None) -> dict:
+    # Get earthquake data from USGS, but first check if we already have it in our caches.
     try:
         # Make sure all our search terms are text strings
         clean_params = {k: str(v) for k, v in params.items()}
-        # Create a special label for this specific search
-        cache_key = f"usgs_data:{json.dumps(clean_params, sort_keys=True)}"
-
-        # If we have our notepad (Redis) working:
-        if redis_client:
-            # Check if we already wrote down this information
-            cached_data = redis_client.get(cache_key)
-            if cached_data:
-                logger.info("🎯 Cache HIT: Returning cached data")
-                return json.loads(cached_data)
-            logger.info("❌ Cache MISS: Fetching from USGS API")
-        # If we didn't find it in our notes, ask USGS
-        response = requests.get(USGS_API_URL, params=clean_params)
-        response.raise_for_status()
-        data = response.json()
-
-
-        # If our notepad is working, write down this new information
-        if redis_client:
-            redis_client.setex(cache_key, CACHE_DURATION, json.dumps(data))
-            logger.info("💾 Stored new data in cache")
-            
-        return data
+        if _can_bucket(clean_params):
+            return await fetch_bucketed(clean_params, where)
+        return await fetch_contained(clean_params, where=where)
+    except UpstreamBusy as e:
+        # Shed: too many requests to USGS right now, and nothing cached to answer with
+        logger.warning(f"🚦 Shedding a request: {str(e)}")
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": retry_after(e)})
+    except DeadlineExceeded as e:
+        # USGS was too slow for this route's time budget (see ROUTE_DEADLINES)
+        logger.error(f"Error fetching data: {str(e)}")
+        raise HTTPException(status_code=504, detail=f"USGS took too long: {str(e)}")
     except Exception as e:
         # If anything goes wrong, write it in our diary and tell the user
         logger.error(f"Error fetching data: {str(e)}")
@@ -92,6 +361,21 @@ def fetch_usgs_data(params: dict) -> dict:
 
 
 
+"""
+def encode_response(data: dict, format_type: str = 'json') -> tuple:
+
+    Purpose: Encodes response data in the requested format (JSON or XML)
+    Returns: Tuple of (body bytes, media type)
+    Used for: Building response bodies once so they can be cached and sent again as they are
+"""
+def encode_response(data: dict, format_type: str = 'json') -> tuple:
+    if format_type.lower() == 'xml':
+        # If they want XML, convert our data to XML format (same elements as xmltodict.unparse)
+        return to_xml(data), "application/xml"
+    # Otherwise, give them JSON (this is like our default wrapping paper)
+    return dumps_json(data), "application/json"
+
+
 """
 def format_response(data: dict, format_type: str = 'json'):
     
@@ -108,9 +392,5 @@ def format_response(data: dict, format_type: str = 'json'):
 """
 def format_response(data: dict, format_type: str = 'json'):
     #  Package our earthquake data in the format the user wants (JSON or XML)
-    if format_type.lower() == 'xml':
-        # If they want XML, convert our data to XML format
-        xml_data = xmltodict.unparse({"response": data}, pretty=True)
-        return Response(content=xml_data, media_type="application/xml")
-    # Otherwise, give them JSON (this is like our default wrapping paper)
-    return JSONResponse(content=data)
+    body, media_type = encode_response(data, format_type)
+    return Response(content=body, media_type=media_type)
@@ -0,0 +1,178 @@
+# This file splits a search's time window into fixed, calendar-aligned buckets
+# so overlapping searches (like a sliding "last 24 hours") can share cached pieces
+
+from datetime import datetime, timedelta, timezone
+from app.config import CACHE_DURATION, WINDOW_MAX_BUCKETS, BUCKET_SETTLE_SECONDS, HISTORICAL_CACHE_DURATION
+from app.columns import merge_columns
+
+# The format USGS (and our validate_date) uses for times
+TIME_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+# Bucket sizes we try, from smallest to largest
+BUCKET_UNITS = ("hour", "day", "month", "year")
+
+
+def parse_time(value: str) -> datetime:
+    # USGS treats times without a timezone as UTC, so do we
+    parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.astimezone(timezone.utc)
+
+
+def format_time(value: datetime) -> str:
+    return value.astimezone(timezone.utc).strftime(TIME_FORMAT)
+
+
+def to_millis(value: datetime) -> int:
+    # USGS reports event times as milliseconds since 1970
+    return int(value.timestamp() * 1000)
+
+
+def floor_time(value: datetime, unit: str) -> datetime:
+    # Round down to the start of the hour/day/month/year the time falls in
+    if unit == "hour":
+        return value.replace(minute=0, second=0, microsecond=0)
+    if unit == "day":
+        return value.replace(hour=0, minute=0, second=0, microsecond=0)
+    if unit == "month":
+        return value.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    return value.replace(month=1, day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def next_boundary(value: datetime, unit: str) -> datetime:
+    # The start of the bucket after the one starting at `value`
+    if unit == "hour":
+        return value + timedelta(hours=1)
+    if unit == "day":
+        return value + timedelta(days=1)
+    if unit == "month":
+        if value.month == 12:
+            return value.replace(year=value.year + 1, month=1)
+        return value.replace(month=value.month + 1)
+    return value.replace(year=value.year + 1)
+
+
+"""
+def split_window(start: datetime, end: datetime) -> list:
+
+    Purpose: Cuts a time window into canonical, calendar-aligned buckets
+    What it does:
+    - Picks the smallest bucket size (hour, day, month, year) that needs at most WINDOW_MAX_BUCKETS buckets
+    - Returns every bucket the window touches, so the first and last may stick out past the window
+    - A window ending exactly on a boundary stops there: USGS end times are inclusive, so the last
+      bucket already holds events at that instant (only an empty window gets its one bucket anyway)
+    Parameters:
+    - start: Start of the requested window (UTC)
+    - end: End of the requested window (UTC)
+    Returns: List of (bucket_start, bucket_end) tuples in time order
+    Used for: Giving searches that overlap in time the same cache keys
+"""
+def split_window(start: datetime, end: datetime) -> list:
+    for unit in BUCKET_UNITS:
+        buckets = []
+        bucket_start = floor_time(start, unit)
+        while bucket_start < end or not buckets:
+            bucket_end = next_boundary(bucket_start, unit)
+            buckets.append((bucket_start, bucket_end))
+            if len(buckets) > WINDOW_MAX_BUCKETS and unit != BUCKET_UNITS[-1]:
+                break
+            bucket_start = bucket_end
+        if len(buckets) <= WINDOW_MAX_BUCKETS or unit == BUCKET_UNITS[-1]:
+            return buckets
+    return buckets
+
+
+"""
+def bucket_ttl(bucket_end: datetime, now: datetime = None) -> int:
+
+    Purpose: Decides how long a bucket may stay cached
+    Returns: HISTORICAL_CACHE_DURATION for buckets that ended well in the past
+             (the catalog barely changes there), otherwise CACHE_DURATION
+"""
+def bucket_ttl(bucket_end: datetime, now: datetime = None) -> int:
+    now = now or datetime.now(timezone.utc)
+    if bucket_end <= now - timedelta(seconds=BUCKET_SETTLE_SECONDS):
+        return HISTORICAL_CACHE_DURATION
+    return CACHE_DURATION
+
+
+"""
+def merge_buckets(results: list, start: datetime, end: datetime) -> dict:
+
+    Purpose: Stitches cached buckets back into the answer for the requested window
+    What it does:
+    - Drops events outside [start, end] (the edge buckets stick out past the window)
+    - Removes duplicates by event id (an event exactly on a bucket boundary shows up in both)
+    - Orders events newest first, like USGS does
+    - Does all of that on the buckets' columnar copies when it can (see app/columns.py)
+    Parameters:
+    - results: USGS FeatureCollections, one per bucket
+    - start, end: The requested window (UTC)
+    Returns: A single GeoJSON FeatureCollection for the window
+"""
+def merge_buckets(results: list, start: datetime, end: datetime) -> dict:
+    start_ms, end_ms = to_millis(start), to_millis(end)
+    merged_columns = merge_columns(results, start_ms, end_ms)
+    if merged_columns is not None:
+        features = merged_columns.features
+    else:
+        seen = set()
+        features = []
+        for result in results:
+            for feature in result.get("features", []):
+                event_time = feature["properties"].get("time")
+                if event_time is None or not start_ms <= event_time <= end_ms:
+                    continue
+                if feature.get("id") in seen:
+                    continue
+                seen.add(feature.get("id"))
+                features.append(feature)
+        features.sort(key=lambda f: f["properties"]["time"], reverse=True)
+
+    # Keep the USGS metadata of the newest bucket, but with the numbers for this answer
+    metadata = dict(results[-1].get("metadata", {})) if results else {}
+    metadata.pop("url", None)
+    metadata["count"] = len(features)
+    merged = {"type": "FeatureCollection", "metadata": metadata, "features": features}
+
+    if merged_columns is not None:
+        if features:
+            merged["bbox"] = merged_columns.bbox()
+    elif features:
+        coordinates = [f["geometry"]["coordinates"] for f in features]
+        lons, lats, depths = zip(*[(c[0], c[1], c[2] if len(c) > 2 and c[2] is not None else 0) for c in coordinates])
+        merged["bbox"] = [min(lons), min(lats), min(depths), max(lons), max(lats), max(depths)]
+    return merged
+
+
+"""
+def merge_updates(data: dict, updates: dict, keep=None) -> dict:
+
+    Purpose: Applies the changes USGS reported since our last sync to an answer we already have
+    What it does:
+    - Adds new events and replaces revised ones, matching them by event id
+    - Drops deleted events (status "deleted") and events `keep` rejects (revised out of the search)
+    - Ignores revisions older than the copy we already have
+    - Orders events newest first, like USGS does
+    Parameters:
+    - data: The answer from the last sync (left untouched)
+    - updates: USGS FeatureCollection of events updated since then (`updatedafter`, `includedeleted`)
+    - keep: Optional feature -> bool check for events that belong in this answer
+    Returns: The up to date FeatureCollection
+"""
+def merge_updates(data: dict, updates: dict, keep=None) -> dict:
+    features = {f["id"]: f for f in data.get("features", [])}
+    for feature in updates.get("features", []):
+        current = features.get(feature["id"])
+        if current is not None and (current["properties"].get("updated") or 0) > (feature["properties"].get("updated") or 0):
+            continue
+        if feature["properties"].get("status") == "deleted" or (keep is not None and not keep(feature)):
+            features.pop(feature["id"], None)
+        else:
+            features[feature["id"]] = feature
+
+    ordered = sorted(features.values(), key=lambda f: f["properties"]["time"], reverse=True)
+    metadata = dict(data.get("metadata", {}))
+    metadata["count"] = len(ordered)
+    return {"type": "FeatureCollection", "metadata": metadata, "features": ordered}
@@ -0,0 +1,110 @@
+# This file writes our responses as XML piece by piece, so a big answer never has to exist
+# as one giant string. The output has the same elements as xmltodict.unparse({"response": data})
+
+from xml.sax.saxutils import escape, quoteattr
+from app.config import XML_PRETTY, XML_CHUNK_SIZE
+
+XML_DECLARATION = '<?xml version="1.0" encoding="utf-8"?>\n'
+
+# xmltodict's conventions for attributes and text inside an element
+ATTR_PREFIX = '@'
+TEXT_KEY = '#text'
+
+
+def _as_element(value):
+    # Turn a value into (attributes, text, children) the same way xmltodict does
+    if value is None:
+        value = {}
+    elif isinstance(value, bool):
+        value = 'true' if value else 'false'
+    elif not isinstance(value, dict):
+        value = str(value)
+    if isinstance(value, str):
+        return {}, value, []
+
+    attrs, text, children = {}, None, []
+    for key, item in value.items():
+        if key == TEXT_KEY:
+            text = item
+        elif key.startswith(ATTR_PREFIX):
+            attrs[key[len(ATTR_PREFIX):]] = item if isinstance(item, str) else str(item)
+        else:
+            children.append((key, item))
+    return attrs, text, children
+
+
+def _items(value) -> list:
+    # A list becomes one element per item with the same tag, anything else is a single element
+    if isinstance(value, (list, tuple)):
+        return value
+    return [value]
+
+
+def _write(out: list, key: str, value, depth: int, pretty: bool):
+    # Append one element (and everything inside it) to `out`
+    attrs, text, children = _as_element(value)
+    if pretty:
+        out.append('\t' * depth)
+    out.append('<' + key)
+    for name, attr in attrs.items():
+        out.append(f' {name}={quoteattr(attr)}')
+    out.append('>')
+    if pretty and children:
+        out.append('\n')
+    for child_key, child_value in children:
+        for item in _items(child_value):
+            _write(out, child_key, item, depth + 1, pretty)
+    if text is not None:
+        out.append(escape(text))
+    if pretty and children:
+        out.append('\t' * depth)
+    out.append(f'</{key}>')
+    if pretty and depth:
+        out.append('\n')
+
+
+"""
+def iter_xml(data: dict, root: str = "response", pretty: bool = XML_PRETTY):
+
+    Purpose: Writes response data as an XML document in chunks
+    What it does:
+    - Writes the declaration and the opening <response> tag first
+    - Writes the root's children one by one; list children (like the features) one item at a time
+    - Hands out the text in pieces of roughly XML_CHUNK_SIZE bytes as it goes
+    Parameters:
+    - data: The response data (a GeoJSON FeatureCollection)
+    - root: Name of the outer element
+    - pretty: Indent with tabs and put every element on its own line, like xmltodict's pretty=True
+    Returns: Generator of UTF-8 encoded chunks
+    Used for: Streaming big XML answers without building the whole document in memory
+"""
+def iter_xml(data: dict, root: str = "response", pretty: bool = XML_PRETTY):
+    attrs, text, children = _as_element(data)
+    chunk = [XML_DECLARATION, '<' + root]
+    for name, attr in attrs.items():
+        chunk.append(f' {name}={quoteattr(attr)}')
+    chunk.append('>')
+    if pretty and children:
+        chunk.append('\n')
+
+    size = 0
+    for key, value in children:
+        for item in _items(value):
+            part = []
+            _write(part, key, item, 1, pretty)
+            part = ''.join(part)
+            chunk.append(part)
+            size += len(part)
+            if size >= XML_CHUNK_SIZE:
+                yield ''.join(chunk).encode('utf-8')
+                chunk, size = [], 0
+
+    if text is not None:
+        chunk.append(escape(text))
+    chunk.append(f'</{root}>')
+    yield ''.join(chunk).encode('utf-8')
+
+
+def to_xml(data: dict, root: str = "response", pretty: bool = XML_PRETTY) -> bytes:
+    # The whole document at once, for small answers and the response cache
+    return b''.join(iter_xml(data, root, pretty))
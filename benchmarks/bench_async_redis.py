@@ -0,0 +1,102 @@
+"""
+Benchmark: Redis-bound cache hits under concurrency, blocking client vs. the async connection pool
+- sync client: one redis.Redis shared by every request, called from async code (blocks the event loop)
+- async pool: the app's redis_pool (redis.asyncio on a BlockingConnectionPool), one round trip per hit
+- async pool, pipelined: the same hits looked up BATCH keys at a time in one round trip (like /batch does)
+Every hit reads a cached response (GET + PTTL, like app/response_cache.py) with nothing kept in-process.
+Also reports the longest time the event loop was stuck, which is what other requests wait for.
+Needs a Redis server
+
+Run with: python benchmarks/bench_async_redis.py [hits] [concurrency]
+"""
+
+import asyncio
+import os
+import random
+import sys
+import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "tests")))
+
+from app.codec import encode, dumps_json
+from app.redis_client import get_redis_client, redis_pool
+from fake_usgs import make_catalog
+
+KEYS = 200
+BATCH = 10
+PREFIX = "usgs_response:bench-async-redis:"
+
+
+def fill(client) -> list:
+    # Cached responses of about the size of a day of Bay Area events
+    features = make_catalog(2000)
+    keys = []
+    for i in range(KEYS):
+        body = dumps_json({"type": "FeatureCollection", "features": features[i % 20 * 50:(i % 20 + 1) * 50]})
+        client.setex(PREFIX + str(i), 600, encode(b"application/json\n" + body, key=PREFIX))
+        keys.append(PREFIX + str(i))
+    return keys
+
+
+async def watch_loop(stop: asyncio.Event) -> float:
+    # The longest the event loop took to come back to us (ideally ~1ms)
+    worst = 0.0
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(0.001)
+        worst = max(worst, time.perf_counter() - started - 0.001)
+    return worst
+
+
+async def drive(hit, keys: list, hits: int, concurrency: int, per_call: int = 1) -> tuple:
+    stop = asyncio.Event()
+    watcher = asyncio.ensure_future(watch_loop(stop))
+    calls = hits // per_call // concurrency
+
+    async def worker():
+        for _ in range(calls):
+            await hit(random.sample(keys, per_call))
+
+    started = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - started
+    stop.set()
+    return calls * per_call * concurrency / elapsed, await watcher
+
+
+async def main(hits: int, concurrency: int):
+    sync_client = get_redis_client(decode_responses=False)
+    if sync_client is None or not await redis_pool.start():
+        sys.exit("Needs a running Redis server")
+    keys = fill(sync_client)
+
+    async def sync_hit(batch):
+        for key in batch:
+            pipe = sync_client.pipeline()
+            pipe.get(key)
+            pipe.pttl(key)
+            pipe.execute()
+
+    async def async_hit(batch):
+        pipe = redis_pool.binary_client.pipeline(transaction=False)
+        for key in batch:
+            pipe.get(key)
+            pipe.pttl(key)
+        await pipe.execute()
+
+    try:
+        print(f"{hits} hits, {concurrency} concurrent requests, pool of {redis_pool.max_connections} connections")
+        print(f"{'client':<24} {'hits/s':>10} {'worst loop stall':>17}")
+        for label, hit, per_call in (("sync client", sync_hit, 1), ("async pool", async_hit, 1),
+                                     (f"async pool, {BATCH} per trip", async_hit, BATCH)):
+            throughput, stall = await drive(hit, keys, hits, concurrency, per_call)
+            print(f"{label:<24} {throughput:>10.0f} {stall * 1000:>15.1f}ms")
+    finally:
+        sync_client.delete(*keys)
+        await redis_pool.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000,
+                     int(sys.argv[2]) if len(sys.argv) > 2 else 50))
@@ -0,0 +1,89 @@
+"""
+Benchmark: filtering and merging cached results in plain Python vs. on their columnar (NumPy) copies
+- python: walks the feature dicts one by one (the old path, COLUMNAR_ENABLED off)
+- columns (cold): the first request for a result, building its columnar copy included
+- columns (warm): every later request for the same cached result (the copy is reused)
+Filters: the /earthquake-felt felt-report filter, a magnitude + radius cut of a cached wider search,
+and merging 24 time buckets into one answer
+
+Run with: python benchmarks/bench_columnar.py [feature counts...]
+"""
+
+import os
+import sys
+import time
+from datetime import datetime, timezone
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "tests")))
+
+from app import columns
+from app.containment import filter_to
+from app.windows import merge_buckets
+from fake_usgs import make_catalog
+
+START = datetime(2024, 1, 1, tzinfo=timezone.utc)
+END = datetime(2024, 1, 31, tzinfo=timezone.utc)
+REPEATS = 5
+
+
+def collection(features: list) -> dict:
+    return {"type": "FeatureCollection", "metadata": {"count": len(features)}, "features": features}
+
+
+def felt_filter(data: dict, _buckets: list) -> int:
+    return len(filter_to(data, {}, where={"minfelt": 10})["features"])
+
+
+def old_felt_filter(data: dict, _buckets: list) -> int:
+    # The list comprehension /earthquake-felt used before
+    return len([
+        feature for feature in data["features"]
+        if feature["properties"].get("felt", 0) is not None
+        and int(feature["properties"].get("felt", 0)) >= 10
+    ])
+
+
+def magnitude_radius(data: dict, _buckets: list) -> int:
+    params = {"latitude": "37.7749", "longitude": "-122.4194", "minmagnitude": "3.5", "maxradiuskm": "80"}
+    return len(filter_to(data, params)["features"])
+
+
+def merge(_data: dict, buckets: list) -> int:
+    return len(merge_buckets(buckets, START, END)["features"])
+
+
+def timed(fn, data: dict, buckets: list, repeats: int) -> float:
+    started = time.perf_counter()
+    for _ in range(repeats):
+        fn(data, buckets)
+    return (time.perf_counter() - started) / repeats
+
+
+def main(counts: list):
+    print(f"{'features':>9} {'operation':<18} {'python':>10} {'cold':>10} {'warm':>10} {'speedup':>8}")
+    for count in counts:
+        features = make_catalog(count)
+        size = max(count // 24, 1)
+        buckets = [collection(features[i:i + size]) for i in range(0, count, size)]
+        for label, fn, python_fn in (
+            ("felt filter", felt_filter, old_felt_filter),
+            ("magnitude+radius", magnitude_radius, magnitude_radius),
+            ("merge 24 buckets", merge, merge),
+        ):
+            columns.COLUMNAR_ENABLED = False
+            python = timed(python_fn, collection(features), buckets, REPEATS)
+            columns.COLUMNAR_ENABLED = True
+            columns.clear()
+            data = collection(features)
+            cold = timed(fn, data, buckets, 1)
+            warm = timed(fn, data, buckets, REPEATS)
+            print(f"{count:>9} {label:<18} {python * 1000:>8.2f}ms {cold * 1000:>8.2f}ms {warm * 1000:>8.2f}ms "
+                  f"{python / warm:>7.1f}x")
+
+
+if __name__ == "__main__":
+    if columns.np is None:
+        sys.exit("numpy is not installed - pip install numpy")
+    counts = [int(arg) for arg in sys.argv[1:]] or [10000, 100000]
+    main(counts)
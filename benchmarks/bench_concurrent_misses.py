@@ -0,0 +1,86 @@
+"""
+Benchmark: throughput of concurrent cache misses, old sync path vs. async pooled client
+Runs both against the local fake USGS server with a fixed upstream latency so the
+difference comes only from how many misses a single worker can keep in flight
+
+Run with: python benchmarks/bench_concurrent_misses.py [requests] [latency_seconds]
+"""
+
+import asyncio
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "tests")))
+
+import httpx
+import requests
+from fastapi import FastAPI, Query
+
+import app.redis_client
+from app import limiter
+import app.usgs_client as usgs_client
+from app.main import app as async_app
+from fake_usgs import FakeUSGSServer
+
+
+def build_sync_app(url: str) -> FastAPI:
+    # The way fetch_usgs_data used to work: a plain 'def' route and a fresh requests.get per miss
+    sync_app = FastAPI()
+
+    @sync_app.get("/earthquake/sf")
+    def get_sf_earthquakes(start_time: str = Query(...), end_time: str = Query(...)):
+        response = requests.get(url, params={
+            "format": "geojson", "starttime": start_time, "endtime": end_time, "minmagnitude": "2.0",
+            "latitude": "37.7749", "longitude": "-122.4194", "maxradiuskm": "100",
+        })
+        response.raise_for_status()
+        return response.json()
+
+    return sync_app
+
+
+async def drive(target_app, total: int) -> float:
+    first_day = datetime(2024, 1, 1)
+    transport = httpx.ASGITransport(app=target_app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+        started = time.perf_counter()
+        responses = await asyncio.gather(*[
+            client.get("/earthquake/sf", params={
+                "start_time": (first_day + timedelta(hours=i)).strftime("%Y-%m-%dT%H:%M:%S"),
+                "end_time": (first_day + timedelta(hours=i, minutes=59)).strftime("%Y-%m-%dT%H:%M:%S"),
+            })
+            for i in range(total)
+        ])
+        elapsed = time.perf_counter() - started
+    assert all(r.status_code == 200 for r in responses)
+    return elapsed
+
+
+async def main(total: int, latency: float):
+    with FakeUSGSServer(latency=latency) as server:
+        usgs_client.USGS_API_URL = server.url
+        # Measure misses only, as many at a time as the client manages
+        app.redis_client.redis_pool.enabled = False
+        limiter.UPSTREAM_MAX_CONCURRENCY = limiter.UPSTREAM_RATE = 0
+
+        elapsed = await drive(build_sync_app(server.url), total)
+        print(f"sync  (requests + threadpool): {total} misses in {elapsed:6.2f}s "
+              f"-> {total / elapsed:7.1f} req/s, max upstream in flight {server.max_in_flight}")
+
+        server.reset_counters()
+        await usgs_client.start_http_client()
+        try:
+            elapsed = await drive(async_app, total)
+        finally:
+            await usgs_client.close_http_client()
+        print(f"async (pooled httpx client):   {total} misses in {elapsed:6.2f}s "
+              f"-> {total / elapsed:7.1f} req/s, max upstream in flight {server.max_in_flight}")
+
+
+if __name__ == "__main__":
+    total = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+    latency = float(sys.argv[2]) if len(sys.argv) > 2 else 0.2
+    asyncio.run(main(total, latency))
@@ -0,0 +1,70 @@
+"""
+Benchmark: USGS answer times with a slow tail, without and with hedged requests
+The fake USGS answers most requests after `latency` seconds and a few (`slow_share`) after `slow` seconds,
+like a real upstream with an occasional stuck request. Both runs fetch the same searches one at a time;
+the hedged run sends a second request when the first is slower than USGS_HEDGE_PERCENTILE of recent answers.
+Reports the median, p95, p99 and worst time per search and how many requests USGS got
+
+Run with: python benchmarks/bench_hedging.py [searches] [slow_share] [slow_seconds] [latency_seconds]
+"""
+
+import asyncio
+import os
+import random
+import sys
+import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "tests")))
+
+from app import limiter, resilience
+import app.usgs_client as usgs_client
+from fake_usgs import FakeUSGSServer
+
+PARAMS = {"format": "geojson", "starttime": "2024-01-05T00:00:00", "endtime": "2024-01-05T01:00:00"}
+
+
+def percentile(times: list, p: float) -> float:
+    ordered = sorted(times)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+
+async def run(server: FakeUSGSServer, searches: int, slow_share: float, slow: float, latency: float) -> tuple:
+    # Same random slow requests for both runs
+    rng = random.Random(42)
+    server.delays = [slow if rng.random() < slow_share else latency for _ in range(searches * 2)]
+    server.reset_counters()
+    times = []
+    for _ in range(searches):
+        started = time.perf_counter()
+        await usgs_client.fetch_json(PARAMS)
+        times.append(time.perf_counter() - started)
+    return times, server.request_count
+
+
+async def main(searches: int, slow_share: float, slow: float, latency: float):
+    with FakeUSGSServer(latency=latency) as server:
+        usgs_client.USGS_API_URL = server.url
+        # Only hedging decides how many requests USGS gets
+        limiter.UPSTREAM_MAX_CONCURRENCY = limiter.UPSTREAM_RATE = 0
+        await usgs_client.start_http_client()
+        try:
+            print(f"{searches} searches, {slow_share:.0%} of USGS answers take {slow}s instead of {latency}s")
+            print(f"{'':<10} {'median':>9} {'p95':>9} {'p99':>9} {'worst':>9} {'USGS requests':>14}")
+            for label, hedge_percentile in (("no hedge", 0), ("hedged", 95)):
+                resilience.reset()
+                resilience.USGS_HEDGE_PERCENTILE = hedge_percentile
+                # Let the hedge see enough answers to know what "slow" means
+                await run(server, resilience.USGS_HEDGE_MIN_SAMPLES, 0, slow, latency)
+                times, requests = await run(server, searches, slow_share, slow, latency)
+                print(f"{label:<10} " + " ".join(f"{percentile(times, p) * 1000:>7.0f}ms" for p in (50, 95, 99, 100))
+                      + f" {requests:>14}")
+        finally:
+            await usgs_client.close_http_client()
+
+
+if __name__ == "__main__":
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 300,
+                     float(sys.argv[2]) if len(sys.argv) > 2 else 0.03,
+                     float(sys.argv[3]) if len(sys.argv) > 3 else 1.0,
+                     float(sys.argv[4]) if len(sys.argv) > 4 else 0.05))
@@ -0,0 +1,93 @@
+"""
+Benchmark: Redis memory and hit latency of overlapping cached searches, stored whole vs. per event
+- whole: every search is one compressed FeatureCollection (each event copied into every search holding it)
+- per event: every event stored once (usgs_event:<id>:<updated>), searches stored as lists of event ids
+Traffic: sliding 7-day windows over a month, one per day, each at three magnitude floors,
+like a set of dashboards looking at "the last week"
+Memory is the sum of the stored value sizes (STRLEN) plus a rough per-key overhead; needs a Redis server
+
+Run with: python benchmarks/bench_normalized_events.py [catalog size]
+"""
+
+import asyncio
+import os
+import sys
+import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "tests")))
+
+from app import cache
+from app.redis_client import get_redis_client, redis_pool
+from fake_usgs import make_catalog
+
+DAY_MS = 86400 * 1000
+KEY_OVERHEAD = 64  # Roughly what Redis needs per key besides the value
+PREFIX = "usgs_data:bench-normalized:"
+
+
+def searches(features: list) -> dict:
+    # Newest first, like USGS answers
+    start = min(f["properties"]["time"] for f in features)
+    result = {}
+    for day in range(24):
+        window_start, window_end = start + day * DAY_MS, start + (day + 7) * DAY_MS
+        for min_mag in (2.0, 3.0, 4.5):
+            kept = [f for f in features
+                    if window_start <= f["properties"]["time"] < window_end and f["properties"]["mag"] >= min_mag]
+            kept.sort(key=lambda f: f["properties"]["time"], reverse=True)
+            result[f"{PREFIX}{day}:{min_mag}"] = {"type": "FeatureCollection",
+                                                  "metadata": {"count": len(kept)}, "features": kept}
+    return result
+
+
+def stored_bytes(client, keys: list) -> tuple:
+    keys = keys + list(client.scan_iter(match=cache.EVENT_KEY_PREFIX + "*"))
+    pipe = client.pipeline()
+    for key in keys:
+        pipe.strlen(key)
+    return len(keys), sum(pipe.execute()) + KEY_OVERHEAD * len(keys)
+
+
+def clear(client, keys: list):
+    events = list(client.scan_iter(match=cache.EVENT_KEY_PREFIX + "*"))
+    if keys or events:
+        client.delete(*keys, *events)
+
+
+async def run(client, data: dict, normalize: bool) -> tuple:
+    cache.CACHE_NORMALIZE_EVENTS = normalize
+    keys = list(data)
+    clear(client, keys)
+    for key, result in data.items():
+        await cache.set_cached(key, result, 3600)
+    count, size = stored_bytes(client, keys)
+
+    # Hit latency from Redis (L1 emptied before every read)
+    started = time.perf_counter()
+    for key in keys:
+        cache.l1_cache.clear()
+        await cache.get_cached(key)
+    per_hit = (time.perf_counter() - started) / len(keys)
+    clear(client, keys)
+    return count, size, per_hit
+
+
+async def main(catalog_size: int):
+    client = get_redis_client(decode_responses=False)
+    if client is None or not await redis_pool.start():
+        sys.exit("Needs a running Redis server")
+    data = searches(make_catalog(catalog_size))
+    events = sum(len(result["features"]) for result in data.values())
+    print(f"{len(data)} searches holding {events} events ({catalog_size} distinct)")
+    print(f"{'storage':<10} {'keys':>7} {'memory':>10} {'hit from Redis':>15}")
+    try:
+        for label, normalize in (("whole", False), ("per event", True)):
+            count, size, per_hit = await run(client, data, normalize)
+            print(f"{label:<10} {count:>7} {size / 1024 / 1024:>8.2f}MB {per_hit * 1000:>13.2f}ms")
+    finally:
+        await redis_pool.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000))
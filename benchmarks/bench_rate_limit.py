@@ -0,0 +1,79 @@
+"""
+Benchmark: what per-client rate limiting adds to a request that is answered from the response cache
+- off: no rate limiting
+- local: this worker's own sliding window counters (no Redis)
+- redis: the shared sliding window, one script call per request
+Requests go through the whole app (middleware included) one at a time; reports median and p99 latency
+and how much the limiter added to the median. The redis run needs a Redis server (skipped without one)
+
+Run with: python benchmarks/bench_rate_limit.py [requests]
+"""
+
+import asyncio
+import os
+import sys
+import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "tests")))
+
+import httpx
+
+import app.usgs_client as usgs_client
+from app import hotkeys, limiter, ratelimit
+from app.main import app as async_app
+from app.redis_client import redis_pool
+from fake_usgs import FakeUSGSServer
+
+PARAMS = {"start_time": "2024-01-05T00:00:00", "end_time": "2024-01-06T00:00:00"}
+
+
+def percentile(times: list, p: float) -> float:
+    ordered = sorted(times)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+
+async def drive(client: httpx.AsyncClient, total: int) -> list:
+    times = []
+    for _ in range(total):
+        started = time.perf_counter()
+        response = await client.get("/earthquake/sf", params=PARAMS, headers={"X-API-Key": "bench"})
+        times.append(time.perf_counter() - started)
+        assert response.status_code == 200
+    return times
+
+
+async def main(total: int):
+    with FakeUSGSServer() as server:
+        usgs_client.USGS_API_URL = server.url
+        usgs_client.USGS_COUNT_URL = server.count_url
+        hotkeys.HOT_KEYS_ENABLED = False
+        limiter.UPSTREAM_MAX_CONCURRENCY = limiter.UPSTREAM_RATE = 0
+        ratelimit.RATE_LIMIT_REQUESTS = total * 10
+        await usgs_client.start_http_client()
+        transport = httpx.ASGITransport(app=async_app)
+        try:
+            async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+                # Fill the response cache, so every timed request is a hit
+                await client.get("/earthquake/sf", params=PARAMS)
+                print(f"{total} cached requests, one at a time")
+                print(f"{'rate limit':<12} {'median':>10} {'p99':>10} {'added':>10}")
+                baseline = None
+                for label in ("off", "local", "redis"):
+                    ratelimit.RATE_LIMIT_ENABLED = label != "off"
+                    if label == "redis" and not await redis_pool.start():
+                        print("redis        skipped (needs a Redis server)")
+                        continue
+                    ratelimit.reset()
+                    times = await drive(client, total)
+                    median = percentile(times, 50)
+                    baseline = median if baseline is None else baseline
+                    print(f"{label:<12} {median * 1e6:>8.0f}us {percentile(times, 99) * 1e6:>8.0f}us "
+                          f"{(median - baseline) * 1e6:>8.0f}us")
+        finally:
+            await redis_pool.close()
+            await usgs_client.close_http_client()
+
+
+if __name__ == "__main__":
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000))
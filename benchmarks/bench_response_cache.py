@@ -0,0 +1,56 @@
+"""
+Benchmark: cost of a cache hit on a large FeatureCollection, before and after the response cache
+- before: json.loads of the cached string, then JSONResponse re-encodes it with the standard json module
+- after:  the encoded bytes come straight out of the response cache
+Also compares encoding on the miss path (JSONResponse vs. dumps_json)
+
+Run with: python benchmarks/bench_response_cache.py [features] [repeats]
+"""
+
+import json
+import os
+import sys
+import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "tests")))
+
+from fastapi import Response
+from fastapi.responses import JSONResponse
+
+from app.response_cache import response_cache
+from app.codec import dumps_json, orjson
+from fake_usgs import make_catalog
+
+
+def timed(label: str, fn, repeats: int) -> float:
+    fn()  # warm up
+    started = time.perf_counter()
+    for _ in range(repeats):
+        fn()
+    per_call_ms = (time.perf_counter() - started) / repeats * 1000
+    print(f"{label:<48} {per_call_ms:9.3f} ms")
+    return per_call_ms
+
+
+def main(features: int, repeats: int):
+    data = {"type": "FeatureCollection", "metadata": {"count": features}, "features": make_catalog(features)}
+    cached_text = json.dumps(data)
+    body = dumps_json(data)
+    response_cache.set("bench", (body, "application/json"), len(body))
+    print(f"{features} features, {len(body) / 1024 / 1024:.1f} MB of JSON, orjson installed: {orjson is not None}\n")
+
+    before = timed("hit before: json.loads + JSONResponse", lambda: JSONResponse(content=json.loads(cached_text)), repeats)
+    after = timed("hit after: cached bytes + Response", lambda: Response(content=response_cache.get("bench")[0],
+                                                                       media_type="application/json"), repeats)
+    print(f"{'hit speed-up':<48} {before / after:9.0f}x\n")
+
+    before = timed("miss encode before: JSONResponse (stdlib json)", lambda: JSONResponse(content=data), repeats)
+    after = timed("miss encode after: dumps_json", lambda: dumps_json(data), repeats)
+    print(f"{'encode speed-up':<48} {before / after:9.1f}x")
+
+
+if __name__ == "__main__":
+    features = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    main(features, repeats)
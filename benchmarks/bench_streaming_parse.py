@@ -0,0 +1,90 @@
+"""
+Benchmark: peak memory of a tsunami-style fetch, before and after incremental parsing
+- before: download the whole body, response.json(), then keep the tsunami events
+- after:  usgs_client.fetch_json with the tsunami filter applied while the body streams in
+The upstream body is encoded once up front and served by a small local HTTP server,
+so the numbers only cover the client side. Peak Python memory is measured with tracemalloc.
+
+Run with: python benchmarks/bench_streaming_parse.py [features]
+"""
+
+import asyncio
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "tests")))
+
+from app import usgs_client
+from app.containment import local_filter
+from fake_usgs import make_catalog
+
+
+def serve(body: bytes) -> ThreadingHTTPServer:
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+async def before(url: str) -> int:
+    client = await usgs_client.get_http_client()
+    response = await client.get(url)
+    data = response.json()
+    return len([f for f in data["features"] if f["properties"].get("tsunami", 0) > 0])
+
+
+async def after(url: str) -> int:
+    data = await usgs_client.fetch_json({}, keep=local_filter({"tsunami": True}))
+    return len(data["features"])
+
+
+async def measure(label: str, fn, url: str):
+    tracemalloc.start()
+    started = time.perf_counter()
+    kept = await fn(url)
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{label:<40} {elapsed:6.2f}s  peak {peak / 1024 / 1024:7.1f} MB  ({kept} tsunami events kept)")
+
+
+async def main(features: int):
+    catalog = make_catalog(features)
+    body = json.dumps({"type": "FeatureCollection", "metadata": {"count": features}, "features": catalog}).encode()
+    del catalog
+    server = serve(body)
+    host, port = server.server_address[:2]
+    url = f"http://{host}:{port}/fdsnws/event/1/query"
+    usgs_client.USGS_API_URL = url
+    print(f"{features} features, {len(body) / 1024 / 1024:.1f} MB upstream body\n")
+
+    await usgs_client.start_http_client()
+    try:
+        await measure("before: response.json() + filter", before, url)
+        await measure("after: streamed parse with filter", after, url)
+    finally:
+        await usgs_client.close_http_client()
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    features = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    asyncio.run(main(features))
@@ -0,0 +1,89 @@
+"""
+Benchmark: tsunami alerts for 168-hour windows, without and with the tsunami index
+- without: every window not in the caches means pulling all M2+ events on Earth for it from USGS
+  (in cached buckets), and keeping only the few with a tsunami flag
+- with: one index sync up front, then every window is read from the few indexed tsunami events
+Traffic: windows ending at every hour of a day, with the caches (but not the index) emptied before
+each request, like a worker seeing each window for the first time
+
+Run with: python benchmarks/bench_tsunami_index.py [catalog size] [latency_seconds]
+"""
+
+import asyncio
+import os
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "tests")))
+
+import httpx
+
+import app.cache
+import app.event_store
+import app.redis_client
+import app.response_cache
+import app.usgs_client as usgs_client
+from app import limiter, tsunami_index
+from app.main import app as async_app
+from fake_usgs import FakeUSGSServer, make_catalog
+
+FIRST_END = datetime(2024, 1, 20, tzinfo=timezone.utc)
+WINDOWS = 24
+
+
+def clear_caches():
+    app.cache.l1_cache.clear()
+    app.response_cache.response_cache.clear()
+    app.event_store.store = app.event_store.EventStore(":memory:")
+
+
+async def drive(server: FakeUSGSServer) -> tuple:
+    transport = httpx.ASGITransport(app=async_app)
+    server.reset_counters()
+    elapsed = 0.0
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+        for hour in range(WINDOWS):
+            clear_caches()
+            started = time.perf_counter()
+            response = await client.get("/california", params={
+                "start_time": (FIRST_END + timedelta(hours=hour)).strftime("%Y-%m-%dT%H:%M:%S"),
+                "time_range": 168,
+            })
+            elapsed += time.perf_counter() - started
+            assert response.status_code == 200
+    return elapsed / WINDOWS, server.request_count, len(response.json()["features"])
+
+
+async def main(catalog_size: int, latency: float):
+    with FakeUSGSServer(catalog=make_catalog(catalog_size), latency=latency) as server:
+        usgs_client.USGS_API_URL = server.url
+        usgs_client.USGS_COUNT_URL = server.count_url
+        # One worker on its own, so every miss reaches USGS
+        app.redis_client.redis_pool.enabled = False
+        limiter.UPSTREAM_MAX_CONCURRENCY = limiter.UPSTREAM_RATE = 0
+        await usgs_client.start_http_client()
+        try:
+            tsunami_index.TSUNAMI_INDEX_ENABLED = False
+            per_request, requests, events = await drive(server)
+            print(f"without index: {per_request * 1000:8.1f} ms/request, {requests:4d} USGS requests "
+                  f"({events} tsunami events in the last window)")
+
+            tsunami_index.TSUNAMI_INDEX_ENABLED = True
+            tsunami_index.reset()
+            tsunami_index.TSUNAMI_INDEX_LOOKBACK_HOURS = 168 + WINDOWS  # Every window of the benchmark
+            started = time.perf_counter()
+            await tsunami_index.sync(FIRST_END + timedelta(hours=WINDOWS - 1))
+            print(f"index sync:    {(time.perf_counter() - started) * 1000:8.1f} ms once")
+            per_request, requests, events = await drive(server)
+            print(f"with index:    {per_request * 1000:8.1f} ms/request, {requests:4d} USGS requests "
+                  f"({events} tsunami events in the last window)")
+        finally:
+            await usgs_client.close_http_client()
+
+
+if __name__ == "__main__":
+    catalog_size = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    latency = float(sys.argv[2]) if len(sys.argv) > 2 else 0.1
+    asyncio.run(main(catalog_size, latency))
@@ -0,0 +1,60 @@
+"""
+Benchmark: XML encoding with xmltodict (the old path) vs. the streaming XML writer
+- xmltodict: xmltodict.unparse builds the whole pretty-printed document as one string
+- streaming: app.xml_writer.iter_xml writes chunks as they are sent (each chunk is dropped after "sending")
+Measures time and peak Python memory (tracemalloc) on top of the already loaded data
+
+Run with: python benchmarks/bench_xml.py [feature counts...]
+"""
+
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "tests")))
+
+import xmltodict
+
+from app.xml_writer import iter_xml
+from fake_usgs import make_catalog
+
+
+def with_xmltodict(data: dict, pretty: bool) -> int:
+    return len(xmltodict.unparse({"response": data}, pretty=pretty).encode("utf-8"))
+
+
+def with_stream(data: dict, pretty: bool) -> int:
+    sent = 0
+    for chunk in iter_xml(data, pretty=pretty):
+        sent += len(chunk)
+    return sent
+
+
+def measure(fn, data: dict, pretty: bool) -> tuple:
+    tracemalloc.start()
+    started = time.perf_counter()
+    size = fn(data, pretty)
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak, size
+
+
+def main(counts: list):
+    print(f"{'features':>9} {'path':<20} {'time':>9} {'peak memory':>12} {'output':>10}")
+    for count in counts:
+        data = {"type": "FeatureCollection", "metadata": {"count": count}, "features": make_catalog(count)}
+        for label, fn, pretty in (
+            ("xmltodict (pretty)", with_xmltodict, True),
+            ("stream (pretty)", with_stream, True),
+            ("stream (compact)", with_stream, False),
+        ):
+            elapsed, peak, size = measure(fn, data, pretty)
+            print(f"{count:>9} {label:<20} {elapsed:>8.2f}s {peak / 1024 / 1024:>10.1f}MB {size / 1024 / 1024:>8.1f}MB")
+
+
+if __name__ == "__main__":
+    counts = [int(arg) for arg in sys.argv[1:]] or [1000, 10000, 50000]
+    main(counts)
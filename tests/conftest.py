@@ -0,0 +1,106 @@
+import asyncio
+import os
+import sys
+
+import pytest
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from fake_usgs import FakeUSGSServer
+
+
+@pytest.fixture(autouse=True)
+def event_store_path(tmp_path, monkeypatch):
+    """
+    Keeps the local event store of every test in the test's own temporary directory (opened on first use),
+    so no test writes a database into the source tree or sees another test's events.
+    """
+    import app.event_store
+
+    monkeypatch.setattr(app.event_store, "EVENT_STORE_PATH", str(tmp_path / "events.sqlite3"))
+    monkeypatch.setattr(app.event_store, "store", None)
+
+
+@pytest.fixture
+def fake_usgs(monkeypatch):
+    """
+    Start a local fake USGS API and point the app at it.
+    Redis is switched off and the local event store is an empty in-memory database,
+    so every test starts from empty caches (and an empty tsunami index). The background ingester doesn't run
+    (tests that need it call it themselves), and neither does hot-key tracking.
+    USGS starts out healthy (closed circuit breaker), requests aren't hedged and neither USGS requests
+    nor clients are limited.
+    """
+    import app.cache
+    import app.chunking
+    import app.columns
+    import app.containment
+    import app.event_store
+    import app.hotkeys
+    import app.ingester
+    import app.limiter
+    import app.metrics
+    import app.ratelimit
+    import app.redis_client
+    import app.resilience
+    import app.response_cache
+    import app.tsunami_index
+    import app.usgs_client
+
+    with FakeUSGSServer() as server:
+        monkeypatch.setattr(app.usgs_client, "USGS_API_URL", server.url)
+        monkeypatch.setattr(app.usgs_client, "USGS_COUNT_URL", server.count_url)
+        monkeypatch.setattr(app.redis_client.redis_pool, "enabled", False)
+        monkeypatch.setattr(app.event_store, "store", app.event_store.EventStore(":memory:"))
+        monkeypatch.setattr(app.ingester, "INGEST_ENABLED", False)
+        monkeypatch.setattr(app.hotkeys, "HOT_KEYS_ENABLED", False)
+        monkeypatch.setattr(app.resilience, "USGS_HEDGE_PERCENTILE", 0)
+        monkeypatch.setattr(app.limiter, "UPSTREAM_MAX_CONCURRENCY", 0)
+        monkeypatch.setattr(app.limiter, "UPSTREAM_RATE", 0)
+        monkeypatch.setattr(app.ratelimit, "RATE_LIMIT_ENABLED", False)
+        app.cache.l1_cache.clear()
+        app.chunking._density.clear()
+        app.chunking._plans.clear()
+        app.columns.clear()
+        app.containment._variants.clear()
+        app.ingester._synced.clear()
+        app.hotkeys.reset()
+        app.resilience.reset()
+        app.limiter.reset()
+        app.metrics.reset()
+        app.ratelimit.reset()
+        app.response_cache.response_cache.clear()
+        app.tsunami_index.reset()
+        yield server
+        app.cache.l1_cache.clear()
+        app.chunking._density.clear()
+        app.chunking._plans.clear()
+        app.columns.clear()
+        app.containment._variants.clear()
+        app.ingester._synced.clear()
+        app.hotkeys.reset()
+        app.resilience.reset()
+        app.limiter.reset()
+        app.metrics.reset()
+        app.ratelimit.reset()
+        app.response_cache.response_cache.clear()
+        app.tsunami_index.reset()
+
+
+@pytest.fixture
+def with_redis():
+    """
+    Runs a coroutine with the app's async Redis pools open, like the app's lifespan does
+    (the pooled connections belong to the event loop that opened them).
+    """
+    from app.redis_client import redis_pool
+
+    def run(coroutine):
+        async def inside_pool():
+            assert await redis_pool.start(), "Expected Redis to answer"
+            try:
+                return await coroutine
+            finally:
+                await redis_pool.close()
+        return asyncio.run(inside_pool())
+    return run
@@ -0,0 +1,263 @@
+"""
+A small stand-in for the USGS earthquake API used by the tests and benchmarks
+Serves a deterministic synthetic catalog over real HTTP so the app's client,
+connection pool and caching behave exactly as they would against earthquake.usgs.gov
+"""
+
+import json
+import math
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+# San Francisco - the centre of most of our queries
+SF_LATITUDE = 37.7749
+SF_LONGITUDE = -122.4194
+
+
+def _to_millis(value: str) -> int:
+    # USGS accepts ISO times without a timezone and treats them as UTC
+    parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return int(parsed.timestamp() * 1000)
+
+
+def _distance_km(lat1, lon1, lat2, lon2) -> float:
+    # Great-circle distance between two points on Earth
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 6371.0 * 2 * math.asin(math.sqrt(min(1.0, a)))
+
+
+"""
+    Purpose: Builds a deterministic list of fake GeoJSON earthquake features
+    What it does:
+    - Spreads `count` events evenly between `start` and `end`
+    - Puts roughly half of them within 150 km of San Francisco, the rest anywhere on Earth
+    - Gives every event a magnitude, felt reports and an occasional tsunami flag
+    Returns: List of GeoJSON features shaped like the real USGS ones
+"""
+def make_catalog(count: int = 2000, start: str = "2024-01-01T00:00:00",
+                 end: str = "2024-01-31T00:00:00", seed: int = 42) -> list:
+    rng = random.Random(seed)
+    start_ms, end_ms = _to_millis(start), _to_millis(end)
+    step = (end_ms - start_ms) / max(count, 1)
+    features = []
+    for i in range(count):
+        event_time = int(start_ms + i * step)
+        if i % 2 == 0:
+            lat = SF_LATITUDE + rng.uniform(-1.3, 1.3)
+            lon = SF_LONGITUDE + rng.uniform(-1.6, 1.6)
+        else:
+            lat = rng.uniform(-60, 60)
+            lon = rng.uniform(-180, 180)
+        mag = round(rng.uniform(0.5, 7.5), 2)
+        felt = rng.choice([None, None, 0, 1, 5, 12, 40, 150])
+        tsunami = 1 if mag >= 6.5 and rng.random() < 0.5 else 0
+        event_id = f"fk{i:07d}"
+        features.append({
+            "type": "Feature",
+            "properties": {
+                "mag": mag,
+                "place": f"{rng.randint(1, 90)} km of Fakeville",
+                "time": event_time,
+                "updated": event_time + 60_000,
+                "tz": None,
+                "url": f"https://example.invalid/event/{event_id}",
+                "felt": felt,
+                "cdi": None,
+                "mmi": None,
+                "alert": None,
+                "status": "reviewed",
+                "tsunami": tsunami,
+                "sig": int(mag * 100),
+                "net": "fk",
+                "code": f"{i:07d}",
+                "ids": f",{event_id},",
+                "types": ",origin,phase-data,",
+                "magType": "ml",
+                "type": "earthquake",
+                "title": f"M {mag} - Fakeville",
+            },
+            "geometry": {"type": "Point", "coordinates": [round(lon, 4), round(lat, 4), round(rng.uniform(0, 30), 2)]},
+            "id": event_id,
+        })
+    return features
+
+
+class FakeUSGSServer:
+    """
+    Runs the fake USGS API on a random local port in a background thread.
+    Records every query so tests can count how many upstream calls were made.
+    Like USGS, /query refuses searches matching more than `max_events` events and /count counts them.
+    Events can be revised or deleted while it runs, and `updatedafter` / `includedeleted` work like USGS'.
+    Single requests can be made slow (`delays`) or fail (`fail_next`), like a struggling USGS.
+    """
+
+    def __init__(self, catalog: list = None, latency: float = 0.0, max_events: int = 20000):
+        self.catalog = catalog if catalog is not None else make_catalog()
+        self.latency = latency          # Seconds to wait before answering each request
+        self.delays = []                # Seconds to wait for the next requests, one each, before `latency` again
+        self.fail_next = 0              # How many of the next requests are answered with `fail_status`
+        self.fail_status = 503
+        self.max_events = max_events    # Largest result /query will return
+        self.requests = []              # Query parameters of every /query request received
+        self.count_requests = []        # Query parameters of every /count request received
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/fdsnws/event/1/query"
+
+    @property
+    def count_url(self) -> str:
+        return self.url[:-len("query")] + "count"
+
+    @property
+    def request_count(self) -> int:
+        return len(self.requests)
+
+    def reset_counters(self):
+        with self._lock:
+            self.requests = []
+            self.count_requests = []
+            self.max_in_flight = 0
+
+    def revise(self, event_id: str, **properties):
+        # Change an event's properties, the way USGS revises events after they happen
+        for feature in self.catalog:
+            if feature["id"] == event_id:
+                feature["properties"].update(properties, updated=int(time.time() * 1000))
+
+    def delete(self, event_id: str):
+        # Delete an event: USGS keeps it, marked as deleted, for `includedeleted` searches
+        self.revise(event_id, status="deleted")
+
+    def query(self, params: dict) -> list:
+        # Apply the subset of USGS filters our service uses
+        features = self.catalog
+        if params.get("includedeleted") != "true":
+            features = [f for f in features if f["properties"]["status"] != "deleted"]
+        if "updatedafter" in params:
+            after_ms = _to_millis(params["updatedafter"])
+            features = [f for f in features if f["properties"]["updated"] > after_ms]
+        if "starttime" in params:
+            start_ms = _to_millis(params["starttime"])
+            features = [f for f in features if f["properties"]["time"] >= start_ms]
+        if "endtime" in params:
+            end_ms = _to_millis(params["endtime"])
+            features = [f for f in features if f["properties"]["time"] <= end_ms]
+        if "minmagnitude" in params:
+            min_mag = float(params["minmagnitude"])
+            features = [f for f in features if f["properties"]["mag"] is not None and f["properties"]["mag"] >= min_mag]
+        if "maxradiuskm" in params:
+            lat, lon = float(params["latitude"]), float(params["longitude"])
+            radius = float(params["maxradiuskm"])
+            features = [
+                f for f in features
+                if _distance_km(lat, lon, f["geometry"]["coordinates"][1], f["geometry"]["coordinates"][0]) <= radius
+            ]
+        # USGS orders results newest first by default
+        return sorted(features, key=lambda f: f["properties"]["time"], reverse=True)
+
+    def _handle(self, handler: BaseHTTPRequestHandler):
+        parsed = urlparse(handler.path)
+        params = {k: v[-1] for k, v in parse_qs(parsed.query).items()}
+        counting = parsed.path.endswith("/count")
+        with self._lock:
+            (self.count_requests if counting else self.requests).append(params)
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            delay = self.delays.pop(0) if self.delays else self.latency
+            failing = self.fail_next > 0
+            if failing:
+                self.fail_next -= 1
+        try:
+            if delay:
+                time.sleep(delay)
+            if failing:
+                self._send(handler, self.fail_status, "text/plain", f"Error {self.fail_status}\n".encode())
+                return
+            features = self.query(params)
+            if counting and params.get("format") == "geojson":
+                self._send(handler, 200, "application/json",
+                           json.dumps({"count": len(features), "maxAllowed": self.max_events}).encode())
+                return
+            if counting:
+                self._send(handler, 200, "text/plain", f"{len(features)}\n".encode())
+                return
+            if len(features) > self.max_events:
+                self._send(handler, 400, "text/plain", (
+                    f"Error 400: Bad Request\n\n{len(features)} matching events exceeds search limit of "
+                    f"{self.max_events}. Modify the search to match fewer events.\n").encode())
+                return
+            body = json.dumps({
+                "type": "FeatureCollection",
+                "metadata": {
+                    "generated": int(time.time() * 1000),
+                    "url": f"http://fake-usgs{handler.path}",
+                    "title": "USGS Earthquakes",
+                    "status": 200,
+                    "api": "1.14.1",
+                    "count": len(features),
+                },
+                "features": features,
+            }).encode()
+            self._send(handler, 200, "application/json", body)
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+    def _send(self, handler: BaseHTTPRequestHandler, status: int, content_type: str, body: bytes):
+        handler.send_response(status)
+        handler.send_header("Content-Type", content_type)
+        handler.send_header("Content-Length", str(len(body)))
+        handler.end_headers()
+        try:
+            handler.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            # The client stopped waiting (like a hedged request that lost the race)
+            pass
+
+    def start(self):
+        owner = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # HTTP/1.1 so clients can keep their connections alive between requests
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                owner._handle(self)
+
+            def log_message(self, *args):
+                pass
+
+        class Server(ThreadingHTTPServer):
+            daemon_threads = True
+            request_queue_size = 512
+
+        self._server = Server(("127.0.0.1", 0), Handler)
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
@@ -0,0 +1,97 @@
+from fastapi.testclient import TestClient
+
+from app import cache, containment, response_cache
+from app.config import BATCH_MAX_QUERIES
+from app.main import app
+
+SF = {"start_time": "2024-01-05T00:00:00", "end_time": "2024-01-06T00:00:00"}
+FELT = {"start_time": "2024-01-05T00:00:00", "end_time": "2024-01-06T00:00:00", "min_felt_reports": 5}
+TSUNAMI = {"state": "CA", "start_time": "2024-01-20T00:00:00", "time_range": 24}
+
+
+def test_batch_answers_like_the_routes(fake_usgs):
+    """
+    Test that every sub-query of a batch gets the same answer as the route asked on its own.
+    """
+    queries = [
+        {"route": "earthquake/sf", "params": SF},
+        {"route": "earthquake-felt", "params": FELT},
+        {"route": "tsunami", "params": TSUNAMI},
+    ]
+    with TestClient(app) as client:
+        response = client.post("/batch", json={"queries": queries})
+        separate = [
+            client.get("/earthquake/sf", params=SF),
+            client.get("/earthquake-felt", params=FELT),
+            client.get("/california", params={"start_time": TSUNAMI["start_time"], "time_range": 24}),
+        ]
+
+    assert response.status_code == 200, "Expected status code 200"
+    results = response.json()["results"]
+    assert [r["route"] for r in results] == ["earthquake/sf", "earthquake-felt", "tsunami"], \
+        "Expected the results in the order of the queries"
+    for result, single in zip(results, separate):
+        assert result["status"] == 200, f"Expected {result['route']} to succeed"
+        assert result["data"] == single.json(), f"Expected {result['route']} to match the route's own answer"
+
+
+def test_batch_shares_fetches_between_sub_queries(fake_usgs):
+    """
+    Test that identical and overlapping sub-queries ask USGS no more often than a single one does.
+    """
+    queries = [
+        {"route": "earthquake/sf", "params": SF},
+        {"route": "earthquake/sf", "params": SF},
+        {"route": "earthquake/sf", "params": {**SF, "min_magnitude": 4.0}},
+        {"route": "earthquake/sf", "params": {**SF, "min_magnitude": 3.0}},
+    ]
+    with TestClient(app) as client:
+        client.get("/earthquake/sf", params=SF)
+        single = fake_usgs.request_count
+        fake_usgs.reset_counters()
+        cache.l1_cache.clear()
+        containment._variants.clear()
+        response_cache.response_cache.clear()
+        response = client.post("/batch", json={"queries": queries})
+
+    assert response.status_code == 200, "Expected status code 200"
+    results = response.json()["results"]
+    assert all(r["status"] == 200 for r in results), "Expected every sub-query to succeed"
+    assert results[0] == results[1], "Expected identical sub-queries to get the same answer"
+    assert fake_usgs.request_count <= single, \
+        "Higher magnitude thresholds of the same window should not need their own USGS requests"
+    assert all(f["properties"]["mag"] >= 4.0 for f in results[2]["data"]["features"]), \
+        "Expected only magnitude 4+ events for the stricter sub-query"
+
+
+def test_failing_sub_queries_only_fail_themselves(fake_usgs):
+    """
+    Test that bad dates, unknown states and routes and invalid parameters give an error result
+    for that sub-query only, with the status the route would have answered.
+    """
+    queries = [
+        {"route": "earthquake/sf", "params": {**SF, "start_time": "yesterday"}},
+        {"route": "tsunami", "params": {**TSUNAMI, "state": "atlantis"}},
+        {"route": "volcanoes", "params": {}},
+        {"route": "tsunami", "params": {**TSUNAMI, "time_range": 500}},
+        {"route": "earthquake/sf", "params": SF},
+    ]
+    with TestClient(app) as client:
+        response = client.post("/batch", json={"queries": queries})
+
+    assert response.status_code == 200, "Expected status code 200 for the batch itself"
+    assert [r["status"] for r in response.json()["results"]] == [400, 404, 404, 422, 200], \
+        "Expected each sub-query to get its own status"
+    assert all("detail" in r for r in response.json()["results"][:4]), "Expected a detail for every error"
+
+
+def test_too_many_sub_queries_are_refused(fake_usgs):
+    """
+    Test that a batch with more than BATCH_MAX_QUERIES sub-queries is a 400.
+    """
+    queries = [{"route": "earthquake/sf", "params": SF}] * (BATCH_MAX_QUERIES + 1)
+    with TestClient(app) as client:
+        response = client.post("/batch", json={"queries": queries})
+
+    assert response.status_code == 400, "Expected status code 400"
+    assert fake_usgs.request_count == 0, "Nothing should be fetched for a refused batch"
@@ -0,0 +1,212 @@
+import json
+
+import pytest
+from fastapi.testclient import TestClient
+
+import app.cache as cache
+from app.cache import LRUCache
+from app.main import app
+from app.redis_client import get_redis_client
+from fake_usgs import make_catalog
+
+
+def collection(features: list) -> dict:
+    """Wraps features like a USGS answer."""
+    return {"type": "FeatureCollection", "metadata": {"count": len(features)}, "features": features}
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_lru_evicts_least_recently_used_entry():
+    """
+    Test that the cache drops the least recently used entry when it has too many.
+    """
+    cache = LRUCache(max_entries=2, max_bytes=1000, ttl=30)
+    cache.set("a", 1, size=10)
+    cache.set("b", 2, size=10)
+    cache.get("a")  # 'a' is now more recently used than 'b'
+    cache.set("c", 3, size=10)
+
+    assert cache.get("b") is None, "Expected 'b' to be evicted"
+    assert cache.get("a") == 1, "Expected 'a' to survive"
+    assert cache.get("c") == 3, "Expected 'c' to be cached"
+    assert cache.evictions == 1, "Expected one eviction"
+
+
+def test_lru_respects_byte_limit():
+    """
+    Test that the cache stays within its approximate byte budget.
+    """
+    cache = LRUCache(max_entries=100, max_bytes=100, ttl=30)
+    cache.set("a", "x", size=60)
+    cache.set("b", "y", size=60)
+    cache.set("too-big", "z", size=500)
+
+    assert cache.get("a") is None, "Expected 'a' to be evicted to make room"
+    assert cache.get("b") == "y", "Expected 'b' to be cached"
+    assert cache.get("too-big") is None, "Entries larger than the whole cache should not be stored"
+    assert cache.total_bytes == 60, "Expected the byte count to match the remaining entry"
+
+
+def test_lru_entries_expire():
+    """
+    Test that entries disappear once their time to live has passed.
+    """
+    clock = FakeClock()
+    cache = LRUCache(max_entries=10, max_bytes=1000, ttl=30, clock=clock)
+    cache.set("a", 1, size=1)
+    cache.set("b", 2, size=1, ttl=5)
+
+    clock.now = 10
+    assert cache.get("a") == 1, "Expected 'a' to still be fresh"
+    assert cache.get("b") is None, "Expected 'b' to have expired"
+    clock.now = 31
+    assert cache.get("a") is None, "Expected 'a' to have expired"
+    assert len(cache) == 0, "Expired entries should be removed"
+
+
+def test_repeat_request_is_served_from_l1_without_redis(fake_usgs):
+    """
+    Test that a repeated search is answered from the in-process cache even though Redis is off.
+    """
+    params = {"start_time": "2024-01-10T00:00:00", "end_time": "2024-01-11T00:00:00"}
+    with TestClient(app) as client:
+        first = client.get("/earthquake/sf", params=params)
+        upstream_calls = fake_usgs.request_count
+        hits = client.get("/admin/stats").json()["l1_cache"]["hits"]
+        # Ask for XML so the finished-response cache can't answer and the data has to come from L1
+        second = client.get("/earthquake/sf", params=dict(params, format="xml"))
+        stats = client.get("/admin/stats").json()
+
+    assert first.status_code == 200 and second.status_code == 200, "Expected status code 200"
+    assert fake_usgs.request_count == upstream_calls, "The second request should not reach USGS"
+    assert stats["l1_cache"]["hits"] > hits, "Expected L1 cache hits"
+
+
+@pytest.mark.skipif(get_redis_client() is None, reason="Needs a running Redis server")
+def test_redis_hit_is_copied_into_l1(with_redis):
+    """
+    Test that data found in Redis (L2) is kept in L1 so the next read skips Redis.
+    The value is written as plain JSON, like entries stored before the binary format existed.
+    """
+    client = get_redis_client(decode_responses=False)
+    cache.l1_cache.clear()
+    key = "usgs_data:test-l2-to-l1"
+    client.setex(key, 30, json.dumps({"features": []}))
+    try:
+        first = with_redis(cache.get_cached(key))
+        client.delete(key)
+        second = with_redis(cache.get_cached(key))
+    finally:
+        client.delete(key)
+        cache.l1_cache.clear()
+
+    assert first == {"features": []}, "Expected the Redis copy"
+    assert second is first, "Expected the parsed L1 copy once Redis has been read"
+
+
+def redis_events(client) -> list:
+    """The per-event keys currently in Redis."""
+    return list(client.scan_iter(match=cache.EVENT_KEY_PREFIX + "*"))
+
+
+def delete_events(client):
+    """Removes every per-event key (and latest-revision key) from Redis."""
+    events = redis_events(client) + list(client.scan_iter(match=cache.EVENT_LATEST_PREFIX + "*"))
+    if events:
+        client.delete(*events)
+
+
+@pytest.mark.skipif(get_redis_client() is None, reason="Needs a running Redis server")
+def test_overlapping_results_share_their_events_in_redis(with_redis):
+    """
+    Test that results holding the same events store every event once in Redis, only add
+    a small list of event ids each, and read back exactly as they were written.
+    """
+    client = get_redis_client(decode_responses=False)
+    features = make_catalog(600)
+    results = {
+        "usgs_data:test-events-all": collection(features),
+        "usgs_data:test-events-first": collection(features[:400]),
+        "usgs_data:test-events-last": dict(collection(features[200:]), bbox=[0, 0, 0, 1, 1, 1]),
+    }
+    delete_events(client)
+    try:
+        for key, data in results.items():
+            with_redis(cache.set_cached(key, data, 30))
+        events = redis_events(client)
+        lists = [client.strlen(key) for key in results]
+        cache.l1_cache.clear()
+        read_back = {key: with_redis(cache.get_cached(key)) for key in results}
+    finally:
+        client.delete(*results)
+        delete_events(client)
+        cache.l1_cache.clear()
+
+    assert len(events) == len(features), f"Expected each event once, got {len(events)} keys for {len(features)} events"
+    assert max(lists) < 20 * len(features), "Expected the results themselves to hold only event ids"
+    for key, data in results.items():
+        assert read_back[key] == data, "Expected the same result back from Redis"
+        assert list(read_back[key]) == list(data), "Expected the same keys in the same order"
+
+
+@pytest.mark.skipif(get_redis_client() is None, reason="Needs a running Redis server")
+def test_result_with_a_missing_event_is_a_miss(with_redis):
+    """
+    Test that a result whose events were dropped from Redis is not served with holes in it.
+    """
+    client = get_redis_client(decode_responses=False)
+    key = "usgs_data:test-events-missing"
+    delete_events(client)
+    try:
+        with_redis(cache.set_cached(key, collection(make_catalog(50)), 30))
+        client.delete(redis_events(client)[0])
+        cache.l1_cache.clear()
+        read_back = with_redis(cache.get_cached(key))
+    finally:
+        client.delete(key)
+        delete_events(client)
+        cache.l1_cache.clear()
+
+    assert read_back is None, "Expected a miss when an event is gone"
+    assert cache.normalized_stats["missing_events"] > 0, "Expected the missing event to be counted"
+
+
+@pytest.mark.skipif(get_redis_client() is None, reason="Needs a running Redis server")
+def test_event_revisions_live_as_long_as_their_searches(with_redis):
+    """
+    Test that events are kept as long as the search holding them (not for hours), that a longer-lived
+    search extends them, and that a newer revision of an event replaces the old one in Redis.
+    """
+    client = get_redis_client(decode_responses=False)
+    features = make_catalog(20)
+    event = features[0]
+    revised = dict(event, properties=dict(event["properties"], mag=7.7, updated=event["properties"]["updated"] + 1))
+    old_key = f"{cache.EVENT_KEY_PREFIX}{event['id']}:{event['properties']['updated']}"
+    new_key = f"{cache.EVENT_KEY_PREFIX}{event['id']}:{revised['properties']['updated']}"
+    keys = ["usgs_data:test-revisions-short", "usgs_data:test-revisions-long", "usgs_data:test-revisions-new"]
+    delete_events(client)
+    try:
+        with_redis(cache.set_cached(keys[0], collection(features), 30))
+        short_ttl = client.pttl(old_key)
+        with_redis(cache.set_cached(keys[1], collection(features[:5]), 600))
+        long_ttl = client.pttl(old_key)
+        with_redis(cache.set_cached(keys[0], collection(features), 30))
+        kept_ttl = client.pttl(old_key)
+        with_redis(cache.set_cached(keys[2], collection([revised] + features[1:]), 30))
+        old_exists, new_exists = client.exists(old_key), client.exists(new_key)
+    finally:
+        client.delete(*keys)
+        delete_events(client)
+        cache.l1_cache.clear()
+
+    assert 0 < short_ttl <= (30 + cache.STALE_KEEP) * 1000, f"Expected the search's lifetime, got {short_ttl} ms"
+    assert long_ttl > (30 + cache.STALE_KEEP) * 1000, "Expected a longer-lived search to extend the event"
+    assert kept_ttl > (30 + cache.STALE_KEEP) * 1000, "Expected a shorter-lived search not to cut it back"
+    assert not old_exists and new_exists, "Expected the newer revision to replace the old one"
@@ -0,0 +1,126 @@
+import asyncio
+
+from app import cache, chunking, event_store, usgs_client, utils
+from app.chunking import gather_limited, split_evenly
+from fake_usgs import make_catalog
+
+# Every event on Earth in the fake catalog's month, with no magnitude or area limit
+WINDOW = {"format": "geojson", "starttime": "2024-01-01T00:00:00", "endtime": "2024-01-31T00:00:00"}
+
+
+def fetch(coroutine_function, *args):
+    """Runs a data-layer call with the shared USGS client open, like the app's lifespan does."""
+    async def run():
+        await usgs_client.start_http_client()
+        try:
+            return await coroutine_function(*args)
+        finally:
+            await usgs_client.close_http_client()
+    return asyncio.run(run())
+
+
+def limit_usgs(server, monkeypatch):
+    """Scales the USGS limits down to the fake catalog: at most 1000 events per query, chunks of 500."""
+    server.max_events = 1000
+    monkeypatch.setattr(chunking, "USGS_MAX_EVENTS", 1000)
+    monkeypatch.setattr(chunking, "CHUNK_TARGET_EVENTS", 500)
+
+
+def test_split_evenly_covers_the_window():
+    """
+    Test that a window is cut into equal, touching pieces that start and end where the window does.
+    """
+    windows = split_evenly({"starttime": "2024-01-01T00:00:00", "endtime": "2024-01-02T00:00:00"}, 3)
+
+    assert windows == [
+        ("2024-01-01T00:00:00", "2024-01-01T08:00:00"),
+        ("2024-01-01T08:00:00", "2024-01-01T16:00:00"),
+        ("2024-01-01T16:00:00", "2024-01-02T00:00:00"),
+    ], "Expected three 8 hour windows"
+
+
+def test_gather_limited_caps_concurrency():
+    """
+    Test that no more than `limit` coroutines run at once and results keep their order.
+    """
+    running, peak = 0, 0
+
+    async def job(i):
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        await asyncio.sleep(0.01)
+        running -= 1
+        return i
+
+    results = asyncio.run(gather_limited([job(i) for i in range(20)], 3))
+
+    assert results == list(range(20)), "Expected results in the order given"
+    assert peak == 3, f"Expected at most 3 at a time, got {peak}"
+
+
+def test_busy_window_is_split_and_merged(fake_usgs, monkeypatch):
+    """
+    Test that a window over the USGS limit is counted, fetched in chunks and merged correctly.
+    """
+    limit_usgs(fake_usgs, monkeypatch)
+
+    data = fetch(utils.fetch_window, WINDOW, "test-busy", 30)
+
+    expected = [f["id"] for f in fake_usgs.query(WINDOW)]
+    assert [f["id"] for f in data["features"]] == expected, "Expected every event once, newest first"
+    assert len(fake_usgs.count_requests) == 1, "Expected one /count request"
+    assert len(fake_usgs.requests) == 4, "Expected 2000 events in four chunks of about 500"
+
+
+def test_refused_window_is_split_after_all(fake_usgs, monkeypatch):
+    """
+    Test that a window USGS refuses as too big (HTTP 400) is counted and split instead of failing.
+    """
+    limit_usgs(fake_usgs, monkeypatch)
+    short = dict(WINDOW, endtime="2024-01-01T12:00:00")
+    monkeypatch.setattr(chunking, "CHUNK_COUNT_MIN_SECONDS", 10**9)  # Never count up front
+
+    fake_usgs.catalog = make_catalog(count=2000, end="2024-01-01T12:00:00")
+
+    data = fetch(utils.fetch_window, short, "test-refused", 30)
+
+    assert len(data["features"]) == 2000, "Expected all events despite the refusal"
+    assert fake_usgs.requests[0] == short, "Expected the whole window to be tried first"
+
+
+def test_partly_cached_window_fetches_only_missing_chunks(fake_usgs, monkeypatch):
+    """
+    Test that chunks are cached on their own, so refetching a window only asks for missing chunks.
+    """
+    limit_usgs(fake_usgs, monkeypatch)
+    monkeypatch.setattr(event_store, "store", None)  # Only the cache, not the local store, should help here
+    monkeypatch.setattr(event_store, "EVENT_STORE_ENABLED", False)
+    fetch(utils.fetch_cached, WINDOW, 30)
+
+    # Forget the merged window and one of its chunks
+    cache.l1_cache._remove(cache.make_cache_key(WINDOW))
+    first_chunk = dict(WINDOW, endtime="2024-01-08T12:00:00")
+    cache.l1_cache._remove(cache.make_cache_key(first_chunk))
+    fake_usgs.reset_counters()
+
+    data = fetch(utils.fetch_cached, WINDOW, 30)
+
+    assert fake_usgs.requests == [first_chunk], "Expected only the missing chunk to be fetched"
+    assert fake_usgs.count_requests == [], "Expected the chunk plan to be reused"
+    assert len(data["features"]) == 2000, "Expected the full window"
+
+
+def test_chunk_plans_stay_within_their_cap(fake_usgs, monkeypatch):
+    """
+    Test that with more live windows than the plan cap, the least recently used plans are dropped
+    instead of the plans growing without bound.
+    """
+    monkeypatch.setattr(chunking, "_plans", cache.LRUCache(5, 5, 0))
+
+    for i in range(12):
+        fetch(chunking.plan_chunks, WINDOW, f"test-plan-{i}", 3600, True)
+
+    assert len(chunking._plans) == 5, f"Expected at most 5 plans, got {len(chunking._plans)}"
+    assert chunking._plans.get("test-plan-0") is None, "Expected the oldest plan to be dropped"
+    assert chunking._plans.get("test-plan-11") is not None, "Expected the newest plan to be kept"
@@ -0,0 +1,100 @@
+import json
+
+import pytest
+
+from app import cache, codec
+from app.redis_client import get_redis_client
+from fake_usgs import make_catalog
+
+
+def sample_collection(count=500):
+    """A USGS-style FeatureCollection from the fake catalog."""
+    features = make_catalog(count=count)
+    return {"type": "FeatureCollection", "metadata": {"count": len(features)}, "features": features}
+
+
+def test_round_trip_matches_original():
+    """
+    Test that encoding and decoding gives back exactly the same data.
+    """
+    data = sample_collection()
+    blob = codec.encode(data)
+
+    assert blob[0] == codec.FORMAT_VERSION, "Expected the format version in the first byte"
+    assert codec.decode(blob) == data, "Decoded value should equal the original"
+
+
+def test_encoded_value_is_smaller_than_json():
+    """
+    Test that the stored form of a big result is much smaller than plain JSON.
+    """
+    data = sample_collection(2000)
+    blob = codec.encode(data, key="usgs_data:test-size")
+    raw = len(json.dumps(data).encode("utf-8"))
+
+    assert len(blob) < raw / 3, f"Expected at least 3x smaller than JSON, got {len(blob)} vs {raw} bytes"
+    sizes = codec.size_stats()["keys"]["usgs_data:test-size"]
+    assert sizes["stored_bytes"] == len(blob), "Stats should record the stored size"
+
+
+def test_bytes_and_legacy_json():
+    """
+    Test that raw bytes survive as bytes and plain JSON from before the format change still reads.
+    """
+    body = b"application/json\n" + b'{"a":1}' * 500
+
+    assert codec.decode(codec.encode(body)) == body, "Bytes should come back unchanged"
+    assert codec.decode(b'{"features": []}') == {"features": []}, "Old plain JSON values should still decode"
+
+
+def test_fresh_until_round_trip():
+    """
+    Test that a value can carry the time it stops being fresh, and values without one report None.
+    """
+    data = sample_collection(10)
+
+    assert codec.decode_entry(codec.encode(data, fresh_until=1700000000.5)) == (data, 1700000000.5), \
+        "Expected the value and its fresh-until time back"
+    assert codec.decode_entry(codec.encode(data)) == (data, None), "Expected no fresh-until time"
+
+
+@pytest.mark.skipif(codec.compression != codec.COMPRESSION_ZSTD or codec.msgpack is None, reason="Needs msgpack and zstd")
+def test_single_events_shrink_with_the_feature_dictionary():
+    """
+    Test that a single event, too small to compress on its own, is compressed against the feature dictionary.
+    """
+    feature = make_catalog(1)[0]
+    blob = codec.encode(feature, feature=True)
+
+    assert blob[2] == codec.COMPRESSION_ZSTD_FEATURE, "Expected the feature dictionary to be used"
+    assert len(blob) < 0.7 * len(codec.encode(feature)), "Expected it to be well below plain msgpack"
+    assert codec.decode(blob) == feature, "Decoded event should equal the original"
+
+
+def test_unknown_version_is_rejected():
+    """
+    Test that a value written in a format we don't know raises instead of returning garbage.
+    """
+    with pytest.raises(ValueError):
+        codec.decode(bytes([99, 2, 2]) + b"whatever")
+
+
+@pytest.mark.skipif(get_redis_client() is None, reason="Needs a running Redis server")
+def test_redis_stores_compressed_value(with_redis):
+    """
+    Test that set_cached writes the binary form to Redis and get_cached reads it back.
+    """
+    client = get_redis_client(decode_responses=False)
+    data = sample_collection()
+    key = "usgs_data:test-codec"
+    try:
+        with_redis(cache.set_cached(key, data, 30))
+        stored = client.get(key)
+        cache.l1_cache.clear()
+        read_back = with_redis(cache.get_cached(key))
+    finally:
+        client.delete(key)
+        cache.l1_cache.clear()
+
+    assert stored[0] == codec.FORMAT_VERSION_FRESH_UNTIL, "Expected the binary format (with its fresh-until time) in Redis"
+    assert read_back == data, "Expected the same data back from Redis"
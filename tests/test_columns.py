@@ -0,0 +1,132 @@
+import copy
+from datetime import datetime, timezone
+
+import pytest
+
+from app import columns
+from app.cache import APPROX_FEATURE_BYTES
+from app.containment import filter_to
+from app.windows import merge_buckets
+from fake_usgs import make_catalog
+
+pytestmark = pytest.mark.skipif(columns.np is None, reason="Needs numpy")
+
+SF = {"latitude": "37.7749", "longitude": "-122.4194"}
+
+
+def collection(features: list) -> dict:
+    """Wraps features like a USGS answer."""
+    return {"type": "FeatureCollection", "metadata": {"count": len(features)}, "features": features}
+
+
+def in_python(monkeypatch, fn, *args, **kwargs):
+    """Runs fn with the columnar copies switched off, i.e. the plain Python way."""
+    with monkeypatch.context() as patch:
+        patch.setattr(columns, "COLUMNAR_ENABLED", False)
+        return fn(*args, **kwargs)
+
+
+def with_gaps(features: list) -> list:
+    """A copy of the catalog where some events lack a magnitude, felt count, tsunami flag or depth."""
+    features = copy.deepcopy(features)
+    for i, feature in enumerate(features):
+        if i % 7 == 0:
+            feature["properties"]["mag"] = None
+        if i % 11 == 0:
+            del feature["properties"]["tsunami"]
+        if i % 13 == 0:
+            feature["geometry"]["coordinates"] = feature["geometry"]["coordinates"][:2]
+    return features
+
+
+@pytest.mark.parametrize("params, where", [
+    (dict(SF, minmagnitude="4.5", maxradiuskm="80"), None),
+    (dict(minmagnitude="3.0"), None),
+    ({}, {"tsunami": True}),
+    ({}, {"minfelt": 10}),
+    (dict(SF, maxradiuskm="150"), {"minfelt": 1, "tsunami": True}),
+])
+def test_filters_match_plain_python(monkeypatch, params, where):
+    """
+    Test that the vectorized filters keep exactly the events (in the same order) the plain Python filters keep.
+    """
+    data = collection(with_gaps(make_catalog(3000)))
+
+    vectorized = filter_to(data, params, where)
+    expected = in_python(monkeypatch, filter_to, data, params, where)
+
+    assert [f["id"] for f in vectorized["features"]] == [f["id"] for f in expected["features"]], \
+        "Expected the same events as the plain Python filter"
+    assert vectorized["metadata"]["count"] == len(expected["features"]), "Expected the right count"
+    assert columns.stats["vectorized"] > 0, "Expected the filter to run on columns"
+
+
+def test_merge_matches_plain_python(monkeypatch):
+    """
+    Test that merging buckets on columns trims, de-duplicates, orders and boxes the events
+    exactly like the plain Python merge.
+    """
+    features = with_gaps(make_catalog(4000))
+    # Overlapping buckets, so some events show up twice
+    buckets = [collection(features[i:i + 1200]) for i in range(0, 4000, 1000)]
+    start = datetime(2024, 1, 3, tzinfo=timezone.utc)
+    end = datetime(2024, 1, 29, 12, tzinfo=timezone.utc)
+
+    vectorized = merge_buckets(buckets, start, end)
+    expected = in_python(monkeypatch, merge_buckets, buckets, start, end)
+
+    assert [f["id"] for f in vectorized["features"]] == [f["id"] for f in expected["features"]], \
+        "Expected the same events in the same order"
+    assert vectorized["bbox"] == expected["bbox"], "Expected the same bounding box"
+    assert vectorized["metadata"] == expected["metadata"], "Expected the same metadata"
+
+
+def test_columns_are_built_once_per_result():
+    """
+    Test that filtering the same cached result again reuses its columnar copy, that filtered and merged
+    answers made per request don't keep theirs, and that a copy is charged for the result it pins.
+    """
+    data = collection(make_catalog(2000))
+    builds = columns.stats["builds"]
+
+    strict = filter_to(data, dict(SF, minmagnitude="3.0", maxradiuskm="100"))
+    filter_to(data, dict(SF, minmagnitude="4.0", maxradiuskm="100"))
+    assert columns.stats["builds"] == builds + 1, "Expected one columnar copy for the cached result"
+
+    merged = merge_buckets([data], datetime(2024, 1, 2, tzinfo=timezone.utc), datetime(2024, 1, 9, tzinfo=timezone.utc))
+    assert columns.stats["builds"] == builds + 1, "Expected the merge to reuse the bucket's copy"
+    assert columns._columns.get(id(strict)) is None and columns._columns.get(id(merged)) is None, \
+        "Per-request answers should not be kept alive by the columnar cache"
+    assert columns._columns.get(id(data))[0] is data, "Expected the cached result's copy to be kept"
+    assert columns._columns.total_bytes >= APPROX_FEATURE_BYTES * len(data["features"]), \
+        "Expected the kept copy to be charged for the features it holds on to"
+
+
+def test_per_request_answers_get_no_columnar_copy():
+    """
+    Test that filtering an answer made for one request (like the felt route's merged buckets) builds
+    and keeps no columnar copy, gives the same events, and still uses a copy that already exists.
+    """
+    data = collection(with_gaps(make_catalog(2000)))
+    builds = columns.stats["builds"]
+
+    filtered = filter_to(data, {}, where={"minfelt": 10}, cached=False)
+    assert columns.stats["builds"] == builds and columns._columns.get(id(data)) is None, \
+        "Expected no columnar copy for a per-request answer"
+    expected = filter_to(data, {}, where={"minfelt": 10})
+    assert [f["id"] for f in filtered["features"]] == [f["id"] for f in expected["features"]], \
+        "Expected the same events as the vectorized filter"
+
+    vectorized = columns.stats["vectorized"]
+    filter_to(data, {}, where={"minfelt": 10}, cached=False)
+    assert columns.stats["vectorized"] == vectorized + 1, "Expected an existing copy to be used"
+
+
+def test_small_results_stay_in_python():
+    """
+    Test that results below COLUMNAR_MIN_FEATURES get no columnar copy.
+    """
+    assert columns.columns_of(collection(make_catalog(columns.COLUMNAR_MIN_FEATURES - 1))) is None, \
+        "Expected no columnar copy for a small result"
+    assert columns.columns_of(collection(make_catalog(columns.COLUMNAR_MIN_FEATURES))) is not None, \
+        "Expected a columnar copy once the result is big enough"
@@ -0,0 +1,80 @@
+from fastapi.testclient import TestClient
+
+from app import containment
+from app.main import app
+
+SF_PARAMS = {"latitude": "37.7749", "longitude": "-122.4194", "maxradiuskm": "100", "minmagnitude": "2.0"}
+
+
+def test_superset_detection():
+    """
+    Test that a lower magnitude floor and a bigger radius contain a stricter search.
+    """
+    assert containment.is_superset(("2.0", "100"), ("3.5", "100")), "M2.0+ contains M3.5+"
+    assert containment.is_superset(("2.0", "200"), ("2.0", "100")), "200 km contains 100 km"
+    assert containment.is_superset((None, None), ("3.5", "50")), "No limits contains everything"
+    assert not containment.is_superset(("3.0", "100"), ("2.5", "100")), "M3.0+ does not contain M2.5+"
+    assert not containment.is_superset(("2.0", "50"), ("2.0", "100")), "50 km does not contain 100 km"
+
+
+def test_widen_lowers_magnitude_to_the_floor():
+    """
+    Test that misses above the magnitude floor are fetched at the floor.
+    """
+    assert containment.widen(dict(SF_PARAMS, minmagnitude="4.5"))["minmagnitude"] == "2.0", "Expected the floor"
+    low = dict(SF_PARAMS, minmagnitude="1.0")
+    assert containment.widen(low) is low, "Searches below the floor are fetched as they are"
+
+
+def test_filter_to_applies_magnitude_and_radius():
+    """
+    Test that filtering a superset keeps only events matching the stricter search.
+    """
+    def feature(event_id, mag, lat, lon):
+        return {"id": event_id, "properties": {"mag": mag}, "geometry": {"coordinates": [lon, lat, 5]}}
+
+    superset = {"features": [
+        feature("strong-near", 4.0, 37.8, -122.4),
+        feature("weak-near", 2.1, 37.8, -122.4),
+        feature("strong-far", 4.0, 38.9, -122.4),   # about 125 km north
+        feature("no-mag", None, 37.8, -122.4),
+    ]}
+    result = containment.filter_to(superset, dict(SF_PARAMS, minmagnitude="3.0"))
+
+    assert [f["id"] for f in result["features"]] == ["strong-near"], "Expected only the strong, nearby event"
+    assert result["metadata"]["count"] == 1, "Expected the count to match"
+    assert len(superset["features"]) == 4, "The cached superset must not be changed"
+
+
+def test_stricter_sf_search_reuses_felt_fetch(fake_usgs):
+    """
+    Test that /earthquake/sf with a higher min_magnitude is answered from the M2.0+ data
+    already fetched for /earthquake-felt, without calling USGS again.
+    """
+    window = {"start_time": "2024-01-03T00:00:00", "end_time": "2024-01-04T00:00:00"}
+    with TestClient(app) as client:
+        felt = client.get("/earthquake-felt", params=dict(window, min_felt_reports=1))
+        upstream_calls = fake_usgs.request_count
+        strict = client.get("/earthquake/sf", params=dict(window, min_magnitude=3.5))
+        stricter = client.get("/earthquake/sf", params=dict(window, min_magnitude=5.0))
+
+    assert felt.status_code == 200 and strict.status_code == 200, "Expected status code 200"
+    assert fake_usgs.request_count == upstream_calls, "The stricter searches should not reach USGS"
+    expected = fake_usgs.query(dict(SF_PARAMS, minmagnitude="3.5", starttime=window["start_time"], endtime=window["end_time"]))
+    assert [f["id"] for f in strict.json()["features"]] == [f["id"] for f in expected], \
+        "Expected exactly the events USGS would return for M3.5+"
+    assert all(f["properties"]["mag"] >= 5.0 for f in stricter.json()["features"]), "Expected only M5.0+"
+
+
+def test_thresholds_share_one_widened_fetch(fake_usgs):
+    """
+    Test that searches with different magnitude thresholds share one fetch per bucket.
+    """
+    window = {"start_time": "2024-01-07T06:00:00", "end_time": "2024-01-07T06:59:59"}
+    with TestClient(app) as client:
+        for min_magnitude in (4.5, 3.0, 2.5, 6.0):
+            response = client.get("/earthquake/sf", params=dict(window, min_magnitude=min_magnitude))
+            assert response.status_code == 200, "Expected status code 200"
+
+    assert fake_usgs.request_count == 1, f"Expected one upstream call, got {fake_usgs.request_count}"
+    assert fake_usgs.requests[0]["minmagnitude"] == "2.0", "Expected the fetch to be widened to M2.0"
@@ -0,0 +1,261 @@
+import time
+from datetime import datetime, timezone
+
+from fastapi.testclient import TestClient
+
+from app import cache, containment, event_store, response_cache, usgs_client
+from app.event_store import EventStore
+from app.main import app
+from fake_usgs import FakeUSGSServer
+
+SF = {"format": "geojson", "latitude": "37.7749", "longitude": "-122.4194"}
+JANUARY = {"starttime": "2024-01-01T00:00:00", "endtime": "2024-01-31T00:00:00"}
+
+
+def usgs_answer(server: FakeUSGSServer, params: dict) -> dict:
+    """What USGS would return for a search, as a FeatureCollection."""
+    return {"type": "FeatureCollection", "metadata": {}, "features": server.query(params)}
+
+
+def clear_caches():
+    """Forget everything except the local event store."""
+    cache.l1_cache.clear()
+    containment._variants.clear()
+    response_cache.response_cache.clear()
+
+
+def test_adjacent_windows_cover_their_union():
+    """
+    Test that two stored halves of a window answer the whole window, the same way USGS would.
+    """
+    server = FakeUSGSServer()
+    store = EventStore(":memory:")
+    first = dict(SF, maxradiuskm="100", starttime="2024-01-01T00:00:00", endtime="2024-01-15T00:00:00")
+    second = dict(SF, maxradiuskm="100", starttime="2024-01-15T00:00:00", endtime="2024-01-31T00:00:00")
+    store.add(first, usgs_answer(server, first))
+    whole = dict(SF, maxradiuskm="100", **JANUARY)
+    assert not store.covers(whole), "Half a window must not cover the whole window"
+
+    store.add(second, usgs_answer(server, second))
+    assert store.covers(whole), "Expected the two halves to cover the whole window"
+    assert [f["id"] for f in store.query(whole)["features"]] == [f["id"] for f in server.query(whole)], \
+        "Expected exactly the events USGS would return, newest first"
+
+
+def test_wider_search_contains_stricter_ones():
+    """
+    Test that a stored search answers searches with a higher magnitude floor or a smaller circle,
+    but not ones asking for more.
+    """
+    server = FakeUSGSServer()
+    store = EventStore(":memory:")
+    wide = dict(SF, maxradiuskm="150", minmagnitude="2.0", **JANUARY)
+    store.add(wide, usgs_answer(server, wide))
+
+    strict = dict(SF, maxradiuskm="80", minmagnitude="4.0", **JANUARY)
+    assert store.covers(strict), "M2.0+ within 150 km contains M4.0+ within 80 km"
+    assert [f["id"] for f in store.query(strict)["features"]] == [f["id"] for f in server.query(strict)], \
+        "Expected exactly the events USGS would return"
+    assert not store.covers(dict(wide, minmagnitude="1.0")), "M2.0+ does not contain M1.0+"
+    assert not store.covers(dict(wide, maxradiuskm="200")), "150 km does not contain 200 km"
+    assert not store.covers(dict(JANUARY, format="geojson")), "A circle does not contain the whole world"
+
+
+def test_filtered_searches_only_answer_filtered_searches():
+    """
+    Test that a tsunami-only copy answers tsunami searches but never the unfiltered search.
+    """
+    server = FakeUSGSServer()
+    store = EventStore(":memory:")
+    world = dict(JANUARY, format="geojson")
+    tsunamis = {"type": "FeatureCollection", "metadata": {},
+                "features": [f for f in server.query(world) if f["properties"]["tsunami"]]}
+    store.add(world, tsunamis, where={"tsunami": True})
+
+    assert store.covers(world, where={"tsunami": True}), "Expected the tsunami search to be covered"
+    assert not store.covers(world), "Only tsunami events were stored, not all of them"
+    result = store.query(world, where={"tsunami": True})
+    assert result["features"] and all(f["properties"]["tsunami"] == 1 for f in result["features"]), \
+        "Expected only tsunami events"
+
+
+def test_unsettled_windows_go_stale():
+    """
+    Test that a window synced while it was still filling up is only trusted while it is recent,
+    and is still good enough when USGS is down.
+    """
+    store = EventStore(":memory:")
+    now = int(time.time() * 1000)
+    params = dict(SF, maxradiuskm="100", starttime="2024-01-01T00:00:00", endtime="2024-01-02T00:00:00")
+    end = 1704153600000  # 2024-01-02T00:00:00
+    store.add(params, {"features": []}, synced_at=end)  # Synced right as the window ended
+
+    assert not store.covers(params, now=now), "An unsettled window synced long ago should not be trusted"
+    assert store.covers(params, fresh=False, now=now), "Expected it to count when freshness doesn't matter"
+    assert store.covers(params, now=end + 1000), "Expected it to count right after syncing"
+
+
+def test_old_searches_are_pruned(tmp_path):
+    """
+    Test that searches not synced for EVENT_STORE_RETENTION_DAYS are forgotten with the events only they
+    held, while events of searches still kept stay, and that coverage lookups have their indexes.
+    """
+    server = FakeUSGSServer()
+    store = EventStore(str(tmp_path / "events.sqlite3"))
+    now = int(time.time() * 1000)
+    days = int(event_store.EVENT_STORE_RETENTION_DAYS * 86400 * 1000)
+    old = dict(SF, maxradiuskm="100", starttime="2024-01-01T00:00:00", endtime="2024-01-15T00:00:00")
+    kept = dict(SF, maxradiuskm="100", starttime="2024-01-15T00:00:00", endtime="2024-01-31T00:00:00")
+    store.add(old, usgs_answer(server, old), synced_at=now - days - 1000)
+    store.add(kept, usgs_answer(server, kept), synced_at=now - 1000)
+    before = store.stats()["events"]
+
+    pruned = store.prune(now)
+
+    assert not store.covers(old, fresh=False, now=now), "Expected the old search to be forgotten"
+    assert store.covers(kept, now=now), "Expected the recently synced search to stay"
+    assert pruned == len(server.query(old)) and store.stats()["events"] == before - pruned, \
+        "Expected exactly the events only the old search held to be dropped"
+    assert [f["id"] for f in store.query(kept)["features"]] == [f["id"] for f in server.query(kept)], \
+        "Expected the kept search to still be answered in full"
+    indexes = {row[0] for row in store._db.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+    assert {"coverage_search", "coverage_window"} <= indexes, "Expected coverage lookups to be indexed"
+    store.close()
+
+
+def test_route_is_answered_from_the_store(fake_usgs):
+    """
+    Test that once a window is in the local store, a request for it never reaches USGS,
+    even with every cache emptied.
+    """
+    window = {"start_time": "2024-01-03T00:00:00", "end_time": "2024-01-04T00:00:00", "min_magnitude": 3.0}
+    with TestClient(app) as client:
+        first = client.get("/earthquake/sf", params=window)
+        upstream_calls = fake_usgs.request_count
+        clear_caches()
+        second = client.get("/earthquake/sf", params=window)
+
+    assert first.status_code == 200 and second.status_code == 200, "Expected status code 200"
+    assert fake_usgs.request_count == upstream_calls, "The second request should not reach USGS"
+    assert [f["id"] for f in second.json()["features"]] == [f["id"] for f in first.json()["features"]], \
+        "Expected the same events from the store"
+    assert event_store.store.hits > 0, "Expected answers from the store"
+
+
+def test_store_answers_when_usgs_is_down(fake_usgs, monkeypatch):
+    """
+    Test that when USGS fails, a window the store holds is answered from it even if it is stale.
+    """
+    window = {"start_time": "2024-01-03T00:00:00", "end_time": "2024-01-04T00:00:00"}
+    with TestClient(app) as client:
+        first = client.get("/earthquake/sf", params=window)
+        # Pretend we synced while the window was still filling up, a long time ago
+        event_store.store._db.execute("UPDATE coverage SET synced_at = end")
+        clear_caches()
+        monkeypatch.setattr(usgs_client, "USGS_API_URL", "http://127.0.0.1:9/fdsnws/event/1/query")  # Nothing listens here
+        second = client.get("/earthquake/sf", params=window)
+
+    assert first.status_code == 200 and second.status_code == 200, "Expected status code 200"
+    assert [f["id"] for f in second.json()["features"]] == [f["id"] for f in first.json()["features"]], \
+        "Expected the stored events while USGS is down"
+    assert event_store.store.fallbacks > 0 and event_store.store.hits == 0, "Expected only fallback answers"
+
+
+def test_stale_window_refreshes_with_updates_only(fake_usgs):
+    """
+    Test that a stored window synced a while ago is refreshed by asking USGS only for events
+    updated since, with revisions and deletions merged in by event id.
+    """
+    window = {"start_time": "2024-01-03T00:00:00", "end_time": "2024-01-04T00:00:00", "min_magnitude": 2.0}
+    with TestClient(app) as client:
+        first = client.get("/earthquake/sf", params=window).json()["features"]
+        revised, deleted = first[0]["id"], first[1]["id"]
+        fake_usgs.revise(revised, mag=7.7)
+        fake_usgs.delete(deleted)
+        # Pretend we synced while the window was still filling up, a long time ago
+        event_store.store._db.execute("UPDATE coverage SET synced_at = end")
+        clear_caches()
+        fake_usgs.reset_counters()
+        second = client.get("/earthquake/sf", params=window).json()["features"]
+
+    assert fake_usgs.requests and all("updatedafter" in r and r["includedeleted"] == "true" for r in fake_usgs.requests), \
+        "Expected only requests for updated events"
+    assert sum(len(fake_usgs.query(r)) for r in fake_usgs.requests) < len(first), \
+        "Expected the refresh to download fewer events than the window holds"
+    by_id = {f["id"]: f for f in second}
+    assert deleted not in by_id, "Expected the deleted event to be gone"
+    assert by_id[revised]["properties"]["mag"] == 7.7, "Expected the revised magnitude"
+    assert len(second) == len(first) - 1, "Expected every other event to stay"
+    assert event_store.store.refreshes > 0, "Expected the refreshes to be counted"
+
+
+def test_refresh_only_asks_for_and_stores_the_searched_area(fake_usgs):
+    """
+    Test that refreshing a stored San Francisco window asks USGS only for updates around San Francisco,
+    and that events outside the search which show up anyway are not stored.
+    """
+    window = {"start_time": "2024-01-03T00:00:00", "end_time": "2024-01-04T00:00:00", "min_magnitude": 2.0}
+    with TestClient(app) as client:
+        first = client.get("/earthquake/sf", params=window).json()["features"]
+        same_window = fake_usgs.query({"starttime": "2024-01-03T00:00:00", "endtime": "2024-01-04T00:00:00"})
+        far = next(f for f in same_window if containment.distance_km(
+            37.7749, -122.4194, f["geometry"]["coordinates"][1], f["geometry"]["coordinates"][0]) > 1000)
+        fake_usgs.revise(far["id"], mag=6.0)
+        fake_usgs.revise(first[0]["id"], mag=7.7)
+        event_store.store._db.execute("UPDATE coverage SET synced_at = end")
+        clear_caches()
+        fake_usgs.reset_counters()
+        client.get("/earthquake/sf", params=window)
+
+    assert fake_usgs.requests and all(r.get("maxradiuskm") and r.get("latitude") == SF["latitude"]
+                                      for r in fake_usgs.requests), "Expected the update requests to keep the area"
+    updates = event_store.updates_query(dict(SF, starttime="2024-01-03T00:00:00", endtime="2024-01-04T00:00:00",
+                                             maxradiuskm="100"), datetime(2024, 1, 1, tzinfo=timezone.utc))
+    assert "minmagnitude" not in updates, "Expected no magnitude floor, so downgraded events show up"
+    stored = {row[0] for row in event_store.store._db.execute("SELECT id FROM events")}
+    assert far["id"] not in stored, "Expected events outside the search not to be stored"
+    assert first[0]["id"] in stored, "Expected the revised event of the search to be stored"
+
+
+def test_updates_outside_the_search_are_not_stored(tmp_path):
+    """
+    Test that add_updates keeps events the search would return and changes to events already stored,
+    but skips new events outside the search's circle or below its magnitude floor.
+    """
+    server = FakeUSGSServer()
+    store = EventStore(str(tmp_path / "events.sqlite3"))
+    params = dict(SF, **JANUARY, minmagnitude="2.0", maxradiuskm="100")
+    store.add(params, usgs_answer(server, params))
+    inside = usgs_answer(server, params)["features"]
+    outside = [f for f in server.catalog if f["id"] not in {g["id"] for g in inside}]
+    downgraded = dict(inside[0], properties=dict(inside[0]["properties"], mag=1.0, updated=10 ** 13))
+
+    store.add_updates(params, {"type": "FeatureCollection", "features": outside[:50] + [downgraded]})
+    stored = {row[0]: row[1] for row in store._db.execute("SELECT id, mag FROM events")}
+    store.close()
+
+    assert not any(f["id"] in stored for f in outside[:50]), "Expected events outside the search to be skipped"
+    assert stored[downgraded["id"]] == 1.0, "Expected a stored event revised out of the search to get its new values"
+    assert len(stored) == len(inside), "Expected nothing but the search's events"
+
+
+def test_events_outside_every_search_area_are_pruned(tmp_path):
+    """
+    Test that pruning drops events inside a kept search's window but outside its circle or below
+    its magnitude floor (say, stored before a revision moved them out), and keeps the search's own events.
+    """
+    server = FakeUSGSServer()
+    store = EventStore(str(tmp_path / "events.sqlite3"))
+    params = dict(SF, **JANUARY, minmagnitude="2.0", maxradiuskm="100")
+    store.add(params, usgs_answer(server, params))
+    # Events of the same window all over the world, stored without a search of their own
+    everywhere = usgs_answer(server, JANUARY)
+    store.add(dict(JANUARY, format="geojson"), everywhere)
+    store._db.execute("DELETE FROM coverage WHERE radius IS NULL")
+
+    pruned = store.prune()
+    remaining = {row[0] for row in store._db.execute("SELECT id FROM events")}
+    store.close()
+
+    assert remaining == {f["id"] for f in server.query(params)}, "Expected only the search's events to stay"
+    assert pruned == len(everywhere["features"]) - len(remaining), "Expected every other event to be dropped"
@@ -0,0 +1,169 @@
+import asyncio
+import time
+
+import pytest
+from fastapi.testclient import TestClient
+
+from app import cache, event_store, hotkeys, ingester, usgs_client, utils
+from app.main import app
+from app.redis_client import get_redis_client
+from app.response_cache import RouteQuery, cached_response, query_key, refresh_query, response_cache, response_cache_key
+
+SF_HOUR = {"format": "geojson", "starttime": "2024-01-05T10:00:00", "endtime": "2024-01-05T11:00:00",
+           "latitude": "37.7749", "longitude": "-122.4194", "maxradiuskm": "100"}
+NOW = 1704448800.0  # 2024-01-05T10:00:00, any fixed unix time will do
+
+
+def record(params: dict, times: int):
+    """Counts `times` requests for a query: the first one built its response, the others were cache hits."""
+    query = {"route": "earthquake/sf", "params": params, "searches": [{"params": params, "ttl": 30, "where": None}]}
+    hotkeys.record_access(query_key("earthquake/sf", params), query)
+    for _ in range(times - 1):
+        hotkeys.record_access(query_key("earthquake/sf", params))
+
+
+def sf_hour(params: dict) -> RouteQuery:
+    """A route query answered from one cached search, kept for 30 seconds."""
+    return RouteQuery("earthquake/sf", {"search": params}, lambda: utils.fetch_contained(params, 30), 30)
+
+
+async def request(query: RouteQuery):
+    """Answers a route query like the route does."""
+    return await cached_response(query.route, query.params, "json", query.build, query.ttl)
+
+
+def test_popular_searches_rank_first_and_decay(monkeypatch):
+    """
+    Test that searches are ranked by their request counts, and that the counts halve every half life.
+    """
+    monkeypatch.setattr(hotkeys, "HOT_KEYS_ENABLED", True)
+    monkeypatch.setattr(hotkeys.redis_pool, "client", None)
+    hotkeys.reset()
+    hot, warm = dict(SF_HOUR, minmagnitude="4.0"), dict(SF_HOUR, minmagnitude="3.0")
+    record(warm, 2)
+    record(hot, 8)
+    asyncio.run(hotkeys.flush(NOW))
+
+    ranked = asyncio.run(hotkeys.hot_keys(10, NOW))
+    assert [entry["params"] for entry in ranked] == [hot, warm], "Expected the most requested search first"
+    assert ranked[0]["score"] == 8 and ranked[0]["searches"][0]["ttl"] == 30, \
+        "Expected the request count and the search behind the query"
+    later = asyncio.run(hotkeys.hot_keys(10, NOW + hotkeys.HOT_KEY_HALF_LIFE))
+    assert later[0]["score"] == 4, f"Expected the count to halve after one half life, got {later[0]['score']}"
+
+    # Lots of recent requests beat more requests long ago
+    record(warm, 5)
+    asyncio.run(hotkeys.flush(NOW + 3 * hotkeys.HOT_KEY_HALF_LIFE))
+    assert asyncio.run(hotkeys.hot_keys(1, NOW + 3 * hotkeys.HOT_KEY_HALF_LIFE))[0]["params"] == warm, \
+        "Expected the recently popular search first"
+    hotkeys.reset()
+
+
+@pytest.mark.skipif(get_redis_client() is None, reason="Needs a running Redis server")
+def test_counts_are_shared_through_redis(monkeypatch, with_redis):
+    """
+    Test that counts flushed to Redis are ranked the same way, and only the most popular queries are kept.
+    """
+    client = get_redis_client()
+    monkeypatch.setattr(hotkeys, "HOT_KEYS_ENABLED", True)
+    monkeypatch.setattr(hotkeys, "HOT_KEY_MAX_TRACKED", 2)
+    client.delete(hotkeys.SCORES_KEY, hotkeys.SEARCHES_KEY, hotkeys.EPOCH_KEY)
+    try:
+        searches = [dict(SF_HOUR, minmagnitude=str(m)) for m in (3.0, 4.0, 5.0)]
+        for times, params in enumerate(searches, start=1):
+            record(params, times)
+        with_redis(hotkeys.flush(NOW))
+        ranked = with_redis(hotkeys.hot_keys(10, NOW))
+
+        assert [entry["params"] for entry in ranked] == searches[:0:-1], "Expected the two most popular searches"
+        assert ranked[0]["score"] == 3, f"Expected the request count, got {ranked[0]['score']}"
+        assert client.hlen(hotkeys.SEARCHES_KEY) == 2, "Expected forgotten queries to be dropped from the hash"
+    finally:
+        client.delete(hotkeys.SCORES_KEY, hotkeys.SEARCHES_KEY, hotkeys.EPOCH_KEY)
+
+
+@pytest.mark.skipif(get_redis_client() is None, reason="Needs a running Redis server")
+def test_one_worker_refreshes(with_redis):
+    """
+    Test that the refresher has its own leader lock: one worker at a time, whoever leads the ingester.
+    """
+    client = get_redis_client()
+    client.delete(hotkeys.LEADER_KEY, ingester.LEADER_KEY)
+
+    async def run():
+        return [await ingester.is_leader("worker-a"), await ingester.is_leader("worker-b", hotkeys.LEADER_KEY),
+                await ingester.is_leader("worker-a", hotkeys.LEADER_KEY)]
+
+    try:
+        ingesting, refreshing, other = with_redis(run())
+    finally:
+        client.delete(hotkeys.LEADER_KEY, ingester.LEADER_KEY)
+
+    assert ingesting and refreshing, "Expected the two locks to be taken independently"
+    assert not other, "Expected only one worker to refresh hot queries"
+
+
+def test_hot_queries_are_refreshed_before_they_expire(fake_usgs, monkeypatch):
+    """
+    Test that the searches behind the most popular query are fetched again shortly before they expire
+    and its stored response is dropped, so its next request is built from the new data without
+    asking USGS, while less popular queries are left to expire.
+    """
+    monkeypatch.setattr(hotkeys, "HOT_KEYS_ENABLED", True)
+    monkeypatch.setattr(hotkeys, "HOT_KEY_TOP_N", 1)
+    monkeypatch.setattr(event_store, "store", None)  # Refreshes should reach USGS
+    monkeypatch.setattr(event_store, "EVENT_STORE_ENABLED", False)
+    hot = sf_hour(dict(SF_HOUR, minmagnitude="3.0"))
+    cold = sf_hour(dict(SF_HOUR, starttime="2024-01-05T12:00:00", endtime="2024-01-05T13:00:00"))
+    hot_response = response_cache_key(hot.route, hot.params, "json")
+
+    async def run():
+        await usgs_client.start_http_client()
+        try:
+            for _ in range(3):
+                await request(hot)
+            await request(cold)
+            counts = [fake_usgs.request_count]
+            counts.append(await hotkeys.refresh_hot_keys(refresh_query))  # Still fresh, nothing to do
+            # 25 seconds later, 5 seconds before both expire
+            monkeypatch.setattr(cache.l1_cache, "clock", lambda: time.monotonic() + 25)
+            counts.append(await hotkeys.refresh_hot_keys(refresh_query))
+            counts.append(fake_usgs.request_count)
+            counts.append(response_cache.get(hot_response))
+            await request(hot)
+            counts.append(fake_usgs.request_count)
+            return counts
+        finally:
+            await usgs_client.close_http_client()
+
+    before, skipped, refreshed, after_refresh, stored, after_request = asyncio.run(run())
+
+    assert before == 2, f"Expected one fetch per query, got {before}"
+    assert skipped == 0, "Fresh queries should not be refreshed"
+    assert refreshed == 1 and after_refresh == 3, "Expected only the hot query to be fetched again"
+    assert stored is None, "Expected the hot query's old response to be dropped"
+    assert after_request == after_refresh, "Expected the hot query to be built from the refreshed data"
+    assert cache.l1_cache.fresh_left(cache.make_cache_key(cold.params["search"])) < hotkeys.HOT_KEY_REFRESH_AHEAD, \
+        "Expected the cold query to be left alone"
+    assert hotkeys.stats["refreshes"] >= 1, "Expected the refresh to be counted"
+
+
+def test_admin_lists_hot_keys(fake_usgs, monkeypatch):
+    """
+    Test that /admin/hot-keys lists the queries behind recent requests, most popular first, and that
+    requests answered from the response cache count too.
+    """
+    monkeypatch.setattr(hotkeys, "HOT_KEYS_ENABLED", True)
+    window = {"start_time": "2024-01-05T10:00:00", "end_time": "2024-01-05T11:00:00"}
+    with TestClient(app) as client:
+        for _ in range(5):
+            client.get("/earthquake/sf", params=dict(window, min_magnitude=4.0))
+        client.get("/earthquake/sf", params=dict(window, min_magnitude=3.0))
+        client.get("/earthquake/sf", params=dict(window, min_magnitude=3.0, format="xml"))
+        response = client.get("/admin/hot-keys", params={"limit": 5})
+
+    assert response.status_code == 200, f"Expected status code 200, got {response.status_code}"
+    body = response.json()
+    ranked = [(entry["params"]["min_magnitude"], entry["score"]) for entry in body["hot_keys"]]
+    assert ranked == [(4.0, 5), (3.0, 2)], f"Expected every request, cache hits and formats included, got {ranked}"
+    assert body["hot_keys"][0]["searches"], "Expected the cached searches behind the query"
@@ -0,0 +1,121 @@
+import asyncio
+import time
+from datetime import datetime, timezone
+
+import pytest
+from fastapi.testclient import TestClient
+
+from app import event_store, ingester, tsunami_index, usgs_client
+from app.main import app
+from app.redis_client import get_redis_client
+
+# A moment inside the fake catalog's month, standing in for "now"
+NOW = datetime(2024, 1, 10, 5, 30, tzinfo=timezone.utc)
+
+
+def ingest(now: datetime, sync_tsunami: bool = False) -> int:
+    """
+    Runs one ingester poll with the shared USGS client open, like the app's lifespan does
+    (and, with sync_tsunami, the tsunami index sync the ingester's leader runs next to it).
+    """
+    async def run():
+        await usgs_client.start_http_client()
+        try:
+            events = await ingester.ingest_once(now)
+            if sync_tsunami:
+                events += await tsunami_index.sync(now)
+            return events
+        finally:
+            await usgs_client.close_http_client()
+    return asyncio.run(run())
+
+
+def test_recent_windows_are_hits_after_a_poll(fake_usgs):
+    """
+    Test that after one poll (one USGS request per feed) and one tsunami index sync, requests for
+    recent windows on every route are answered without USGS, with the same events USGS would return.
+    """
+    ingest(NOW, sync_tsunami=True)
+    assert fake_usgs.request_count == len(ingester.FEEDS) + 1, "Expected one USGS request per feed and one sync"
+
+    window = {"start_time": "2024-01-09T06:00:00", "end_time": "2024-01-10T05:00:00"}
+    with TestClient(app) as client:
+        sf = client.get("/earthquake/sf", params=dict(window, min_magnitude=3.0))
+        felt = client.get("/earthquake-felt", params=dict(window, min_felt_reports=5))
+        tsunami = client.get("/california", params={"start_time": "2024-01-10T05:00:00", "time_range": 24})
+
+    assert all(r.status_code == 200 for r in (sf, felt, tsunami)), "Expected status code 200"
+    assert fake_usgs.request_count == len(ingester.FEEDS) + 1, "The requests should not reach USGS"
+    assert event_store.store.hits == 0, "Expected cache hits, not answers from the local store"
+    expected = fake_usgs.query({"minmagnitude": "3.0", "latitude": "37.7749", "longitude": "-122.4194",
+                                "maxradiuskm": "100", "starttime": window["start_time"], "endtime": window["end_time"]})
+    assert [f["id"] for f in sf.json()["features"]] == [f["id"] for f in expected], \
+        "Expected exactly the events USGS would return"
+
+
+@pytest.mark.skipif(get_redis_client() is None, reason="Needs a running Redis server")
+def test_only_one_worker_leads(with_redis):
+    """
+    Test that the leader lock lets one worker poll at a time, and another takes over once it lets go.
+    """
+    client = get_redis_client()
+    client.delete(ingester.LEADER_KEY)
+
+    async def take_turns():
+        leaders = [await ingester.is_leader("worker-a"), await ingester.is_leader("worker-b"),
+                   await ingester.is_leader("worker-a")]
+        await ingester.release_leadership("worker-a")
+        return leaders + [await ingester.is_leader("worker-b")]
+
+    try:
+        first, second, again, after_release = with_redis(take_turns())
+    finally:
+        client.delete(ingester.LEADER_KEY)
+
+    assert first, "The first worker should become leader"
+    assert not second, "A second worker must not poll at the same time"
+    assert again, "The leader should keep its lock"
+    assert after_release, "Another worker should take over after a release"
+
+
+def test_lifespan_runs_the_ingester(fake_usgs, monkeypatch):
+    """
+    Test that the app starts polling in the background on startup and stops on shutdown.
+    """
+    monkeypatch.setattr(ingester, "INGEST_ENABLED", True)
+    with TestClient(app):
+        deadline = time.monotonic() + 5
+        while fake_usgs.request_count < len(ingester.FEEDS) and time.monotonic() < deadline:
+            time.sleep(0.05)
+        assert ingester._task is not None, "Expected the ingester task to be running"
+
+    assert fake_usgs.request_count >= len(ingester.FEEDS), "Expected the ingester to poll every feed"
+    assert ingester._task is None, "Expected the ingester to stop with the app"
+
+
+def test_later_polls_only_fetch_updates(fake_usgs):
+    """
+    Test that polls after the first only ask USGS for events updated since the previous poll,
+    and the warm buckets show the revisions and deletions.
+    """
+    ingest(NOW)
+    window = {"start_time": "2024-01-09T06:00:00", "end_time": "2024-01-10T05:00:00", "min_magnitude": 2.0}
+    with TestClient(app) as client:
+        first = client.get("/earthquake/sf", params=window).json()["features"]
+    revised, deleted = first[0]["id"], first[1]["id"]
+    fake_usgs.revise(revised, mag=1.0)  # Now below the feed's M2.0 floor
+    fake_usgs.delete(deleted)
+    fake_usgs.reset_counters()
+
+    events = ingest(NOW)
+    with TestClient(app) as client:
+        second = client.get("/earthquake/sf", params=dict(window, min_magnitude=2.5)).json()["features"]
+
+    assert len(fake_usgs.requests) == len(ingester.FEEDS), "Expected one request per feed and no user request"
+    assert all("updatedafter" in r for r in fake_usgs.requests), "Expected only requests for updated events"
+    assert all(r.get("maxradiuskm") == ingester.FEEDS["sf"]["maxradiuskm"] for r in fake_usgs.requests), \
+        "Expected the update requests to stay within the feed's area"
+    assert events == 2 * len(ingester.FEEDS), "Expected only the two changed events from each feed"
+    ids = {f["id"] for f in second}
+    assert revised not in ids and deleted not in ids, "Expected the revised-out and deleted events to be gone"
+    assert ingester.stats["incremental_polls"] >= len(ingester.FEEDS), "Expected incremental polls to be counted"
@@ -0,0 +1,91 @@
+import json
+
+import pytest
+from fastapi.testclient import TestClient
+
+from app import cache, states
+from app.codec import dumps_json
+from app.containment import local_filter
+from app.json_stream import FeatureCollectionParser, iter_json
+from app.main import app
+from fake_usgs import make_catalog
+
+
+def sample_body(count=300):
+    """A USGS-style response body, with whitespace and non-ASCII text like the real one may contain."""
+    data = {
+        "type": "FeatureCollection",
+        "metadata": {"count": count, "title": "Séisme ☃"},
+        "features": make_catalog(count=count),
+        "bbox": [-180.0, -60.0, 0.5, 180.0, 60.0, 12],
+    }
+    return data, json.dumps(data, ensure_ascii=False, indent=1).encode("utf-8")
+
+
+def parse_in_chunks(body: bytes, size: int, keep=None) -> dict:
+    parser = FeatureCollectionParser(keep)
+    for i in range(0, len(body), size):
+        parser.feed(body[i:i + size])
+    return parser.close()
+
+
+def test_parser_matches_json_loads_for_any_chunk_size():
+    """
+    Test that parsing the body in pieces of any size gives exactly what json.loads gives.
+    """
+    data, body = sample_body()
+
+    for size in (1, 7, 1000, len(body)):
+        assert parse_in_chunks(body, size) == data, f"Chunks of {size} bytes should parse to the same data"
+
+
+def test_parser_filters_while_parsing():
+    """
+    Test that features failing the filter are dropped and the count is updated.
+    """
+    data, body = sample_body()
+    expected = [f for f in data["features"] if f["properties"]["tsunami"] > 0]
+
+    parsed = parse_in_chunks(body, 4096, keep=local_filter({"tsunami": True}))
+
+    assert parsed["features"] == expected, "Expected only the tsunami events"
+    assert parsed["metadata"]["count"] == len(expected), "Expected the count of the kept events"
+
+
+def test_truncated_body_is_an_error():
+    """
+    Test that a body cut off in the middle raises instead of returning partial data.
+    """
+    _, body = sample_body(10)
+
+    with pytest.raises(ValueError):
+        parse_in_chunks(body[:-20], 100)
+
+
+def test_streamed_json_matches_dumps_json():
+    """
+    Test that the streamed JSON joins up to exactly the bytes of a one-go encode.
+    """
+    data, _ = sample_body(2000)
+    chunks = list(iter_json(data))
+
+    assert len(chunks) > 1, "Expected the answer in several chunks"
+    assert b"".join(chunks) == dumps_json(data), "Expected identical JSON bytes"
+
+
+def test_tsunami_route_caches_only_tsunami_events(fake_usgs):
+    """
+    Test that the tsunami route answers correctly (the state's tsunami events) and only tsunami events are ever cached.
+    """
+    with TestClient(app) as client:
+        response = client.get("/california", params={"start_time": "2024-01-20T00:00:00", "time_range": 168})
+
+    expected = fake_usgs.query({"starttime": "2024-01-13T00:00:00", "endtime": "2024-01-20T00:00:00",
+                                "minmagnitude": "2.0"})
+    expected = [f["id"] for f in states.get_index().filter(expected, "CA") if f["properties"]["tsunami"] > 0]
+    cached_features = [f for value, *_ in cache.l1_cache._entries.values() for f in value["features"]]
+
+    assert response.status_code == 200, "Expected status code 200"
+    assert [f["id"] for f in response.json()["features"]] == expected, "Expected the tsunami events of the window"
+    assert cached_features and all(f["properties"]["tsunami"] > 0 for f in cached_features), \
+        "Only tsunami events should be cached"
@@ -0,0 +1,195 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import httpx
+import pytest
+from fastapi import Request
+from fastapi.responses import StreamingResponse
+from fastapi.testclient import TestClient
+
+from app import limiter, usgs_client
+from app.main import app, shed_excess_requests
+from app.redis_client import get_redis_client
+
+
+def windows(count: int) -> list:
+    # A different hour per request so none of them can share a fetch or a cache entry
+    first = datetime(2024, 1, 1)
+    return [{"start_time": (first + timedelta(hours=i)).strftime("%Y-%m-%dT%H:%M:%S"),
+             "end_time": (first + timedelta(hours=i, minutes=59)).strftime("%Y-%m-%dT%H:%M:%S")}
+            for i in range(count)]
+
+
+def get_all(params: list) -> list:
+    # Sends every request at the same time to the app, like a burst of clients
+    async def run():
+        await usgs_client.start_http_client()
+        try:
+            transport = httpx.ASGITransport(app=app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+                return await asyncio.gather(*[client.get("/earthquake/sf", params=p) for p in params])
+        finally:
+            await usgs_client.close_http_client()
+    return asyncio.run(run())
+
+
+def test_usgs_requests_in_flight_are_limited(fake_usgs, monkeypatch):
+    """
+    Test that no more than UPSTREAM_MAX_CONCURRENCY requests reach USGS at the same time,
+    and that requests waiting for a slot still get answered.
+    """
+    monkeypatch.setattr(limiter, "UPSTREAM_MAX_CONCURRENCY", 2)
+    monkeypatch.setattr(limiter, "UPSTREAM_QUEUE_WAIT", 5)
+    fake_usgs.latency = 0.2
+
+    responses = get_all(windows(6))
+
+    assert all(r.status_code == 200 for r in responses), "Expected every request to get a slot in time"
+    assert fake_usgs.max_in_flight <= 2, f"Expected at most 2 USGS requests at once, saw {fake_usgs.max_in_flight}"
+    assert limiter.stats["waited"] > 0, "Expected some requests to wait for a slot"
+
+
+def test_excess_requests_are_shed_with_retry_after(fake_usgs, monkeypatch):
+    """
+    Test that requests that can't get a slot quickly are answered 503 with Retry-After instead of queueing.
+    """
+    monkeypatch.setattr(limiter, "UPSTREAM_MAX_CONCURRENCY", 1)
+    monkeypatch.setattr(limiter, "UPSTREAM_QUEUE_WAIT", 0.1)
+    fake_usgs.latency = 0.5
+
+    responses = get_all(windows(3))
+    shed = [r for r in responses if r.status_code == 503]
+
+    assert any(r.status_code == 200 for r in responses), "Expected the request holding the slot to succeed"
+    assert shed, "Expected the others to be shed"
+    assert all(int(r.headers["Retry-After"]) >= 1 for r in shed), "Expected a Retry-After header on shed requests"
+    assert fake_usgs.request_count == 1, "Shed requests must not reach USGS"
+
+
+def test_full_worker_sheds_requests_at_once(fake_usgs, monkeypatch):
+    """
+    Test that beyond ADMISSION_MAX_IN_FLIGHT requests in progress, new ones get 503 right away.
+    """
+    monkeypatch.setattr(limiter, "ADMISSION_MAX_IN_FLIGHT", 1)
+    fake_usgs.latency = 0.3
+
+    responses = get_all(windows(3))
+
+    assert [r.status_code for r in responses].count(200) == 1, "Expected only one request to be admitted"
+    assert all(r.headers.get("Retry-After") for r in responses if r.status_code == 503), \
+        "Expected a Retry-After header on shed requests"
+    assert limiter.stats["shed_requests"] == 2, "Expected both extra requests to be counted as shed"
+    assert limiter._in_flight == 0, "Expected every admitted request to be let go again"
+
+
+def test_token_bucket_refills_over_time(fake_usgs, monkeypatch):
+    """
+    Test that the token bucket allows a burst, then one request per 1/UPSTREAM_RATE seconds.
+    """
+    monkeypatch.setattr(limiter, "UPSTREAM_RATE", 2)
+    monkeypatch.setattr(limiter, "UPSTREAM_BURST", 2)
+
+    async def run():
+        granted = [await limiter.try_acquire(now=1000.0) for _ in range(3)]
+        later = await limiter.try_acquire(now=1000.5)
+        return granted, later
+
+    granted, later = asyncio.run(run())
+
+    assert granted[0] and granted[1] and granted[2] is None, "Expected a burst of 2, then no token"
+    assert later is not None, "Expected a new token half a second later at 2 per second"
+
+
+@pytest.mark.skipif(get_redis_client() is None, reason="Needs a running Redis server")
+def test_limits_are_shared_through_redis(with_redis, monkeypatch):
+    """
+    Test that slots taken by one worker count for every worker (Redis script), and are freed by release.
+    """
+    monkeypatch.setattr(limiter, "UPSTREAM_MAX_CONCURRENCY", 1)
+    monkeypatch.setattr(limiter, "UPSTREAM_RATE", 0)
+    client = get_redis_client()
+    client.delete(limiter.SLOTS_KEY, limiter.BUCKET_KEY)
+
+    async def run():
+        holder = await limiter.acquire(wait=0)
+        # Another worker has no slots of its own, only the shared ones
+        limiter._local_slots.clear()
+        with pytest.raises(limiter.UpstreamBusy):
+            await limiter.acquire(wait=0.1)
+        await limiter.release(holder)
+        return await limiter.acquire(wait=0)
+
+    try:
+        second = with_redis(run())
+        assert second is not None, "Expected the freed slot to be taken again"
+        assert client.zcard(limiter.SLOTS_KEY) == 1, "Expected exactly one slot held in Redis"
+        assert limiter.stats["local_fallbacks"] == 0, "Expected Redis to do the limiting"
+    finally:
+        client.delete(limiter.SLOTS_KEY, limiter.BUCKET_KEY)
+        limiter.reset()
+
+
+def test_streamed_responses_count_until_their_body_is_sent(fake_usgs, monkeypatch):
+    """
+    Test that a request with a streamed body stays in progress until the last chunk is sent,
+    so a worker busy streaming big answers still sheds new requests.
+    """
+    monkeypatch.setattr(limiter, "ADMISSION_MAX_IN_FLIGHT", 1)
+    seen = []
+
+    async def body():
+        for chunk in (b"[", b"]"):
+            seen.append(limiter._in_flight)
+            yield chunk
+
+    async def call_next(request):
+        return StreamingResponse(body(), media_type="application/json")
+
+    async def run():
+        request = Request({"type": "http", "method": "GET", "path": "/earthquake/sf", "headers": []})
+        response = await shed_excess_requests(request, call_next)
+        shed = await shed_excess_requests(request, call_next)
+        sent = [chunk async for chunk in response.body_iterator]
+        return shed, sent
+
+    shed, sent = asyncio.run(run())
+
+    assert sent == [b"[", b"]"], "Expected the body to be passed through unchanged"
+    assert seen == [1, 1], "Expected the request to count as in progress while its body is sent"
+    assert shed.status_code == 503, "Expected a new request to be shed while the body is still being sent"
+    assert limiter._in_flight == 0, "Expected the request to be let go once its body was sent"
+
+
+def test_health_check_is_admitted_when_the_worker_is_full(fake_usgs, monkeypatch):
+    """
+    Test that the health check at "/" is answered while every admission slot is taken,
+    so load balancers don't take a busy worker out of rotation, while other requests are shed.
+    """
+    monkeypatch.setattr(limiter, "ADMISSION_MAX_IN_FLIGHT", 1)
+    monkeypatch.setattr(limiter, "_in_flight", 1)
+
+    with TestClient(app) as client:
+        health = client.get("/")
+        search = client.get("/earthquake/sf", params=windows(1)[0])
+
+    assert health.status_code == 200, f"Expected the health check to be admitted, got {health.status_code}"
+    assert search.status_code == 503, "Expected other requests to be shed while the worker is full"
+    assert limiter._in_flight == 1, "Expected the health check not to take or free a slot"
+
+
+def test_cold_day_searches_fit_in_the_upstream_burst(fake_usgs, monkeypatch):
+    """
+    Test that a few cold 24-hour searches at once are all answered within the default token bucket
+    (each is a couple of day buckets, not 25 hour buckets), instead of some being shed.
+    """
+    monkeypatch.setattr(limiter, "UPSTREAM_QUEUE_WAIT", 0.1)
+    first = datetime(2024, 1, 2, 5)
+    days = [{"start_time": (first + timedelta(days=i)).strftime("%Y-%m-%dT%H:%M:%S"),
+             "end_time": (first + timedelta(days=i + 1)).strftime("%Y-%m-%dT%H:%M:%S")} for i in range(0, 12, 3)]
+
+    responses = get_all(days)
+
+    assert all(r.status_code == 200 for r in responses), \
+        f"Expected every cold search to be answered, got {[r.status_code for r in responses]}"
+    assert limiter.stats["shed_rate"] == 0 and limiter.stats["shed_concurrency"] == 0, "Expected nothing shed"
+    assert fake_usgs.request_count <= limiter.UPSTREAM_BURST, "Expected the searches to fit in one burst"
@@ -0,0 +1,132 @@
+import asyncio
+import json
+import time
+
+import httpx
+import pytest
+from fastapi.testclient import TestClient
+
+from app import limiter, metrics, usgs_client
+from app.main import app
+from app.redis_client import get_redis_client
+
+WINDOW = {"start_time": "2024-01-05T00:00:00", "end_time": "2024-01-06T00:00:00"}
+
+
+def line_value(text: str, prefix: str) -> float:
+    # The value of the first metric line starting with prefix
+    for line in text.splitlines():
+        if line.startswith(prefix):
+            return float(line.rsplit(" ", 1)[1])
+    raise AssertionError(f"No metric line starts with {prefix}")
+
+
+def test_requests_are_counted_and_timed_per_route(fake_usgs):
+    """
+    Test that /metrics reports requests by route template (not raw path), status and method,
+    with latency and size histograms, in the Prometheus text format.
+    """
+    with TestClient(app) as client:
+        for _ in range(3):
+            assert client.get("/earthquake/sf", params=WINDOW).status_code == 200
+        response = client.get("/metrics")
+
+    text = response.text
+    assert response.status_code == 200, "Expected /metrics to answer"
+    assert response.headers["content-type"].startswith("text/plain; version=0.0.4"), "Expected the Prometheus type"
+    assert "# TYPE earthquake_http_request_duration_seconds histogram" in text, "Expected a latency histogram"
+    assert line_value(text, 'earthquake_http_requests_total{route="/earthquake/sf",method="GET",status="200"}') == 3, \
+        "Expected the three requests to be counted"
+    assert line_value(text, 'earthquake_http_request_duration_seconds_bucket{route="/earthquake/sf",le="+Inf"}') == 3, \
+        "Expected every request in the +Inf bucket"
+    assert line_value(text, 'earthquake_http_response_size_bytes_sum{route="/earthquake/sf"}') > 0, \
+        "Expected the response bodies to be measured"
+    assert line_value(text, "earthquake_http_requests_in_flight") == 1, "Only the /metrics request is in flight"
+
+
+def test_cache_and_upstream_results_are_counted(fake_usgs):
+    """
+    Test that the first request misses the caches and asks USGS, and the repeat is a response cache hit.
+    """
+    with TestClient(app) as client:
+        client.get("/earthquake/sf", params=WINDOW)
+        client.get("/earthquake/sf", params=WINDOW)
+        text = client.get("/metrics").text
+
+    assert line_value(text, 'earthquake_cache_lookups_total{layer="response",result="miss"}') >= 1, \
+        "Expected the first request to miss the response cache"
+    assert line_value(text, 'earthquake_cache_lookups_total{layer="response",result="hit"}') >= 1, \
+        "Expected the repeat to be a response cache hit"
+    assert line_value(text, 'earthquake_upstream_requests_total{endpoint="query",result="ok"}') == \
+        fake_usgs.request_count, "Expected every USGS query to be counted"
+    assert line_value(text, 'earthquake_upstream_request_duration_seconds_count{endpoint="query"}') >= 1, \
+        "Expected USGS latency to be recorded"
+    assert 'earthquake_internal_events_total{source="single_flight"' in text, "Expected the admin counters too"
+
+
+def test_histogram_buckets_are_cumulative(fake_usgs):
+    """
+    Test the rendered histogram: cumulative buckets ending at +Inf, with _sum and _count.
+    """
+    for seconds in (0.003, 0.02, 0.02, 7.0):
+        metrics.observe("upstream_request_duration_seconds", seconds, "count")
+
+    text = metrics.render(metrics.merge([metrics.snapshot()]))
+    prefix = 'earthquake_upstream_request_duration_seconds_bucket{endpoint="count",le='
+
+    assert line_value(text, prefix + '"0.005"}') == 1, "Expected one observation up to 5 ms"
+    assert line_value(text, prefix + '"0.025"}') == 3, "Expected buckets to include the smaller ones"
+    assert line_value(text, prefix + '"+Inf"}') == 4, "Expected every observation in +Inf"
+    assert line_value(text, 'earthquake_upstream_request_duration_seconds_sum{endpoint="count"}') == \
+        pytest.approx(7.043), "Expected the sum of the observations"
+
+
+@pytest.mark.skipif(get_redis_client() is None, reason="Needs a running Redis server")
+def test_metrics_of_all_workers_are_added_up(fake_usgs, with_redis, monkeypatch):
+    """
+    Test that /metrics adds up the snapshots other workers shared in Redis, and forgets workers
+    whose snapshot expired.
+    """
+    monkeypatch.setattr(metrics.redis_pool, "enabled", True)
+    client = get_redis_client()
+    other = {"values": {"http_requests_total": [[["/earthquake/sf", "GET", "200"], 5]], "workers": [[[], 1]]},
+             "at": time.time()}
+    client.set(metrics.SNAPSHOT_PREFIX + "other:1", json.dumps(other), ex=60)
+    client.sadd(metrics.WORKERS_KEY, "other:1", "gone:2")
+    metrics.inc("http_requests_total", "/earthquake/sf", "GET", "200", amount=2)
+
+    try:
+        text = with_redis(metrics.collect())
+        assert line_value(text, 'earthquake_http_requests_total{route="/earthquake/sf",method="GET",status="200"}') \
+            == 7, "Expected both workers' requests to be added up"
+        assert line_value(text, "earthquake_workers") == 2, "Expected this worker and the other one"
+        assert not client.sismember(metrics.WORKERS_KEY, "gone:2"), "Expected the expired worker to be forgotten"
+    finally:
+        client.delete(metrics.WORKERS_KEY, metrics.SNAPSHOT_PREFIX + "other:1", metrics.SNAPSHOT_PREFIX + metrics.WORKER)
+
+
+def test_shed_requests_are_counted(fake_usgs, monkeypatch):
+    """
+    Test that requests the admission middleware turns away with 503 still show up in /metrics,
+    under the route they asked for.
+    """
+    monkeypatch.setattr(limiter, "ADMISSION_MAX_IN_FLIGHT", 1)
+    fake_usgs.latency = 0.3
+
+    async def run():
+        await usgs_client.start_http_client()
+        try:
+            transport = httpx.ASGITransport(app=app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+                burst = await asyncio.gather(*[client.get("/earthquake/sf", params=WINDOW) for _ in range(3)])
+                return burst, (await client.get("/metrics")).text
+        finally:
+            await usgs_client.close_http_client()
+
+    burst, text = asyncio.run(run())
+
+    assert [r.status_code for r in burst].count(503) == 2, "Expected two requests to be shed"
+    assert line_value(text, 'earthquake_http_requests_total{route="/earthquake/sf",method="GET",status="503"}') == 2, \
+        "Expected the shed requests to be counted"
+    assert line_value(text, 'earthquake_http_requests_total{route="/earthquake/sf",method="GET",status="200"}') == 1, \
+        "Expected the admitted request to be counted"
@@ -0,0 +1,93 @@
+import asyncio
+
+import pytest
+from fastapi.testclient import TestClient
+
+from app import ratelimit
+from app.main import app
+from app.redis_client import get_redis_client
+
+WINDOW = {"start_time": "2024-01-05T00:00:00", "end_time": "2024-01-06T00:00:00"}
+
+
+def test_clients_over_their_limit_get_429(fake_usgs, monkeypatch):
+    """
+    Test that a client gets 429 with Retry-After once it used up its requests, while another
+    client (different API key) is not affected.
+    """
+    monkeypatch.setattr(ratelimit, "RATE_LIMIT_ENABLED", True)
+    monkeypatch.setattr(ratelimit, "RATE_LIMIT_REQUESTS", 3)
+    with TestClient(app) as client:
+        busy = [client.get("/earthquake/sf", params=WINDOW, headers={"X-API-Key": "script"}) for _ in range(5)]
+        other = client.get("/earthquake/sf", params=WINDOW, headers={"X-API-Key": "dashboard"})
+        health = client.get("/admin/stats", headers={"X-API-Key": "script"})
+
+    assert [r.status_code for r in busy] == [200, 200, 200, 429, 429], "Expected 3 requests, then 429"
+    assert int(busy[3].headers["Retry-After"]) >= 1, "Expected a Retry-After header"
+    assert busy[2].headers["X-RateLimit-Remaining"] == "0", "Expected the last allowed request to have none left"
+    assert other.status_code == 200, "Another client's limit must not be affected"
+    assert health.status_code == 200, "Admin requests are not limited"
+    assert ratelimit.stats["limited"] == 2, "Expected the refused requests to be counted"
+
+
+def test_window_slides(fake_usgs, monkeypatch):
+    """
+    Test that the previous window's requests count for the part of it still in the last
+    RATE_LIMIT_WINDOW seconds: halfway through the next window, half of them are forgotten.
+    """
+    monkeypatch.setattr(ratelimit, "RATE_LIMIT_REQUESTS", 10)
+    monkeypatch.setattr(ratelimit, "RATE_LIMIT_WINDOW", 60)
+
+    async def run():
+        first = [(await ratelimit.check("ip:1.2.3.4", now=6000.0 + i))[0] for i in range(11)]
+        halfway = [(await ratelimit.check("ip:1.2.3.4", now=6090.0))[0] for _ in range(6)]
+        return first, halfway
+
+    first, halfway = asyncio.run(run())
+
+    assert first == [True] * 10 + [False], "Expected 10 requests in the first window"
+    assert halfway == [True] * 5 + [False], "Expected half of the previous window's requests to still count"
+
+
+@pytest.mark.skipif(get_redis_client() is None, reason="Needs a running Redis server")
+def test_limits_are_shared_through_redis(with_redis, monkeypatch):
+    """
+    Test that all workers count a client's requests together in Redis, with the same sliding window.
+    """
+    monkeypatch.setattr(ratelimit, "RATE_LIMIT_REQUESTS", 10)
+    monkeypatch.setattr(ratelimit, "RATE_LIMIT_WINDOW", 60)
+    client = get_redis_client()
+    keys = [f"{ratelimit.KEY_PREFIX}ip:5.6.7.8:{n}" for n in (100, 101)]
+    client.delete(*keys)
+
+    async def run():
+        first = [(await ratelimit.check("ip:5.6.7.8", now=6000.0 + i))[0] for i in range(11)]
+        # Another worker has none of this worker's counters
+        ratelimit._local_counts.clear()
+        halfway = [(await ratelimit.check("ip:5.6.7.8", now=6090.0))[0] for _ in range(6)]
+        return first, halfway
+
+    try:
+        first, halfway = with_redis(run())
+        assert first == [True] * 10 + [False], "Expected 10 requests in the first window"
+        assert halfway == [True] * 5 + [False], "Expected the shared counters to slide like the local ones"
+        assert ratelimit.stats["local_fallbacks"] == 0, "Expected Redis to do the counting"
+    finally:
+        client.delete(*keys)
+        ratelimit.reset()
+
+
+def test_health_check_is_never_limited(fake_usgs, monkeypatch):
+    """
+    Test that the health check at "/" keeps answering 200 for a client far over its limit,
+    while the same client's searches get 429.
+    """
+    monkeypatch.setattr(ratelimit, "RATE_LIMIT_ENABLED", True)
+    monkeypatch.setattr(ratelimit, "RATE_LIMIT_REQUESTS", 2)
+    with TestClient(app) as client:
+        checks = [client.get("/", headers={"X-API-Key": "probe"}) for _ in range(5)]
+        search = [client.get("/earthquake/sf", params=WINDOW, headers={"X-API-Key": "probe"}) for _ in range(3)]
+
+    assert all(r.status_code == 200 for r in checks), "Expected every health check to be answered"
+    assert "X-RateLimit-Limit" not in checks[0].headers, "Expected health checks to skip the rate limit"
+    assert [r.status_code for r in search] == [200, 200, 429], "Expected health checks not to use up the limit"
@@ -1,5 +1,10 @@
+import asyncio
 import os
-from app.redis_client import get_redis_client
+
+import pytest
+
+import app.redis_client as redis_client_module
+from app.redis_client import get_redis_client, AsyncRedisPool
 from app.config import REDIS_HOST, REDIS_PORT
 
 def test_redis_connection():
@@ -43,4 +48,43 @@ def test_redis_connection_failure():
         assert redis_client is None, "Expected Redis client to be None due to connection failure"
     finally:
         # Restore the original Redis host
-        os.environ["REDIS_HOST"] = original_host
\ No newline at end of file
+        os.environ["REDIS_HOST"] = original_host
+
+@pytest.mark.skipif(get_redis_client() is None, reason="Needs a running Redis server")
+def test_async_pool_shares_a_few_connections():
+    """
+    Test that many concurrent async Redis calls share the pool's few connections,
+    and that closing the pool drops its clients.
+    """
+    pool = AsyncRedisPool(max_connections=2)
+
+    async def run():
+        assert await pool.start(), "Expected the async pool to reach Redis"
+        try:
+            await pool.binary_client.set("test_async_pool", b"value")
+            values = await asyncio.gather(*[pool.binary_client.get("test_async_pool") for _ in range(50)])
+            connections = pool.binary_client.connection_pool
+            created = len(connections._available_connections) + len(connections._in_use_connections)
+            await pool.binary_client.delete("test_async_pool")
+            return values, created, await pool.ping()
+        finally:
+            await pool.close()
+
+    values, created, healthy = asyncio.run(run())
+    assert values == [b"value"] * 50, "Expected every concurrent call to get the value"
+    assert created <= 2, f"Expected at most 2 pooled connections, got {created}"
+    assert healthy, "Expected the open pool to answer a ping"
+    assert pool.client is None and pool.binary_client is None, "Expected the clients to be gone after closing"
+
+
+def test_async_pool_without_redis(monkeypatch):
+    """
+    Test that the async pool stays closed when Redis doesn't answer, so the app runs without it.
+    """
+    monkeypatch.setattr(redis_client_module, "REDIS_PORT", 1)
+    pool = AsyncRedisPool()
+
+    started = asyncio.run(pool.start())
+    assert not started, "Expected the pool not to start without Redis"
+    assert pool.client is None and pool.binary_client is None, "Expected no clients without Redis"
+    assert not asyncio.run(pool.ping()), "Expected a ping to report Redis as down"
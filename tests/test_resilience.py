@@ -0,0 +1,165 @@
+import asyncio
+import time
+
+import httpx
+import pytest
+from fastapi.testclient import TestClient
+
+from app import resilience, usgs_client
+from app.config import ROUTE_DEADLINES
+from app.main import app
+
+PARAMS = {"format": "geojson", "starttime": "2024-01-05T00:00:00", "endtime": "2024-01-05T06:00:00"}
+
+
+def fetch():
+    # One fetch_json call through the shared client, like a route makes it
+    async def run():
+        await usgs_client.start_http_client()
+        try:
+            return await usgs_client.fetch_json(PARAMS)
+        finally:
+            await usgs_client.close_http_client()
+    return asyncio.run(run())
+
+
+def test_failed_requests_are_retried(fake_usgs, monkeypatch):
+    """
+    Test that 5xx answers are tried again (after a short random wait) until USGS answers.
+    """
+    monkeypatch.setattr(resilience, "USGS_RETRY_BACKOFF", 0.01)
+    fake_usgs.fail_next = 2
+
+    data = fetch()
+
+    assert data["type"] == "FeatureCollection", "Expected the third try to succeed"
+    assert fake_usgs.request_count == 3, f"Expected 3 requests, got {fake_usgs.request_count}"
+    assert resilience.stats["retries"] == 2, "Expected both retries to be counted"
+    assert resilience.breaker.state == "closed", "A recovered USGS should leave the breaker closed"
+
+
+def test_client_errors_are_not_retried(fake_usgs):
+    """
+    Test that a 400 (like USGS refusing a search as too big) fails at once and doesn't count against USGS.
+    """
+    fake_usgs.fail_next = 1
+    fake_usgs.fail_status = 400
+
+    with pytest.raises(httpx.HTTPStatusError):
+        fetch()
+
+    assert fake_usgs.request_count == 1, "Expected no retries for a 400"
+    assert resilience.breaker.failures == 0, "A 400 is an answer, not a USGS failure"
+
+
+def test_breaker_fails_fast_then_recovers(fake_usgs, monkeypatch):
+    """
+    Test that after enough failures in a row USGS isn't asked at all, and that one trial request
+    after the cool-down closes the breaker again when USGS is back.
+    """
+    now = [1000.0]
+    monkeypatch.setattr(resilience, "USGS_RETRIES", 0)
+    monkeypatch.setattr(resilience, "breaker", resilience.CircuitBreaker(2, 30, clock=lambda: now[0]))
+    fake_usgs.fail_next = 2
+
+    for _ in range(2):
+        with pytest.raises(httpx.HTTPStatusError):
+            fetch()
+    assert resilience.breaker.state == "open", "Expected two failures in a row to open the breaker"
+
+    with pytest.raises(resilience.CircuitOpenError):
+        fetch()
+    assert fake_usgs.request_count == 2, "An open breaker must not ask USGS"
+    assert resilience.stats["breaker_rejected"] == 1, "Expected the fast failure to be counted"
+
+    now[0] += 31
+    assert fetch()["type"] == "FeatureCollection", "Expected the trial request to get through"
+    assert resilience.breaker.state == "closed", "Expected a successful trial to close the breaker"
+
+
+def test_slow_requests_are_hedged(fake_usgs, monkeypatch):
+    """
+    Test that a request much slower than USGS' recent answers is sent again, and the faster copy wins.
+    """
+    monkeypatch.setattr(resilience, "USGS_HEDGE_PERCENTILE", 95)
+    for _ in range(resilience.USGS_HEDGE_MIN_SAMPLES):
+        resilience.latency("query").record(0.01)
+    fake_usgs.delays = [2.0]
+
+    started = time.perf_counter()
+    data = fetch()
+    elapsed = time.perf_counter() - started
+
+    assert data["type"] == "FeatureCollection", "Expected an answer"
+    assert elapsed < 1.5, f"Expected the hedge to answer long before the slow request, took {elapsed:.2f}s"
+    assert fake_usgs.request_count == 2, "Expected exactly one hedge"
+    assert resilience.stats["hedge_wins"] == 1, "Expected the hedge to be counted as the winner"
+
+
+def test_route_deadline_gives_504(fake_usgs, monkeypatch):
+    """
+    Test that a route whose USGS request runs past the route's time budget answers 504 in time.
+    """
+    monkeypatch.setitem(ROUTE_DEADLINES, "earthquake/sf", 0.3)
+    fake_usgs.latency = 1.0
+
+    with TestClient(app) as client:
+        started = time.perf_counter()
+        response = client.get("/earthquake/sf", params={"start_time": "2024-01-05T10:00:00",
+                                                        "end_time": "2024-01-05T12:00:00"})
+        elapsed = time.perf_counter() - started
+
+    assert response.status_code == 504, f"Expected status code 504, got {response.status_code}"
+    assert elapsed < 0.9, f"Expected the budget to cut the request short, took {elapsed:.2f}s"
+    assert resilience.stats["deadline_exceeded"] > 0, "Expected the exceeded budget to be counted"
+
+
+def test_late_answer_of_the_losing_attempt_is_closed(monkeypatch):
+    """
+    Test that when the slow attempt gets its answer just after the hedge won, that answer is handed
+    to `discard` (closing it) instead of being dropped with its pooled connection still open.
+    """
+    class Tracker:
+        # Hedge right away, as if every past answer was fast
+        def hedge_delay(self):
+            return 0.01
+
+        def record(self, seconds):
+            pass
+
+    async def take_slot():
+        return "slot"
+
+    async def give_back(holder):
+        pass
+
+    monkeypatch.setattr(resilience, "latency", lambda name: Tracker())
+    monkeypatch.setattr(resilience.limiter, "try_acquire", take_slot)
+    monkeypatch.setattr(resilience.limiter, "release", give_back)
+    closed = []
+
+    async def run():
+        slow_answer = asyncio.get_running_loop().create_future()
+        attempts = []
+
+        async def send():
+            attempts.append(1)
+            if len(attempts) == 1:
+                return await slow_answer
+            # The first attempt's answer lands right after the hedge's, before the loser is cancelled
+            loop = asyncio.get_running_loop()
+            loop.call_soon(loop.call_soon, slow_answer.set_result, "first")
+            return "hedge"
+
+        async def discard(answer):
+            closed.append(answer)
+
+        result = await resilience.hedged("query", send, discard=discard)
+        for _ in range(5):
+            await asyncio.sleep(0)
+        return result
+
+    result = asyncio.run(run())
+
+    assert result == "hedge", "Expected the hedge's answer"
+    assert closed == ["first"], f"Expected the losing attempt's answer to be closed, got {closed}"
@@ -0,0 +1,63 @@
+import asyncio
+import json
+
+from fastapi.testclient import TestClient
+
+from app import response_cache
+from app.main import app
+from app.utils import dumps_json
+
+
+def test_dumps_json_matches_standard_json():
+    """
+    Test that the fast encoder produces the same compact JSON as the standard library.
+    """
+    data = {"type": "FeatureCollection", "features": [{"id": "a", "properties": {"place": "Zürich", "mag": 2.5}}]}
+    expected = json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+    assert dumps_json(data) == expected, "Expected identical compact JSON bytes"
+
+
+def test_cached_response_builds_once_per_format(monkeypatch):
+    """
+    Test that a response is built and encoded once, then served as stored bytes.
+    """
+    monkeypatch.setattr(response_cache.redis_pool, "binary_client", None)
+    response_cache.response_cache.clear()
+    builds = []
+
+    async def build():
+        builds.append(1)
+        return {"type": "FeatureCollection", "features": []}
+
+    async def run():
+        first = await response_cache.cached_response("test", {"a": 1}, "json", build)
+        second = await response_cache.cached_response("test", {"a": 1}, "json", build)
+        xml = await response_cache.cached_response("test", {"a": 1}, "xml", build)
+        return first, second, xml
+
+    first, second, xml = asyncio.run(run())
+    response_cache.response_cache.clear()
+
+    assert len(builds) == 2, "Expected one build for JSON and one for XML"
+    assert first.body == second.body, "Expected the same bytes on a hit"
+    assert second.media_type == "application/json", "Expected JSON media type"
+    assert xml.media_type == "application/xml", "Expected XML media type"
+
+
+def test_repeat_request_skips_fetching_and_encoding(fake_usgs):
+    """
+    Test that a repeated /earthquake-felt request is answered from the response cache.
+    """
+    params = {"start_time": "2024-01-12T00:00:00", "end_time": "2024-01-12T12:00:00", "min_felt_reports": 5}
+    with TestClient(app) as client:
+        first = client.get("/earthquake-felt", params=params)
+        data_hits = client.get("/admin/stats").json()["l1_cache"]["hits"]
+        second = client.get("/earthquake-felt", params=params)
+        stats = client.get("/admin/stats").json()
+
+    assert first.status_code == 200 and second.status_code == 200, "Expected status code 200"
+    assert first.content == second.content, "Expected byte-identical responses"
+    assert second.headers["Content-Type"] == "application/json", "Expected JSON response"
+    assert stats["l1_cache"]["hits"] == data_hits, "The hit should not touch the data cache"
+    assert stats["response_cache"]["hits"] >= 1, "Expected a response cache hit"
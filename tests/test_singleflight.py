@@ -0,0 +1,142 @@
+import asyncio
+
+import httpx
+import pytest
+import redis
+
+import app.singleflight as singleflight
+import app.usgs_client as usgs_client
+from app.main import app
+from app.redis_client import get_redis_client
+
+
+def test_concurrent_calls_share_one_fetch():
+    """
+    Test that concurrent callers for one key run the fetch only once.
+    """
+    calls = []
+
+    async def fetch():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return {"value": 42}
+
+    async def run():
+        return await asyncio.gather(*[singleflight.single_flight("k", fetch) for _ in range(50)])
+
+    before = singleflight.stats["coalesced_waiters"]
+    results = asyncio.run(run())
+
+    assert len(calls) == 1, "Expected a single fetch"
+    assert all(r == {"value": 42} for r in results), "Every caller should get the shared result"
+    assert singleflight.stats["coalesced_waiters"] - before == 49, "Expected 49 coalesced waiters"
+    assert "k" not in singleflight._in_flight, "Finished fetches should be forgotten"
+
+
+def test_errors_are_shared_and_not_cached():
+    """
+    Test that a failed fetch raises for every waiter and the next call tries again.
+    """
+    calls = []
+
+    async def failing_fetch():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        raise RuntimeError("USGS is down")
+
+    async def run():
+        return await asyncio.gather(
+            *[singleflight.single_flight("broken", failing_fetch) for _ in range(5)],
+            return_exceptions=True,
+        )
+
+    results = asyncio.run(run())
+    assert all(isinstance(r, RuntimeError) for r in results), "Every waiter should see the error"
+    asyncio.run(run())
+    assert len(calls) == 2, "A new call after a failure should fetch again"
+
+
+def test_concurrent_endpoint_misses_make_one_upstream_call(fake_usgs):
+    """
+    Test that a burst of identical /earthquake/sf requests reaches USGS once.
+    """
+    fake_usgs.latency = 0.2
+    params = {"start_time": "2024-01-05T10:00:00", "end_time": "2024-01-05T10:30:00"}
+
+    async def run():
+        await usgs_client.start_http_client()
+        try:
+            transport = httpx.ASGITransport(app=app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+                return await asyncio.gather(*[client.get("/earthquake/sf", params=params) for _ in range(30)])
+        finally:
+            await usgs_client.close_http_client()
+
+    responses = asyncio.run(run())
+
+    assert all(r.status_code == 200 for r in responses), "Expected every request to succeed"
+    assert fake_usgs.request_count == 1, f"Expected one upstream call, got {fake_usgs.request_count}"
+
+
+@pytest.mark.skipif(get_redis_client() is None, reason="Needs a running Redis server")
+def test_waiting_worker_reads_leaders_result(with_redis):
+    """
+    Test that a second worker waits on the Redis lock and reuses the cached result.
+    """
+    client = get_redis_client()
+    key = "usgs_data:test-singleflight"
+    client.delete(key, f"lock:{key}")
+    calls = []
+
+    async def fetch():
+        calls.append(1)
+        await asyncio.sleep(0.2)
+        client.setex(key, 5, "cached")
+        return "fresh"
+
+    async def read_cached():
+        return client.get(key)
+
+    async def run():
+        # Two different workers would not share an in-process single flight, so call the cluster variant directly
+        return await asyncio.gather(
+            singleflight.cluster_single_flight(key, fetch, read_cached),
+            singleflight.cluster_single_flight(key, fetch, read_cached),
+        )
+
+    try:
+        results = with_redis(run())
+    finally:
+        client.delete(key, f"lock:{key}")
+
+    assert len(calls) == 1, "Only the lock holder should fetch"
+    assert sorted(results) == ["cached", "fresh"], "The waiter should read the leader's cached result"
+
+
+def test_redis_error_while_waiting_falls_back_to_fetch(monkeypatch):
+    """
+    Test that when Redis fails while we wait for another worker's lock, we fetch ourselves
+    instead of passing the Redis error on to the request.
+    """
+    class BrokenRedis:
+        # The lock is held elsewhere, then Redis goes away
+        async def set(self, *args, **kwargs):
+            return False
+
+        async def exists(self, key):
+            raise redis.ConnectionError("Connection reset by peer")
+
+    monkeypatch.setattr(singleflight.redis_pool, "client", BrokenRedis())
+    calls = []
+
+    async def fetch():
+        calls.append(1)
+        return {"value": 42}
+
+    async def read_cached():
+        return None
+
+    result = asyncio.run(singleflight.cluster_single_flight("k", fetch, read_cached))
+
+    assert result == {"value": 42}, "Expected our own fetch's result"
+    assert calls == [1], "Expected exactly one fetch after the Redis error"
@@ -0,0 +1,119 @@
+import asyncio
+import time
+
+import pytest
+from fastapi.testclient import TestClient
+
+from app import cache, event_store, singleflight, usgs_client, utils
+from app.config import HISTORICAL_CACHE_DURATION
+from app.main import app
+from app.redis_client import get_redis_client, redis_pool
+from app.response_cache import response_cache
+
+SF_HOUR = {"format": "geojson", "starttime": "2024-01-05T10:00:00", "endtime": "2024-01-05T11:00:00",
+           "minmagnitude": "2.0", "latitude": "37.7749", "longitude": "-122.4194", "maxradiuskm": "100"}
+
+
+def without_event_store(monkeypatch):
+    """Switches the local event store off, so only the cache can answer without USGS."""
+    monkeypatch.setattr(event_store, "store", None)
+    monkeypatch.setattr(event_store, "EVENT_STORE_ENABLED", False)
+
+
+def test_expired_entry_is_served_while_it_refreshes(fake_usgs, monkeypatch):
+    """
+    Test that an entry that just expired is returned right away, and one background fetch replaces it.
+    """
+    without_event_store(monkeypatch)
+
+    async def run():
+        await usgs_client.start_http_client()
+        try:
+            first = await utils.fetch_cached(SF_HOUR, 0)  # Expires right away
+            stale = await asyncio.gather(*(utils.fetch_cached(SF_HOUR, 30) for _ in range(5)))
+            while singleflight._in_flight:
+                await asyncio.sleep(0.01)
+            fresh = await cache.get_cached(cache.make_cache_key(SF_HOUR))
+            return first, stale, fresh
+        finally:
+            await usgs_client.close_http_client()
+
+    first, stale, fresh = asyncio.run(run())
+
+    assert all(data is first for data in stale), "Expected the expired entry to be served as it is"
+    assert fake_usgs.request_count == 2, f"Expected one background refresh, got {fake_usgs.request_count - 1}"
+    assert fresh is not None and fresh is not first, "Expected the refresh to replace the entry"
+
+
+def test_expired_data_is_served_when_usgs_fails(fake_usgs, monkeypatch):
+    """
+    Test that when USGS fails, a request gets the expired data with a header marking it stale
+    instead of an error, and the answer is not kept in the response cache.
+    """
+    without_event_store(monkeypatch)
+    window = {"start_time": "2024-01-05T10:00:00", "end_time": "2024-01-05T12:00:00"}
+    with TestClient(app) as client:
+        first = client.get("/earthquake/sf", params=window)
+        # Move the cache's clock past the buckets' time to live, and beyond stale-while-revalidate
+        monkeypatch.setattr(cache.l1_cache, "clock", lambda: time.monotonic() + HISTORICAL_CACHE_DURATION + 600)
+        monkeypatch.setattr(utils, "CACHE_STALE_WHILE_REVALIDATE", 0)
+        monkeypatch.setattr(usgs_client, "USGS_API_URL", "http://127.0.0.1:9/fdsnws/event/1/query")  # Nothing listens here
+        response_cache.clear()
+        second = client.get("/earthquake/sf", params=window)
+
+    assert first.status_code == 200 and "X-Cache-Stale" not in first.headers, "Expected a fresh first answer"
+    assert second.status_code == 200, f"Expected stale data instead of an error, got {second.status_code}"
+    assert second.headers.get("X-Cache-Stale") == "true", "Expected the stale answer to be marked"
+    assert second.json()["features"] == first.json()["features"], "Expected the expired events"
+    assert len(response_cache) == 0, "A stale answer must not be kept in the response cache"
+    assert cache.stale_stats["stale_on_error"] > 0, "Expected the fallback to be counted"
+
+
+def test_errors_without_expired_data_still_fail(fake_usgs, monkeypatch):
+    """
+    Test that with nothing cached, a USGS failure is still reported as 503.
+    """
+    without_event_store(monkeypatch)
+    monkeypatch.setattr(usgs_client, "USGS_API_URL", "http://127.0.0.1:9/fdsnws/event/1/query")
+    with TestClient(app) as client:
+        response = client.get("/earthquake/sf", params={"start_time": "2024-01-05T10:00:00",
+                                                        "end_time": "2024-01-05T12:00:00"})
+
+    assert response.status_code == 503, f"Expected status code 503, got {response.status_code}"
+
+
+@pytest.mark.skipif(get_redis_client() is None, reason="Needs a running Redis server")
+def test_fresher_value_from_another_worker_beats_stale_l1(fake_usgs, with_redis, monkeypatch):
+    """
+    Test that a worker holding an expired L1 copy picks up the fresh value another worker already
+    wrote to Redis, instead of serving its own copy and asking USGS again.
+    """
+    without_event_store(monkeypatch)
+    monkeypatch.setattr(redis_pool, "enabled", True)
+    key = cache.make_cache_key(SF_HOUR)
+    client = get_redis_client()
+    client.delete(key, f"lock:{key}")
+    ours = {"type": "FeatureCollection", "metadata": {"worker": "A"}, "features": []}
+    theirs = {"type": "FeatureCollection", "metadata": {"worker": "B"}, "features": []}
+
+    async def run():
+        await usgs_client.start_http_client()
+        try:
+            # Worker B refreshed the search in Redis; worker A still has its own expired copy in L1
+            await cache.set_cached(key, theirs, 60)
+            cache.l1_cache.set(key, ours, 100, ttl=0, keep=cache.STALE_KEEP)
+            data, stale = await utils.fetch_cached_entry(SF_HOUR, 60)
+            # What a request waiting on another worker's cache lock polls (see utils._fetch_once)
+            waited = await cache.get_cached(key)
+            return data, stale, waited
+        finally:
+            await usgs_client.close_http_client()
+
+    try:
+        data, stale, waited = with_redis(run())
+        assert data["metadata"]["worker"] == "B" and not stale, "Expected worker B's fresh value from Redis"
+        assert waited["metadata"]["worker"] == "B", "Expected cache waiters to see the fresh value too"
+        assert fake_usgs.request_count == 0, "Expected no USGS request while Redis has fresh data"
+        assert not singleflight._in_flight, "Expected no background refresh"
+    finally:
+        client.delete(key, f"lock:{key}")
@@ -0,0 +1,69 @@
+import pytest
+from fastapi.testclient import TestClient
+
+from app import states, tsunami_index
+from app.containment import distance_km
+from app.main import app
+
+
+@pytest.mark.parametrize("name, code", [
+    ("CA", "CA"), ("ca", "CA"), ("California", "CA"), ("new-york", "NY"), ("New_York", "NY"), ("hi", "HI"),
+])
+def test_states_are_found_by_code_or_name(name, code):
+    """
+    Test that states can be asked for by their code or their name, written any way.
+    """
+    assert states.resolve(name).code == code, f"Expected {name} to be {code}"
+
+
+@pytest.mark.parametrize("lat, lon, expected", [
+    (37.77, -122.42, ["CA"]),   # San Francisco
+    (40.3, -125.5, ["CA", "OR"]),  # Off Cape Mendocino, in both coastal zones
+    (39.53, -119.81, ["NV"]),   # Reno: on land, so only the state it is in
+    (21.3, -157.85, ["HI"]),    # Honolulu
+    (52.9, 172.9, ["AK"]),      # Attu, west of the antimeridian
+    (56.5, -151.0, ["AK"]),     # Gulf of Alaska, off Kodiak
+    (40.71, -74.0, ["NY"]),     # Manhattan
+    (0.0, -140.0, []),          # Open Pacific
+    (35.7, 139.7, []),          # Tokyo
+])
+def test_events_are_assigned_to_states(lat, lon, expected):
+    """
+    Test that points on land belong to their state, and points at sea to the coastal states nearby.
+    """
+    assert sorted(states.get_index().states_at(lat, lon)) == expected, f"Wrong states for ({lat}, {lon})"
+
+
+def test_search_circles_hold_their_states():
+    """
+    Test that the USGS search circle of every state holds its whole outline and coastal zone.
+    """
+    for region in states.get_index().regions.values():
+        area = region.search_area()
+        lat, lon, radius = float(area["latitude"]), float(area["longitude"]), float(area["maxradiuskm"])
+        farthest = max(distance_km(lat, lon, point_lat, point_lon)
+                       for ring in region.polygons for point_lon, point_lat in ring)
+        assert farthest + region.zone_km <= radius, f"The search circle of {region.code} is too small"
+
+
+def test_route_fetches_only_the_state_area(fake_usgs, monkeypatch):
+    """
+    Test that without the tsunami index, the route asks USGS for the area around the state only
+    and returns exactly the state's tsunami events; unknown states are a 404.
+    """
+    monkeypatch.setattr(tsunami_index, "TSUNAMI_INDEX_ENABLED", False)
+    with TestClient(app) as client:
+        response = client.get("/california", params={"start_time": "2024-01-20T00:00:00", "time_range": 24})
+        unknown = client.get("/atlantis", params={"start_time": "2024-01-20T00:00:00", "time_range": 24})
+
+    assert response.status_code == 200, "Expected status code 200"
+    assert unknown.status_code == 404, "Expected status code 404 for an unknown state"
+    area = states.resolve("CA").search_area()
+    assert fake_usgs.requests and all(r.get("maxradiuskm") == area["maxradiuskm"] for r in fake_usgs.requests), \
+        "Expected USGS to be asked for California's area only"
+    everything = fake_usgs.query({"starttime": "2024-01-19T00:00:00", "endtime": "2024-01-20T00:00:00",
+                                  "minmagnitude": "2.0"})
+    expected = [f["id"] for f in states.get_index().filter(everything, "CA") if f["properties"]["tsunami"] > 0]
+    assert expected, "The window should hold some tsunami events in California"
+    assert [f["id"] for f in response.json()["features"]] == expected, "Expected California's tsunami events"
+    assert response.json()["metadata"]["state"] == "CA", "Expected the state's code in the metadata"
@@ -0,0 +1,130 @@
+import asyncio
+from datetime import datetime, timezone
+
+import pytest
+from fastapi.testclient import TestClient
+
+from app import tsunami_index, usgs_client, states
+from app.main import app
+from app.redis_client import get_redis_client
+from app.windows import to_millis
+from fake_usgs import make_catalog
+
+# A moment inside the fake catalog's month, standing in for "now"
+NOW = datetime(2024, 1, 10, 5, 30, tzinfo=timezone.utc)
+WEEK_BEFORE = datetime(2024, 1, 3, 6, 0, tzinfo=timezone.utc)
+NEXT_HOUR = datetime(2024, 1, 10, 6, 0, tzinfo=timezone.utc)
+
+
+def sync(now: datetime) -> int:
+    """Runs one tsunami index sync with the shared USGS client open, like the ingester does."""
+    async def run():
+        await usgs_client.start_http_client()
+        try:
+            return await tsunami_index.sync(now)
+        finally:
+            await usgs_client.close_http_client()
+    return asyncio.run(run())
+
+
+def tsunami_ids(server, start: datetime, end: datetime, state: str = None) -> list:
+    """The ids USGS would return for a tsunami search of the window (in the state, if given), newest first."""
+    features = server.query({"minmagnitude": "2.0", "starttime": start.isoformat(), "endtime": end.isoformat()})
+    if state:
+        features = states.get_index().filter(features, state)
+    return [f["id"] for f in features if f["properties"]["tsunami"] > 0]
+
+
+def test_tsunami_route_is_answered_from_the_index(fake_usgs):
+    """
+    Test that once the index is synced, every state and window inside it is answered from
+    the index without asking USGS, with the events USGS would return for the state.
+    """
+    sync(NOW)
+    requests, hits = fake_usgs.request_count, tsunami_index.stats["hits"]
+    with TestClient(app) as client:
+        california = client.get("/california", params={"start_time": "2024-01-10T05:00:00", "time_range": 48})
+        hawaii = client.get("/HI", params={"start_time": "2024-01-10T05:00:00", "time_range": 48})
+        shorter = client.get("/ca", params={"start_time": "2024-01-09T17:30:00", "time_range": 12})
+
+    assert all(r.status_code == 200 for r in (california, hawaii, shorter)), "Expected status code 200"
+    assert fake_usgs.request_count == requests, "The index should answer without asking USGS"
+    assert tsunami_index.stats["hits"] == hits + 3, "Expected every request to be an index hit"
+    expected = tsunami_ids(fake_usgs, datetime(2024, 1, 8, 5), datetime(2024, 1, 10, 5), "CA")
+    assert expected, "The window should hold some tsunami events in California"
+    assert [f["id"] for f in california.json()["features"]] == expected, "Expected California's tsunami events"
+    assert [f["id"] for f in hawaii.json()["features"]] == \
+        tsunami_ids(fake_usgs, datetime(2024, 1, 8, 5), datetime(2024, 1, 10, 5), "HI"), \
+        "Expected Hawaii's tsunami events"
+    assert [f["id"] for f in shorter.json()["features"]] == \
+        tsunami_ids(fake_usgs, datetime(2024, 1, 9, 5, 30), datetime(2024, 1, 9, 17, 30), "CA"), \
+        "Expected the tsunami events of the shorter window"
+
+
+def test_incremental_sync_applies_revisions_and_deletions(fake_usgs):
+    """
+    Test that after the first full sync, later syncs only ask for updated events and
+    add, replace or drop them in the index.
+    """
+    sync(NOW)
+    incremental = tsunami_index.stats["incremental_syncs"]
+    start_ms, end_ms = to_millis(WEEK_BEFORE), to_millis(NEXT_HOUR)
+    before = [f["id"] for f in asyncio.run(tsunami_index.read(start_ms, end_ms))]
+    assert before == tsunami_ids(fake_usgs, WEEK_BEFORE, NEXT_HOUR), "Expected the week's tsunami events"
+
+    revised, deleted = before[0], before[1]
+    flagged = next(f for f in fake_usgs.query({"starttime": WEEK_BEFORE.isoformat(), "endtime": NOW.isoformat(),
+                                               "minmagnitude": "2.0"}) if not f["properties"]["tsunami"])
+    fake_usgs.revise(revised, tsunami=0)
+    fake_usgs.delete(deleted)
+    fake_usgs.revise(flagged["id"], tsunami=1)
+    fake_usgs.reset_counters()
+    sync(NOW)
+
+    assert tsunami_index.stats["incremental_syncs"] == incremental + 1, "Expected the second sync to be incremental"
+    assert "updatedafter" in fake_usgs.requests[0], "Expected only the updated events to be asked for"
+    after = [f["id"] for f in asyncio.run(tsunami_index.read(start_ms, end_ms))]
+    assert revised not in after and deleted not in after, "Expected unflagged and deleted events to be dropped"
+    assert flagged["id"] in after, "Expected the newly flagged event to be added"
+    assert after == tsunami_ids(fake_usgs, WEEK_BEFORE, NEXT_HOUR), "Expected the index to match USGS"
+
+
+def test_uncovered_windows_are_not_answered(fake_usgs):
+    """
+    Test that the index only answers windows it holds completely.
+    """
+    assert asyncio.run(tsunami_index.read(to_millis(WEEK_BEFORE), to_millis(NOW))) is None, "Nothing is indexed yet"
+    sync(NOW)
+    assert asyncio.run(tsunami_index.read(to_millis(WEEK_BEFORE), to_millis(NOW))) is not None, \
+        "Expected the synced week"
+    assert asyncio.run(tsunami_index.read(to_millis(datetime(2024, 1, 2, tzinfo=timezone.utc)), to_millis(NOW))) \
+        is None, "Hours before the synced week must not be answered"
+    assert asyncio.run(tsunami_index.read(to_millis(WEEK_BEFORE), to_millis(NOW), min_magnitude=1.0)) is None, \
+        "Magnitudes below the index's floor must not be answered"
+
+
+@pytest.mark.skipif(get_redis_client() is None, reason="Needs a running Redis server")
+def test_index_round_trips_through_redis(monkeypatch, with_redis):
+    """
+    Test that the index written to Redis answers reads, newest first, and replaces dropped events.
+    """
+    client = get_redis_client(decode_responses=False)
+    keys = ("test-tsunami:events", "test-tsunami:features", "test-tsunami:coverage")
+    monkeypatch.setattr(tsunami_index, "EVENTS_KEY", keys[0])
+    monkeypatch.setattr(tsunami_index, "FEATURES_KEY", keys[1])
+    monkeypatch.setattr(tsunami_index, "COVERAGE_KEY", keys[2])
+    client.delete(*keys)
+    features = [f for f in make_catalog(2000) if f["properties"]["tsunami"]]
+    params = {"format": "geojson", "starttime": "2024-01-01T00:00:00", "endtime": "2024-01-31T00:00:00"}
+    try:
+        with_redis(tsunami_index.remember(params, {"features": features}))
+        start_ms, end_ms = to_millis(datetime(2024, 1, 1, tzinfo=timezone.utc)), features[-1]["properties"]["time"]
+        assert with_redis(tsunami_index.read(start_ms, end_ms)) == sorted(
+            features, key=lambda f: f["properties"]["time"], reverse=True), "Expected the features back from Redis"
+
+        with_redis(tsunami_index.remember(params, {"features": features[1:]}))
+        assert features[0]["id"] not in [f["id"] for f in with_redis(tsunami_index.read(start_ms, end_ms))], \
+            "Expected an event missing from a newer answer to be dropped"
+        assert not tsunami_index._local_events, "Nothing should be kept locally while Redis works"
+    finally:
+        client.delete(*keys)
@@ -0,0 +1,69 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import httpx
+import pytest
+from fastapi.testclient import TestClient
+
+import app.usgs_client as usgs_client
+from app.main import app
+
+
+def test_sf_endpoint_uses_fake_usgs(fake_usgs):
+    """
+    Test that the async route fetches from USGS through the shared client.
+    """
+    with TestClient(app) as client:
+        response = client.get(
+            "/earthquake/sf",
+            params={"start_time": "2024-01-01T00:00:00", "end_time": "2024-01-03T00:00:00", "min_magnitude": 3.0},
+        )
+
+    assert response.status_code == 200, "Expected status code 200"
+    data = response.json()
+    assert data["type"] == "FeatureCollection", "Expected type to be 'FeatureCollection'"
+    assert len(data["features"]) > 0, "Expected the fake catalog to return some earthquakes"
+    for feature in data["features"]:
+        assert feature["properties"]["mag"] >= 3.0, "All earthquakes should have magnitude >= 3.0"
+    assert fake_usgs.request_count > 0, "Expected the route to call the fake USGS server"
+
+
+def test_client_lifecycle_follows_app_lifespan(fake_usgs):
+    """
+    Test that the shared client is opened at startup and closed at shutdown.
+    """
+    with TestClient(app):
+        assert usgs_client.http_client is not None, "Client should exist while the app is running"
+    assert usgs_client.http_client is None, "Client should be closed when the app stops"
+
+
+def test_concurrent_misses_are_not_capped_by_threadpool(fake_usgs):
+    """
+    Test that one worker keeps far more upstream misses in flight than the
+    default threadpool (40 threads) would allow.
+    """
+    fake_usgs.latency = 0.5
+    concurrent_requests = 120
+    first_day = datetime(2024, 1, 1)
+
+    async def run():
+        await usgs_client.start_http_client()
+        try:
+            transport = httpx.ASGITransport(app=app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+                # A different hour per request so none of them can be answered from a cache
+                responses = await asyncio.gather(*[
+                    client.get("/earthquake/sf", params={
+                        "start_time": (first_day + timedelta(hours=hour)).strftime("%Y-%m-%dT%H:%M:%S"),
+                        "end_time": (first_day + timedelta(hours=hour, minutes=59)).strftime("%Y-%m-%dT%H:%M:%S"),
+                    })
+                    for hour in range(concurrent_requests)
+                ])
+        finally:
+            await usgs_client.close_http_client()
+        return responses
+
+    responses = asyncio.run(run())
+
+    assert all(r.status_code == 200 for r in responses), "Expected every request to succeed"
+    assert fake_usgs.max_in_flight > 40, f"Expected more than 40 upstream calls in flight, saw {fake_usgs.max_in_flight}"
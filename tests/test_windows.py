@@ -0,0 +1,124 @@
+from datetime import datetime, timedelta, timezone
+
+from fastapi.testclient import TestClient
+
+from app.config import CACHE_DURATION, HISTORICAL_CACHE_DURATION
+from app.main import app
+from app.windows import bucket_ttl, merge_buckets, merge_updates, parse_time, split_window
+
+
+def test_shifted_windows_share_buckets():
+    """
+    Test that windows shifted by a second map to the same hour buckets.
+    """
+    first = split_window(parse_time("2024-01-01T00:00:00"), parse_time("2024-01-01T05:30:00"))
+    shifted = split_window(parse_time("2024-01-01T00:00:01"), parse_time("2024-01-01T05:30:01"))
+
+    assert first == shifted, "Expected both windows to use the same buckets"
+    assert first[0][0] == parse_time("2024-01-01T00:00:00"), "Buckets should be hour aligned"
+    assert all(end - start == timedelta(hours=1) for start, end in first), "Expected hour buckets"
+
+
+def test_wide_windows_use_larger_buckets():
+    """
+    Test that long windows switch to day, month or year buckets to stay within the bucket limit.
+    """
+    day = split_window(parse_time("2024-01-01T05:00:00"), parse_time("2024-01-02T05:00:00"))
+    week = split_window(parse_time("2024-01-01T00:00:00"), parse_time("2024-01-08T00:00:00"))
+    half_year = split_window(parse_time("2023-01-15T00:00:00"), parse_time("2023-07-15T00:00:00"))
+    decades = split_window(parse_time("2004-01-01T00:00:00"), parse_time("2024-01-01T00:00:00"))
+
+    assert len(day) == 2 and day[0][1] - day[0][0] == timedelta(days=1), \
+        "Expected a 24-hour window to cost two day buckets, not 25 hour buckets"
+    assert len(week) == 7 and week[0][1] - week[0][0] == timedelta(days=1), "Expected day buckets"
+    assert len(half_year) == 7 and half_year[0][0] == parse_time("2023-01-01T00:00:00"), "Expected month buckets"
+    assert len(decades) == 20 and decades[0][1] == parse_time("2005-01-01T00:00:00"), "Expected year buckets"
+
+
+def test_boundary_aligned_windows_have_no_empty_trailing_bucket():
+    """
+    Test that a window ending exactly on a bucket boundary doesn't get an extra bucket starting at its end
+    (the bucket before it already includes events at that instant), while one ending just after does.
+    """
+    hours = split_window(parse_time("2024-01-01T00:00:00"), parse_time("2024-01-01T06:00:00"))
+    past = split_window(parse_time("2024-01-01T00:00:00"), parse_time("2024-01-01T06:00:01"))
+    instant = split_window(parse_time("2024-01-01T05:00:00"), parse_time("2024-01-01T05:00:00"))
+
+    assert len(hours) == 6, f"Expected 6 hour buckets, got {len(hours)}"
+    assert hours[-1][1] == parse_time("2024-01-01T06:00:00"), "Expected the last bucket to end at the window's end"
+    assert len(past) == 7, "Expected one more bucket for a window ending past the boundary"
+    assert instant == [(parse_time("2024-01-01T05:00:00"), parse_time("2024-01-01T06:00:00"))], \
+        "Expected an empty window to still get its one bucket"
+
+
+def test_past_buckets_get_long_ttl():
+    """
+    Test that only buckets that ended well in the past are cached for a long time.
+    """
+    now = datetime(2024, 6, 1, 12, 0, tzinfo=timezone.utc)
+
+    assert bucket_ttl(now - timedelta(days=2), now) == HISTORICAL_CACHE_DURATION, "Old buckets should be historical"
+    assert bucket_ttl(now + timedelta(minutes=30), now) == CACHE_DURATION, "The current bucket should use CACHE_DURATION"
+
+
+def test_merge_trims_and_deduplicates():
+    """
+    Test that merging drops events outside the window and duplicates on bucket edges.
+    """
+    def feature(event_id, minute):
+        event_time = int(parse_time(f"2024-01-01T00:{minute:02d}:00").timestamp() * 1000)
+        return {"id": event_id, "properties": {"time": event_time}, "geometry": {"coordinates": [1, 2, 3]}}
+
+    first = {"features": [feature("a", 5), feature("edge", 30)]}
+    second = {"features": [feature("edge", 30), feature("b", 45)]}
+    merged = merge_buckets([first, second], parse_time("2024-01-01T00:10:00"), parse_time("2024-01-01T00:50:00"))
+
+    assert [f["id"] for f in merged["features"]] == ["b", "edge"], "Expected trimmed, deduplicated, newest first"
+    assert merged["metadata"]["count"] == 2, "Expected the count to match the merged features"
+
+
+def test_merge_updates_applies_changes_by_id():
+    """
+    Test that updates add new events, replace revised ones and drop deleted or revised-out ones,
+    but never replace an event with an older revision.
+    """
+    def feature(event_id, minute, updated, mag=3.0, status="reviewed"):
+        return {"id": event_id, "properties": {"time": minute, "updated": updated, "mag": mag, "status": status}}
+
+    cached = {"metadata": {"count": 4}, "features": [
+        feature("revised", 4, 10), feature("deleted", 3, 10), feature("weakened", 2, 10), feature("newer", 1, 50),
+    ]}
+    updates = {"features": [
+        feature("new", 5, 20),
+        feature("revised", 4, 20, mag=3.5),
+        feature("deleted", 3, 20, status="deleted"),
+        feature("weakened", 2, 20, mag=1.0),
+        feature("newer", 1, 20, mag=9.9),
+    ]}
+    merged = merge_updates(cached, updates, keep=lambda f: f["properties"]["mag"] >= 2.0)
+
+    assert [f["id"] for f in merged["features"]] == ["new", "revised", "newer"], "Expected the changes applied, newest first"
+    assert merged["features"][1]["properties"]["mag"] == 3.5, "Expected the revised magnitude"
+    assert merged["features"][2]["properties"]["mag"] == 3.0, "An older revision must not replace a newer one"
+    assert merged["metadata"]["count"] == 3 and cached["metadata"]["count"] == 4, "Expected a new count, cache untouched"
+
+
+def test_shifted_request_hits_cached_buckets(fake_usgs):
+    """
+    Test that a request shifted by one second is answered without calling USGS again.
+    """
+    first_params = {"start_time": "2024-01-01T00:00:00", "end_time": "2024-01-01T23:30:00"}
+    shifted_params = {"start_time": "2024-01-01T00:00:01", "end_time": "2024-01-01T23:30:01"}
+    with TestClient(app) as client:
+        first = client.get("/earthquake/sf", params=first_params)
+        upstream_calls = fake_usgs.request_count
+        shifted = client.get("/earthquake/sf", params=shifted_params)
+
+    assert first.status_code == 200 and shifted.status_code == 200, "Expected status code 200"
+    assert fake_usgs.request_count == upstream_calls, "The shifted request should not reach USGS"
+    expected = fake_usgs.query({
+        "starttime": "2024-01-01T00:00:01", "endtime": "2024-01-01T23:30:01", "minmagnitude": "2.0",
+        "latitude": "37.7749", "longitude": "-122.4194", "maxradiuskm": "100",
+    })
+    assert [f["id"] for f in shifted.json()["features"]] == [f["id"] for f in expected], \
+        "Expected exactly the events USGS would return for the shifted window"
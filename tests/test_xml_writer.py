@@ -0,0 +1,56 @@
+import xmltodict
+from fastapi.testclient import TestClient
+
+from app.main import app
+from app.xml_writer import iter_xml, to_xml
+from fake_usgs import make_catalog
+
+
+def sample_collection(count=300):
+    """A USGS-style FeatureCollection with the kinds of values real responses contain."""
+    return {
+        "type": "FeatureCollection",
+        "metadata": {"count": count, "title": "Quakes <near> R&D", "status": None, "final": True},
+        "features": make_catalog(count=count),
+        "bbox": [-180.0, -60.0, 0, 180.0, 60.0, 10.5],
+    }
+
+
+def test_output_matches_xmltodict():
+    """
+    Test that the writer produces exactly what xmltodict.unparse did, pretty and compact.
+    """
+    data = sample_collection()
+
+    assert to_xml(data) == xmltodict.unparse({"response": data}, pretty=True).encode("utf-8"), \
+        "Pretty output should match xmltodict"
+    assert to_xml(data, pretty=False) == xmltodict.unparse({"response": data}).encode("utf-8"), \
+        "Compact output should match xmltodict"
+
+
+def test_large_documents_come_in_chunks():
+    """
+    Test that a big answer is handed out in several pieces rather than one string.
+    """
+    chunks = list(iter_xml(sample_collection(2000)))
+
+    assert len(chunks) > 10, f"Expected many chunks, got {len(chunks)}"
+    assert max(len(c) for c in chunks) < 256 * 1024, "Expected chunks of roughly XML_CHUNK_SIZE"
+
+
+def test_xml_route_streams_same_document(fake_usgs):
+    """
+    Test that an XML request is streamed, parses back to the JSON answer and is cached for the repeat.
+    """
+    params = {"start_time": "2024-01-12T00:00:00", "end_time": "2024-01-12T12:00:00", "min_felt_reports": 5}
+    with TestClient(app) as client:
+        as_json = client.get("/earthquake-felt", params=params).json()
+        first = client.get("/earthquake-felt", params=dict(params, format="xml"))
+        upstream_calls = fake_usgs.request_count
+        second = client.get("/earthquake-felt", params=dict(params, format="xml"))
+
+    assert first.status_code == 200, "Expected status code 200"
+    assert first.headers["Content-Type"] == "application/xml", "Expected XML response"
+    assert first.content == to_xml(as_json), "Expected the XML form of the JSON answer"
+    assert second.content == first.content, "Expected the cached XML on the repeat"
+    assert fake_usgs.request_count == upstream_calls, "The repeat should not reach USGS"